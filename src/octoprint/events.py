@@ -14,6 +14,7 @@ import collections
 
 from octoprint.settings import settings
 import octoprint.plugin
+import octoprint.printer
 
 # singleton
 _instance = None
@@ -98,6 +99,26 @@ def eventManager():
 	return _instance
 
 
+def printer_payload(printer_id, payload=None):
+	"""
+	Adds the identifier of the printer an event concerns to its ``payload``, as ``printer``. See
+	:class:`~octoprint.printer.registry.PrinterRegistry`.
+
+	Arguments:
+	    printer_id (str): Identifier of the printer, the ``payload`` is returned as is if this is None.
+	    payload (dict): The event's payload, not modified.
+
+	Returns:
+	    dict: A copy of the payload including the printer's identifier.
+	"""
+	if printer_id is None:
+		return payload
+
+	result = dict(payload) if payload else dict()
+	result["printer"] = printer_id
+	return result
+
+
 class EventManager(object):
 	"""
 	Handles receiving events and dispatching them to subscribers
@@ -225,9 +246,20 @@ class DebugEventListener(GenericEventListener):
 
 
 class CommandTrigger(GenericEventListener):
-	def __init__(self, printer):
+	"""
+	Executes the commands configured in "events > subscriptions" in the settings when their events are fired.
+
+	GCODE commands are sent to the printer the event concerns (the ``printer`` in its payload, see
+	:func:`printer_payload`), or to the default printer for events that concern no printer in particular. A
+	subscription may limit itself to the events of one printer by setting ``printer`` to that printer's identifier.
+
+	Arguments:
+	    printerRegistry (PrinterRegistry): The registry of all printers served by this process.
+	"""
+
+	def __init__(self, printerRegistry):
 		GenericEventListener.__init__(self)
-		self._printer = printer
+		self._printerRegistry = printerRegistry
 		self._subscriptions = {}
 
 		self._initSubscriptions()
@@ -258,10 +290,11 @@ class CommandTrigger(GenericEventListener):
 			command = subscription["command"]
 			commandType = subscription["type"]
 			debug = subscription["debug"] if "debug" in subscription else False
+			printerId = subscription["printer"] if "printer" in subscription else None
 
 			if not event in self._subscriptions.keys():
 				self._subscriptions[event] = []
-			self._subscriptions[event].append((command, commandType, debug))
+			self._subscriptions[event].append((command, commandType, debug, printerId))
 
 			if not event in eventsToSubscribe:
 				eventsToSubscribe.append(event)
@@ -279,23 +312,34 @@ class CommandTrigger(GenericEventListener):
 		if not event in self._subscriptions:
 			return
 
-		for command, commandType, debug in self._subscriptions[event]:
+		eventPrinterId = payload.get("printer") if isinstance(payload, dict) else None
+
+		for command, commandType, debug, printerId in self._subscriptions[event]:
+			if printerId is not None and eventPrinterId is not None and printerId != eventPrinterId:
+				continue
+
+			try:
+				printer = self._printerRegistry.get(printerId if printerId is not None else eventPrinterId)
+			except octoprint.printer.UnknownPrinter:
+				self._logger.warn("Unknown printer for the following command trigger, not executing it: %s" % command)
+				continue
+
 			try:
 				if isinstance(command, (tuple, list, set)):
 					processedCommand = []
 					for c in command:
-						processedCommand.append(self._processCommand(c, payload))
+						processedCommand.append(self._processCommand(c, payload, printer))
 				else:
-					processedCommand = self._processCommand(command, payload)
-				self.executeCommand(processedCommand, commandType, debug=debug)
+					processedCommand = self._processCommand(command, payload, printer)
+				self.executeCommand(processedCommand, commandType, debug=debug, printer=printer)
 			except KeyError, e:
 				self._logger.warn("There was an error processing one or more placeholders in the following command: %s" % command)
 
-	def executeCommand(self, command, commandType, debug=False):
+	def executeCommand(self, command, commandType, debug=False, printer=None):
 		if commandType == "system":
 			self._executeSystemCommand(command, debug=debug)
 		elif commandType == "gcode":
-			self._executeGcodeCommand(command, debug=debug)
+			self._executeGcodeCommand(command, debug=debug, printer=printer)
 
 	def _executeSystemCommand(self, command, debug=False):
 		def commandExecutioner(command):
@@ -317,15 +361,18 @@ class CommandTrigger(GenericEventListener):
 		except:
 			self._logger.exception("Command failed")
 
-	def _executeGcodeCommand(self, command, debug=False):
+	def _executeGcodeCommand(self, command, debug=False, printer=None):
+		if printer is None:
+			printer = self._printerRegistry.default
+
 		commands = [command]
 		if isinstance(command, (list, tuple, set)):
 			commands = list(command)
 		if debug:
-			self._logger.info("Executing GCode commands: %r" % command)
-		self._printer.commands(commands)
+			self._logger.info("Executing GCode commands on printer %s: %r" % (printer.get_identifier(), command))
+		printer.commands(commands)
 
-	def _processCommand(self, command, payload):
+	def _processCommand(self, command, payload, printer):
 		"""
 		Performs string substitutions in the command string based on a couple of current parameters.
 
@@ -336,6 +383,7 @@ class CommandTrigger(GenericEventListener):
 		  - {__progress} : current print progress in percent, 0 if no print is in progress
 		  - {__data} : the string representation of the event's payload
 		  - {__now} : ISO 8601 representation of the current date and time
+		  - {__printer} : identifier of the printer the command is executed for
 
 		Additionally, the keys of the event's payload can also be used as placeholder.
 		"""
@@ -345,10 +393,11 @@ class CommandTrigger(GenericEventListener):
 			"__filename": "NO FILE",
 			"__progress": "0",
 			"__data": str(payload),
-			"__now": datetime.datetime.now().isoformat()
+			"__now": datetime.datetime.now().isoformat(),
+			"__printer": printer.get_identifier()
 		}
 
-		currentData = self._printer.get_current_data()
+		currentData = printer.get_current_data()
 
 		if "currentZ" in currentData.keys() and currentData["currentZ"] is not None:
 			params["__currentZ"] = str(currentData["currentZ"])
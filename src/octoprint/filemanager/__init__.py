@@ -16,7 +16,7 @@ from octoprint.events import eventManager, Events
 from .destinations import FileDestinations
 from .analysis import QueueEntry, AnalysisQueue
 from .storage import LocalFileStorage
-from .util import AbstractFileWrapper, StreamWrapper, DiskFileWrapper
+from .util import AbstractFileWrapper, StreamWrapper, DiskFileWrapper, UploadProcessor
 
 from collections import namedtuple
 
@@ -180,6 +180,9 @@ class FileManager(object):
 		self._progress_plugins = []
 		self._preprocessor_hooks = dict()
 
+		self._uploads = dict()
+		self._uploads_mutex = threading.Lock()
+
 	def initialize(self):
 		self.reload_plugins()
 
@@ -359,10 +362,44 @@ class FileManager(object):
 			result[dst] = self._storage_managers[dst].list_files(path=path, filter=filter, recursive=recursive)
 		return result
 
+	def create_upload_processor(self, filename, path, content_type=None, printer_profile=None):
+		"""
+		Creates an :class:`~octoprint.filemanager.util.UploadProcessor` for a file that is being uploaded to the
+		temporary file ``path``, which hashes the contents of the upload and for analyzable file types analyzes them
+		while they are received. If the upload is then added through :meth:`add_file` via a
+		:class:`~octoprint.filemanager.util.DiskFileWrapper` of ``path``, neither hashing nor analysis need to read
+		the file again.
+
+		Arguments:
+		    filename (str): Name of the uploaded file.
+		    path (str): Path of the temporary file the upload is stored in.
+		    content_type (str): Content type of the upload.
+		    printer_profile (dict): Printer profile to analyze the upload for, defaults to the current one. Needs to be
+		        the profile the upload is then added with for the analysis to be used.
+
+		Returns:
+		    UploadProcessor: The processor to supply the contents of the upload to.
+		"""
+		if printer_profile is None:
+			printer_profile = self._printer_profile_manager.get_current_or_default()
+
+		analysis = None
+		file_type = get_file_type(filename)
+		if file_type:
+			analysis = self._analysis_queue.stream(file_type[-1], printer_profile)
+
+		processor = UploadProcessor(path, analysis=analysis, printer_profile=printer_profile, close_callback=self._on_upload_closed)
+		with self._uploads_mutex:
+			self._uploads[path] = processor
+		return processor
+
 	def add_file(self, destination, path, file_object, links=None, allow_overwrite=False, printer_profile=None, analysis=None):
 		if printer_profile is None:
 			printer_profile = self._printer_profile_manager.get_current_or_default()
 
+		upload = self._claim_upload(file_object)
+		original_file_object = file_object
+
 		for hook in self._preprocessor_hooks.values():
 			try:
 				hook_file_object = hook(path, file_object, links=links, printer_profile=printer_profile, allow_overwrite=allow_overwrite)
@@ -372,6 +409,17 @@ class FileManager(object):
 
 			if hook_file_object is not None:
 				file_object = hook_file_object
+
+		file_hash = stream = None
+		if upload is not None:
+			if file_object is original_file_object:
+				# the contents were processed as uploaded
+				file_hash = file_object.hash = upload.hash
+				if upload.printer_profile == printer_profile:
+					stream = upload.analysis
+			if upload.analysis is not None and upload.analysis is not stream:
+				upload.analysis.abort()
+
 		file_path = self._storage(destination).add_file(path, file_object, links=links, printer_profile=printer_profile, allow_overwrite=allow_overwrite)
 		absolute_path = self._storage(destination).path_on_disk(file_path)
 
@@ -379,8 +427,15 @@ class FileManager(object):
 			file_type = get_file_type(absolute_path)
 			if file_type:
 				queue_entry = QueueEntry(file_path, file_type[-1], destination, absolute_path, printer_profile)
-				self._analysis_queue.enqueue(queue_entry, high_priority=True)
+				if stream is not None:
+					self._analysis_queue.enqueue(queue_entry, high_priority=True, stream=stream, file_hash=file_hash)
+				else:
+					self._analysis_queue.enqueue(queue_entry, high_priority=True)
+			elif stream is not None:
+				stream.abort()
 		else:
+			if stream is not None:
+				stream.abort()
 			self._add_analysis_result(destination, path, analysis)
 
 		eventManager().fire(Events.UPDATED_FILES, dict(type="printables"))
@@ -468,6 +523,12 @@ class FileManager(object):
 	def get_metadata(self, destination, path):
 		return self._storage(destination).get_metadata(path)
 
+	def find_files(self, destination, hash=None, name=None, changed_since=None):
+		return self._storage(destination).find_files(hash=hash, name=name, changed_since=changed_since)
+
+	def get_diagnostics(self):
+		return dict((destination, storage.get_diagnostics()) for destination, storage in self._storage_managers.items())
+
 	def add_link(self, destination, path, rel, data):
 		self._storage(destination).add_link(path, rel, data)
 
@@ -527,3 +588,27 @@ class FileManager(object):
 	def _on_analysis_finished(self, entry, result):
 		self._add_analysis_result(entry.location, entry.path, result)
 
+	def _claim_upload(self, file_object):
+		"""
+		Returns the finished :class:`UploadProcessor` for the upload wrapped by ``file_object``, if any.
+		"""
+		if not isinstance(file_object, DiskFileWrapper):
+			return None
+
+		with self._uploads_mutex:
+			upload = self._uploads.get(file_object.path)
+			if upload is None or upload.hash is None:
+				return None
+			del self._uploads[file_object.path]
+		return upload
+
+	def _on_upload_closed(self, processor):
+		with self._uploads_mutex:
+			if self._uploads.get(processor.path) is not processor:
+				# claimed by add_file
+				return
+			del self._uploads[processor.path]
+
+		if processor.analysis is not None:
+			processor.analysis.abort()
+
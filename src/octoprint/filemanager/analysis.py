@@ -6,16 +6,21 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 __copyright__ = "Copyright (C) 2014 The OctoPrint Project - Released under terms of the AGPLv3 License"
 
 
+import hashlib
 import logging
 import Queue as queue
 import os
 import threading
 import collections
+import multiprocessing
 import time
 
 from octoprint.events import Events, eventManager
+from octoprint.filemanager.util import content_hash
+from octoprint.settings import settings
 
 import octoprint.util.gcodeInterpreter as gcodeInterpreter
+import octoprint.util.gcodeParallel as gcodeParallel
 
 
 class QueueEntry(collections.namedtuple("QueueEntry", "path, type, location, absolute_path, printer_profile")):
@@ -36,6 +41,227 @@ class QueueEntry(collections.namedtuple("QueueEntry", "path, type, location, abs
 		return "{location}:{path}".format(location=self.location, path=self.path)
 
 
+def printer_profile_fingerprint(printer_profile):
+	"""
+	Arguments:
+	    printer_profile (dict): The printer profile to fingerprint.
+
+	Returns:
+	    str: A hash over all properties of ``printer_profile`` that might influence an analysis, that is all but its
+	        identifier, name, model, color and default flag.
+	"""
+	import hashlib
+	import json
+
+	relevant = dict((key, value) for key, value in printer_profile.items() if not key in ("id", "name", "model", "color", "default"))
+	return hashlib.sha1(json.dumps(relevant, sort_keys=True)).hexdigest()
+
+
+def check_print_volume(analysis, printer_profile):
+	"""
+	Checks whether the extruding moves of a file as found by its ``analysis`` (see :class:`GcodeAnalysisQueue`) fit
+	into the print volume of ``printer_profile``. Non-extruding moves outside of the print volume (e.g. parking moves
+	to a purge bucket) don't make a job impossible and are hence not checked.
+
+	The bounds of the moves are checked against the current print volume. For circular beds, only the bounding
+	square is checked this way, moves outside of the circle are only detected via the count of extruding moves
+	outside the print volume the file was analyzed with.
+
+	Arguments:
+	    analysis (dict): The analysis result of the file.
+	    printer_profile (dict): The printer profile to check against.
+
+	Returns:
+	    str: A description of why the file doesn't fit, None if it does or it can't be told.
+	"""
+	if not analysis or not printer_profile:
+		return None
+
+	volume = gcodeInterpreter.print_volume(printer_profile)
+	if volume is None:
+		return None
+	minX, maxX, minY, maxY, maxZ, radius = volume
+
+	tolerance = 0.01
+	for tool, bounds in sorted((analysis.get("bounds") or dict()).items()):
+		if bounds["minX"] < minX - tolerance or bounds["maxX"] > maxX + tolerance:
+			return "{} extrudes at X from {:.2f} to {:.2f}, outside of the print volume from {:.2f} to {:.2f}".format(tool, bounds["minX"], bounds["maxX"], minX, maxX)
+		if bounds["minY"] < minY - tolerance or bounds["maxY"] > maxY + tolerance:
+			return "{} extrudes at Y from {:.2f} to {:.2f}, outside of the print volume from {:.2f} to {:.2f}".format(tool, bounds["minY"], bounds["maxY"], minY, maxY)
+		if bounds["maxZ"] > maxZ + tolerance:
+			return "{} extrudes up to Z {:.2f}, above the print volume's height of {:.2f}".format(tool, bounds["maxZ"], maxZ)
+
+	if radius is not None:
+		outOfVolume = analysis.get("outOfVolume")
+		if outOfVolume and outOfVolume.get("extrude"):
+			return "{} extruding moves end outside of the print volume, the first one in line {}".format(outOfVolume["extrude"], outOfVolume["line"])
+
+	return None
+
+
+class AnalysisCache(object):
+	"""
+	A content addressed cache of analysis results, so that files with the same contents (e.g. uploaded again, renamed,
+	copied to another storage) don't need to be analyzed again.
+
+	Results are mapped by keys as created by :meth:`AnalysisQueue.cache_key`. If more than ``size`` results are
+	cached, those that were used least recently are evicted. Each result is persisted as a YAML file of its own in the
+	folder ``path`` when it is added, the order in which the results were used through the modification times of these
+	files. Persisted results are only read once they are used.
+
+	Arguments:
+	    path (str): Folder to persist the cache to, the cache is only held in memory if None.
+	    size (int): Maximum number of results to cache.
+	"""
+
+	def __init__(self, path=None, size=1000):
+		self._logger = logging.getLogger(__name__)
+		self._path = path
+		self._size = max(size, 1)
+		self._mutex = threading.RLock()
+
+		# by the names of their files, ordered from least to most recently used, None if not read yet
+		self._results = collections.OrderedDict()
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+		self._load()
+
+	def get(self, key):
+		"""
+		Arguments:
+		    key (str): The key of the result.
+
+		Returns:
+		    dict: The cached result or None if there is no result cached for ``key``.
+		"""
+		name = self._name(key)
+		with self._mutex:
+			if not name in self._results:
+				self.misses += 1
+				return None
+
+			result = self._results.pop(name)
+			if result is None:
+				result = self._read(name, key)
+				if result is None:
+					self._remove(name)
+					self.misses += 1
+					return None
+
+			self.hits += 1
+			self._results[name] = result
+			self._touch(name)
+			return result
+
+	def put(self, key, result):
+		"""
+		Caches ``result`` for ``key``, evicting the least recently used results if the cache is full.
+		"""
+		name = self._name(key)
+		with self._mutex:
+			self._results.pop(name, None)
+			self._results[name] = result
+			self._write(name, key, result)
+			while len(self._results) > self._size:
+				evicted, _ = self._results.popitem(last=False)
+				self._remove(evicted)
+				self.evictions += 1
+
+	def clear(self):
+		with self._mutex:
+			for name in self._results:
+				self._remove(name)
+			self._results.clear()
+
+	@property
+	def stats(self):
+		"""
+		Returns:
+		    dict: The number of cached results (``count``), the maximum number (``size``) as well as the number of
+		        ``hits``, ``misses`` and ``evictions`` since the cache was created.
+		"""
+		with self._mutex:
+			return dict(count=len(self._results), size=self._size, hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+	def __len__(self):
+		with self._mutex:
+			return len(self._results)
+
+	def __contains__(self, key):
+		with self._mutex:
+			return self._name(key) in self._results
+
+	def _name(self, key):
+		# keys contain settings, so they are not necessarily valid file names
+		return hashlib.sha1(key.encode("utf-8")).hexdigest() + ".yaml"
+
+	def _load(self):
+		if self._path is None or not os.path.isdir(self._path):
+			return
+
+		try:
+			names = [name for name in os.listdir(self._path) if name.endswith(".yaml")]
+			names.sort(key=lambda name: os.stat(os.path.join(self._path, name)).st_mtime)
+		except EnvironmentError:
+			self._logger.exception("Error while loading the analysis cache from {}".format(self._path))
+			return
+
+		for name in names[:-self._size]:
+			self._remove(name)
+		for name in names[-self._size:]:
+			self._results[name] = None
+
+	def _read(self, name, key):
+		try:
+			import yaml
+			with open(os.path.join(self._path, name)) as f:
+				data = yaml.safe_load(f)
+		except:
+			self._logger.exception("Error while reading the cached analysis result {} from {}".format(key, self._path))
+			return None
+
+		if not isinstance(data, dict) or data.get("key") != key:
+			return None
+		return data.get("result")
+
+	def _write(self, name, key, result):
+		if self._path is None:
+			return
+
+		try:
+			import yaml
+			from octoprint.util import atomic_write
+
+			if not os.path.isdir(self._path):
+				os.makedirs(self._path)
+			with atomic_write(os.path.join(self._path, name), "wb") as f:
+				yaml.safe_dump(dict(key=key, result=result), f, default_flow_style=False, indent="  ", allow_unicode=True)
+		except:
+			self._logger.exception("Error while saving the analysis result {} to {}".format(key, self._path))
+
+	def _touch(self, name):
+		if self._path is None:
+			return
+
+		try:
+			os.utime(os.path.join(self._path, name), None)
+		except EnvironmentError:
+			self._logger.exception("Error while updating the cached analysis result {} in {}".format(name, self._path))
+
+	def _remove(self, name):
+		if self._path is None:
+			return
+
+		try:
+			os.remove(os.path.join(self._path, name))
+		except EnvironmentError:
+			if os.path.exists(os.path.join(self._path, name)):
+				self._logger.exception("Error while removing the cached analysis result {} from {}".format(name, self._path))
+
+
 class AnalysisQueue(object):
 	"""
 	OctoPrint's :class:`AnalysisQueue` can manage various :class:`AbstractAnalysisQueue` implementations, mapped
@@ -51,40 +277,486 @@ class AnalysisQueue(object):
 	:meth:`enqueue` allows enqueuing :class:`QueueEntry` instances to analyze. If the :attr:`QueueEntry.type` is unknown
 	(no specific child class of :class:`AbstractAnalysisQueue` is registered for it), nothing will happen. Otherwise the
 	entry will be enqueued with the type specific analysis queue.
+
+	If an :class:`AnalysisCache` is provided, the result for an entry's contents and printer profile is looked up in it
+	on the worker of the type specific queue before the entry is analyzed, so files don't need to be hashed on the
+	thread enqueuing them. On a hit the entry is finished without analyzing it. Results of finished analyses are added
+	to the cache.
+
+	:meth:`stream` allows analyzing a file while its contents are still being received, e.g. during an upload, if the
+	type specific queue supports it and ``gcodeAnalysis.streaming.enabled`` is set. The resulting
+	:class:`AnalysisStream` can then be supplied to :meth:`enqueue` in place of analyzing the file again.
+
+	Analysis is throttled by an :class:`AnalysisThrottle` while print jobs are running, these are registered via
+	:meth:`register_latency_source`.
+
+	Arguments:
+	    cache (AnalysisCache): The cache of analysis results to use, if any.
+	    throttle (AnalysisThrottle): The throttle to use, a new one is created if not set.
+	    hasher (octoprint.filemanager.util.FileHasher): The hasher to hash files for :meth:`cache_key` with, usually
+	        shared with the storages so files they already hashed aren't read again. Files are hashed directly if not set.
 	"""
 
-	def __init__(self):
+	def __init__(self, cache=None, throttle=None, hasher=None):
 		self._logger = logging.getLogger(__name__)
 		self._callbacks = []
+
+		if throttle is None:
+			throttle = AnalysisThrottle()
+		self._throttle = throttle
+		self._pausing_sources = []
+
+		self._cache = cache
+		self._hasher = hasher
+		self._file_hashes = dict()
+		self._cache_keys = dict()
+		self._cache_mutex = threading.Lock()
+
+		lookup_callback = self._cached_result if cache is not None else None
 		self._queues = dict(
-			gcode=GcodeAnalysisQueue(self._analysis_finished)
+			gcode=GcodeAnalysisQueue(self._analysis_finished, throttle=throttle, lookup_callback=lookup_callback)
 		)
 
+		self._paused = False
+		self._streams = set()
+		self._streams_mutex = threading.Lock()
+
 	def register_finish_callback(self, callback):
 		self._callbacks.append(callback)
 
 	def unregister_finish_callback(self, callback):
 		self._callbacks.remove(callback)
 
-	def enqueue(self, entry, high_priority=False):
+	def enqueue(self, entry, high_priority=False, stream=None, file_hash=None):
+		"""
+		Arguments:
+		    entry (QueueEntry): The entry to analyze.
+		    high_priority (boolean): Whether to analyze the entry before those with normal priority.
+		    stream (AnalysisStream): Analysis of the entry's contents performed while they were received, see
+		        :meth:`stream`. Its result is used once it's done, if it fails the entry is analyzed as usual.
+		    file_hash (str): The hash of the file's contents if already known, see :meth:`cache_key`.
+		"""
 		if not entry.type in self._queues:
+			if stream is not None:
+				stream.abort()
+			return
+
+		key = None
+		if self._cache is not None and stream is not None and file_hash is not None:
+			# the key is cheap without a file to hash, and a cached result makes analyzing the stream unnecessary
+			key = self.cache_key(entry, file_hash=file_hash)
+			result = self._cache.get(key)
+			if result is not None:
+				self._logger.debug("Found cached analysis result for entry {entry}".format(**locals()))
+				stream.abort()
+				self._notify_finished(entry, result)
+				return
+
+		if stream is not None:
+			def on_stream_done(result):
+				if result is None:
+					self._logger.debug("Analysis of entry {entry} while it was received failed, enqueuing it".format(**locals()))
+					self.enqueue(entry, high_priority=high_priority, file_hash=file_hash)
+					return
+
+				self._logger.debug("Entry {entry} was analyzed while it was received".format(**locals()))
+				if key is not None:
+					self._cache.put(key, result)
+				self._notify_finished(entry, result)
+
+			stream.add_done_callback(on_stream_done)
 			return
 
+		if self._cache is not None:
+			with self._cache_mutex:
+				self._file_hashes[(entry.location, entry.path)] = file_hash
+
 		self._queues[entry.type].enqueue(entry, high_priority=high_priority)
 
+	def stream(self, entry_type, printer_profile):
+		"""
+		Starts analyzing a file of type ``entry_type`` whose contents are supplied to the returned stream while they
+		are received. Analysis is performed on a separate thread and aborted if the queue gets paused.
+
+		Arguments:
+		    entry_type (str): Type of the file to analyze.
+		    printer_profile (dict): The printer profile to analyze for.
+
+		Returns:
+		    AnalysisStream: The started analysis, None if the file can't be analyzed that way, e.g. because the type
+		        specific queue doesn't support it or the queue is paused.
+		"""
+		if not entry_type in self._queues or not settings().getBoolean(["gcodeAnalysis", "streaming", "enabled"]):
+			return None
+
+		with self._streams_mutex:
+			if self._paused:
+				return None
+
+			analysis_queue = self._queues[entry_type]
+			analyzer = analysis_queue.create_stream_analyzer(printer_profile)
+			if analyzer is None:
+				return None
+
+			stream = AnalysisStream(analyzer, analysis_queue.get_stream_result, settings().getInt(["gcodeAnalysis", "streaming", "maxBacklog"]))
+			self._streams.add(stream)
+
+		def on_done(result):
+			with self._streams_mutex:
+				self._streams.discard(stream)
+		stream.add_done_callback(on_done)
+
+		return stream
+
+	def cache_key(self, entry, file_hash=None):
+		"""
+		Arguments:
+		    entry (QueueEntry): The entry to create the key for.
+		    file_hash (str): The hash of the file's contents if already known, saves reading the file.
+
+		Returns:
+		    str: Key of the analysis result of ``entry`` in the :class:`AnalysisCache`, made up of the type of the entry
+		        and the analysis version of the type specific queue (see
+		        :meth:`AbstractAnalysisQueue.get_analysis_version`), the hash of the file's contents and the fingerprint
+		        of the printer profile. None if the file cannot be read.
+		"""
+		if file_hash is None:
+			if entry.absolute_path is None or not os.path.isfile(entry.absolute_path):
+				return None
+
+			try:
+				if self._hasher is not None:
+					file_hash = self._hasher.hash(entry.absolute_path)
+				else:
+					file_hash = content_hash(entry.absolute_path)
+			except EnvironmentError:
+				self._logger.exception("Could not hash {}".format(entry.absolute_path))
+				return None
+
+		fingerprint = printer_profile_fingerprint(entry.printer_profile) if entry.printer_profile else "none"
+		return "{}-{}-{}-{}".format(entry.type, self._queues[entry.type].get_analysis_version(), file_hash, fingerprint)
+
+	def register_latency_source(self, source):
+		"""
+		Registers a running print job, see :meth:`AnalysisThrottle.register_latency_source`. If
+		``gcodeAnalysis.throttle.enabled`` is not set, analysis is paused until all print jobs are unregistered
+		instead.
+		"""
+		if settings().getBoolean(["gcodeAnalysis", "throttle", "enabled"]):
+			self._throttle.register_latency_source(source)
+		else:
+			self._pausing_sources.append(source)
+			self.pause()
+
+	def unregister_latency_source(self, source):
+		self._throttle.unregister_latency_source(source)
+		if source in self._pausing_sources:
+			self._pausing_sources.remove(source)
+			if not self._pausing_sources:
+				self.resume()
+
+	@property
+	def cache_stats(self):
+		"""
+		Returns:
+		    dict: The stats of the analysis cache as returned by :attr:`AnalysisCache.stats`, None if there is no
+		        cache.
+		"""
+		if self._cache is None:
+			return None
+		return self._cache.stats
+
 	def pause(self):
+		with self._streams_mutex:
+			self._paused = True
+			streams = list(self._streams)
+		for stream in streams:
+			stream.abort()
+
 		for queue in self._queues.values():
 			queue.pause()
 
 	def resume(self):
+		with self._streams_mutex:
+			self._paused = False
+
 		for queue in self._queues.values():
 			queue.resume()
 
+	def _cached_result(self, entry):
+		item = (entry.location, entry.path)
+		with self._cache_mutex:
+			if not item in self._file_hashes:
+				return None
+			file_hash = self._file_hashes.pop(item)
+
+		key = self.cache_key(entry, file_hash=file_hash)
+		if key is None:
+			return None
+
+		result = self._cache.get(key)
+		if result is None:
+			with self._cache_mutex:
+				self._cache_keys[item] = key
+		return result
+
 	def _analysis_finished(self, entry, result):
+		if self._cache is not None:
+			with self._cache_mutex:
+				key = self._cache_keys.pop((entry.location, entry.path), None)
+			if key is not None and result is not None:
+				self._cache.put(key, result)
+
+		self._notify_finished(entry, result)
+
+	def _notify_finished(self, entry, result):
 		for callback in self._callbacks:
 			callback(entry, result)
 		eventManager().fire(Events.METADATA_ANALYSIS_FINISHED, {"file": entry.path, "result": result})
 
+class AnalysisThrottle(object):
+	"""
+	Throttles analysis performed in OctoPrint's own process so that it leaves enough of the CPU to whatever else needs
+	it, most importantly sending commands to printers while printing.
+
+	Analysis may use all of the CPU unless a print job is running or the host is under load. While any print jobs
+	are running (see :meth:`register_latency_source`), analysis gets a share of ``gcodeAnalysis.throttle.printingBudget``
+	of the CPU time, which is reduced in proportion if the latency of the send loop of any of the printers exceeds
+	``gcodeAnalysis.throttle.maxSendLatency`` seconds. Independent of that the share is reduced in proportion if the
+	load average per CPU exceeds ``gcodeAnalysis.throttle.maxLoad``.
+
+	Analyses call the throttle returned by :meth:`callback` after each analyzed line. Lines are analyzed in slices,
+	after each slice the analysis sleeps as long as necessary to stay within its share and the number of lines of the
+	next slice is adapted so that it takes :attr:`SLICE` seconds, :attr:`BUSY_SLICE` seconds while printing.
+	"""
+
+	SLICE = 0.1
+	"""Duration of a slice of analysis in seconds."""
+
+	BUSY_SLICE = 0.01
+	"""Duration of a slice of analysis in seconds while printing, shorter to yield the CPU more often."""
+
+	MIN_BUDGET = 0.02
+	"""Minimum share of the CPU time for analysis, so it never stalls completely."""
+
+	MIN_QUANTUM = 10
+	MAX_QUANTUM = 100000
+
+	def __init__(self):
+		self._logger = logging.getLogger(__name__)
+		self._sources = []
+		self._mutex = threading.Lock()
+
+	def register_latency_source(self, source):
+		"""
+		Registers a running print job. Analysis is throttled until it is unregistered again.
+
+		Arguments:
+		    source (callable): Returns the current latency of the printer's send loop in seconds (see
+		        :meth:`~octoprint.util.comm.MachineCom.getSendLatency`), None if unknown.
+		"""
+		with self._mutex:
+			self._sources.append(source)
+
+	def unregister_latency_source(self, source):
+		with self._mutex:
+			if source in self._sources:
+				self._sources.remove(source)
+
+	@property
+	def busy(self):
+		"""Whether any print jobs are running."""
+		return len(self._sources) > 0
+
+	def get_budget(self):
+		"""
+		Returns:
+		    float: The share of the CPU time analysis may currently use, between :attr:`MIN_BUDGET` and 1.0.
+		"""
+		with self._mutex:
+			sources = list(self._sources)
+
+		budget = 1.0
+		if sources:
+			budget = settings().getFloat(["gcodeAnalysis", "throttle", "printingBudget"])
+
+			latencies = []
+			for source in sources:
+				try:
+					latency = source()
+				except:
+					self._logger.exception("Error while determining the send latency via {}".format(source))
+					continue
+				if latency is not None:
+					latencies.append(latency)
+
+			max_latency = settings().getFloat(["gcodeAnalysis", "throttle", "maxSendLatency"])
+			if latencies and max(latencies) > max_latency:
+				budget *= max_latency / max(latencies)
+
+		load = self._get_load()
+		if load is not None:
+			max_load = settings().getFloat(["gcodeAnalysis", "throttle", "maxLoad"])
+			if load > max_load:
+				budget *= max_load / load
+
+		return min(max(budget, self.__class__.MIN_BUDGET), 1.0)
+
+	def callback(self):
+		"""
+		Returns:
+		    callable: The throttle for one analysis, to be called after each analyzed line.
+		"""
+		return _ThrottleSlices(self)
+
+	def _get_load(self):
+		try:
+			return os.getloadavg()[0] / multiprocessing.cpu_count()
+		except (AttributeError, OSError, NotImplementedError):
+			# not available on this platform
+			return None
+
+
+class _ThrottleSlices(object):
+	def __init__(self, throttle):
+		self._throttle = throttle
+		self._quantum = throttle.MIN_QUANTUM
+		self._left = self._quantum
+		self._start = time.time()
+
+	def __call__(self):
+		self._left -= 1
+		if self._left <= 0:
+			self._end_slice()
+
+	def _end_slice(self):
+		throttle = self._throttle
+		work = time.time() - self._start
+		target = throttle.BUSY_SLICE if throttle.busy else throttle.SLICE
+
+		# make the next slice take as long as the target duration
+		if work > 0:
+			quantum = int(self._quantum * target / work)
+		else:
+			quantum = self._quantum * 2
+		self._quantum = min(max(quantum, throttle.MIN_QUANTUM), throttle.MAX_QUANTUM)
+
+		budget = throttle.get_budget()
+		if budget < 1.0:
+			time.sleep(work * (1.0 - budget) / budget)
+
+		self._left = self._quantum
+		self._start = time.time()
+
+
+class AnalysisStream(object):
+	"""
+	Analysis of a file while its contents are still being received, as started by :meth:`AnalysisQueue.stream`.
+
+	The contents supplied via :meth:`update` are analyzed on a separate thread so that receiving them isn't slowed
+	down by the analysis. If more than ``max_backlog`` bytes are waiting to be analyzed because they are received
+	faster than they can be analyzed, the analysis is given up to keep the memory usage bounded, the file then gets
+	analyzed through the queue as usual.
+
+	Arguments:
+	    analyzer (object): The type specific analyzer, see :meth:`AbstractAnalysisQueue.create_stream_analyzer`.
+	    finish (callable): Called with ``analyzer`` after all contents were fed to it, returns the analysis result.
+	    max_backlog (int): Maximum number of bytes waiting to be analyzed.
+	"""
+
+	def __init__(self, analyzer, finish, max_backlog):
+		self._logger = logging.getLogger(__name__)
+
+		self._analyzer = analyzer
+		self._finish = finish
+		self._max_backlog = max_backlog
+
+		self._chunks = queue.Queue()
+		self._backlog = 0
+		self._aborted = False
+
+		self._done = False
+		self._result = None
+		self._callbacks = []
+		self._mutex = threading.Lock()
+
+		self._worker = threading.Thread(target=self._work)
+		self._worker.daemon = True
+		self._worker.start()
+
+	def update(self, data):
+		"""
+		Supplies the next chunk of the file's contents.
+		"""
+		if self._aborted:
+			return
+
+		with self._mutex:
+			self._backlog += len(data)
+			exceeded = self._backlog > self._max_backlog
+
+		if exceeded:
+			self._logger.debug("Contents are received faster than they can be analyzed, giving up on analyzing them while they are received")
+			self.abort()
+		else:
+			self._chunks.put(data)
+
+	def finish(self):
+		"""
+		Signals that all contents have been supplied.
+		"""
+		self._chunks.put(None)
+
+	def abort(self):
+		"""
+		Aborts the analysis, its result will be None.
+		"""
+		self._aborted = True
+		self._analyzer.abort()
+		self._chunks.put(None)
+
+	def add_done_callback(self, callback):
+		"""
+		Registers ``callback`` to be called with the result of the analysis (None if it failed or was aborted) once
+		it's done, right away if it's done already.
+		"""
+		with self._mutex:
+			if not self._done:
+				self._callbacks.append(callback)
+				return
+		callback(self._result)
+
+	def _work(self):
+		result = None
+		try:
+			while True:
+				data = self._chunks.get()
+				if data is None:
+					break
+
+				with self._mutex:
+					self._backlog -= len(data)
+				self._analyzer.feed(data)
+
+			if not self._aborted:
+				result = self._finish(self._analyzer)
+		except gcodeInterpreter.AnalysisAborted:
+			pass
+		except:
+			self._logger.exception("Error while analyzing received contents")
+		finally:
+			with self._mutex:
+				self._result = result if not self._aborted else None
+				self._done = True
+				callbacks, self._callbacks = self._callbacks, []
+
+			for callback in callbacks:
+				try:
+					callback(self._result)
+				except:
+					self._logger.exception("Error while calling callback {} for analysis result".format(callback))
+
+
 class AbstractAnalysisQueue(object):
 	"""
 	The :class:`AbstractAnalysisQueue` is the parent class of all specific analysis queues such as the
@@ -95,6 +767,9 @@ class AbstractAnalysisQueue(object):
 	    finished_callback (callable): Callback that will be called upon finishing analysis of an entry in the queue.
 	        The callback will be called with the analyzed entry as the first argument and the analysis result as
 	        returned from the queue implementation as the second parameter.
+	    throttle (AnalysisThrottle): The throttle to apply to the analysis, a new one is created if not set.
+	    lookup_callback (callable): Called with each entry on the worker before it is analyzed, if it returns a result
+	        other than None the entry is finished with that result instead of analyzing it.
 
 	.. automethod:: _do_analysis
 
@@ -104,10 +779,24 @@ class AbstractAnalysisQueue(object):
 	LOW_PRIO = 0
 	HIGH_PRIO = 100
 
-	def __init__(self, finished_callback):
+	ANALYSIS_VERSION = 1
+	"""Version of the analysis, to be increased whenever a change in the analysis changes its results."""
+
+	def get_analysis_version(self):
+		"""
+		Returns:
+		    str: Identifies the analysis performed by the queue, analysis results with another version are outdated.
+		        Defaults to :attr:`ANALYSIS_VERSION`, sub classes may add anything configurable that changes the
+		        results.
+		"""
+		return str(self.__class__.ANALYSIS_VERSION)
+
+	def __init__(self, finished_callback, throttle=None, lookup_callback=None):
 		self._logger = logging.getLogger(__name__)
 
 		self._finished_callback = finished_callback
+		self._lookup_callback = lookup_callback
+		self._throttle = throttle if throttle is not None else AnalysisThrottle()
 
 		self._active = threading.Event()
 		self._active.set()
@@ -117,6 +806,7 @@ class AbstractAnalysisQueue(object):
 
 		self._queue = queue.PriorityQueue()
 		self._current = None
+		self._current_batch = None
 
 		self._worker = threading.Thread(target=self._work)
 		self._worker.daemon = True
@@ -151,7 +841,7 @@ class AbstractAnalysisQueue(object):
 
 		self._logger.debug("Pausing analysis")
 		self._active.clear()
-		if self._current is not None:
+		if self._current is not None or self._current_batch is not None:
 			self._logger.debug("Aborting running analysis, will restart when analyzer is resumed")
 			self._do_abort()
 
@@ -167,24 +857,100 @@ class AbstractAnalysisQueue(object):
 		aborted = None
 		while True:
 			if aborted is not None:
-				entry = aborted
+				entries = aborted
 				aborted = None
-				self._logger.debug("Got an aborted analysis job for entry {entry}, processing this instead of first item in queue".format(**locals()))
+				self._logger.debug("Got aborted analysis jobs for entries {}, processing these instead of first item in queue".format(", ".join(map(str, entries))))
 			else:
 				(priority, entry) = self._queue.get()
 				self._logger.debug("Processing entry {entry} from queue (priority {priority})".format(**locals()))
+				entries = [entry]
 
 			self._active.wait()
 
+			if len(entries) == 1:
+				# entries queued while we were waiting can be analyzed along with this one
+				entries += self._get_batch(priority, self._batch_size(priority) - 1)
+
+			entries = self._skip_known(entries)
+			if not entries:
+				continue
+
 			try:
-				self._analyze(entry, high_priority=(priority == self.__class__.HIGH_PRIO))
-				self._queue.task_done()
+				if len(entries) == 1:
+					self._analyze(entries[0], high_priority=(priority == self.__class__.HIGH_PRIO))
+					self._queue.task_done()
+				else:
+					self._current_batch = entries
+					try:
+						self._analyze_batch(entries, high_priority=(priority == self.__class__.HIGH_PRIO))
+					finally:
+						self._current_batch = None
 			except gcodeInterpreter.AnalysisAborted:
-				aborted = entry
-				self._logger.debug("Running analysis of entry {entry} aborted".format(**locals()))
+				aborted = entries
+				self._logger.debug("Running analysis of entries {} aborted".format(", ".join(map(str, entries))))
 			else:
 				time.sleep(1.0)
 
+	def _skip_known(self, entries):
+		"""
+		Finishes those of ``entries`` whose results the ``lookup_callback`` knows right away and returns the others.
+		"""
+		if self._lookup_callback is None:
+			return entries
+
+		remaining = []
+		for entry in entries:
+			try:
+				result = self._lookup_callback(entry)
+			except:
+				self._logger.exception("Error while looking up the analysis result of entry {entry}".format(**locals()))
+				result = None
+
+			if result is None:
+				remaining.append(entry)
+				continue
+
+			self._logger.debug("Analysis result of entry {entry} is already known, not analyzing it".format(**locals()))
+			self._finished_callback(entry, result)
+			self._queue.task_done()
+		return remaining
+
+	def _get_batch(self, priority, count):
+		"""
+		Takes up to ``count`` further entries with priority ``priority`` from the queue without waiting.
+		"""
+		batch = []
+		while len(batch) < count:
+			try:
+				(entry_priority, entry) = self._queue.get_nowait()
+			except queue.Empty:
+				break
+
+			if entry_priority != priority:
+				self._queue.put((entry_priority, entry))
+				self._queue.task_done()
+				break
+			batch.append(entry)
+		return batch
+
+	def _batch_size(self, priority):
+		"""
+		Number of entries with priority ``priority`` to hand to :meth:`_analyze_batch` at once. Sub classes that can
+		analyze several entries at once may override this, defaults to 1.
+		"""
+		return 1
+
+	def _analyze_batch(self, entries, high_priority=False):
+		"""
+		Analyzes several ``entries`` at once. Finished entries are removed from ``entries``, so if an
+		:class:`~octoprint.util.gcodeInterpreter.AnalysisAborted` is raised, ``entries`` contains only those that
+		still need to be analyzed. Defaults to analyzing the entries one after the other.
+		"""
+		while entries:
+			self._analyze(entries[0], high_priority=high_priority)
+			entries.pop(0)
+			self._queue.task_done()
+
 	def _analyze(self, entry, high_priority=False):
 		path = entry.absolute_path
 		if path is None or not os.path.exists(path):
@@ -226,6 +992,30 @@ class AbstractAnalysisQueue(object):
 		"""
 		pass
 
+	def create_stream_analyzer(self, printer_profile):
+		"""
+		Creates an analyzer for :class:`AnalysisStream` that is fed the contents of a file in chunks via
+		``feed(data)`` and can be aborted via ``abort()``. Sub classes may override this to support analyzing files
+		while they are received, defaults to not supporting it.
+
+		Arguments:
+		    printer_profile (dict): The printer profile to analyze for.
+
+		Returns:
+		    object: The analyzer, None if not supported.
+		"""
+		return None
+
+	def get_stream_result(self, analyzer):
+		"""
+		Finishes the analysis of ``analyzer`` as created by :meth:`create_stream_analyzer` after all contents have
+		been fed.
+
+		Returns:
+		    object: The result of the analysis, like the one returned by :meth:`_do_analysis`.
+		"""
+		return None
+
 
 class GcodeAnalysisQueue(AbstractAnalysisQueue):
 	"""
@@ -245,34 +1035,192 @@ class GcodeAnalysisQueue(AbstractAnalysisQueue):
 	     * The extruded length in mm
 	   - * ``filament.toolX.volume``
 	     * The extruded volume in cm³
+	   - * ``layers``
+	     * Index of the layers of the file, see :class:`~octoprint.util.gcodeInterpreter.LayerIndex`. Lists of the
+	       height (``z``, in mm), the byte offset (``offset``) and the number of the first line (``line``) of each
+	       layer, the estimated print time (``time``, in seconds) and the extruded filament (``filament``, in mm, all
+	       tools) before it and the state of the printer at its start (``state``, see
+	       :meth:`~octoprint.util.gcodeInterpreter.LayerIndex.get_checkpoint`), in layer order.
+	   - * ``bounds``
+	     * Bounds of the extruding moves of each tool (``tool0``, ``tool1`` and so on), with the keys ``minX``,
+	       ``maxX``, ``minY``, ``maxY``, ``minZ`` and ``maxZ`` (in mm, in the coordinate system of the printer)
+	   - * ``travelBounds``
+	     * Bounds of all other moves, structured like those of the tools
+	   - * ``distance``
+	     * Length of the non-extruding (``travel``) and the extruding moves (``extrude``) in mm
+	   - * ``outOfVolume``
+	     * Number of non-extruding (``travel``) and extruding moves (``extrude``) ending outside of the print volume
+	       of the printer profile the file was analyzed with, and the number of the first line containing one of
+	       them (``line``, None if there are none). Always 0 if the printer profile doesn't define a print volume.
+
+	Jobs not fitting into the print volume can be detected from this via :func:`check_print_volume`.
+
+	Analysis is throttled by the :class:`AnalysisThrottle` of the queue.
+
+	If ``gcodeAnalysis.parallel.enabled`` is set, analysis is performed on a pool of
+	``gcodeAnalysis.parallel.processes`` processes (defaults to the number of CPUs): Files of at least
+	``gcodeAnalysis.parallel.minChunkSize`` bytes are split into chunks analyzed in parallel (see
+	:mod:`octoprint.util.gcodeParallel`), and the entries queued with low priority, e.g. the backlog of files not
+	analyzed yet, are analyzed several files at once. Analysis in the pool processes cannot be throttled, so the pool
+	is not used while printing, batches being analyzed on it when a print starts are aborted and analyzed one after
+	the other instead.
+
+	The print time is estimated by the estimator configured as ``gcodeAnalysis.estimator``, see
+	:mod:`octoprint.util.gcodeEstimator`.
 	"""
 
+	ANALYSIS_VERSION = 5
+
+	def __init__(self, finished_callback, throttle=None, lookup_callback=None):
+		self._gcode = None
+		self._pool = None
+		self._pool_mutex = threading.RLock()
+		self._aborted = threading.Event()
+		AbstractAnalysisQueue.__init__(self, finished_callback, throttle=throttle, lookup_callback=lookup_callback)
+
 	def _do_analysis(self, high_priority=False):
 		try:
-			def throttle():
-				time.sleep(0.01)
+			throttle_callback = self._throttle.callback()
+
+			pool = self._get_pool()
+			chunks = 1
+			if pool is not None:
+				min_chunk_size = max(settings().getInt(["gcodeAnalysis", "parallel", "minChunkSize"]), 1)
+				chunks = min(self._processes(), os.stat(self._current.absolute_path).st_size // min_chunk_size)
 
-			throttle_callback = throttle
-			if high_priority:
-				throttle_callback = None
+			def progress(percentage):
+				self._current_progress = percentage
 
 			self._gcode = gcodeInterpreter.gcode()
-			self._gcode.load(self._current.absolute_path, self._current.printer_profile, throttle=throttle_callback)
-
-			result = dict()
-			if self._gcode.totalMoveTimeMinute:
-				result["estimatedPrintTime"] = self._gcode.totalMoveTimeMinute * 60
-			if self._gcode.extrusionAmount:
-				result["filament"] = dict()
-				for i in range(len(self._gcode.extrusionAmount)):
-					result["filament"]["tool%d" % i] = {
-						"length": self._gcode.extrusionAmount[i],
-						"volume": self._gcode.extrusionVolume[i]
-					}
-			return result
+			self._gcode.progressCallback = progress
+			self._gcode.load(self._current.absolute_path, self._current.printer_profile, throttle=throttle_callback, pool=pool, chunks=chunks)
+
+			return self._to_result(self._gcode)
 		finally:
 			self._gcode = None
 
 	def _do_abort(self):
+		self._aborted.set()
 		if self._gcode:
 			self._gcode.abort()
+
+		with self._pool_mutex:
+			if self._pool is not None:
+				# pool processes can't be interrupted, just replace them
+				self._pool.terminate()
+				self._pool = None
+
+	def get_analysis_version(self):
+		return "{}.{}".format(self.__class__.ANALYSIS_VERSION, settings().get(["gcodeAnalysis", "estimator"]))
+
+	def create_stream_analyzer(self, printer_profile):
+		return gcodeInterpreter.StreamingAnalysis(printer_profile, throttle=self._throttle.callback())
+
+	def get_stream_result(self, analyzer):
+		return self._to_result(analyzer.finish())
+
+	def _batch_size(self, priority):
+		if priority == self.__class__.HIGH_PRIO or self._throttle.busy or not settings().getBoolean(["gcodeAnalysis", "parallel", "enabled"]):
+			return 1
+		return self._processes()
+
+	def _analyze_batch(self, entries, high_priority=False):
+		pool = self._get_pool()
+		if pool is None:
+			AbstractAnalysisQueue._analyze_batch(self, entries, high_priority=high_priority)
+			return
+
+		self._aborted.clear()
+		max_extruders = settings().getInt(["gcodeAnalysis", "maxExtruders"])
+
+		batch = [entry for entry in entries if entry.absolute_path is not None and os.path.exists(entry.absolute_path)]
+		for entry in batch:
+			self._logger.info("Starting analysis of {entry}".format(**locals()))
+			eventManager().fire(Events.METADATA_ANALYSIS_STARTED, {"file": entry.path, "type": entry.type})
+
+		estimator = settings().get(["gcodeAnalysis", "estimator"])
+		jobs = [(entry.absolute_path, entry.printer_profile, max_extruders, estimator) for entry in batch]
+		results = pool.imap_unordered(_analyze_file_job, enumerate(jobs))
+		for _ in range(len(jobs)):
+			while True:
+				if self._throttle.busy:
+					# a print started, the pool processes would compete with it
+					self._do_abort()
+				if self._aborted.is_set():
+					raise gcodeInterpreter.AnalysisAborted()
+				try:
+					index, state = results.next(0.5)
+					break
+				except multiprocessing.TimeoutError:
+					pass
+
+			entry = batch[index]
+			self._logger.debug("Analysis of entry {entry} finished, notifying callback".format(**locals()))
+			if state is not None:
+				analysis = gcodeInterpreter.gcode()
+				analysis._setResult(state)
+				self._finished_callback(entry, self._to_result(analysis))
+			entries.remove(entry)
+			self._queue.task_done()
+
+		# entries whose files don't exist (anymore)
+		for entry in list(entries):
+			entries.remove(entry)
+			self._queue.task_done()
+
+	def _processes(self):
+		processes = settings().getInt(["gcodeAnalysis", "parallel", "processes"])
+		if not processes:
+			processes = multiprocessing.cpu_count()
+		return processes
+
+	def _get_pool(self):
+		if not settings().getBoolean(["gcodeAnalysis", "parallel", "enabled"]) or self._throttle.busy:
+			return None
+
+		with self._pool_mutex:
+			if self._pool is None:
+				self._pool = self._create_pool(self._processes())
+			return self._pool
+
+	def _create_pool(self, processes):
+		return multiprocessing.Pool(processes)
+
+	def _to_result(self, analysis):
+		result = dict()
+		if analysis.totalMoveTimeMinute:
+			result["estimatedPrintTime"] = analysis.totalMoveTimeMinute * 60
+		if analysis.extrusionAmount:
+			result["filament"] = dict()
+			for i in range(len(analysis.extrusionAmount)):
+				result["filament"]["tool%d" % i] = {
+					"length": analysis.extrusionAmount[i],
+					"volume": analysis.extrusionVolume[i]
+				}
+		if analysis.layerList:
+			layers = analysis.layerList
+			result["layers"] = dict(
+				z=[round(layer["z"], 3) for layer in layers],
+				offset=[layer["offset"] for layer in layers],
+				line=[layer["line"] for layer in layers],
+				time=[round(layer["time"], 1) for layer in layers],
+				filament=[round(layer["filament"], 1) for layer in layers],
+				state=[dict(layer["state"], temperatures=dict(layer["state"]["temperatures"])) for layer in layers]
+			)
+		if analysis.bounds:
+			result["bounds"] = dict(("tool%d" % tool, bounds) for tool, bounds in analysis.bounds.items())
+		if analysis.travelBounds:
+			result["travelBounds"] = analysis.travelBounds
+		result["distance"] = dict(travel=analysis.travelDistance, extrude=analysis.extrudeDistance)
+		if analysis.outOfVolume:
+			result["outOfVolume"] = analysis.outOfVolume
+		return result
+
+
+def _analyze_file_job(job):
+	index, job = job
+	try:
+		return index, gcodeParallel.analyze_file(job)
+	except:
+		logging.getLogger(__name__).exception("Error while analyzing {}".format(job[0]))
+		return index, None
@@ -0,0 +1,506 @@
+# coding=utf-8
+"""
+This module contains the backends in which :class:`~octoprint.filemanager.storage.LocalFileStorage` keeps the
+metadata of its files.
+
+Metadata is handled per folder: the metadata of a folder is a :class:`dict` mapping the names of the files within it
+to their metadata. Callers get that dictionary via :meth:`MetadataBackend.get`, modify it and hand it back to
+:meth:`MetadataBackend.save`, optionally together with the names of the entries they changed.
+
+Two backends are available:
+
+  * ``yaml`` (:class:`YamlMetadataBackend`, the default) keeps a ``.metadata.yaml`` file per folder which is rewritten
+    completely on every change.
+  * ``sqlite`` (:class:`SqliteMetadataBackend`) keeps the metadata of all folders in a SQLite database in the base
+    folder of the storage, one row per file. Only changed entries are written, each change in one transaction, and
+    files can be looked up by their hash, name or the time their metadata last changed. Existing ``.metadata.yaml``
+    files are migrated into the database the first time their folder is accessed.
+
+Switching back from ``sqlite`` to ``yaml`` exports the database into ``.metadata.yaml`` files again when the storage
+is opened, after which the database is renamed to ``.metadata.db.backup``.
+"""
+
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import collections
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+METADATA_FILE = ".metadata.yaml"
+"""Name of the file the ``yaml`` backend keeps the metadata of a folder in."""
+
+MIGRATED_METADATA_FILE = ".metadata.yaml.backup"
+"""Name ``.metadata.yaml`` files are renamed to after they have been migrated into the ``sqlite`` backend."""
+
+METADATA_DATABASE = ".metadata.db"
+"""Name of the database the ``sqlite`` backend keeps the metadata of all folders in, within the base folder."""
+
+MIGRATED_METADATA_DATABASE = ".metadata.db.backup"
+"""Name the database of the ``sqlite`` backend is renamed to after it has been exported to the ``yaml`` backend."""
+
+METADATA_FILES = (METADATA_FILE, MIGRATED_METADATA_FILE)
+"""Names of the files within the folders of a storage that only hold metadata."""
+
+DEFAULT_CACHE_SIZE = 4 * 1024 * 1024
+"""Default size of the metadata to cache, in bytes, see :class:`MetadataCache`."""
+
+
+def create_backend(name, basefolder, cache_size=DEFAULT_CACHE_SIZE):
+	"""
+	Arguments:
+	    name (str): Name of the backend to create, ``yaml`` or ``sqlite``. Defaults to ``yaml`` if None.
+	    basefolder (str): The base folder of the storage to manage the metadata of.
+	    cache_size (int): Size of the metadata to cache, in bytes, see :class:`MetadataCache`.
+
+	Returns:
+	    MetadataBackend: The backend.
+
+	Raises:
+	    ValueError: ``name`` is not a known backend.
+	"""
+	if name is None or name == "yaml":
+		return YamlMetadataBackend(basefolder, cache_size=cache_size)
+	elif name == "sqlite":
+		return SqliteMetadataBackend(basefolder, cache_size=cache_size)
+	raise ValueError("Unknown metadata backend: {}".format(name))
+
+
+class MetadataCache(object):
+	"""
+	A LRU cache for the metadata of folders that is bounded by the size of the cached metadata rather than the number
+	of folders, so that many small folders can be cached as well as few large ones. Sizes are estimated by the callers
+	from the serialized metadata. The most recently used folder is cached regardless of its size.
+
+	Arguments:
+	    max_size (int): Size of the metadata to cache at most.
+	"""
+
+	def __init__(self, max_size):
+		self._max_size = max_size
+		self._mutex = threading.RLock()
+
+		# ordered from least to most recently used
+		self._entries = collections.OrderedDict()
+		self._size = 0
+
+		self._hits = 0
+		self._misses = 0
+		self._evictions = 0
+
+	def get(self, path):
+		"""
+		Returns:
+		    object: The value cached for ``path``, None if there is none.
+		"""
+		with self._mutex:
+			entry = self._entries.pop(path, None)
+			if entry is None:
+				self._misses += 1
+				return None
+			self._hits += 1
+			self._entries[path] = entry
+			return entry[0]
+
+	def put(self, path, value, size):
+		"""
+		Caches ``value`` of the given ``size`` for ``path``, evicting the least recently used entries as long as the
+		cache is too large.
+		"""
+		with self._mutex:
+			self.remove(path)
+			self._entries[path] = (value, size)
+			self._size += size
+
+			while self._size > self._max_size and len(self._entries) > 1:
+				_, (_, evicted) = self._entries.popitem(last=False)
+				self._size -= evicted
+				self._evictions += 1
+
+	def remove(self, path):
+		with self._mutex:
+			entry = self._entries.pop(path, None)
+			if entry is not None:
+				self._size -= entry[1]
+
+	def keys(self):
+		with self._mutex:
+			return list(self._entries.keys())
+
+	def get_stats(self):
+		"""
+		Returns:
+		    dict: The number of ``hits``, ``misses`` and ``evictions`` so far, the number of cached folders
+		        (``entries``), and the ``size`` of their metadata and the ``maxSize`` of the cache in bytes.
+		"""
+		with self._mutex:
+			return dict(hits=self._hits,
+			            misses=self._misses,
+			            evictions=self._evictions,
+			            entries=len(self._entries),
+			            size=self._size,
+			            maxSize=self._max_size)
+
+
+class MetadataBackend(object):
+	"""
+	Interface of the backends keeping the metadata of a :class:`~octoprint.filemanager.storage.LocalFileStorage`.
+
+	Folders are identified by their absolute path on disk.
+
+	Arguments:
+	    basefolder (str): The base folder of the storage.
+	    cache_size (int): Size of the metadata to cache, in bytes, see :class:`MetadataCache`.
+	"""
+
+	name = None
+	"""Name of the backend as understood by :func:`create_backend`."""
+
+	def __init__(self, basefolder, cache_size=DEFAULT_CACHE_SIZE):
+		self._logger = logging.getLogger(__name__)
+		self._basefolder = basefolder
+		self._mutex = threading.RLock()
+		self._cache = MetadataCache(cache_size)
+
+	def get(self, path):
+		"""
+		Arguments:
+		    path (str): The folder to get the metadata of.
+
+		Returns:
+		    dict: The metadata of the files in the folder, by name. Empty if there is none.
+		"""
+		raise NotImplementedError()
+
+	def save(self, path, metadata, names=None):
+		"""
+		Saves the metadata of a folder.
+
+		Arguments:
+		    path (str): The folder to save the metadata of.
+		    metadata (dict): The metadata of the files in the folder, by name.
+		    names (list): The names of the entries that were changed, added or removed, all entries might have changed
+		        if None.
+		"""
+		raise NotImplementedError()
+
+	def remove_folder(self, path):
+		"""
+		Forgets the metadata of a removed folder and all of its sub folders.
+
+		Arguments:
+		    path (str): The removed folder.
+		"""
+		with self._mutex:
+			for cached in self._cache.keys():
+				if cached == path or cached.startswith(path + os.path.sep):
+					self._cache.remove(cached)
+
+	def find(self, hash=None, name=None, changed_since=None):
+		"""
+		Looks up files by their metadata. All given criteria have to match.
+
+		Arguments:
+		    hash (str): The hash of the files to find.
+		    name (str): The name of the files to find.
+		    changed_since (float): Only find files whose metadata changed after this timestamp.
+
+		Returns:
+		    list: Tuples of the path of each found file relative to the base folder (with ``/`` as separator) and
+		        its metadata.
+
+		Raises:
+		    NotImplementedError: The backend can't look up files by one of the criteria.
+		"""
+		raise NotImplementedError()
+
+	def get_cache_stats(self):
+		"""
+		Returns:
+		    dict: The statistics of the metadata cache, see :meth:`MetadataCache.get_stats`.
+		"""
+		return self._cache.get_stats()
+
+	def close(self):
+		"""
+		Releases the resources held by the backend.
+		"""
+		pass
+
+	def _relative(self, path):
+		relative = os.path.relpath(path, self._basefolder)
+		if relative == os.curdir:
+			return ""
+		return relative.replace(os.path.sep, "/")
+
+
+class YamlMetadataBackend(MetadataBackend):
+	"""
+	Keeps the metadata of each folder in a ``.metadata.yaml`` file within it.
+
+	The size of the cached metadata is estimated from the size of these files. If the base folder contains the database
+	of the ``sqlite`` backend, its contents are exported to the folders first, taking precedence over the entries of
+	existing ``.metadata.yaml`` files.
+	"""
+
+	name = "yaml"
+
+	def __init__(self, basefolder, cache_size=DEFAULT_CACHE_SIZE):
+		MetadataBackend.__init__(self, basefolder, cache_size=cache_size)
+
+		database = os.path.join(basefolder, METADATA_DATABASE)
+		if os.path.exists(database):
+			self._export(database)
+
+	def get(self, path):
+		metadata = self._cache.get(path)
+		if metadata is not None:
+			return metadata
+
+		metadata_path = os.path.join(path, METADATA_FILE)
+		if os.path.exists(metadata_path):
+			with self._mutex:
+				with open(metadata_path) as f:
+					try:
+						import yaml
+						metadata = yaml.safe_load(f)
+					except:
+						self._logger.exception("Error while reading .metadata.yaml from {path}".format(**locals()))
+					else:
+						self._cache.put(path, metadata, os.fstat(f.fileno()).st_size)
+						return metadata
+		return dict()
+
+	def save(self, path, metadata, names=None):
+		metadata_path = os.path.join(path, METADATA_FILE)
+
+		with self._mutex:
+			try:
+				import yaml
+
+				file_obj = tempfile.NamedTemporaryFile(delete=False)
+				try:
+					yaml.safe_dump(metadata, stream=file_obj, default_flow_style=False, indent="  ", allow_unicode=True)
+					size = file_obj.tell()
+					file_obj.close()
+					shutil.move(file_obj.name, metadata_path)
+				finally:
+					try:
+						if os.path.exists(file_obj.name):
+							os.remove(file_obj.name)
+					except Exception as e:
+						self._logger.warn("Could not delete file {}: {}".format(file_obj.name, str(e)))
+			except:
+				self._logger.exception("Error while writing .metadata.yaml to {path}".format(**locals()))
+			else:
+				self._cache.put(path, metadata, size)
+
+	def find(self, hash=None, name=None, changed_since=None):
+		if changed_since is not None:
+			raise NotImplementedError("The yaml metadata backend doesn't track when metadata changed")
+
+		result = []
+		for path, folders, _ in os.walk(self._basefolder):
+			folders[:] = sorted(folder for folder in folders if not folder.startswith("."))
+
+			metadata = self.get(path)
+			if not metadata:
+				continue
+
+			folder = self._relative(path)
+			for entry, data in sorted(metadata.items()):
+				if not isinstance(data, dict) or name is not None and entry != name or hash is not None and data.get("hash") != hash:
+					continue
+				result.append((folder + "/" + entry if folder else entry, data))
+		return result
+
+	def _export(self, database):
+		try:
+			exported = collections.defaultdict(dict)
+			backend = SqliteMetadataBackend(self._basefolder, cache_size=0, database=database)
+			try:
+				for path, data in backend.find():
+					folder, _, name = path.rpartition("/")
+					exported[folder][name] = data
+			finally:
+				backend.close()
+
+			for folder, entries in exported.items():
+				path = os.path.join(self._basefolder, *folder.split("/")) if folder else self._basefolder
+				if not os.path.isdir(path):
+					continue
+				metadata = dict(self.get(path) or dict())
+				metadata.update(entries)
+				self.save(path, metadata)
+		except:
+			self._logger.exception("Error while exporting the metadata database {database}, keeping it".format(**locals()))
+			return
+
+		try:
+			shutil.move(database, os.path.join(self._basefolder, MIGRATED_METADATA_DATABASE))
+		except:
+			self._logger.exception("Could not rename exported metadata database {database}".format(**locals()))
+		self._logger.info("Exported the metadata of {} files from the database".format(sum(len(entries) for entries in exported.values())))
+
+
+class SqliteMetadataBackend(MetadataBackend):
+	"""
+	Keeps the metadata of all folders in a SQLite database, one row per file.
+
+	Each entry is stored as JSON, indexed by its folder (relative to the base folder), its name, its hash and the time
+	it was last changed. For every cached folder the JSON of its entries is kept as well, so that :meth:`save` only
+	writes the entries that actually changed, even if it's not told which ones did. The size of the cached metadata
+	is estimated from the size of the JSON.
+
+	Arguments:
+	    database (str): Path of the database, defaults to :data:`METADATA_DATABASE` in the base folder.
+	"""
+
+	name = "sqlite"
+
+	def __init__(self, basefolder, cache_size=DEFAULT_CACHE_SIZE, database=None):
+		MetadataBackend.__init__(self, basefolder, cache_size=cache_size)
+
+		import sqlite3
+
+		if database is None:
+			database = os.path.join(basefolder, METADATA_DATABASE)
+		self._connection = sqlite3.connect(database, check_same_thread=False)
+		with self._mutex:
+			self._connection.execute("PRAGMA journal_mode=WAL")
+			self._connection.execute("PRAGMA synchronous=NORMAL")
+			with self._connection:
+				self._connection.execute("CREATE TABLE IF NOT EXISTS metadata (folder TEXT NOT NULL, name TEXT NOT NULL, hash TEXT, changed REAL NOT NULL, data TEXT NOT NULL, PRIMARY KEY (folder, name))")
+				self._connection.execute("CREATE INDEX IF NOT EXISTS metadata_hash ON metadata (hash)")
+				self._connection.execute("CREATE INDEX IF NOT EXISTS metadata_name ON metadata (name)")
+				self._connection.execute("CREATE INDEX IF NOT EXISTS metadata_changed ON metadata (changed)")
+
+	def get(self, path):
+		with self._mutex:
+			return self._load(path)[0]
+
+	def save(self, path, metadata, names=None):
+		with self._mutex:
+			try:
+				_, stored, size = self._load(path)
+				if names is None:
+					names = set(metadata.keys()) | set(stored.keys())
+
+				folder = self._relative(path)
+				changed = time.time()
+				updates = []
+				removals = []
+				serialized = dict()
+				for name in names:
+					if name in metadata:
+						data = json.dumps(metadata[name], sort_keys=True)
+						if stored.get(name) != data:
+							file_hash = metadata[name].get("hash") if isinstance(metadata[name], dict) else None
+							updates.append((folder, name, file_hash, changed, data))
+							serialized[name] = data
+					elif name in stored:
+						removals.append((folder, name))
+
+				if updates or removals:
+					with self._connection:
+						self._connection.executemany("INSERT OR REPLACE INTO metadata (folder, name, hash, changed, data) VALUES (?, ?, ?, ?, ?)", updates)
+						self._connection.executemany("DELETE FROM metadata WHERE folder = ? AND name = ?", removals)
+			except:
+				self._logger.exception("Error while writing the metadata of {path}".format(**locals()))
+			else:
+				for name, data in serialized.items():
+					size += len(data) - len(stored.get(name, ""))
+				stored.update(serialized)
+				for _, name in removals:
+					size -= len(stored.pop(name))
+				self._cache.put(path, (metadata, stored, size), size)
+
+	def remove_folder(self, path):
+		with self._mutex:
+			MetadataBackend.remove_folder(self, path)
+			folder = self._relative(path)
+			with self._connection:
+				self._connection.execute("DELETE FROM metadata WHERE folder = ? OR substr(folder, 1, ?) = ?", (folder, len(folder) + 1, folder + "/"))
+
+	def find(self, hash=None, name=None, changed_since=None):
+		criteria = []
+		parameters = []
+		if hash is not None:
+			criteria.append("hash = ?")
+			parameters.append(hash)
+		if name is not None:
+			criteria.append("name = ?")
+			parameters.append(name)
+		if changed_since is not None:
+			criteria.append("changed > ?")
+			parameters.append(changed_since)
+
+		query = "SELECT folder, name, data FROM metadata"
+		if criteria:
+			query += " WHERE " + " AND ".join(criteria)
+		query += " ORDER BY folder, name"
+
+		with self._mutex:
+			rows = self._connection.execute(query, parameters).fetchall()
+		return [(folder + "/" + entry if folder else entry, json.loads(data)) for folder, entry, data in rows]
+
+	def close(self):
+		with self._mutex:
+			self._connection.close()
+
+	def _load(self, path):
+		cached = self._cache.get(path)
+		if cached is not None:
+			return cached
+
+		folder = self._relative(path)
+		stored = dict(self._connection.execute("SELECT name, data FROM metadata WHERE folder = ?", (folder,)).fetchall())
+		if not stored:
+			stored = self._migrate(path)
+
+		metadata = dict((name, json.loads(data)) for name, data in stored.items())
+		size = sum(len(data) for data in stored.values())
+		self._cache.put(path, (metadata, stored, size), size)
+		return metadata, stored, size
+
+	def _migrate(self, path):
+		metadata_path = os.path.join(path, METADATA_FILE)
+		if not os.path.exists(metadata_path):
+			return dict()
+
+		try:
+			import yaml
+			with open(metadata_path) as f:
+				metadata = yaml.safe_load(f)
+			if not metadata:
+				metadata = dict()
+
+			folder = self._relative(path)
+			changed = time.time()
+			stored = dict()
+			rows = []
+			for name, data in metadata.items():
+				stored[name] = json.dumps(data, sort_keys=True)
+				rows.append((folder, name, data.get("hash") if isinstance(data, dict) else None, changed, stored[name]))
+			with self._connection:
+				self._connection.executemany("INSERT OR REPLACE INTO metadata (folder, name, hash, changed, data) VALUES (?, ?, ?, ?, ?)", rows)
+		except:
+			self._logger.exception("Error while migrating .metadata.yaml from {path}".format(**locals()))
+			return dict()
+
+		try:
+			shutil.move(metadata_path, os.path.join(path, MIGRATED_METADATA_FILE))
+		except:
+			self._logger.exception("Could not rename migrated .metadata.yaml in {path}".format(**locals()))
+		self._logger.info("Migrated the metadata of {} files in {} to the database".format(len(rows), path))
+		return stored
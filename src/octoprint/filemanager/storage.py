@@ -6,15 +6,59 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 __copyright__ = "Copyright (C) 2014 The OctoPrint Project - Released under terms of the AGPLv3 License"
 
 
+import collections
 import logging
 import os
-import pylru
-import tempfile
+import Queue as queue
+import threading
+import time
+import watchdog.events
 
 import octoprint.filemanager
 
+from octoprint.filemanager.metadata import create_backend, DEFAULT_CACHE_SIZE, METADATA_FILES
+from octoprint.filemanager.util import AbstractFileWrapper, FileHasher
 from octoprint.util import is_hidden_path
 
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+
+def _scan(path):
+	"""
+	Returns the name, type, size and modification date of all files and folders in ``path`` with a single ``stat``
+	call per entry (none for folders if ``scandir`` is available).
+	"""
+	result = dict()
+	if scandir is not None:
+		for entry in scandir(path):
+			if entry.is_file():
+				stat = entry.stat()
+				result[entry.name] = (True, stat.st_size, stat.st_mtime)
+			elif entry.is_dir():
+				result[entry.name] = (False, None, None)
+	else:
+		import stat as stat_module
+		for name in os.listdir(path):
+			try:
+				stat = os.stat(os.path.join(path, name))
+			except OSError:
+				# vanished in the meantime or a broken link
+				continue
+			if stat_module.S_ISREG(stat.st_mode):
+				result[name] = (True, stat.st_size, stat.st_mtime)
+			elif stat_module.S_ISDIR(stat.st_mode):
+				result[name] = (False, None, None)
+	return result
+
+
+_FolderScan = collections.namedtuple("_FolderScan", "mtime, scanned, entries")
+
 class StorageInterface(object):
 	"""
 	Interface of storage adapters for OctoPrint.
@@ -211,6 +255,26 @@ class StorageInterface(object):
 		"""
 		raise NotImplementedError()
 
+	def find_files(self, hash=None, name=None, changed_since=None):
+		"""
+		Finds files by their metadata, all given criteria have to match.
+
+		:param hash: the hash of the files to find
+		:param name: the name of the files to find
+		:param changed_since: only find files whose metadata changed after this timestamp
+		:return: a list of tuples of the path of each found file and its metadata
+		"""
+		raise NotImplementedError()
+
+	def get_diagnostics(self):
+		"""
+		Returns information about the internal state of the storage, e.g. statistics of its caches, for diagnosing
+		performance problems.
+
+		:return: a dictionary with storage specific contents, empty if there is nothing to report
+		"""
+		return dict()
+
 	def sanitize(self, path):
 		"""
 		Sanitizes the given ``path``, stripping it of all invalid characters. The ``path`` may consist of both
@@ -284,19 +348,38 @@ class LocalFileStorage(StorageInterface):
 	"""
 	The ``LocalFileStorage`` is a storage implementation which holds all files, folders and metadata on disk.
 
-	Metadata is managed inside ``.metadata.yaml`` files in the respective folders, indexed by the sanitized filenames
-	stored within the folder. Metadata access is managed through an LRU cache to minimize access overhead.
+	Metadata is managed per folder, indexed by the sanitized filenames stored within the folder, by one of the
+	backends in :mod:`octoprint.filemanager.metadata`: inside ``.metadata.yaml`` files in the respective folders (the
+	default) or in a SQLite database. Metadata access is managed through an LRU cache to minimize access overhead.
+
+	The contents of the folders are cached as well and only scanned again once the modification date of a folder
+	changes, or on any change reported by a watchdog observer passed to :func:`watch` (which also detects files
+	modified in place). Files found without any metadata are hashed in the background, listings don't wait for that.
+	Hashing is done by a :class:`~octoprint.filemanager.util.FileHasher`, which hashes on a bounded pool of threads and
+	doesn't read files again whose hashes it already knows, e.g. from when they were uploaded.
 
 	This storage type implements :func:`path_on_disk`.
 	"""
 
-	def __init__(self, basefolder, create=False):
+	RACY_SCAN_WINDOW = 2.0
+	"""
+	Scans of folders modified less than this many seconds before they were scanned are not reused, since further
+	changes within the resolution of the file system's timestamps wouldn't change the modification date.
+	"""
+
+	def __init__(self, basefolder, create=False, metadata_backend=None, metadata_cache_size=DEFAULT_CACHE_SIZE, hasher=None):
 		"""
 		Initializes a ``LocalFileStorage`` instance under the given ``basefolder``, creating the necessary folder
 		if necessary and ``create`` is set to ``True``.
 
-		:param string basefolder: the path to the folder under which to create the storage
-		:param bool create:       ``True`` if the folder should be created if it doesn't exist yet, ``False`` otherwise
+		:param string basefolder:       the path to the folder under which to create the storage
+		:param bool create:             ``True`` if the folder should be created if it doesn't exist yet, ``False`` otherwise
+		:param string metadata_backend: the backend to keep the metadata in, ``yaml`` (the default) or ``sqlite``, see
+		                                :mod:`octoprint.filemanager.metadata`
+		:param int metadata_cache_size: the size of the metadata to cache in bytes, see
+		                                :class:`~octoprint.filemanager.metadata.MetadataCache`
+		:param FileHasher hasher:       the hasher to hash files with, possibly shared with the analysis queue, a new one
+		                                that keeps the hashes it knows in memory only is created if not set
 		"""
 		self._logger = logging.getLogger(__name__)
 
@@ -306,10 +389,20 @@ class LocalFileStorage(StorageInterface):
 		if not os.path.exists(self.basefolder) or not os.path.isdir(self.basefolder):
 			raise RuntimeError("{basefolder} is not a valid directory".format(**locals()))
 
-		import threading
-		self._metadata_lock = threading.Lock()
+		self._metadata = create_backend(metadata_backend, self.basefolder, cache_size=metadata_cache_size)
+
+		# held around every read-modify-save of the metadata of a folder, which is shared with the background hashing
+		self._metadata_mutex = threading.RLock()
 
-		self._metadata_cache = pylru.lrucache(10)
+		self._scans = dict()
+
+		if hasher is None:
+			hasher = FileHasher()
+		self._hasher = hasher
+		self._hash_queue = queue.Queue()
+		self._hash_pending = set()
+		self._hash_mutex = threading.Lock()
+		self._hash_thread = None
 
 		self._old_metadata = None
 		self._initialize_metadata()
@@ -329,8 +422,8 @@ class LocalFileStorage(StorageInterface):
 			except:
 				self._logger.exception("Error while loading old metadata file")
 
-			# make sure the metadata is initialized as far as possible
-			self._list_folder(self.basefolder)
+			# make sure the metadata is initialized as far as possible, including the analysis from the old metadata
+			self._list_folder(self.basefolder, defer_hashing=False)
 
 			# rename the old metadata file
 			self._old_metadata = None
@@ -344,7 +437,9 @@ class LocalFileStorage(StorageInterface):
 			# make sure the metadata is initialized as far as possible
 			self._list_folder(self.basefolder)
 
-		self._logger.info("... file metadata for {} initialized successfully.".format(self.basefolder))
+		# the listing above loaded the metadata and contents of all folders, as far as they fit into the caches
+		stats = self._metadata.get_cache_stats()
+		self._logger.info("... file metadata for {} initialized successfully, cached the metadata of {} folders ({} bytes).".format(self.basefolder, stats["entries"], stats["size"]))
 
 	@property
 	def analysis_backlog(self):
@@ -358,16 +453,20 @@ class LocalFileStorage(StorageInterface):
 		if path is None:
 			path = self.basefolder
 
-		metadata = self._get_metadata(path)
-		if not metadata:
-			metadata = dict()
-		for entry in os.listdir(path):
-			if is_hidden_path(entry) or not octoprint.filemanager.valid_file_type(entry):
+		# this is a generator, so don't hold on to the metadata while the caller processes the entries
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			if not metadata:
+				metadata = dict()
+			analyzed = set(name for name, data in metadata.items() if isinstance(data, dict) and "analysis" in data)
+
+		for entry, (is_file, _, _) in self._scan_folder(path).items():
+			if not octoprint.filemanager.valid_file_type(entry):
 				continue
 
 			absolute_path = os.path.join(path, entry)
-			if os.path.isfile(absolute_path):
-				if not entry in metadata or not isinstance(metadata[entry], dict) or not "analysis" in metadata[entry]:
+			if is_file:
+				if not entry in analyzed:
 					printer_profile_rels = self.get_link(absolute_path, "printerprofile")
 					if printer_profile_rels:
 						printer_profile_id = printer_profile_rels[0]["id"]
@@ -375,7 +474,7 @@ class LocalFileStorage(StorageInterface):
 						printer_profile_id = None
 
 					yield entry, absolute_path, printer_profile_id
-			elif os.path.isdir(absolute_path):
+			else:
 				for sub_entry in self._analysis_backlog_generator(absolute_path):
 					yield self.join_path(entry, sub_entry[0]), sub_entry[1], sub_entry[2]
 
@@ -400,6 +499,7 @@ class LocalFileStorage(StorageInterface):
 				raise RuntimeError("{sanitized_foldername} does already exist in {virtual_path}".format(**locals()))
 		else:
 			os.mkdir(folder_path)
+			self._invalidate(path)
 
 		return self.path_in_storage((path, name))
 
@@ -410,24 +510,23 @@ class LocalFileStorage(StorageInterface):
 		if not os.path.exists(folder_path):
 			return
 
-		contents = os.listdir(folder_path)
-		if ".metadata.yaml" in contents:
-			contents.remove(".metadata.yaml")
+		contents = [entry for entry in os.listdir(folder_path) if not entry in METADATA_FILES]
 		if contents and not recursive:
 			raise RuntimeError("{sanitized_foldername} in {virtual_path} is not empty".format(**locals()))
 
 		import shutil
 		shutil.rmtree(folder_path)
+		self._metadata.remove_folder(folder_path)
+		self._invalidate(path)
+		for scanned in list(self._scans.keys()):
+			if scanned == folder_path or scanned.startswith(folder_path + os.path.sep):
+				self._invalidate(scanned)
 
 	def add_file(self, path, file_object, printer_profile=None, links=None, allow_overwrite=False):
 		path, name = self.sanitize(path)
 		if not octoprint.filemanager.valid_file_type(name):
 			raise RuntimeError("{name} is an unrecognized file type".format(**locals()))
 
-		metadata = self._get_metadata(path)
-		if not metadata:
-			metadata = dict()
-
 		file_path = os.path.join(path, name)
 		if os.path.exists(file_path) and not os.path.isfile(file_path):
 			raise RuntimeError("{name} does already exist in {path} and is not a file".format(**locals()))
@@ -441,15 +540,23 @@ class LocalFileStorage(StorageInterface):
 		# save the file
 		file_object.save(file_path)
 
-		# save the file's hash to the metadata of the folder
-		file_hash = self._create_hash(file_path)
-		if not name in metadata or not "hash" in metadata[name] or metadata[name]["hash"] != file_hash:
-			# make sure to create a new metadata entry if we've never seen that file with that content before
-			file_metadata = dict(
-				hash=file_hash
-			)
-			metadata[name] = file_metadata
-			self._save_metadata(path, metadata)
+		# save the file's hash to the metadata of the folder, wrappers of uploads might already know it
+		file_hash = file_object.hash if isinstance(file_object, AbstractFileWrapper) and file_object.hash else None
+		if file_hash is None:
+			file_hash = self._create_hash(file_path)
+
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			if not metadata:
+				metadata = dict()
+
+			if not name in metadata or not "hash" in metadata[name] or metadata[name]["hash"] != file_hash:
+				# make sure to create a new metadata entry if we've never seen that file with that content before
+				file_metadata = dict(
+					hash=file_hash
+				)
+				metadata[name] = file_metadata
+				self._save_metadata(path, metadata, names=[name])
 
 		# process any links that were also provided for adding to the file
 		if not links:
@@ -462,43 +569,54 @@ class LocalFileStorage(StorageInterface):
 
 		# touch the file to set last access and modification time to now
 		os.utime(file_path, None)
+		self._invalidate(path)
+
+		# the touch changed the file's signature, the hasher only takes the hash once it's outside its racy window
+		self._hasher.remember(file_path, file_hash)
 
 		return self.path_in_storage((path, name))
 
 	def remove_file(self, path):
 		path, name = self.sanitize(path)
 
-		metadata = self._get_metadata(path)
-
-		file_path = os.path.join(path, name)
-		if not os.path.exists(file_path):
-			return
-		if not os.path.isfile(file_path):
-			raise RuntimeError("{name} in {path} is not a file".format(**locals()))
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
 
-		try:
-			os.remove(file_path)
-		except Exception as e:
-			raise RuntimeError("Could not delete {name} in {path}".format(**locals()), e)
+			file_path = os.path.join(path, name)
+			if not os.path.exists(file_path):
+				return
+			if not os.path.isfile(file_path):
+				raise RuntimeError("{name} in {path} is not a file".format(**locals()))
 
-		if name in metadata:
-			if "hash" in metadata[name]:
-				hash = metadata[name]["hash"]
-				for m in metadata.values():
-					if not "links" in m:
-						continue
-					for link in m["links"]:
-						if "rel" in link and "hash" in link and (link["rel"] == "model" or link["rel"] == "machinecode") and link["hash"] == hash:
-							m["links"].remove(link)
-			del metadata[name]
-			self._save_metadata(path, metadata)
+			try:
+				os.remove(file_path)
+			except Exception as e:
+				raise RuntimeError("Could not delete {name} in {path}".format(**locals()), e)
+			self._invalidate(path)
+
+			if name in metadata:
+				if "hash" in metadata[name]:
+					hash = metadata[name]["hash"]
+					for m in metadata.values():
+						if not "links" in m:
+							continue
+						for link in m["links"]:
+							if "rel" in link and "hash" in link and (link["rel"] == "model" or link["rel"] == "machinecode") and link["hash"] == hash:
+								m["links"].remove(link)
+				del metadata[name]
+				self._save_metadata(path, metadata)
 
 	def get_metadata(self, path):
 		path, name = self.sanitize(path)
 
-		metadata = self._get_metadata(path)
-		if name in metadata:
-			return metadata[name]
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			if name in metadata:
+				return metadata[name]
+
+		if os.path.isfile(os.path.join(path, name)) and octoprint.filemanager.valid_file_type(name):
+			# listed before its hash was created in the background
+			return self._add_basic_metadata(path, name)
 		else:
 			return None
 
@@ -529,41 +647,70 @@ class LocalFileStorage(StorageInterface):
 
 	def set_additional_metadata(self, path, key, data, overwrite=False, merge=False):
 		path, name = self.sanitize(path)
-		metadata = self._get_metadata(path)
-		metadata_dirty = False
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			metadata_dirty = False
 
-		if not name in metadata:
-			return
+			if not name in metadata:
+				return
 
-		if not key in metadata[name] or overwrite:
-			metadata[name][key] = data
-			metadata_dirty = True
-		elif key in metadata[name] and isinstance(metadata[name][key], dict) and isinstance(data, dict) and merge:
-			current_data = metadata[name][key]
+			if not key in metadata[name] or overwrite:
+				metadata[name][key] = data
+				metadata_dirty = True
+			elif key in metadata[name] and isinstance(metadata[name][key], dict) and isinstance(data, dict) and merge:
+				current_data = metadata[name][key]
 
-			import octoprint.util
-			new_data = octoprint.util.dict_merge(current_data, data)
-			metadata[name][key] = new_data
-			metadata_dirty = True
-		elif key in metadata[name] and overwrite:
-			metadata[name][key] = data
-			metadata_dirty = True
+				import octoprint.util
+				new_data = octoprint.util.dict_merge(current_data, data)
+				metadata[name][key] = new_data
+				metadata_dirty = True
+			elif key in metadata[name] and overwrite:
+				metadata[name][key] = data
+				metadata_dirty = True
 
-		if metadata_dirty:
-			self._save_metadata(path, metadata)
+			if metadata_dirty:
+				self._save_metadata(path, metadata, names=[name])
 
 	def remove_additional_metadata(self, path, key):
 		path, name = self.sanitize(path)
-		metadata = self._get_metadata(path)
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
 
-		if not name in metadata:
-			return
+			if not name in metadata:
+				return
+
+			if not key in metadata[name]:
+				return
+
+			del metadata[name][key]
+			self._save_metadata(path, metadata, names=[name])
+
+	def find_files(self, hash=None, name=None, changed_since=None):
+		with self._metadata_mutex:
+			return self._metadata.find(hash=hash, name=name, changed_since=changed_since)
+
+	def get_diagnostics(self):
+		with self._hash_mutex:
+			pending_hashes = len(self._hash_pending)
+		return dict(
+			metadata=dict(
+				backend=self._metadata.name,
+				cache=self._metadata.get_cache_stats()
+			),
+			scannedFolders=len(self._scans),
+			pendingHashes=pending_hashes,
+			hashing=self._hasher.get_stats()
+		)
 
-		if not key in metadata[name]:
-			return
+	def watch(self, observer):
+		"""
+		Schedules a handler on the watchdog ``observer`` that drops the cached contents of folders in which files or
+		folders were changed. Without it, only changes that alter the modification date of a folder (e.g. adding,
+		removing or renaming files) are detected, files modified in place are not.
 
-		del metadata[name][key]
-		self._save_metadata(path, metadata)
+		:param observer: the watchdog observer to schedule the handler on
+		"""
+		observer.schedule(_ScanInvalidationHandler(self), self.basefolder, recursive=True)
 
 	def split_path(self, path):
 		split = path.split("/")
@@ -664,363 +811,439 @@ class LocalFileStorage(StorageInterface):
 	##~~ internals
 
 	def _add_history(self, name, path, data):
-		metadata = self._get_metadata(path)
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
 
-		if not name in metadata:
-			metadata[name] = dict()
+			if not name in metadata:
+				metadata[name] = dict()
 
-		if not "hash" in metadata[name]:
-			metadata[name]["hash"] = self._create_hash(os.path.join(path, name))
+			if not "hash" in metadata[name]:
+				metadata[name]["hash"] = self._create_hash(os.path.join(path, name))
 
-		if not "history" in metadata[name]:
-			metadata[name]["history"] = []
+			if not "history" in metadata[name]:
+				metadata[name]["history"] = []
 
-		metadata[name]["history"].append(data)
-		self._calculate_stats_from_history(name, path, metadata=metadata, save=False)
-		self._save_metadata(path, metadata)
+			metadata[name]["history"].append(data)
+			self._calculate_stats_from_history(name, path, metadata=metadata, save=False)
+			self._save_metadata(path, metadata, names=[name])
 
 	def _update_history(self, name, path, index, data):
-		metadata = self._get_metadata(path)
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
 
-		if not name in metadata or not "history" in metadata[name]:
-			return
+			if not name in metadata or not "history" in metadata[name]:
+				return
 
-		try:
-			metadata[name]["history"][index].update(data)
-			self._calculate_stats_from_history(name, path, metadata=metadata, save=False)
-			self._save_metadata(path, metadata)
-		except IndexError:
-			pass
+			try:
+				metadata[name]["history"][index].update(data)
+				self._calculate_stats_from_history(name, path, metadata=metadata, save=False)
+				self._save_metadata(path, metadata, names=[name])
+			except IndexError:
+				pass
 
 	def _delete_history(self, name, path, index):
-		metadata = self._get_metadata(path)
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
 
-		if not name in metadata or not "history" in metadata[name]:
-			return
+			if not name in metadata or not "history" in metadata[name]:
+				return
 
-		try:
-			del metadata[name]["history"][index]
-			self._calculate_stats_from_history(name, path, metadata=metadata, save=False)
-			self._save_metadata(path, metadata)
-		except IndexError:
-			pass
+			try:
+				del metadata[name]["history"][index]
+				self._calculate_stats_from_history(name, path, metadata=metadata, save=False)
+				self._save_metadata(path, metadata, names=[name])
+			except IndexError:
+				pass
 
 	def _calculate_stats_from_history(self, name, path, metadata=None, save=True):
-		if metadata is None:
-			metadata = self._get_metadata(path)
+		with self._metadata_mutex:
+			if metadata is None:
+				metadata = self._get_metadata(path)
 
-		if not name in metadata or not "history" in metadata[name]:
-			return
+			if not name in metadata or not "history" in metadata[name]:
+				return
 
-		# collect data from history
-		former_print_times = dict()
-		last_print = dict()
+			# collect data from history
+			former_print_times = dict()
+			last_print = dict()
 
 
-		for history_entry in metadata[name]["history"]:
-			if not "printTime" in history_entry or not "success" in history_entry or not history_entry["success"] or not "printerProfile" in history_entry:
-				continue
+			for history_entry in metadata[name]["history"]:
+				if not "printTime" in history_entry or not "success" in history_entry or not history_entry["success"] or not "printerProfile" in history_entry:
+					continue
 
-			printer_profile = history_entry["printerProfile"]
-			print_time = history_entry["printTime"]
+				printer_profile = history_entry["printerProfile"]
+				print_time = history_entry["printTime"]
 
-			if not printer_profile in former_print_times:
-				former_print_times[printer_profile] = []
-			former_print_times[printer_profile].append(print_time)
+				if not printer_profile in former_print_times:
+					former_print_times[printer_profile] = []
+				former_print_times[printer_profile].append(print_time)
 
-			if not printer_profile in last_print or last_print[printer_profile] is None or ("timestamp" in history_entry and history_entry["timestamp"] > last_print[printer_profile]["timestamp"]):
-				last_print[printer_profile] = history_entry
+				if not printer_profile in last_print or last_print[printer_profile] is None or ("timestamp" in history_entry and history_entry["timestamp"] > last_print[printer_profile]["timestamp"]):
+					last_print[printer_profile] = history_entry
 
-		# calculate stats
-		statistics = dict(averagePrintTime=dict(), lastPrintTime=dict())
+			# calculate stats
+			statistics = dict(averagePrintTime=dict(), lastPrintTime=dict())
 
-		for printer_profile in former_print_times:
-			if not former_print_times[printer_profile]:
-				continue
-			statistics["averagePrintTime"][printer_profile] = sum(former_print_times[printer_profile]) / float(len(former_print_times[printer_profile]))
+			for printer_profile in former_print_times:
+				if not former_print_times[printer_profile]:
+					continue
+				statistics["averagePrintTime"][printer_profile] = sum(former_print_times[printer_profile]) / float(len(former_print_times[printer_profile]))
 
-		for printer_profile in last_print:
-			if not last_print[printer_profile]:
-				continue
-			statistics["lastPrintTime"][printer_profile] = last_print[printer_profile]["printTime"]
+			for printer_profile in last_print:
+				if not last_print[printer_profile]:
+					continue
+				statistics["lastPrintTime"][printer_profile] = last_print[printer_profile]["printTime"]
 
-		metadata[name]["statistics"] = statistics
+			metadata[name]["statistics"] = statistics
 
-		if save:
-			self._save_metadata(path, metadata)
+			if save:
+				self._save_metadata(path, metadata, names=[name])
 
 	def _get_links(self, name, path, searched_rel):
-		metadata = self._get_metadata(path)
-		result = []
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			result = []
 
-		if not name in metadata:
-			return result
+			if not name in metadata:
+				return result
 
-		if not "links" in metadata[name]:
-			return result
+			if not "links" in metadata[name]:
+				return result
 
-		for data in metadata[name]["links"]:
-			if not "rel" in data or not data["rel"] == searched_rel:
-				continue
-			result.append(data)
-		return result
+			for data in metadata[name]["links"]:
+				if not "rel" in data or not data["rel"] == searched_rel:
+					continue
+				result.append(data)
+			return result
 
 	def _add_links(self, name, path, links):
 		file_type = octoprint.filemanager.get_file_type(name)
 		if file_type:
 			file_type = file_type[0]
 
-		metadata = self._get_metadata(path)
-		metadata_dirty = False
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			metadata_dirty = False
 
-		if not name in metadata:
-			metadata[name] = dict()
+			if not name in metadata:
+				metadata[name] = dict()
 
-		if not "hash" in metadata[name]:
-			metadata[name]["hash"] = self._create_hash(os.path.join(path, name))
+			if not "hash" in metadata[name]:
+				metadata[name]["hash"] = self._create_hash(os.path.join(path, name))
 
-		if not "links" in metadata[name]:
-			metadata[name]["links"] = []
+			if not "links" in metadata[name]:
+				metadata[name]["links"] = []
 
-		for rel, data in links:
-			if (rel == "model" or rel == "machinecode") and "name" in data:
-				if file_type == "model" and rel == "model":
-					# adding a model link to a model doesn't make sense
-					return
-				elif file_type == "machinecode" and rel == "machinecode":
-					# adding a machinecode link to a machinecode doesn't make sense
-					return
+			for rel, data in links:
+				if (rel == "model" or rel == "machinecode") and "name" in data:
+					if file_type == "model" and rel == "model":
+						# adding a model link to a model doesn't make sense
+						return
+					elif file_type == "machinecode" and rel == "machinecode":
+						# adding a machinecode link to a machinecode doesn't make sense
+						return
 
-				ref_path = os.path.join(path, data["name"])
-				if not os.path.exists(ref_path):
-					# file doesn't exist, we won't create the link
-					continue
+					ref_path = os.path.join(path, data["name"])
+					if not os.path.exists(ref_path):
+						# file doesn't exist, we won't create the link
+						continue
 
-				# fetch hash of target file
-				if data["name"] in metadata and "hash" in metadata[data["name"]]:
-					hash = metadata[data["name"]]["hash"]
-				else:
-					hash = self._create_hash(ref_path)
-					if not data["name"] in metadata:
-						metadata[data["name"]] = dict(
-							hash=hash,
-							links=[]
-						)
+					# fetch hash of target file
+					if data["name"] in metadata and "hash" in metadata[data["name"]]:
+						hash = metadata[data["name"]]["hash"]
 					else:
-						metadata[data["name"]]["hash"] = hash
-
-				if "hash" in data and not data["hash"] == hash:
-					# file doesn't have the correct hash, we won't create the link
-					continue
+						hash = self._create_hash(ref_path)
+						if not data["name"] in metadata:
+							metadata[data["name"]] = dict(
+								hash=hash,
+								links=[]
+							)
+						else:
+							metadata[data["name"]]["hash"] = hash
+
+					if "hash" in data and not data["hash"] == hash:
+						# file doesn't have the correct hash, we won't create the link
+						continue
 
-				if not "links" in metadata[data["name"]]:
-					metadata[data["name"]]["links"] = []
+					if not "links" in metadata[data["name"]]:
+						metadata[data["name"]]["links"] = []
 
-				# add reverse link to link target file
-				metadata[data["name"]]["links"].append(
-					dict(rel="machinecode" if rel == "model" else "model", name=name, hash=metadata[name]["hash"])
-				)
-				metadata_dirty = True
+					# add reverse link to link target file
+					metadata[data["name"]]["links"].append(
+						dict(rel="machinecode" if rel == "model" else "model", name=name, hash=metadata[name]["hash"])
+					)
+					metadata_dirty = True
 
-				link_dict = dict(
-					rel=rel,
-					name=data["name"],
-					hash=hash
-				)
+					link_dict = dict(
+						rel=rel,
+						name=data["name"],
+						hash=hash
+					)
 
-			elif rel == "web" and "href" in data:
-				link_dict = dict(
-					rel=rel,
-					href=data["href"]
-				)
-				if "retrieved" in data:
-					link_dict["retrieved"] = data["retrieved"]
+				elif rel == "web" and "href" in data:
+					link_dict = dict(
+						rel=rel,
+						href=data["href"]
+					)
+					if "retrieved" in data:
+						link_dict["retrieved"] = data["retrieved"]
 
-			else:
-				continue
+				else:
+					continue
 
-			if link_dict:
-				metadata[name]["links"].append(link_dict)
-				metadata_dirty = True
+				if link_dict:
+					metadata[name]["links"].append(link_dict)
+					metadata_dirty = True
 
-		if metadata_dirty:
-			self._save_metadata(path, metadata)
+			if metadata_dirty:
+				self._save_metadata(path, metadata)
 
 	def _remove_links(self, name, path, links):
-		metadata = self._get_metadata(path)
-		metadata_dirty = False
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			metadata_dirty = False
 
-		if not name in metadata or not "hash" in metadata[name]:
-			hash = self._create_hash(os.path.join(path, name))
-		else:
-			hash = metadata[name]["hash"]
-
-		for rel, data in links:
-			if (rel == "model" or rel == "machinecode") and "name" in data:
-				if data["name"] in metadata and "links" in metadata[data["name"]]:
-					ref_rel = "model" if rel == "machinecode" else "machinecode"
-					for link in metadata[data["name"]]["links"]:
-						if link["rel"] == ref_rel and "name" in link and link["name"] == name and "hash" in link and link["hash"] == hash:
-							metadata[data["name"]]["links"].remove(link)
-							metadata_dirty = True
-
-			if "links" in metadata[name]:
-				for link in metadata[name]["links"]:
-					if not link["rel"] == rel:
+			if not name in metadata or not "hash" in metadata[name]:
+				hash = self._create_hash(os.path.join(path, name))
+			else:
+				hash = metadata[name]["hash"]
+
+			for rel, data in links:
+				if (rel == "model" or rel == "machinecode") and "name" in data:
+					if data["name"] in metadata and "links" in metadata[data["name"]]:
+						ref_rel = "model" if rel == "machinecode" else "machinecode"
+						for link in metadata[data["name"]]["links"]:
+							if link["rel"] == ref_rel and "name" in link and link["name"] == name and "hash" in link and link["hash"] == hash:
+								metadata[data["name"]]["links"].remove(link)
+								metadata_dirty = True
+
+				if "links" in metadata[name]:
+					for link in metadata[name]["links"]:
+						if not link["rel"] == rel:
+							continue
+
+						matches = True
+						for k, v in data.items():
+							if not k in link or not link[k] == v:
+								matches = False
+								break
+
+						if not matches:
+							continue
+
+						metadata[name]["links"].remove(link)
+						metadata_dirty = True
+
+			if metadata_dirty:
+				self._save_metadata(path, metadata)
+
+	def _list_folder(self, path, filter=None, recursive=True, defer_hashing=True):
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			if not metadata:
+				metadata = dict()
+			metadata_dirty = False
+
+			result = dict()
+			for entry, (is_file, size, mtime) in self._scan_folder(path).items():
+				entry_path = os.path.join(path, entry)
+
+				# file handling
+				if is_file:
+					file_type = octoprint.filemanager.get_file_type(entry)
+					if not file_type:
+						# only supported extensions
 						continue
+					else:
+						file_type = file_type[0]
+
+					if entry in metadata and isinstance(metadata[entry], dict):
+						entry_data = metadata[entry]
+					elif defer_hashing:
+						# hashing might take a while for large files, don't let the listing wait for it
+						self._hash_later(path, entry)
+						entry_data = dict(links=[], notes=[])
+					else:
+						entry_data = self._add_basic_metadata(path, entry, save=False, metadata=metadata)
+						metadata_dirty = True
 
-					matches = True
-					for k, v in data.items():
-						if not k in link or not link[k] == v:
-							matches = False
-							break
+					# TODO extract model hash from source if possible to recreate link
 
-					if not matches:
-						continue
+					if not filter or filter(entry, entry_data):
+						# only add files passing the optional filter
+						extended_entry_data = dict()
+						extended_entry_data.update(entry_data)
+						extended_entry_data["name"] = entry
+						extended_entry_data["type"] = file_type
+						extended_entry_data["size"] = size
+						extended_entry_data["date"] = int(mtime)
 
-					metadata[name]["links"].remove(link)
-					metadata_dirty = True
+						result[entry] = extended_entry_data
 
-		if metadata_dirty:
-			self._save_metadata(path, metadata)
+				# folder recursion
+				elif recursive:
+					sub_result = self._list_folder(entry_path, filter=filter, defer_hashing=defer_hashing)
+					result[entry] = dict(
+						name=entry,
+						type="folder",
+						children=sub_result
+					)
 
-	def _list_folder(self, path, filter=None, recursive=True):
-		metadata = self._get_metadata(path)
-		if not metadata:
-			metadata = dict()
-		metadata_dirty = False
+			# TODO recreate links if we have metadata less entries
 
-		result = dict()
-		for entry in os.listdir(path):
-			if is_hidden_path(entry):
-				# no hidden files and folders
-				continue
+			# save metadata
+			if metadata_dirty:
+				self._save_metadata(path, metadata)
 
-			entry_path = os.path.join(path, entry)
+			return result
 
-			# file handling
-			if os.path.isfile(entry_path):
-				file_type = octoprint.filemanager.get_file_type(entry)
-				if not file_type:
-					# only supported extensions
-					continue
-				else:
-					file_type = file_type[0]
+	def _scan_folder(self, path):
+		"""
+		Returns the non hidden files and folders in ``path`` as mapping from their names to tuples of whether they are
+		a file and their size and modification date, from the cache if the folder's modification date didn't change
+		since it was scanned.
+		"""
+		mtime = os.stat(path).st_mtime
+		scan = self._scans.get(path)
+		if scan is not None and scan.mtime == mtime and scan.scanned - mtime > self.__class__.RACY_SCAN_WINDOW:
+			return scan.entries
+
+		scanned = time.time()
+		entries = dict((name, data) for name, data in _scan(path).items() if not is_hidden_path(name))
+		self._scans[path] = _FolderScan(mtime, scanned, entries)
+		return entries
+
+	def _invalidate(self, path):
+		self._scans.pop(path, None)
+
+	def _hash_later(self, path, name):
+		with self._hash_mutex:
+			if (path, name) in self._hash_pending:
+				return
+			self._hash_pending.add((path, name))
+
+			if self._hash_thread is None:
+				self._hash_thread = threading.Thread(target=self._hash_worker, name="LocalFileStorage hashing")
+				self._hash_thread.daemon = True
+				self._hash_thread.start()
+		self._hash_queue.put((path, name))
+
+	def _hash_worker(self):
+		while True:
+			jobs = [self._hash_queue.get()]
+			try:
+				while True:
+					jobs.append(self._hash_queue.get_nowait())
+			except queue.Empty:
+				pass
 
-				if entry in metadata and isinstance(metadata[entry], dict):
-					entry_data = metadata[entry]
-				else:
-					entry_data = self._add_basic_metadata(path, entry, save=False, metadata=metadata)
-					metadata_dirty = True
+			folders = collections.OrderedDict()
+			for path, name in jobs:
+				folders.setdefault(path, []).append(name)
 
-				# TODO extract model hash from source if possible to recreate link
-
-				if not filter or filter(entry, entry_data):
-					# only add files passing the optional filter
-					extended_entry_data = dict()
-					extended_entry_data.update(entry_data)
-					extended_entry_data["name"] = entry
-					extended_entry_data["type"] = file_type
-					stat = os.stat(entry_path)
-					if stat:
-						extended_entry_data["size"] = stat.st_size
-						extended_entry_data["date"] = int(stat.st_mtime)
-
-					result[entry] = extended_entry_data
-
-			# folder recursion
-			elif os.path.isdir(entry_path) and recursive:
-				sub_result = self._list_folder(entry_path, filter=filter)
-				result[entry] = dict(
-					name=entry,
-					type="folder",
-					children=sub_result
-				)
+			for path, names in folders.items():
+				try:
+					self._hash_files(path, names)
+				except:
+					self._logger.exception("Error while creating the metadata of new files in {}".format(path))
+				finally:
+					with self._hash_mutex:
+						self._hash_pending.difference_update((path, name) for name in names)
 
-		# TODO recreate links if we have metadata less entries
+	def _hash_files(self, path, names, save_interval=5.0):
+		with self._metadata_mutex:
+			metadata = self._get_metadata(path)
+			names = [name for name in names if not (name in metadata and isinstance(metadata[name], dict)) and os.path.isfile(os.path.join(path, name))]
 
-		# save metadata
-		if metadata_dirty:
-			self._save_metadata(path, metadata)
+		# hash all files at once on the hasher's pool, but add them in order as they are done
+		jobs = [self._hasher.submit(os.path.join(path, name)) for name in names]
 
-		return result
+		added = collections.OrderedDict()
+		last_save = time.time()
+		for index, (name, job) in enumerate(zip(names, jobs)):
+			file_hash = job.wait()
+			if file_hash is not None:
+				added[name] = file_hash
+			# otherwise vanished in the meantime or unreadable
 
-	def _add_basic_metadata(self, path, entry, additional_metadata=None, save=True, metadata=None):
+			if not added:
+				continue
+
+			with self._metadata_mutex:
+				# the metadata might have been reloaded since the last save, so add all files not saved yet to the
+				# current one, files already in it are left alone
+				metadata = self._get_metadata(path)
+				for added_name, added_hash in added.items():
+					self._add_basic_metadata(path, added_name, save=False, metadata=metadata, file_hash=added_hash)
+
+				if index == len(names) - 1 or time.time() - last_save > save_interval:
+					self._save_metadata(path, metadata, names=list(added.keys()))
+					added.clear()
+					last_save = time.time()
+
+	def _add_basic_metadata(self, path, entry, additional_metadata=None, save=True, metadata=None, file_hash=None):
 		if additional_metadata is None:
 			additional_metadata = dict()
 
-		if metadata is None:
-			metadata = self._get_metadata(path)
+		# hashing might take a while, don't block access to the metadata in the meantime
+		if file_hash is None:
+			file_hash = self._create_hash(os.path.join(path, entry))
 
-		entry_data = dict(
-			hash=self._create_hash(os.path.join(path, entry)),
-			links=[],
-			notes=[]
-		)
+		with self._metadata_mutex:
+			if metadata is None:
+				metadata = self._get_metadata(path)
 
-		if path == self.basefolder and self._old_metadata is not None and entry in self._old_metadata and "gcodeAnalysis" in self._old_metadata[entry]:
-			# if there is still old metadata available and that contains an analysis for this file, use it!
-			entry_data["analysis"] = self._old_metadata[entry]["gcodeAnalysis"]
+			if entry in metadata and isinstance(metadata[entry], dict):
+				# added in the meantime, e.g. by the background hashing
+				return metadata[entry]
 
-		entry_data.update(additional_metadata)
-		metadata[entry] = entry_data
+			entry_data = dict(
+				hash=file_hash,
+				links=[],
+				notes=[]
+			)
 
-		if save:
-			self._save_metadata(path, metadata)
+			if path == self.basefolder and self._old_metadata is not None and entry in self._old_metadata and "gcodeAnalysis" in self._old_metadata[entry]:
+				# if there is still old metadata available and that contains an analysis for this file, use it!
+				entry_data["analysis"] = self._old_metadata[entry]["gcodeAnalysis"]
 
-		return entry_data
+			entry_data.update(additional_metadata)
+			metadata[entry] = entry_data
 
-	def _create_hash(self, path):
-		import hashlib
+			if save:
+				self._save_metadata(path, metadata, names=[entry])
 
-		blocksize = 65536
-		hash = hashlib.sha1()
-		with open(path, "rb") as f:
-			buffer = f.read(blocksize)
-			while len(buffer) > 0:
-				hash.update(buffer)
-				buffer = f.read(blocksize)
+			return entry_data
 
-		return hash.hexdigest()
+	def _create_hash(self, path):
+		return self._hasher.hash(path)
 
 	def _get_metadata(self, path):
-		if path in self._metadata_cache:
-			return self._metadata_cache[path]
-
-		metadata_path = os.path.join(path, ".metadata.yaml")
-		if os.path.exists(metadata_path):
-			with self._metadata_lock:
-				with open(metadata_path) as f:
-					try:
-						import yaml
-						metadata = yaml.safe_load(f)
-					except:
-						self._logger.exception("Error while reading .metadata.yaml from {path}".format(**locals()))
-					else:
-						self._metadata_cache[path] = metadata
-						return metadata
-		return dict()
+		return self._metadata.get(path)
 
-	def _save_metadata(self, path, metadata):
-		metadata_path = os.path.join(path, ".metadata.yaml")
+	def _save_metadata(self, path, metadata, names=None):
+		self._metadata.save(path, metadata, names=names)
 
-		with self._metadata_lock:
-			try:
-				import yaml
-				import shutil
 
-				file_obj = tempfile.NamedTemporaryFile(delete=False)
-				try:
-					yaml.safe_dump(metadata, stream=file_obj, default_flow_style=False, indent="  ", allow_unicode=True)
-					file_obj.close()
-					shutil.move(file_obj.name, metadata_path)
-				finally:
-					try:
-						if os.path.exists(file_obj.name):
-							os.remove(file_obj.name)
-					except Exception as e:
-						self._logger.warn("Could not delete file {}: {}".format(file_obj.name, str(e)))
-			except:
-				self._logger.exception("Error while writing .metadata.yaml to {path}".format(**locals()))
-			else:
-				self._metadata_cache[path] = metadata
+class _ScanInvalidationHandler(watchdog.events.FileSystemEventHandler):
+	"""
+	Drops the cached contents of the folders of a :class:`LocalFileStorage` in which anything changed.
+	"""
+
+	def __init__(self, storage):
+		watchdog.events.FileSystemEventHandler.__init__(self)
+		self._storage = storage
+
+	def on_any_event(self, event):
+		paths = [event.src_path]
+		if hasattr(event, "dest_path"):
+			paths.append(event.dest_path)
+
+		for path in paths:
+			if is_hidden_path(path):
+				# metadata files
+				continue
+			self._storage._invalidate(os.path.dirname(path))
+			if event.is_directory:
+				self._storage._invalidate(path)
@@ -5,10 +5,431 @@ __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
 __copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
 
+import collections
 import io
+import json
+import logging
+import os
+import Queue as queue
+import threading
+import time
 
 from octoprint.util import atomic_write
 
+
+HASH_BLOCKSIZE = 1024 * 1024
+"""Size of the blocks in which :func:`content_hash` reads files by default."""
+
+
+def content_hash(path, blocksize=HASH_BLOCKSIZE):
+	"""
+	Arguments:
+	    path (str): Path of the file to hash.
+	    blocksize (int): Size of the blocks in which to read the file.
+
+	Returns:
+	    str: The hex encoded SHA1 hash of the contents of the file at ``path``.
+	"""
+	import hashlib
+
+	hash = hashlib.sha1()
+	buf = bytearray(blocksize)
+	view = memoryview(buf)
+	with io.open(path, "rb", buffering=0) as f:
+		read = f.readinto(buf)
+		while read:
+			hash.update(view[:read])
+			read = f.readinto(buf)
+
+	return hash.hexdigest()
+
+
+def file_signature(path):
+	"""
+	Arguments:
+	    path (str): Path of the file.
+
+	Returns:
+	    tuple: The device, inode, size and modification date of the file at ``path``. Changes if the file's contents
+	        are changed, but not if it's moved or renamed within the same file system.
+	"""
+	stat = os.stat(path)
+	return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class FileHasher(object):
+	"""
+	Hashes files on a bounded pool of worker threads (see :meth:`submit` and :meth:`hash_all`) or the calling thread
+	(see :meth:`hash`) and remembers the hashes by the :func:`file_signature` of the files, so files that didn't change
+	are never read again, even if they were moved in the meantime. Hashes computed elsewhere, e.g. while a file was
+	uploaded, can be added via :meth:`remember`.
+
+	If more than ``size`` hashes are known, those that were used least recently are forgotten. The known hashes are
+	persisted to ``path`` as JSON by the worker threads whenever they run out of work (or right away, see
+	:meth:`flush`), so that files don't need to be hashed again after a restart either.
+
+	Arguments:
+	    path (str): Path of the file to persist the known hashes to, they are only held in memory if None.
+	    size (int): Maximum number of hashes to remember.
+	    workers (int): Number of worker threads to hash files on.
+	"""
+
+	RACY_WINDOW = 2.0
+	"""
+	Hashes of files modified less than this many seconds before they were hashed are not remembered, since further
+	changes within the resolution of the file system's timestamps wouldn't change the signature.
+	"""
+
+	def __init__(self, path=None, size=10000, workers=2):
+		self._logger = logging.getLogger(__name__)
+		self._path = path
+		self._size = max(size, 1)
+		self._workers = max(workers, 1)
+
+		# ordered from least to most recently used
+		self._hashes = collections.OrderedDict()
+		self._dirty = False
+		self._mutex = threading.RLock()
+
+		# held while saving, so a save of older hashes can't overwrite the file after one of newer hashes
+		self._save_mutex = threading.Lock()
+
+		self._jobs = dict()
+		self._queue = queue.Queue()
+		self._threads = []
+
+		self.hits = 0
+		self.misses = 0
+
+		self._load()
+
+	def lookup(self, path):
+		"""
+		Arguments:
+		    path (str): Path of the file.
+
+		Returns:
+		    str: The known hash of the file at ``path`` if it didn't change since it was hashed, None otherwise.
+		"""
+		try:
+			signature = file_signature(path)
+		except EnvironmentError:
+			return None
+		return self._get(signature)
+
+	def hash(self, path):
+		"""
+		Hashes the file at ``path`` on the calling thread, unless its hash is known or it's already being hashed by a
+		worker thread.
+
+		Arguments:
+		    path (str): Path of the file to hash.
+
+		Returns:
+		    str: The hex encoded SHA1 hash of the contents of the file at ``path``.
+
+		Raises:
+		    EnvironmentError: The file could not be read.
+		"""
+		with self._mutex:
+			job = self._jobs.get(path)
+		if job is not None:
+			return job.wait()
+		return self._hash(path)
+
+	def submit(self, path, callback=None):
+		"""
+		Hashes the file at ``path`` on one of the worker threads, unless its hash is known.
+
+		Arguments:
+		    path (str): Path of the file to hash.
+		    callback (callable): Called with the hash (None if the file could not be read) once it's done, on the
+		        calling thread if it's known already.
+
+		Returns:
+		    HashJob: The job to wait for the hash on.
+		"""
+		with self._mutex:
+			job = self._jobs.get(path)
+			if job is None:
+				file_hash = self.lookup(path)
+				job = HashJob(path)
+				if file_hash is not None:
+					job.done(file_hash)
+				else:
+					self._jobs[path] = job
+					self._start_workers()
+					self._queue.put(job)
+
+		if callback is not None:
+			job.add_done_callback(callback)
+		return job
+
+	def hash_all(self, paths):
+		"""
+		Hashes the files at ``paths`` on the worker threads and waits for them to be done.
+
+		Arguments:
+		    paths (list): Paths of the files to hash.
+
+		Returns:
+		    dict: Mapping of the paths to the hashes of the files, None for files that could not be read.
+		"""
+		jobs = [self.submit(path) for path in paths]
+		return dict((job.path, job.wait()) for job in jobs)
+
+	def remember(self, path, file_hash):
+		"""
+		Remembers ``file_hash`` as the hash of the contents of the file at ``path``, e.g. if it was computed while the
+		file was written. Like hashes computed by the hasher itself, it is not remembered if the file was modified less
+		than :attr:`RACY_WINDOW` seconds ago.
+
+		Arguments:
+		    path (str): Path of the file.
+		    file_hash (str): The hex encoded SHA1 hash of the contents of the file.
+		"""
+		try:
+			signature = file_signature(path)
+		except EnvironmentError:
+			return
+
+		if self._is_racy(signature):
+			return
+
+		self._put(signature, file_hash)
+		self._schedule_save()
+
+	def flush(self):
+		"""
+		Persists the known hashes to the hasher's ``path`` right away if they changed since they were last saved.
+		"""
+		if self._path is None:
+			return
+
+		with self._save_mutex:
+			with self._mutex:
+				if not self._dirty:
+					return
+				data = [list(_signature_from_key(key)) + [file_hash] for key, file_hash in self._hashes.items()]
+				self._dirty = False
+
+			try:
+				with atomic_write(self._path, "wb") as f:
+					json.dump(data, f)
+			except:
+				self._logger.exception("Error while saving the known file hashes to {}".format(self._path))
+
+	def get_stats(self):
+		"""
+		Returns:
+		    dict: The number of known hashes (``entries``), the maximum number (``size``), the number of files waiting to
+		        be hashed (``pending``) as well as the number of ``hits`` and ``misses`` since the hasher was created.
+		"""
+		with self._mutex:
+			return dict(entries=len(self._hashes), size=self._size, pending=len(self._jobs), hits=self.hits, misses=self.misses)
+
+	def _hash(self, path, lookup=True):
+		if lookup:
+			file_hash = self.lookup(path)
+			if file_hash is not None:
+				return file_hash
+
+		before = file_signature(path)
+		file_hash = content_hash(path)
+		after = file_signature(path)
+
+		if before == after and not self._is_racy(after):
+			self._put(after, file_hash)
+		return file_hash
+
+	def _is_racy(self, signature):
+		mtime = signature[3]
+		return time.time() - mtime <= self.__class__.RACY_WINDOW
+
+	def _get(self, signature):
+		key = _signature_key(signature)
+		with self._mutex:
+			if not key in self._hashes:
+				self.misses += 1
+				return None
+
+			self.hits += 1
+			file_hash = self._hashes.pop(key)
+			self._hashes[key] = file_hash
+			return file_hash
+
+	def _put(self, signature, file_hash):
+		key = _signature_key(signature)
+		with self._mutex:
+			self._hashes.pop(key, None)
+			self._hashes[key] = file_hash
+			while len(self._hashes) > self._size:
+				self._hashes.popitem(last=False)
+			self._dirty = True
+
+	def _start_workers(self):
+		with self._mutex:
+			while len(self._threads) < self._workers:
+				thread = threading.Thread(target=self._work, name="FileHasher worker {}".format(len(self._threads)))
+				thread.daemon = True
+				thread.start()
+				self._threads.append(thread)
+
+	def _schedule_save(self):
+		if self._path is None:
+			return
+
+		# an empty job only makes a worker save the known hashes once it runs out of work
+		self._start_workers()
+		self._queue.put(None)
+
+	def _work(self):
+		while True:
+			job = self._queue.get()
+			if job is not None:
+				try:
+					# looked up when the job was submitted
+					file_hash = self._hash(job.path, lookup=False)
+				except EnvironmentError as e:
+					self._logger.warn("Could not hash {}: {}".format(job.path, e))
+					file_hash = None
+				except:
+					self._logger.exception("Error while hashing {}".format(job.path))
+					file_hash = None
+
+				with self._mutex:
+					self._jobs.pop(job.path, None)
+				job.done(file_hash)
+
+			if self._queue.empty():
+				self.flush()
+
+	def _load(self):
+		if self._path is None or not os.path.exists(self._path):
+			return
+
+		try:
+			with io.open(self._path, "rb") as f:
+				data = json.load(f)
+		except:
+			self._logger.exception("Error while loading the known file hashes from {}".format(self._path))
+			return
+
+		if not isinstance(data, list):
+			return
+
+		for item in data[-self._size:]:
+			if isinstance(item, list) and len(item) == 5:
+				self._hashes[_signature_key(item[:4])] = item[4]
+
+
+def _signature_key(signature):
+	dev, ino, size, mtime = signature
+	return "{}:{}:{}:{!r}".format(int(dev), int(ino), int(size), float(mtime))
+
+
+def _signature_from_key(key):
+	dev, ino, size, mtime = key.split(":")
+	return int(dev), int(ino), int(size), float(mtime)
+
+
+class HashJob(object):
+	"""
+	A file being hashed by a :class:`FileHasher`.
+
+	Arguments:
+	    path (str): Path of the file.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.hash = None
+
+		self._done = threading.Event()
+		self._callbacks = []
+		self._mutex = threading.Lock()
+
+	def wait(self, timeout=None):
+		"""
+		Waits for the file to be hashed.
+
+		Returns:
+		    str: The hash of the file, None if it could not be read or the ``timeout`` ran out.
+		"""
+		self._done.wait(timeout)
+		return self.hash
+
+	def add_done_callback(self, callback):
+		"""
+		Adds a callback to call with the hash once the file is hashed, right away if it already is.
+		"""
+		with self._mutex:
+			if not self._done.is_set():
+				self._callbacks.append(callback)
+				return
+		callback(self.hash)
+
+	def done(self, file_hash):
+		with self._mutex:
+			self.hash = file_hash
+			self._done.set()
+			callbacks, self._callbacks = self._callbacks, []
+
+		for callback in callbacks:
+			try:
+				callback(file_hash)
+			except:
+				logging.getLogger(__name__).exception("Error while calling back with the hash of {}".format(self.path))
+
+
+class UploadProcessor(object):
+	"""
+	Processes the contents of an uploaded file while they are received, see
+	:meth:`octoprint.filemanager.FileManager.create_upload_processor`. Hashes the contents and feeds them to the
+	``analysis`` if set.
+
+	Arguments:
+	    path (str): Path of the temporary file the upload is stored in.
+	    analysis (octoprint.filemanager.analysis.AnalysisStream): The analysis of the contents, if any.
+	    printer_profile (dict): The printer profile ``analysis`` is performed for.
+	    close_callback (callable): Called with the processor on :meth:`close`.
+	"""
+
+	def __init__(self, path, analysis=None, printer_profile=None, close_callback=None):
+		import hashlib
+
+		self.path = path
+		self.analysis = analysis
+		self.printer_profile = printer_profile
+		self.hash = None
+
+		self._sha1 = hashlib.sha1()
+		self._close_callback = close_callback
+
+	def update(self, data):
+		"""
+		Processes the next chunk of the contents.
+		"""
+		self._sha1.update(data)
+		if self.analysis is not None:
+			self.analysis.update(data)
+
+	def finish(self):
+		"""
+		Called after all contents were received, makes :attr:`hash` available.
+		"""
+		self.hash = self._sha1.hexdigest()
+		if self.analysis is not None:
+			self.analysis.finish()
+
+	def close(self):
+		"""
+		Called once handling of the upload is done, whether it was successful or not.
+		"""
+		if self._close_callback is not None:
+			self._close_callback(self)
+
+
 class AbstractFileWrapper(object):
 	"""
 	Wrapper for file representations to save to storages.
@@ -17,6 +438,9 @@ class AbstractFileWrapper(object):
 	    filename (str): The file's name
 	"""
 
+	hash = None
+	"""The hex encoded SHA1 hash of the file's contents if already known, saves storages from reading them again."""
+
 	def __init__(self, filename):
 		self.filename = filename
 
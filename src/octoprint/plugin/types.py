@@ -57,8 +57,13 @@ class OctoPrintPlugin(Plugin):
 
 	.. attribute:: _printer
 
-	   The :class:`~octoprint.printer.PrinterInterface` instance. Injected by the plugin core system upon initialization
-	   of the implementation.
+	   The :class:`~octoprint.printer.PrinterInterface` instance of the default printer. Injected by the plugin core
+	   system upon initialization of the implementation.
+
+	.. attribute:: _printer_registry
+
+	   The :class:`~octoprint.printer.registry.PrinterRegistry` instance holding all printers served by this instance.
+	   Injected by the plugin core system upon initialization of the implementation.
 
 	.. attribute:: _app_session_manager
 
@@ -5,10 +5,64 @@ __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
 __copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
 
+import weakref
+
+import flask
+
 import octoprint.plugin
+from octoprint.settings import settings
 from . import fastbot
 
-class FastbotPrinterPlugin(octoprint.plugin.SettingsPlugin):
+class FastbotPrinterPlugin(octoprint.plugin.SettingsPlugin,
+                           octoprint.plugin.SimpleApiPlugin):
+
+    def __init__(self):
+        self._connections = weakref.WeakSet()
+
+    def get_settings_defaults(self):
+        return dict(
+            readSize=4096,
+            sendBufferSize=None,
+            host="127.0.0.1",
+            ports=dict(
+                read=50012,
+                write=50002,
+                emergency=50013
+            ),
+            connectTimeout=3.0,
+            reconnect=dict(
+                enabled=True,
+                initialDelay=0.5,
+                maxDelay=10.0,
+                timeout=120.0
+            )
+        )
+
+    def is_api_adminonly(self):
+        # the metrics reveal the daemon's endpoint and errors
+        return True
+
+    def on_api_get(self, request):
+        return flask.jsonify(connections=[connection.get_metrics() for connection in list(self._connections)])
+
+    def _get_pipe_options(self):
+        reconnect = self._settings.get_boolean(["reconnect", "enabled"])
+        if reconnect and settings().getBoolean(["serial", "eventLoop"]):
+            # reconnecting blocks, which we can't do on the event loop's thread
+            self._logger.info("Not reconnecting to the Fastbot daemon since the connection is served from the event loop")
+            reconnect = False
+
+        return dict(
+            host=self._settings.get(["host"]),
+            readPort=self._settings.get_int(["ports", "read"]),
+            writePort=self._settings.get_int(["ports", "write"]),
+            emergencyPort=self._settings.get_int(["ports", "emergency"]),
+            connectTimeout=self._settings.get_float(["connectTimeout"]),
+            reconnect=reconnect,
+            reconnectDelay=self._settings.get_float(["reconnect", "initialDelay"]),
+            reconnectMaxDelay=self._settings.get_float(["reconnect", "maxDelay"]),
+            reconnectTimeout=self._settings.get_float(["reconnect", "timeout"])
+        )
 
     def fastbot_printer_factory(self, comm_instance, port, baudrate, read_timeout):
         #if not port == "socket":
@@ -19,7 +73,11 @@ class FastbotPrinterPlugin(octoprint.plugin.SettingsPlugin):
             return None
         '''
         
-        serial_obj = fastbot.FastbotPrinter(read_timeout=float(read_timeout))
+        serial_obj = fastbot.FastbotPrinter(read_timeout=float(read_timeout),
+                                            read_size=self._settings.get_int(["readSize"]) or 4096,
+                                            send_buffer_size=self._settings.get_int(["sendBufferSize"]),
+                                            pipe_options=self._get_pipe_options())
+        self._connections.add(serial_obj)
         print("get fastbotPrinter 1")
         return serial_obj
 
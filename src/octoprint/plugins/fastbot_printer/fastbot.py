@@ -15,7 +15,6 @@ import Queue
 
 from octoprint.settings import settings
 from octoprint.plugin import plugin_manager
-from octoprint.util import get_exception_string
 
 from .pipeReadWrite import PipeReadWrite
 
@@ -26,13 +25,16 @@ class FastbotPrinter():
 	sleep_after_next_regex = re.compile("sleep_after_next ([GM]\d+) (\d+)")
 	custom_action_regex = re.compile("action_custom ([a-zA-Z0-9_]+)(\s+.*)?")
 
-	def __init__(self, read_timeout=5.0, write_timeout=10.0):
+	def __init__(self, read_timeout=5.0, write_timeout=10.0, read_size=4096, send_buffer_size=None, pipe_options=None):
 		import logging
 		self._logger = logging.getLogger("octoprint.plugin.fastbot_printer.FastbotPrinter")
 		
 		self._read_timeout = read_timeout
 		self._write_timeout = write_timeout
-		self._pipe = PipeReadWrite(self._read_timeout, self._write_timeout)
+		if pipe_options is None:
+			pipe_options = dict()
+		self._pipe = PipeReadWrite(self._read_timeout, self._write_timeout, readSize=read_size, sendBufferSize=send_buffer_size, **pipe_options)
+		self._metrics = None
 				
 		
 
@@ -46,8 +48,7 @@ class FastbotPrinter():
 		try:
 			self._pipe.writeEmerg(command)
 		except:
-			exceptionString = get_exception_string()
-			print("Unexpected error while writeEmerg pipe port: %s" % exceptionString)
+			self._logger.exception("Unexpected error while writing to the emergency pipe port")
 			self.close()
 			raise IOError("Failed to write, remote close")	
 			
@@ -57,8 +58,7 @@ class FastbotPrinter():
 		try:
 			self._pipe.write(command)
 		except:
-			exceptionString = get_exception_string()
-			print("Unexpected error while writing pipe port: %s" % exceptionString)
+			self._logger.exception("Unexpected error while writing to the pipe port")
 			self.close()
 			raise IOError("Failed to write, remote close")	
 
@@ -69,17 +69,58 @@ class FastbotPrinter():
 			line = self._pipe.readline()		
 			#print("lkj readline: %s" % str(line))
 		except:
-			exceptionString = get_exception_string()
-			print("lkj Unexpected error while reading pipe port: %s" % exceptionString)
+			self._logger.exception("Unexpected error while reading from the pipe port")
 			self.close()
 			raise IOError("Failed to readline, remote close")	
 			#return None
 		return line
 
+	def fileno(self):
+		return self._pipe.fileno()
+
+	def read_available(self):
+		if self._pipe is None:
+			raise IOError("Failed to read, already closed")
+		try:
+			data = self._pipe.read_available()
+		except:
+			self._logger.exception("Unexpected error while reading from the pipe port")
+			self.close()
+			raise IOError("Failed to read, remote close")
+		return data
+
+	def write_fileno(self):
+		return self._pipe.write_fileno()
+
+	def write_available(self, data):
+		if self._pipe is None:
+			raise IOError("Failed to write, already closed")
+		try:
+			written = self._pipe.write_available(data)
+		except:
+			self._logger.exception("Unexpected error while writing to the pipe port")
+			self.close()
+			raise IOError("Failed to write, remote close")
+		return written
+
+	def set_reconnect_callback(self, callback):
+		self._pipe.setReconnectCallback(callback)
+
+	def get_metrics(self):
+		"""
+		Returns:
+		    dict: Connection metrics as provided by :meth:`PipeReadWrite.getMetrics`, the last known ones if already closed.
+		"""
+		pipe = self._pipe
+		if pipe is not None:
+			return pipe.getMetrics()
+		return self._metrics
+
 	def close(self):
 		try:
 			if self._pipe is not None:
 				self._pipe.close()
+				self._metrics = self._pipe.getMetrics()
 		finally:
 			self._pipe = None
 			
@@ -4,10 +4,13 @@ __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agp
 __copyright__ = "Copyright (C) 2014 luokj - Released under terms of the AGPLv3 License"
 
 import os, time
+import errno
 import glob
+import select
 import threading
 
 from octoprint.util import get_exception_string
+from octoprint.util.eventloop import ReceiveBuffer
 import logging
 import socket
 
@@ -19,76 +22,266 @@ xx readline()
 """
 
 class PipeReadWrite():
+	"""
+	Connection to the Fastbot printer daemon, which consists of three TCP sockets: one for reading from the printer,
+	one for writing to it and one for emergency commands.
+
+	If the connection breaks, e.g. because the daemon gets restarted, all three sockets are reestablished with
+	exponential backoff from within the failing call, so the connection's user (and with it all of its state like
+	line numbers) survives as long as the daemon comes back within ``reconnectTimeout``. A broken connection is noticed
+	when reading or writing fails and also checked for on every read timeout. If it can't be reestablished, the
+	failing call raises an :class:`IOError`.
+
+	The non-blocking :meth:`read_available` and :meth:`write_available` must not wait for that, so they reconnect in a
+	thread of their own instead and return None until the reconnect callback (see :meth:`setReconnectCallback`) got
+	called.
+
+	Arguments:
+	    readTimeout (float): Timeout for :meth:`readline` in seconds.
+	    writeTimeout (float): Timeout for writes in seconds, a write that doesn't complete in time counts as a broken
+	        connection. Writes block until they are done if not set.
+	    readSize (int): Maximum number of bytes to receive at once.
+	    sendBufferSize (int): Send buffer size to configure on the write socket, the OS default will be used if not set.
+	    host (str): Host the daemon is running on.
+	    readPort (int): Port of the daemon's read socket.
+	    writePort (int): Port of the daemon's write socket.
+	    emergencyPort (int): Port of the daemon's emergency socket.
+	    connectTimeout (float): Timeout for establishing each of the sockets in seconds.
+	    reconnect (bool): Whether to reconnect if the connection breaks.
+	    reconnectDelay (float): Delay before the second reconnection attempt in seconds, doubled with every further
+	        failed attempt.
+	    reconnectMaxDelay (float): Maximum delay between two reconnection attempts in seconds.
+	    reconnectTimeout (float): Time after which to give up reconnecting in seconds.
+	"""
 
 	_fifo_read_name = "/tmp/fifo_py_rd_c_wr"
 	_fifo_write_name = "/tmp/fifo_py_wr_c_rd"
 
-	def __init__(self, readTimeout, writeTimeout):
-		self._HOST='127.0.0.1'
-		#self._HOST='192.168.111.1'
-		#self._HOST='192.168.7.2'
-		#self._HOST='192.168.1.102'
-		#self._HOST='192.168.1.101'
-		#self._HOST='192.168.1.112'
-		self._ReadPORT= 50012
-		self._WriteEmergencyPORT= 50013
-		self._WritePORT=50002
+	def __init__(self, readTimeout, writeTimeout, readSize=4096, sendBufferSize=None,
+	             host="127.0.0.1", readPort=50012, writePort=50002, emergencyPort=50013, connectTimeout=3.0,
+	             reconnect=True, reconnectDelay=0.5, reconnectMaxDelay=10.0, reconnectTimeout=120.0):
+		self._HOST = host
+		self._ReadPORT = readPort
+		self._WriteEmergencyPORT = emergencyPort
+		self._WritePORT = writePort
 		self._logger = logging.getLogger("lkj-PipeReadWrite")
-		print(" in PipeReadWrite 0 ")
-		self._socketRead = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-		#print(" in PipeReadWrite 1 ")
-		self._socketWrite = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-		self._socketEmergencyWrite = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-		
-		print(" in PipeReadWrite 2 ")
-		self._connectionTimeout = 3   #3 s
+
+		self._connectionTimeout = connectTimeout
 		self._readTimeout = readTimeout
 		self._writeTimeout = writeTimeout
-		self._logger.info("PipeReadWrite init")
-
-		self._socketRead.setblocking(1)
-		self._socketRead.connect((self._HOST,self._ReadPORT))
-		
-		self._socketWrite.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 256) 
-		self._socketWrite.setblocking(1)
-		
-		self._socketEmergencyWrite.connect((self._HOST, self._WriteEmergencyPORT))
-		
-		self._socketWrite.connect((self._HOST,self._WritePORT))
-		self._readBuffer = []
-		self._finishreadBuffer = True
+		self._sendBufferSize = sendBufferSize
+
+		self._reconnect = reconnect
+		self._reconnectDelay = reconnectDelay
+		self._reconnectMaxDelay = reconnectMaxDelay
+		self._reconnectTimeout = reconnectTimeout
+
+		self._socketRead = None
+		self._socketWrite = None
+		self._socketEmergencyWrite = None
+		self._closed = threading.Event()
+
+		# incremented with every (re)connect, allows telling whether a failure still concerns the current sockets
+		self._generation = 0
+		self._connectMutex = threading.Lock()
 		self._stateMutex = threading.Lock()
 
-	def close(self):
-		#import traceback
-		#lkj traceback.print_stack()
-		if self._socketWrite is not None:
-			self._socketWrite.send("exit")
-			self._socketWrite.close()
-			self._socketWrite = None
-			
-		if self._socketEmergencyWrite is not None:
-			self._socketEmergencyWrite.close()
-			self._socketEmergencyWrite = None		
+		self._reconnecting = False
+		self._reconnectingMutex = threading.Lock()
+		self._reconnectCallback = None
+
+		self._metrics = dict(
+			reconnects=0,
+			failedAttempts=0,
+			lastReconnectLatency=None,
+			maxReconnectLatency=None,
+			totalDowntime=0.0,
+			lastError=None
+		)
+
+		self._receiveBuffer = ReceiveBuffer(readSize)
+		self._connect()
+		self._logger.info("PipeReadWrite init, connected to {}:{}/{}/{}".format(self._HOST, self._ReadPORT, self._WritePORT, self._WriteEmergencyPORT))
+
+	def _connect(self):
+		sockets = []
+		try:
+			socketRead = self._open(self._ReadPORT)
+			sockets.append(socketRead)
+
+			socketEmergencyWrite = self._open(self._WriteEmergencyPORT, timeout=self._writeTimeout)
+			sockets.append(socketEmergencyWrite)
 
+			options = []
+			if self._sendBufferSize:
+				options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, self._sendBufferSize))
+			# commands are small and answered one by one, don't let them wait for more data to send
+			options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+			socketWrite = self._open(self._WritePORT, options=options, timeout=self._writeTimeout)
+			sockets.append(socketWrite)
+		except:
+			for sock in sockets:
+				_closeQuietly(sock)
+			raise
 
-		if self._socketRead is not None:
-			self._socketRead.close()
-			self._socketRead = None
+		self._socketRead = socketRead
+		self._socketEmergencyWrite = socketEmergencyWrite
+		self._socketWrite = socketWrite
+		self._receiveBuffer.clear()
+		self._generation += 1
 
-		'''
+	def _open(self, port, options=None, timeout=None):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		try:
-			if self._pipeRead  is not  None :
-				self._pipeRead.close()
-			if self._pipeWrite is not  None :
-				self._pipeWrite.close()
+			if options:
+				for option in options:
+					sock.setsockopt(*option)
+			sock.settimeout(self._connectionTimeout if self._connectionTimeout else None)
+			sock.connect((self._HOST, port))
+			sock.settimeout(timeout if timeout else None)
 		except:
-			exceptionString = get_exception_string()
-			self._logger.error("Unexpected error while close pipe: %s" % exceptionString)
+			_closeQuietly(sock)
+			raise
+		return sock
+
+	def _disconnect(self):
+		for name in ("_socketWrite", "_socketEmergencyWrite", "_socketRead"):
+			sock = getattr(self, name)
+			setattr(self, name, None)
+			if sock is not None:
+				_closeQuietly(sock)
+
+	def _reconnectAfter(self, generation, error):
+		"""
+		Reestablishes the connection after ``error`` occurred on the sockets of connection ``generation``.
+
+		Returns:
+		    bool: True if the connection is usable again (possibly because another thread already reconnected), False
+		        if reconnecting is disabled, the connection got closed or the daemon didn't come back in time.
+		"""
+		if not self._reconnect or self._closed.is_set():
+			return False
+
+		with self._connectMutex:
+			if self._closed.is_set():
+				return False
+			if generation != self._generation:
+				# somebody else already took care of it while we were waiting
+				return True
+
+			self._logger.warn("Lost connection to {}: {}, reconnecting".format(self._HOST, error))
+			self._metrics["lastError"] = str(error)
+			self._disconnect()
+
+			start = time.time()
+			delay = self._reconnectDelay
+			while not self._closed.is_set():
+				try:
+					self._connect()
+				except (IOError, socket.error) as e:
+					self._metrics["failedAttempts"] += 1
+					if time.time() - start + delay > self._reconnectTimeout:
+						self._logger.error("Could not reconnect to {} within {}s, giving up: {}".format(self._HOST, self._reconnectTimeout, e))
+						return False
+					self._closed.wait(delay)
+					delay = min(delay * 2, self._reconnectMaxDelay)
+				else:
+					latency = time.time() - start
+					self._metrics["reconnects"] += 1
+					self._metrics["lastReconnectLatency"] = latency
+					if self._metrics["maxReconnectLatency"] is None or latency > self._metrics["maxReconnectLatency"]:
+						self._metrics["maxReconnectLatency"] = latency
+					self._metrics["totalDowntime"] += latency
+					self._logger.info("Reconnected to {} after {:.2f}s".format(self._HOST, latency))
+					return True
+			return False
+
+	def _reconnectInBackground(self, generation, error):
+		"""
+		Like :meth:`_reconnectAfter`, but reconnects in a thread of its own and returns right away. The reconnect
+		callback gets called once that's done, whether it succeeded or not.
+
+		Returns:
+		    bool: True if the connection is being reestablished, False if reconnecting is disabled or the connection
+		        got closed.
+		"""
+		if not self._reconnect or self._closed.is_set():
+			return False
+
+		with self._reconnectingMutex:
+			if self._reconnecting:
+				return True
+			self._reconnecting = True
+
+		thread = threading.Thread(target=self._reconnectThread, args=(generation, error), name="PipeReadWrite.reconnect")
+		thread.daemon = True
+		thread.start()
+		return True
+
+	def _reconnectThread(self, generation, error):
+		try:
+			self._reconnectAfter(generation, error)
+		finally:
+			with self._reconnectingMutex:
+				self._reconnecting = False
+
+			callback = self._reconnectCallback
+			if callback is not None:
+				try:
+					callback()
+				except:
+					self._logger.exception("Error while calling the reconnect callback")
 
-		self._pipeRead = None
-		self._pipeWrite = None
-		'''
+	def setReconnectCallback(self, callback):
+		"""
+		Sets the ``callback`` to call without arguments once reconnecting in the background finished, see
+		:meth:`read_available` and :meth:`write_available`. It is called on the reconnecting thread. If reconnecting
+		failed, :meth:`fileno` and :meth:`write_fileno` will raise an :class:`IOError` from then on, otherwise they
+		return the new sockets' file descriptors.
+		"""
+		self._reconnectCallback = callback
+
+	def _isHealthy(self):
+		"""
+		The daemon never sends anything on the write sockets, so them becoming readable means that they got closed.
+		"""
+		sockets = [sock for sock in (self._socketWrite, self._socketEmergencyWrite) if sock is not None]
+		if len(sockets) < 2:
+			return False
+
+		try:
+			readable, _, _ = select.select(sockets, [], [], 0)
+			for sock in readable:
+				if not sock.recv(256, socket.MSG_DONTWAIT):
+					return False
+		except (IOError, socket.error, select.error):
+			return False
+		return True
+
+	def getMetrics(self):
+		"""
+		Returns:
+		    dict: Statistics about the connection: number of ``reconnects``, ``failedAttempts`` to reconnect, latency of
+		        the last and longest reconnect and ``totalDowntime`` in seconds as well as the ``lastError`` that lead
+		        to a reconnect.
+		"""
+		metrics = dict(self._metrics)
+		metrics["connected"] = self._socketRead is not None
+		metrics["endpoint"] = "{}:{}/{}/{}".format(self._HOST, self._ReadPORT, self._WritePORT, self._WriteEmergencyPORT)
+		return metrics
+
+	def close(self):
+		#import traceback
+		#lkj traceback.print_stack()
+		self._closed.set()
+
+		with self._connectMutex:
+			if self._socketWrite is not None:
+				try:
+					self._socketWrite.send("exit")
+				except:
+					self._logger.warn("Could not tell the daemon we are leaving: %s" % get_exception_string())
+			self._disconnect()
 
 		self._connectionTimeout = 0
 		self._readTimeout = 0
@@ -97,53 +290,146 @@ class PipeReadWrite():
 		self._logger.info("PipeReadWrite close")
 
 	def readline(self):
-		#print("lkj start read")
-
-		while len(self._readBuffer) >= 1 :
-			ret = self._readBuffer.pop()
-			#print("return ret=%s" % ret)
-			#self._logger.info("PipeReadWrite readline:%s" % ret)
-			self._finishreadBuffer = False
-			return ret
-
-
-		if len(self._readBuffer) == 0 :
-			self._finishreadBuffer = True
-
-		if self._finishreadBuffer :
-			a = self._socketRead.recv(256)
-			if a is not None:
-				#str2 = self._readBuffer.pop() + a
-				self._readBuffer = a.split('\n')
-				self._readBuffer.reverse()
-				ret = self._readBuffer.pop()
-				#self._logger.info("PipeReadWrite readline:%s" % ret)
-				return ret
-
-		print("lkj end read, cann't stand here!!!!")
-		return a
+		"""
+		Returns the next line received including its terminating newline, like ``serial.Serial.readline``. Returns
+		"" if no complete line arrived within the read timeout, an incomplete line stays buffered until it is
+		completed.
+		"""
+		while True:
+			line = self._receiveBuffer.readline()
+			if line is not None:
+				return line
+
+			generation = self._generation
+			socketRead = self._socketRead
+			try:
+				if socketRead is None:
+					raise IOError("Failed to read, not connected")
+
+				readable, _, _ = select.select([socketRead], [], [], self._readTimeout if self._readTimeout else None)
+				if not readable:
+					if not self._isHealthy():
+						raise IOError("Connection closed by remote")
+					return ""
+				self._receiveBuffer.fill(socketRead)
+			except (IOError, socket.error, select.error) as e:
+				if not self._reconnectAfter(generation, e):
+					raise
+				# report the time we spent reconnecting as a timeout
+				return ""
+
+	def fileno(self):
+		socketRead = self._socketRead
+		if socketRead is None:
+			raise IOError("Failed to read, not connected")
+		return socketRead.fileno()
+
+	def read_available(self):
+		"""
+		Returns everything that can be read from the read socket without blocking, "" if nothing is available.
+
+		If the connection broke, it is reestablished in the background and None is returned, see
+		:meth:`setReconnectCallback`.
+		"""
+		generation = self._generation
+		socketRead = self._socketRead
+		if socketRead is None:
+			if self._reconnecting:
+				return None
+			raise IOError("Failed to read, not connected")
+
+		try:
+			self._receiveBuffer.fill(socketRead, socket.MSG_DONTWAIT)
+		except (IOError, socket.error) as e:
+			if getattr(e, "errno", None) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				if not self._reconnectInBackground(generation, e):
+					raise
+				return None
+		return self._receiveBuffer.read_all()
+
+	def write_fileno(self):
+		socketWrite = self._socketWrite
+		if socketWrite is None:
+			raise IOError("Failed to write, not connected")
+		return socketWrite.fileno()
+
+	def write_available(self, value):
+		"""
+		Sends as much of ``value`` as possible on the write socket without blocking.
+
+		If the connection broke, it is reestablished in the background and None is returned, see
+		:meth:`setReconnectCallback`.
+
+		Returns:
+		    int: The number of bytes sent, 0 if the socket's buffer is full.
+		"""
+		generation = self._generation
+		with self._stateMutex:
+			sock = self._socketWrite
+			if sock is None:
+				if self._reconnecting:
+					return None
+				raise IOError("Failed to write, not connected")
+
+			try:
+				# with a write timeout configured, send would wait for room for up to that long
+				_, writable, _ = select.select([], [sock], [], 0)
+				if not writable:
+					return 0
+				return sock.send(value, socket.MSG_DONTWAIT)
+			except (IOError, socket.error, select.error) as e:
+				if getattr(e, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return 0
+				error = e
+				self._logger.warn("Error while writing to {}: {}".format(self._HOST, e))
+
+		# whatever got lost on the way will be requested again by the firmware
+		if not self._reconnectInBackground(generation, error):
+			raise IOError("Failed to write to {}: {}".format(self._HOST, error))
+		return None
+
 	def writeEmerg(self, value):
-		if self._socketEmergencyWrite is not None:
-			self._logger.info("PipeReadWrite writeEmerg:%s" % str(value))
-			with self._stateMutex :
-				try:	
-					self._socketEmergencyWrite.send(value)
-					#self._socketWrite.flush()
-				except:
-					exceptionString = get_exception_string()
-					self._logger.error("Unexpected error while writing pipe port: %s" % exceptionString)
+		self._logger.info("PipeReadWrite writeEmerg:%s" % str(value))
+		self._send("_socketEmergencyWrite", value)
 
 	def write(self, value):
-		if self._socketWrite is not None:
-			#lkj self._logger.info("PipeReadWrite write:%s" % value)
+		#lkj self._logger.info("PipeReadWrite write:%s" % value)
+		# batches of lines are handed to us in one go, sendall makes sure they are written completely
+		self._send("_socketWrite", value)
 
-			with self._stateMutex :
-				try:						
-					self._socketWrite.send(value)
-					#self._socketWrite.flush()
-				except:
-					exceptionString = get_exception_string()
-					self._logger.error("Unexpected error while writing pipe port: %s" % exceptionString)
+	def _send(self, name, value):
+		"""
+		Sends ``value`` completely on the socket ``name``, reconnecting if that fails.
+
+		Raises:
+		    IOError: The connection is closed or broken and could not be reestablished.
+		"""
+		while True:
+			generation = self._generation
+			with self._stateMutex:
+				sock = getattr(self, name)
+				if sock is None and self._closed.is_set():
+					raise IOError("Failed to write, connection closed")
+				try:
+					if sock is None:
+						raise IOError("Failed to write, not connected")
+					# bounded by the write timeout, so a daemon that stopped reading can't block us forever
+					sock.sendall(value)
+					return
+				except (IOError, socket.error) as e:
+					error = e
+					self._logger.warn("Error while writing to {}: {}".format(self._HOST, e))
+
+			# whatever got lost on the way will be requested again by the firmware
+			if not self._reconnectAfter(generation, error):
+				raise IOError("Failed to write to {}: {}".format(self._HOST, error))
+
+
+def _closeQuietly(sock):
+	try:
+		sock.close()
+	except:
+		pass
 
 
 # for test
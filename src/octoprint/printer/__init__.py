@@ -230,9 +230,21 @@ class PrinterInterface(object):
 		"""
 		raise NotImplementedError()
 
-	def start_print(self):
+	def start_print(self, pos=None, layer=None):
 		"""
 		Starts printing the currently selected file. If no file is currently selected, does nothing.
+
+		A print can also start in the middle of the file, e.g. to resume a failed print. If started at a ``layer``
+		from the layer index of the file's analysis, the state of the printer at the start of that layer (temperatures,
+		tool, position, extruder position, fan, positioning modes) is restored before.
+
+		Arguments:
+		    pos (int): Byte offset of the line to start printing at. The state of the printer is only restored if this
+		        is the start of a layer.
+		    layer (int): Number of the layer to start printing at, takes precedence over ``pos``.
+
+		Raises:
+		    ValueError: ``layer`` is not in the layer index of the selected file or ``pos`` not within it.
 		"""
 		raise NotImplementedError()
 
@@ -291,6 +303,29 @@ class PrinterInterface(object):
 		"""
 		raise NotImplementedError()
 
+	def get_printer_profile(self):
+		"""
+		Returns:
+		    (dict) The printer profile this printer is currently using, or the default profile if none is selected.
+		"""
+		raise NotImplementedError()
+
+	def get_identifier(self):
+		"""
+		Returns:
+		    (str) The identifier of this printer in the :class:`~octoprint.printer.registry.PrinterRegistry`, included
+		        as ``printer`` in the payload of the events it fires, or ``None`` if it is not registered.
+		"""
+		raise NotImplementedError()
+
+	def get_resend_statistics(self):
+		"""
+		Returns:
+		    (dict) Statistics about the resend requests of the printer during the current print job, or ``None`` if
+		        the printer is currently not connected.
+		"""
+		raise NotImplementedError()
+
 	def is_closed_or_error(self):
 		"""
 		Returns:
@@ -459,6 +494,7 @@ class PrinterCallback(object):
 		        filepos: <current position in the file in bytes>
 		        printTime: <current time elapsed for printing, in seconds>
 		        printTimeLeft: <estimated time left to finish printing, in seconds>
+		        layer: <number of the layer currently printed, if known from the file's analysis>
 		    currentZ: <current position of the z axis, in mm>
 		    offsets: <current configured temperature offsets, keys are "bed" or "tool[0-9]+", values the offset in degC>
 
@@ -470,3 +506,8 @@ class PrinterCallback(object):
 class UnknownScript(Exception):
 	def __init__(self, name, *args, **kwargs):
 		self.name = name
+
+class UnknownPrinter(Exception):
+	def __init__(self, identifier, *args, **kwargs):
+		Exception.__init__(self, "Unknown printer: {}".format(identifier), *args, **kwargs)
+		self.identifier = identifier
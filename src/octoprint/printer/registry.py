@@ -0,0 +1,217 @@
+# coding=utf-8
+"""
+This module contains the :class:`PrinterRegistry`, which allows one server process to host several printers.
+
+Every printer in the registry is a full :class:`~octoprint.printer.PrinterInterface` implementation with its own
+connection and state monitor, while all of them share the file manager, the analysis queue and the slicing manager
+of the server. Printers are identified by a short identifier which is also used in their API routes
+(``/api/printers/<identifier>/...``) and push channels (``/sockjs/printers/<identifier>``). The printer known from
+single printer setups is always registered under :data:`PrinterRegistry.DEFAULT`.
+
+Additional printers are configured in ``config.yaml``:
+
+.. code-block:: yaml
+
+   printers:
+   - id: left
+     name: Left printer
+     port: /dev/ttyACM1
+     baudrate: 250000
+     profile: _default
+     autoconnect: true
+"""
+
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import logging
+import re
+import threading
+
+from collections import OrderedDict
+
+from octoprint.printer import UnknownPrinter
+
+
+_valid_identifier = re.compile("^[a-zA-Z0-9_-]+$")
+
+
+class PrinterRegistry(object):
+	"""
+	Registry of all printers served by this process.
+
+	Arguments:
+	    factory (callable): Called with the identifier of a printer to add, needs to return a new
+	        :class:`~octoprint.printer.PrinterInterface` implementation for it.
+	"""
+
+	DEFAULT = "_default"
+	"""Identifier of the default printer."""
+
+	def __init__(self, factory):
+		self._logger = logging.getLogger(__name__)
+		self._factory = factory
+		self._printers = OrderedDict()
+		self._mutex = threading.RLock()
+
+	def add(self, identifier, name=None, connection=None):
+		"""
+		Creates a new printer and adds it to the registry.
+
+		Arguments:
+		    identifier (str): Identifier of the printer, may only consist of letters, digits, ``_`` and ``-``.
+		    name (str): Human readable name of the printer, defaults to the identifier.
+		    connection (dict): Connection parameters of the printer, may contain ``port``, ``baudrate``, ``profile``
+		        and ``autoconnect``.
+
+		Returns:
+		    PrinterInterface: The newly created printer.
+
+		Raises:
+		    ValueError: The identifier is invalid or already taken.
+		"""
+		if not identifier or not _valid_identifier.match(identifier):
+			raise ValueError("Invalid printer identifier: {!r}".format(identifier))
+
+		with self._mutex:
+			if identifier in self._printers:
+				raise ValueError("There already is a printer with identifier {}".format(identifier))
+
+			printer = self._factory(identifier)
+			self._printers[identifier] = dict(
+				name=name if name else identifier,
+				printer=printer,
+				connection=dict(connection) if connection else dict()
+			)
+
+		self._logger.info("Added printer {}".format(identifier))
+		return printer
+
+	def remove(self, identifier):
+		"""
+		Disconnects the printer identified by ``identifier`` and removes it from the registry.
+
+		Raises:
+		    UnknownPrinter: There is no printer with that identifier.
+		    ValueError: The default printer cannot be removed.
+		"""
+		if identifier == self.DEFAULT:
+			raise ValueError("The default printer cannot be removed")
+
+		with self._mutex:
+			if not identifier in self._printers:
+				raise UnknownPrinter(identifier)
+			entry = self._printers.pop(identifier)
+
+		try:
+			entry["printer"].disconnect()
+		except:
+			self._logger.exception("Error while disconnecting removed printer {}".format(identifier))
+		self._logger.info("Removed printer {}".format(identifier))
+
+	def get(self, identifier=None):
+		"""
+		Arguments:
+		    identifier (str): Identifier of the printer to return, the default printer will be returned if not set.
+
+		Returns:
+		    PrinterInterface: The printer.
+
+		Raises:
+		    UnknownPrinter: There is no printer with that identifier.
+		"""
+		if identifier is None:
+			identifier = self.DEFAULT
+
+		with self._mutex:
+			if not identifier in self._printers:
+				raise UnknownPrinter(identifier)
+			return self._printers[identifier]["printer"]
+
+	@property
+	def default(self):
+		return self.get(self.DEFAULT)
+
+	def get_all(self):
+		"""
+		Returns:
+		    list: One dict per registered printer, in the order they were added, containing ``id``, ``name`` and
+		        ``printer``.
+		"""
+		with self._mutex:
+			return [dict(id=identifier, name=entry["name"], printer=entry["printer"]) for identifier, entry in self._printers.items()]
+
+	def load_from_settings(self, entries):
+		"""
+		Adds all printers configured in ``entries`` (see the ``printers`` setting). Invalid entries are logged and
+		skipped.
+
+		Arguments:
+		    entries (list): List of dicts, each containing at least an ``id``.
+
+		Returns:
+		    list: Identifiers of the printers that were added.
+		"""
+		added = []
+		for entry in entries or []:
+			if not isinstance(entry, dict):
+				self._logger.warn("Ignoring invalid printer configuration: {!r}".format(entry))
+				continue
+
+			identifier = entry.get("id")
+			connection = dict((key, entry[key]) for key in ("port", "baudrate", "profile", "autoconnect") if key in entry)
+			try:
+				self.add(identifier, name=entry.get("name"), connection=connection)
+			except ValueError as e:
+				self._logger.warn("Ignoring printer configuration: {}".format(str(e)))
+				continue
+			added.append(identifier)
+		return added
+
+	def autoconnect(self, available_ports):
+		"""
+		Connects all printers configured to ``autoconnect`` whose port is available.
+
+		Arguments:
+		    available_ports (list): The currently available serial ports.
+		"""
+		with self._mutex:
+			entries = list(self._printers.items())
+
+		for identifier, entry in entries:
+			connection = entry["connection"]
+			if not connection.get("autoconnect", False):
+				continue
+
+			port = connection.get("port")
+			if port is not None and not port in available_ports:
+				self._logger.info("Not autoconnecting printer {}, port {} is not available".format(identifier, port))
+				continue
+
+			entry["printer"].connect(port=port, baudrate=connection.get("baudrate"), profile=connection.get("profile"))
+
+	def reload_plugins(self):
+		"""
+		Makes all printers pick up changes in the registered plugins.
+		"""
+		with self._mutex:
+			printers = [entry["printer"] for entry in self._printers.values()]
+
+		for printer in printers:
+			printer.reload_plugins()
+
+	def __contains__(self, identifier):
+		with self._mutex:
+			return identifier in self._printers
+
+	def __iter__(self):
+		with self._mutex:
+			return iter(list(self._printers.keys()))
+
+	def __len__(self):
+		with self._mutex:
+			return len(self._printers)
@@ -19,13 +19,15 @@ import flask
 import math
 
 from octoprint import util as util
-from octoprint.events import eventManager, Events
+from octoprint.events import eventManager, Events, printer_payload
 from octoprint.filemanager import FileDestinations
+from octoprint.filemanager.analysis import check_print_volume
 from octoprint.plugin import plugin_manager, ProgressPlugin
 from octoprint.printer import PrinterInterface, PrinterCallback, UnknownScript
 from octoprint.printer.estimation import TimeEstimationHelper
 from octoprint.settings import settings
 from octoprint.util import comm as comm
+from octoprint.util.gcodeInterpreter import LayerIndex
 from octoprint.util import InvariantContainer
 
 
@@ -35,10 +37,11 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 	itself with it as a callback to react to changes on the communication layer.
 	"""
 
-	def __init__(self, fileManager, analysisQueue, printerProfileManager):
+	def __init__(self, fileManager, analysisQueue, printerProfileManager, identifier=None):
 		from collections import deque
 
 		self._logger = logging.getLogger(__name__)
+		self._identifier = identifier
 
 		self._analysisQueue = analysisQueue
 		self._fileManager = fileManager
@@ -78,6 +81,8 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 		self._streamingFinishedCallback = None
 
 		self._selectedFile = None
+		self._layerIndex = None
+		self._startProgress = None
 		self._timeEstimationData = None
 		
 		#lkj 
@@ -125,7 +130,7 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 					"volume": None
 				}
 			},
-			progress={"completion": None, "filepos": None, "printTime": None, "printTimeLeft": None},
+			progress={"completion": None, "filepos": None, "printTime": None, "printTimeLeft": None, "layer": None},
 			current_z=None
 		)
 
@@ -199,6 +204,9 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 
 	#~~ progress plugin reporting
 
+	def _fire_event(self, event, payload=None):
+		eventManager().fire(event, printer_payload(self._identifier, payload))
+
 	def _reportPrintProgressToPlugins(self, progress):
 		if not progress or not self._selectedFile or not "sd" in self._selectedFile or not "filename" in self._selectedFile:
 			return
@@ -233,7 +241,7 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 		if self._comm is not None:				
 			self._comm.close()			
 		self._printerProfileManager.select(profile)
-		self._comm = comm.MachineCom(port, baudrate, callbackObject=self, printerProfileManager=self._printerProfileManager)
+		self._comm = comm.MachineCom(port, baudrate, callbackObject=self, printerProfileManager=self._printerProfileManager, printerId=self._identifier)
 		self._last_connect_time = now
 
 	def disconnect(self):
@@ -244,9 +252,18 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 			self._comm.close()
 		self._comm = None
 		self._printerProfileManager.deselect()
-		eventManager().fire(Events.DISCONNECTED)
+		self._fire_event(Events.DISCONNECTED)
 		self._last_read_temp_time = 0
-		
+
+	def reload_plugins(self):
+		"""
+		 Refreshes the registered progress plugins and the communication layer's hooks, e.g. after a plugin got
+		 enabled or disabled.
+		"""
+		self._progressPlugins = plugin_manager().get_implementations(ProgressPlugin)
+		if self._comm is not None:
+			self._comm.reload_hooks()
+
 	def get_transport(self):
 
 		if self._comm is None:
@@ -499,6 +516,10 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 			return
 		print("lkj standard.py select file")		
 		sd = origin == FileDestinations.SDCARD #lkj
+		if not sd:
+			reason = self._check_print_volume(origin, path)
+			if reason is not None:
+				raise ValueError("{path} does not fit into the print volume: {reason}".format(path=path, reason=reason))
 		self._printAfterSelect = printAfterSelect
 		#lkj self._comm.selectFile("/" + path if sd else path, sd)
 		self._comm.selectFile("/" + path if sd else path, origin)
@@ -514,7 +535,7 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 		self._setProgressData(0, None, None, None)
 		self._setCurrentZ(None)
 
-	def start_print(self):
+	def start_print(self, pos=None, layer=None):
 		"""
 		 Starts the currently loaded print job.
 		 Only starts if the printer is connected and operational, not currently printing and a printjob is loaded
@@ -523,6 +544,26 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 			return
 		if self._selectedFile is None:
 			return
+		if not self._selectedFile["sd"]:
+			origin = self._selectedFile["origin"]
+			reason = self._check_print_volume(origin, self._fileManager.path_on_disk(origin, self._selectedFile["filename"]))
+			if reason is not None:
+				raise ValueError("The selected file does not fit into the print volume: {reason}".format(reason=reason))
+
+		checkpoint = None
+		if layer is not None:
+			if self._layerIndex is None or not 0 <= layer < len(self._layerIndex):
+				raise ValueError("layer is not in the layer index of the selected file: {layer}".format(layer=layer))
+			pos = self._layerIndex.get_layer_data(layer)["offset"]
+			checkpoint = self._layerIndex.get_checkpoint(layer)
+		elif pos is not None:
+			if not 0 <= pos < self._selectedFile["filesize"]:
+				raise ValueError("pos is not within the selected file: {pos}".format(pos=pos))
+			if self._layerIndex is not None:
+				# the state is only known at the start of a layer
+				layer = self._layerIndex.get_layer(pos)
+				if layer is not None and self._layerIndex.get_layer_data(layer)["offset"] == pos:
+					checkpoint = self._layerIndex.get_checkpoint(layer)
 
 		rolling_window = None
 		threshold = None
@@ -540,9 +581,15 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 		self._timeEstimationData = TimeEstimationHelper(rolling_window=rolling_window, threshold=threshold, countdown=countdown)
 
 		self._lastProgressReport = None
+		self._startProgress = None
+		if pos:
+			if self._layerIndex is not None:
+				self._startProgress = self._layerIndex.get_progress(pos)
+			elif self._selectedFile["filesize"]:
+				self._startProgress = float(pos) / float(self._selectedFile["filesize"])
 		self._setProgressData(0, None, None, None)
 		self._setCurrentZ(None)
-		self._comm.startPrint()
+		self._comm.startPrint(pos=pos, checkpoint=checkpoint)
 
 	def toggle_pause_print(self):
 		"""
@@ -578,7 +625,7 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 			}
 			if self._selectedFile["sd"]:
 				payload["origin"] = FileDestinations.SDCARD
-			eventManager().fire(Events.PRINT_FAILED, payload)
+			self._fire_event(Events.PRINT_FAILED, payload)
 
 	def get_state_string(self):
 		"""
@@ -630,6 +677,17 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 		printer_profile = self._printerProfileManager.get_current_or_default()
 		return self._comm.getStateString(), port, baudrate, printer_profile
 
+	def get_printer_profile(self):
+		return self._printerProfileManager.get_current_or_default()
+
+	def get_identifier(self):
+		return self._identifier
+
+	def get_resend_statistics(self):
+		if self._comm is None:
+			return None
+		return self._comm.getResendStatistics()
+
 	def is_closed_or_error(self):
 		return self._comm is None or self._comm.isClosedOrError()
 
@@ -737,18 +795,28 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 
 			return result
 
-	def _setProgressData(self, progress, filepos, printTime, cleanedPrintTime):
-		estimatedTotalPrintTime = self._estimateTotalPrintTime(progress, cleanedPrintTime)
+	def _setProgressData(self, progress, filepos, printTime, cleanedPrintTime, layer=None, printTimeLeftEstimate=None):
+		# progress of the part actually printed if the print started in the middle of the file
+		printedProgress = progress
+		if progress and self._startProgress and self._startProgress < 1.0:
+			printedProgress = max(progress - self._startProgress, 0.0) / (1.0 - self._startProgress)
+
+		estimatedTotalPrintTime = self._estimateTotalPrintTime(printedProgress, cleanedPrintTime)
 		totalPrintTime = estimatedTotalPrintTime
 
 		if self._selectedFile and "estimatedPrintTime" in self._selectedFile and self._selectedFile["estimatedPrintTime"]:
 			statisticalTotalPrintTime = self._selectedFile["estimatedPrintTime"]
+			if printTimeLeftEstimate is not None and cleanedPrintTime is not None and self._selectedFile.get("analysisPrintTime"):
+				# the time left according to the layer index of the file, scaled like the statistical print time
+				statisticalTotalPrintTime = cleanedPrintTime + printTimeLeftEstimate * statisticalTotalPrintTime / self._selectedFile["analysisPrintTime"]
+			elif self._startProgress:
+				statisticalTotalPrintTime *= 1.0 - self._startProgress
 			if progress and cleanedPrintTime:
 				if estimatedTotalPrintTime is None:
 					totalPrintTime = statisticalTotalPrintTime
 				else:
-					if progress < 0.5:
-						sub_progress = progress * 2
+					if printedProgress < 0.5:
+						sub_progress = printedProgress * 2
 					else:
 						sub_progress = 1.0
 					totalPrintTime = (1 - sub_progress) * statisticalTotalPrintTime + sub_progress * estimatedTotalPrintTime
@@ -761,7 +829,8 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 			"completion": self._progress * 100 if self._progress is not None else None,
 			"filepos": filepos,
 			"printTime": int(self._printTime) if self._printTime is not None else None,
-			"printTimeLeft": int(self._printTimeLeft) if self._printTimeLeft is not None else None
+			"printTimeLeft": int(self._printTimeLeft) if self._printTimeLeft is not None else None,
+			"layer": layer
 		})
 
 		if progress:
@@ -797,6 +866,7 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 
 	#lkj def _setJobData(self, filename, filesize, sd):
 	def _setJobData(self, filename, filesize, origin):		
+		self._layerIndex = None
 		if filename is not None:
 			print("_setJobData %s" % str(origin))
 			sd = origin == FileDestinations.SDCARD
@@ -815,7 +885,8 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 				"filesize": filesize,
 				"sd": sd,
 			        "origin": origin,   #lkj add
-				"estimatedPrintTime": None
+				"estimatedPrintTime": None,
+				"analysisPrintTime": None
 			}
 		else:
 			self._selectedFile = None
@@ -856,6 +927,10 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 						estimatedPrintTime = fileData["analysis"]["estimatedPrintTime"]
 					if "filament" in fileData["analysis"].keys():
 						filament = fileData["analysis"]["filament"]
+					if "layers" in fileData["analysis"] and estimatedPrintTime and self._comm is not None:
+						self._selectedFile["analysisPrintTime"] = estimatedPrintTime
+						self._layerIndex = LayerIndex(fileData["analysis"]["layers"], estimatedPrintTime, filesize)
+						self._comm.setPrintLayerIndex(self._layerIndex)
 				if "statistics" in fileData:
 					printer_profile = self._printerProfileManager.get_current_or_default()["id"]
 					if "averagePrintTime" in fileData["statistics"] and printer_profile in fileData["statistics"]["averagePrintTime"]:
@@ -897,6 +972,23 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 			sys.stderr.write("ERROR: %s\n" % str(err))
 			pass
 
+	def _check_print_volume(self, origin, path):
+		if not settings().getBoolean(["feature", "printVolumeCheck"]):
+			return None
+
+		try:
+			fileData = self._fileManager.get_metadata(origin, path)
+		except:
+			fileData = None
+		if not fileData or not "analysis" in fileData:
+			return None
+		return check_print_volume(fileData["analysis"], self._printerProfileManager.get_current_or_default())
+
+	def _get_send_latency(self):
+		if self._comm is None:
+			return None
+		return self._comm.getSendLatency()
+
 	def _getStateFlags(self):
 		return {
 			"operational": self.is_operational(),
@@ -947,9 +1039,9 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 				if state == comm.MachineCom.STATE_CLOSED or state == comm.MachineCom.STATE_ERROR or state == comm.MachineCom.STATE_CLOSED_WITH_ERROR:
 					#lkj self._fileManager.log_print(FileDestinations.SDCARD if self._selectedFile["sd"] else FileDestinations.LOCAL, self._selectedFile["filename"], time.time(), self._comm.getPrintTime(), False, self._printerProfileManager.get_current_or_default()["id"])
 					self._fileManager.log_print(self._selectedFile["origin"], self._selectedFile["filename"], time.time(), self._comm.getPrintTime(), False, self._printerProfileManager.get_current_or_default()["id"])
-			self._analysisQueue.resume() # printing done, put those cpu cycles to good use
+			self._analysisQueue.unregister_latency_source(self._get_send_latency) # printing done, put those cpu cycles to good use
 		elif state == comm.MachineCom.STATE_PRINTING:
-			self._analysisQueue.pause() # do not analyse files while printing
+			self._analysisQueue.register_latency_source(self._get_send_latency) # leave the cpu to sending while printing
 		elif state == comm.MachineCom.STATE_CLOSED or state == comm.MachineCom.STATE_CLOSED_WITH_ERROR:
 			if self._comm is not None:
 				self._comm = None
@@ -978,12 +1070,12 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 		progress = self._comm.getPrintProgress()
 		if progress > 0.98:
 			print("lkj on_comm_progress 2")
-			self._setProgressData(self._comm.getPrintProgress(), self._comm.getPrintFilepos(), self._comm.getPrintTime(), self._comm.getCleanedPrintTime())	
+			self._setProgressData(self._comm.getPrintProgress(), self._comm.getPrintFilepos(), self._comm.getPrintTime(), self._comm.getCleanedPrintTime(), layer=self._comm.getPrintLayer(), printTimeLeftEstimate=self._comm.getPrintTimeLeftEstimate())	
 		else:				
 			delta = time.time() - self._progress_update_last			
 			if self._progress_update_interval <= delta :
 				print("lkj on_comm_progress 6")
-				self._setProgressData(self._comm.getPrintProgress(), self._comm.getPrintFilepos(), self._comm.getPrintTime(), self._comm.getCleanedPrintTime())
+				self._setProgressData(self._comm.getPrintProgress(), self._comm.getPrintFilepos(), self._comm.getPrintTime(), self._comm.getCleanedPrintTime(), layer=self._comm.getPrintLayer(), printTimeLeftEstimate=self._comm.getPrintTimeLeftEstimate())
 				self._progress_update_last = time.time()			 
 		#lkj end 
 		#self._setProgressData(self._comm.getPrintProgress(), self._comm.getPrintFilepos(), self._comm.getPrintTime(), self._comm.getCleanedPrintTime())
@@ -997,7 +1089,7 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 		if newZ != oldZ:
 			# we have to react to all z-changes, even those that might "go backward" due to a slicer's retraction or
 			# anti-backlash-routines. Event subscribes should individually take care to filter out "wrong" z-changes
-			eventManager().fire(Events.Z_CHANGE, {"new": newZ, "old": oldZ})
+			self._fire_event(Events.Z_CHANGE, {"new": newZ, "old": oldZ})
 
 		self._setCurrentZ(newZ)
 
@@ -1007,7 +1099,7 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 
 	def on_comm_sd_files(self, files):
 		print("lkj on_comm_sd_files")
-		eventManager().fire(Events.UPDATED_FILES, {"type": "gcode"})
+		self._fire_event(Events.UPDATED_FILES, {"type": "gcode"})
 		self._sdFilelistAvailable.set()
 
 	#lkj def on_comm_file_selected(self, filename, filesize, sd):
@@ -1017,7 +1109,10 @@ class Printer(PrinterInterface, comm.MachineComPrintCallback):
 		self._stateMonitor.set_state({"text": self.get_state_string(), "flags": self._getStateFlags()})
 
 		if self._printAfterSelect:
-			self.start_print()
+			try:
+				self.start_print()
+			except ValueError as e:
+				self._logger.warn("Not starting the print of {filename}: {message}".format(filename=filename, message=str(e)))
 
 	def on_comm_print_job_done(self):
 		print("lkj on_comm_print_job_done")
@@ -6,8 +6,10 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 __copyright__ = "Copyright (C) 2014 The OctoPrint Project - Released under terms of the AGPLv3 License"
 
 import uuid
+import functools
 from sockjs.tornado import SockJSRouter
-from flask import Flask, g, request, session, Blueprint
+from flask import Flask, g, request, session, Blueprint, abort, has_request_context
+from werkzeug.local import LocalProxy
 from flask.ext.login import LoginManager, current_user
 from flask.ext.principal import Principal, Permission, RoleNeed, identity_loaded, UserNeed
 from flask.ext.babel import Babel, gettext, ngettext
@@ -31,7 +33,7 @@ assets = None
 babel = None
 debug = False
 
-printer = None
+printerRegistry = None
 printerProfileManager = None
 fileManager = None
 slicingManager = None
@@ -47,10 +49,19 @@ principals = Principal(app)
 admin_permission = Permission(RoleNeed("admin"))
 user_permission = Permission(RoleNeed("user"))
 
+def _get_current_printer():
+	if has_request_context() and getattr(g, "printer", None) is not None:
+		return g.printer
+	return printerRegistry.default
+
+# the printer addressed by the current request (via /api/printers/<printer_id>/...), the default printer otherwise
+printer = LocalProxy(_get_current_printer)
+
 # only import the octoprint stuff down here, as it might depend on things defined above to be initialized already
 from octoprint.printer import get_connection_options
 from octoprint.printer.profile import PrinterProfileManager
 from octoprint.printer.standard import Printer
+from octoprint.printer.registry import PrinterRegistry
 from octoprint.settings import settings
 import octoprint.users as users
 import octoprint.events as events
@@ -60,6 +71,7 @@ import octoprint._version
 import octoprint.util
 import octoprint.filemanager.storage
 import octoprint.filemanager.analysis
+import octoprint.filemanager.util
 import octoprint.slicing
 
 from . import util
@@ -131,7 +143,7 @@ class Server():
 		global app
 		global babel
 
-		global printer
+		global printerRegistry
 		global printerProfileManager
 		global fileManager
 		global slicingManager
@@ -182,12 +194,29 @@ class Server():
 
 		printerProfileManager = PrinterProfileManager()
 		eventManager = events.eventManager()
-		analysisQueue = octoprint.filemanager.analysis.AnalysisQueue()
+		analysisCache = None
+		if s.getBoolean(["gcodeAnalysis", "cache", "enabled"]):
+			analysisCache = octoprint.filemanager.analysis.AnalysisCache(os.path.join(s.getBaseFolder("data"), "analysis_cache"),
+			                                                             size=s.getInt(["gcodeAnalysis", "cache", "size"]))
+		fileHasher = octoprint.filemanager.util.FileHasher(os.path.join(s.getBaseFolder("data"), "file_hashes.json"),
+		                                                   size=s.getInt(["storage", "hashing", "cacheSize"]),
+		                                                   workers=s.getInt(["storage", "hashing", "workers"]))
+		analysisQueue = octoprint.filemanager.analysis.AnalysisQueue(cache=analysisCache, hasher=fileHasher)
 		slicingManager = octoprint.slicing.SlicingManager(s.getBaseFolder("slicingProfiles"), printerProfileManager)
 		storage_managers = dict()
-		storage_managers[octoprint.filemanager.FileDestinations.LOCAL] = octoprint.filemanager.storage.LocalFileStorage(s.getBaseFolder("uploads"))
+		storage_managers[octoprint.filemanager.FileDestinations.LOCAL] = octoprint.filemanager.storage.LocalFileStorage(s.getBaseFolder("uploads"),
+		                                                                                                               metadata_backend=s.get(["storage", "local", "metadataBackend"]),
+		                                                                                                               metadata_cache_size=s.getInt(["storage", "local", "metadataCacheSize"]),
+		                                                                                                               hasher=fileHasher)
 		fileManager = octoprint.filemanager.FileManager(analysisQueue, slicingManager, printerProfileManager, initial_storage_managers=storage_managers)
-		printer = Printer(fileManager, analysisQueue, printerProfileManager)
+
+		def printer_factory(identifier):
+			# additional printers get a profile manager of their own so that they can each select a different profile
+			profile_manager = printerProfileManager if identifier == PrinterRegistry.DEFAULT else PrinterProfileManager()
+			return Printer(fileManager, analysisQueue, profile_manager, identifier=identifier)
+		printerRegistry = PrinterRegistry(printer_factory)
+		default_printer = printerRegistry.add(PrinterRegistry.DEFAULT, name=s.get(["appearance", "name"]))
+		printerRegistry.load_from_settings(s.get(["printers"]))
 		appSessionManager = util.flask.AppSessionManager()
 		pluginLifecycleManager = LifecycleManager(pluginManager)
 
@@ -201,7 +230,8 @@ class Server():
 				analysis_queue=analysisQueue,
 				slicing_manager=slicingManager,
 				file_manager=fileManager,
-				printer=printer,
+				printer=default_printer,
+				printer_registry=printerRegistry,
 				app_session_manager=appSessionManager,
 				plugin_lifecycle_manager=pluginLifecycleManager,
 				data_folder=os.path.join(settings().getBaseFolder("data"), name)
@@ -258,6 +288,9 @@ class Server():
 		slicingManager.initialize()
 		pluginLifecycleManager.add_callback(["enabled", "disabled"], lambda name, plugin: slicingManager.reload_slicers())
 
+		# make sure the printers pick up changes in the registered plugins too
+		pluginLifecycleManager.add_callback(["enabled", "disabled"], lambda name, plugin: printerRegistry.reload_plugins())
+
 		# setup jinja2
 		self._setup_jinja2()
 		def template_enabled(name, plugin):
@@ -278,7 +311,7 @@ class Server():
 		octoprint.timelapse.configureTimelapse()
 
 		# setup command triggers
-		events.CommandTrigger(printer)
+		events.CommandTrigger(printerRegistry)
 		if self._debug:
 			events.DebugEventListener()
 
@@ -334,6 +367,11 @@ class Server():
 		ioloop.install()
 
 		self._router = SockJSRouter(self._create_socket_connection, "/sockjs")
+		self._printer_routers = dict()
+		for identifier in printerRegistry:
+			if identifier == PrinterRegistry.DEFAULT:
+				continue
+			self._printer_routers[identifier] = SockJSRouter(functools.partial(self._create_socket_connection, printer_id=identifier), "/sockjs/printers/" + identifier)
 
 		upload_suffixes = dict(name=s.get(["server", "uploads", "nameSuffix"]), path=s.get(["server", "uploads", "pathSuffix"]))
 
@@ -358,7 +396,7 @@ class Server():
 				joined.update(d)
 			return joined
 
-		server_routes = self._router.urls + [
+		server_routes = self._router.urls + sum([router.urls for router in self._printer_routers.values()], []) + [
 			# various downloads
 		        #lkj (r"/downloads/files/local/([^/]*\.(gco|gcode|g))", util.tornado.LargeResponseHandler, dict(path=settings().getBaseFolder("uploads"), as_attachment=True)),
 		        (r"/downloadSD", util.tornado.LkjDownFileHandler),		        		        
@@ -391,11 +429,22 @@ class Server():
 						self._logger.debug("Adding additional route {route} handled by handler {handler} and with additional arguments {kwargs!r}".format(**locals()))
 						server_routes.append((route, handler, kwargs))
 
-		server_routes.append((r".*", util.tornado.UploadStorageFallbackHandler, dict(fallback=util.tornado.WsgiInputContainer(app.wsgi_app), file_prefix="octoprint-file-upload-", file_suffix=".tmp", suffixes=upload_suffixes)))
+		def printer_upload_processor(filename, path, content_type=None, printer_id=None):
+			printer_profile = None
+			if printer_id in printerRegistry:
+				printer_profile = printerRegistry.get(printer_id).get_printer_profile()
+			return fileManager.create_upload_processor(filename, path, content_type=content_type, printer_profile=printer_profile)
+
+		# only uploads to the files API are hashed and analyzed while they are received
+		upload_kwargs = dict(fallback=util.tornado.WsgiInputContainer(app.wsgi_app), file_prefix="octoprint-file-upload-", file_suffix=".tmp", suffixes=upload_suffixes)
+		server_routes.append((r"/api/files/[^/]+", util.tornado.UploadStorageFallbackHandler, joined_dict(upload_kwargs, dict(file_processor=fileManager.create_upload_processor))))
+		server_routes.append((r"/api/printers/(?P<printer_id>[^/]+)/files/[^/]+", util.tornado.UploadStorageFallbackHandler, joined_dict(upload_kwargs, dict(file_processor=printer_upload_processor))))
+		server_routes.append((r".*", util.tornado.UploadStorageFallbackHandler, upload_kwargs))
 
 		self._tornado_app = Application(server_routes)
 		max_body_sizes = [
 			("POST", r"/api/files/([^/]*)", s.getInt(["server", "uploads", "maxSize"])),
+			("POST", r"/api/printers/([^/]*)/files/([^/]*)", s.getInt(["server", "uploads", "maxSize"])),
 			("POST", r"/api/languages", 5 * 1024 * 1024)
 		]
 
@@ -430,7 +479,9 @@ class Server():
 			printer_profile = printerProfileManager.get_default()
 			connectionOptions = get_connection_options()
 			if port in connectionOptions["ports"]:
-				printer.connect(port=port, baudrate=baudrate, profile=printer_profile["id"] if "id" in printer_profile else "_default")
+				default_printer.connect(port=port, baudrate=baudrate, profile=printer_profile["id"] if "id" in printer_profile else "_default")
+		if len(printerRegistry) > 1:
+			printerRegistry.autoconnect(get_connection_options()["ports"])
 
 		# start up watchdogs
 		if s.getBoolean(["feature", "pollWatched"]):
@@ -439,7 +490,10 @@ class Server():
 		else:
 			# use os default
 			observer = Observer()
-		observer.schedule(util.watchdog.GcodeWatchdogHandler(fileManager, printer), s.getBaseFolder("watched"))
+		observer.schedule(util.watchdog.GcodeWatchdogHandler(fileManager, default_printer), s.getBaseFolder("watched"))
+		if s.getBoolean(["storage", "local", "watchChanges"]) and not s.getBoolean(["feature", "pollWatched"]):
+			# polling the whole upload folder would cost more than the cached folder scans save
+			storage_managers[octoprint.filemanager.FileDestinations.LOCAL].watch(observer)
 		observer.start()
 
 		# run our startup plugins
@@ -506,9 +560,9 @@ class Server():
 			self._logger.fatal("Now that is embarrassing... Something really really went wrong here. Please report this including the stacktrace below in OctoPrint's bugtracker. Thanks!")
 			self._logger.exception("Stacktrace follows:")
 
-	def _create_socket_connection(self, session):
-		global printer, fileManager, analysisQueue, userManager, eventManager
-		return util.sockjs.PrinterStateConnection(printer, fileManager, analysisQueue, userManager, eventManager, pluginManager, session)
+	def _create_socket_connection(self, session, printer_id=None):
+		global printerRegistry, fileManager, analysisQueue, userManager, eventManager
+		return util.sockjs.PrinterStateConnection(printerRegistry.get(printer_id), fileManager, analysisQueue, userManager, eventManager, pluginManager, session)
 
 	def _check_for_root(self):
 		if "geteuid" in dir(os) and os.geteuid() == 0:
@@ -696,6 +750,9 @@ class Server():
 		app.register_blueprint(api, url_prefix="/api")
 		app.register_blueprint(apps, url_prefix="/apps")
 
+		# make the printer specific parts of the API also available per printer
+		self._register_printer_routes()
+
 		# also register any blueprints defined in BlueprintPlugins
 		self._register_blueprint_plugins()
 
@@ -708,6 +765,30 @@ class Server():
 		pluginLifecycleManager.add_callback("enabled", clear_apps)
 		pluginLifecycleManager.add_callback("disabled", clear_apps)
 
+	def _register_printer_routes(self):
+		printer_prefixes = ("/api/connection", "/api/printer", "/api/job", "/api/files")
+
+		def is_printer_rule(rule):
+			return any(rule == prefix or rule.startswith(prefix + "/") for prefix in printer_prefixes)
+
+		for rule in list(app.url_map.iter_rules()):
+			if not is_printer_rule(rule.rule):
+				continue
+			app.add_url_rule("/api/printers/<string:printer_id>" + rule.rule[len("/api"):],
+			                 endpoint=rule.endpoint,
+			                 view_func=app.view_functions[rule.endpoint],
+			                 methods=rule.methods)
+
+		@app.url_value_preprocessor
+		def select_printer(endpoint, values):
+			if not values or not "printer_id" in values:
+				return
+
+			identifier = values.pop("printer_id")
+			if not identifier in printerRegistry:
+				abort(404)
+			g.printer = printerRegistry.get(identifier)
+
 	def _register_blueprint_plugins(self):
 		blueprint_plugins = octoprint.plugin.plugin_manager().get_implementations(octoprint.plugin.BlueprintPlugin)
 		for plugin in blueprint_plugins:
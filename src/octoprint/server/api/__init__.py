@@ -28,6 +28,7 @@ from octoprint.server.util.flask import restricted_access, get_json_command_from
 api = Blueprint("api", __name__)
 
 from . import printer as api_printer
+from . import printers as api_printers
 from . import job as api_job
 from . import connection as api_connection
 from . import files as api_files
@@ -59,7 +60,7 @@ def pluginData(name):
 		return make_response("More than one api provider registered for {name}, can't proceed".format(name=name), 500)
 
 	api_plugin = api_plugins[0]
-	if api_plugin.is_api_adminonly() and not current_user.is_admin():
+	if api_plugin.is_api_adminonly() and (current_user is None or current_user.is_anonymous() or not current_user.is_admin()):
 		return make_response("Forbidden", 403)
 
 	response = api_plugin.on_api_get(request)
@@ -141,6 +142,16 @@ def apiVersion():
 		"api": VERSION
 	})
 
+#~~ diagnostics
+
+
+@api.route("/system/diagnostics", methods=["GET"])
+@restricted_access
+@admin_permission.require(403)
+def getDiagnostics():
+	return jsonify(files=octoprint.server.fileManager.get_diagnostics(),
+	               analysis=dict(cache=octoprint.server.analysisQueue.cache_stats))
+
 #~~ system control
 
 
@@ -5,6 +5,8 @@ __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
 __copyright__ = "Copyright (C) 2014 The OctoPrint Project - Released under terms of the AGPLv3 License"
 
+import logging
+
 from flask import request, jsonify, make_response, url_for
 
 from octoprint.filemanager.destinations import FileDestinations
@@ -12,7 +14,7 @@ from octoprint.settings import settings, valid_boolean_trues
 from octoprint.server import printer, fileManager, slicingManager, eventManager, NO_CONTENT
 from octoprint.server.util.flask import restricted_access, get_json_command_from_request
 from octoprint.server.api import api
-from octoprint.events import Events
+from octoprint.events import Events, printer_payload
 import octoprint.filemanager
 import octoprint.filemanager.util
 import octoprint.slicing
@@ -61,14 +63,14 @@ def readGcodeFilesForOrigin(origin):
 
 
 def _getFileDetails(origin, filename):
-	files = _getFileList(origin)
+	files = _getFileList(origin, layers=True)
 	for file in files:
 		if file["name"] == filename:
 			return file
 	return None
 
 
-def _getFileList(origin, filter=None):
+def _getFileList(origin, filter=None, layers=False):
 	if origin == FileDestinations.SDCARD:
 		sdFileList = printer.get_sd_files()
 
@@ -111,6 +113,9 @@ def _getFileList(origin, filter=None):
 			if "analysis" in file and octoprint.filemanager.valid_file_type(file["name"], type="gcode"):
 				file["gcodeAnalysis"] = file["analysis"]
 				del file["analysis"]
+				if not layers and "layers" in file["gcodeAnalysis"]:
+					# the layer index is only part of the details of a single file
+					file["gcodeAnalysis"] = dict((key, value) for key, value in file["gcodeAnalysis"].items() if key != "layers")
 
 			if "history" in file and octoprint.filemanager.valid_file_type(file["name"], type="gcode"):
 				# convert print log
@@ -328,9 +333,12 @@ def uploadFastBotSDCARD(target):
 		exact file is already selected, such reloading it.
 		"""
 		if octoprint.filemanager.valid_file_type(added_file, "gcode") and (selectAfterUpload or printAfterSelect or (currentFilename == filename and currentOrigin == destination)):
-			printer.select_file(absFilename, destination == FileDestinations.FastbotSDCARD, printAfterSelect)
+			try:
+				printer.select_file(absFilename, destination == FileDestinations.FastbotSDCARD, printAfterSelect)
+			except ValueError as e:
+				logging.getLogger(__name__).warn("Not selecting {}: {}".format(filename, str(e)))
 	print("lkj uploadGcodeFile 6")		
-	added_file = fileManager.add_file(FileDestinations.FastbotSDCARD, upload.filename, upload, allow_overwrite=True)
+	added_file = fileManager.add_file(FileDestinations.FastbotSDCARD, upload.filename, upload, allow_overwrite=True, printer_profile=printer.get_printer_profile())
 	if added_file is None:
 		return make_response("Could not upload the file %s" % upload.filename, 500)
 	
@@ -345,7 +353,7 @@ def uploadFastBotSDCARD(target):
 
 	sdFilename = filename
 
-	eventManager.fire(Events.UPLOAD, {"file": filename, "target": target})
+	eventManager.fire(Events.UPLOAD, printer_payload(printer.get_identifier(), {"file": filename, "target": target}))
 
 	files = {}
 	'''
@@ -471,9 +479,12 @@ def uploadGcodeFile(target):
 		exact file is already selected, such reloading it.
 		"""
 		if octoprint.filemanager.valid_file_type(added_file, "gcode") and (selectAfterUpload or printAfterSelect or (currentFilename == filename and currentOrigin == destination)):
-			printer.select_file(absFilename, destination == FileDestinations.SDCARD, printAfterSelect)
+			try:
+				printer.select_file(absFilename, destination == FileDestinations.SDCARD, printAfterSelect)
+			except ValueError as e:
+				logging.getLogger(__name__).warn("Not selecting {}: {}".format(filename, str(e)))
 
-	added_file = fileManager.add_file(FileDestinations.LOCAL, upload.filename, upload, allow_overwrite=True)
+	added_file = fileManager.add_file(FileDestinations.LOCAL, upload.filename, upload, allow_overwrite=True, printer_profile=printer.get_printer_profile())
 	if added_file is None:
 		return make_response("Could not upload the file %s" % upload.filename, 500)
 	if octoprint.filemanager.valid_file_type(added_file, "stl"):
@@ -491,7 +502,7 @@ def uploadGcodeFile(target):
 	if isinstance(filename, tuple):
 		filename, sdFilename = filename
 
-	eventManager.fire(Events.UPLOAD, {"file": filename, "target": target})
+	eventManager.fire(Events.UPLOAD, printer_payload(printer.get_identifier(), {"file": filename, "target": target}))
 
 	files = {}
 	location = url_for(".readGcodeFile", target=FileDestinations.LOCAL, filename=filename, _external=True)
@@ -566,7 +577,10 @@ def gcodeFileCommand(filename, target):
 		else:
 			filenameToSelect = fileManager.path_on_disk(target, filename)
 		#lkj printer.select_file(filenameToSelect, sd, printAfterLoading)
-		printer.select_file(filenameToSelect, target, printAfterLoading)
+		try:
+			printer.select_file(filenameToSelect, target, printAfterLoading)
+		except ValueError as e:
+			return make_response(str(e), 409)
 
 	elif command == "slice":
 		try:
@@ -647,7 +661,10 @@ def gcodeFileCommand(filename, target):
 					sd = True
 				else:
 					filenameToSelect = fileManager.path_on_disk(target, gcode_name)
-				printer.select_file(filenameToSelect, sd, print_after_slicing)
+				try:
+					printer.select_file(filenameToSelect, sd, print_after_slicing)
+				except ValueError as e:
+					logging.getLogger(__name__).warn("Not selecting {}: {}".format(gcode_name, str(e)))
 
 		try:
 			fileManager.slice(slicer, target, filename, target, gcode_name,
@@ -35,7 +35,19 @@ def controlJob():
 	if command == "start":
 		if activePrintjob:
 			return make_response("Printer already has an active print job, did you mean 'restart'?", 409)
-		printer.start_print()
+
+		start = dict()
+		for key in ("pos", "layer"):
+			if key in data:
+				try:
+					start[key] = int(data[key])
+				except (ValueError, TypeError):
+					return make_response("Not a number for %s: %r" % (key, data[key]), 400)
+
+		try:
+			printer.start_print(**start)
+		except ValueError as e:
+			return make_response("Cannot start print: %s" % str(e), 400)
 	elif command == "restart":
 		if not printer.is_paused():
 			return make_response("Printer does not have an active print job or is not paused", 409)
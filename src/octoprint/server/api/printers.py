@@ -0,0 +1,28 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+from flask import jsonify, url_for
+
+import octoprint.server
+from octoprint.server.api import api
+
+
+@api.route("/printers", methods=["GET"])
+def getPrinters():
+	printers = []
+	for entry in octoprint.server.printerRegistry.get_all():
+		state, port, baudrate, printer_profile = entry["printer"].get_current_connection()
+		printers.append({
+			"id": entry["id"],
+			"name": entry["name"],
+			"state": state,
+			"port": port,
+			"baudrate": baudrate,
+			"printerProfile": printer_profile["id"] if printer_profile is not None and "id" in printer_profile else "_default",
+			"resource": url_for(".connectionState", printer_id=entry["id"], _external=True)
+		})
+	return jsonify(printers=printers)
@@ -122,12 +122,19 @@ class UploadStorageFallbackHandler(tornado.web.RequestHandler):
 
 	The underlying application can then access the contained files via their respective paths and just move them
 	where necessary.
+
+	If a ``file_processor`` is supplied, it is called with the ``filename``, the ``path`` of the temporary file and
+	the ``content_type`` for each file in the request body, plus the named groups of the route as keyword arguments,
+	and may return a processor object, whose ``update`` method
+	is then called with each chunk of the file's contents as it is received, ``finish`` once the file has been
+	received completely and ``close`` once the request has been handled or the connection was closed. That allows
+	processing uploads while they are received instead of reading the temporary files again afterwards.
 	"""
 
 	BODY_METHODS = ("POST", "PATCH", "PUT")
 	""" The request methods that may contain a request body. """
 
-	def initialize(self, fallback, file_prefix="tmp", file_suffix="", path=None, suffixes=None):
+	def initialize(self, fallback, file_prefix="tmp", file_suffix="", path=None, suffixes=None, file_processor=None):
 		if not suffixes:
 			suffixes = dict()
 
@@ -135,6 +142,7 @@ class UploadStorageFallbackHandler(tornado.web.RequestHandler):
 		self._file_prefix = file_prefix
 		self._file_suffix = file_suffix
 		self._path = path
+		self._file_processor = file_processor
 
 		self._suffixes = dict((key, key) for key in ("name", "path", "content_type", "size"))
 		for suffix_type, suffix in suffixes.iteritems():
@@ -144,6 +152,7 @@ class UploadStorageFallbackHandler(tornado.web.RequestHandler):
 		# Parts, files and values will be stored here
 		self._parts = dict()
 		self._files = []
+		self._processors = []
 
 		# Part currently being processed
 		self._current_part = None
@@ -299,6 +308,7 @@ class UploadStorageFallbackHandler(tornado.web.RequestHandler):
 		* ``content_type``: content type of the part
 		* ``file``: file handle for the temporary file (mode "wb", not deleted on close, will be deleted however after
 		  handling of the request has finished in :func:`_handle_method`)
+		* ``processor``: the processor created by the ``file_processor`` for the file, if any
 
 		Structure of ``data`` parts:
 
@@ -315,12 +325,24 @@ class UploadStorageFallbackHandler(tornado.web.RequestHandler):
 			# this is a file
 			import tempfile
 			handle = tempfile.NamedTemporaryFile(mode="wb", prefix=self._file_prefix, suffix=self._file_suffix, dir=self._path, delete=False)
-			return dict(name=tornado.escape.utf8(name),
+			part = dict(name=tornado.escape.utf8(name),
 						filename=tornado.escape.utf8(filename),
 						path=tornado.escape.utf8(handle.name),
 						content_type=tornado.escape.utf8(content_type),
 						file=handle)
 
+			if self._file_processor is not None:
+				try:
+					processor = self._file_processor(part["filename"], part["path"], part["content_type"], **self.path_kwargs)
+				except:
+					self._logger.exception("Error while creating processor for uploaded file {}".format(filename))
+				else:
+					if processor is not None:
+						part["processor"] = processor
+						self._processors.append(processor)
+
+			return part
+
 		else:
 			return dict(name=tornado.escape.utf8(name), content_type=content_type, data=b"")
 
@@ -333,6 +355,8 @@ class UploadStorageFallbackHandler(tornado.web.RequestHandler):
 		"""
 		if "file" in part:
 			part["file"].write(data)
+			if "processor" in part:
+				part["processor"].update(data)
 		else:
 			part["data"] += data
 
@@ -349,6 +373,9 @@ class UploadStorageFallbackHandler(tornado.web.RequestHandler):
 			self._files.append(part["path"])
 			part["file"].close()
 			del part["file"]
+			if "processor" in part:
+				part["processor"].finish()
+				del part["processor"]
 
 	def _on_request_body_finish(self):
 		"""
@@ -419,6 +446,19 @@ class UploadStorageFallbackHandler(tornado.web.RequestHandler):
 			# make sure the temporary files are removed again
 			for f in self._files:
 				octoprint.util.silent_remove(f)
+			self._close_processors()
+
+	def on_connection_close(self):
+		tornado.web.RequestHandler.on_connection_close(self)
+		self._close_processors()
+
+	def _close_processors(self):
+		processors, self._processors = self._processors, []
+		for processor in processors:
+			try:
+				processor.close()
+			except:
+				self._logger.exception("Error while closing processor {}".format(processor))
 
 	# make all http methods trigger _handle_method
 	get = _handle_method
@@ -85,7 +85,24 @@ default_settings = {
 			"sdStatus": 1
 		},
 		"additionalPorts": [],
-		"longRunningCommands": ["G4", "G28", "G29", "G30", "G32"]
+		"longRunningCommands": ["G4", "G28", "G29", "G30", "G32"],
+		"advancedStreaming": {
+			"enabled": False,
+			"maxLines": 4,
+			"rxBuffer": 127
+		},
+		"readAhead": {
+			"enabled": True,
+			"lines": 500,
+			"blockSize": 64 * 1024
+		},
+		"sdTransfer": {
+			"batched": False,
+			"maxLines": 4,
+			"rxBuffer": 127
+		},
+		"resendHistory": 2000,
+		"eventLoop": False
 	},
 	"server": {
 		"host": "0.0.0.0",
@@ -139,7 +156,38 @@ default_settings = {
 		"sizeThreshold": 20 * 1024 * 1024, # 20MB
 	},
 	"gcodeAnalysis": {
-		"maxExtruders": 10
+		"maxExtruders": 10,
+		"estimator": "legacy",
+		"parallel": {
+			"enabled": False,
+			"processes": None,
+			"minChunkSize": 5 * 1024 * 1024
+		},
+		"cache": {
+			"enabled": True,
+			"size": 1000
+		},
+		"streaming": {
+			"enabled": True,
+			"maxBacklog": 16 * 1024 * 1024
+		},
+		"throttle": {
+			"enabled": True,
+			"printingBudget": 0.25,
+			"maxSendLatency": 0.02,
+			"maxLoad": 1.5
+		}
+	},
+	"storage": {
+		"local": {
+			"metadataBackend": "yaml",
+			"metadataCacheSize": 4 * 1024 * 1024,
+			"watchChanges": True
+		},
+		"hashing": {
+			"workers": 2,
+			"cacheSize": 10000
+		}
 	},
 	"feature": {
 		"temperatureGraph": True,
@@ -156,7 +204,8 @@ default_settings = {
 		"keyboardControl": True,
 		"pollWatched": False,
 		"ignoreIdenticalResends": False,
-		"identicalResendsCountdown": 7
+		"identicalResendsCountdown": 7,
+		"printVolumeCheck": True
 	},
 	"folder": {
 		"uploads": None,
@@ -220,6 +269,7 @@ default_settings = {
 		}
 	},
 	"controls": [],
+	"printers": [],
 	"system": {
 		"actions": []
 	},
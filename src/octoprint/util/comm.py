@@ -6,6 +6,8 @@ __copyright__ = "Copyright (C) 2013 David Braam - Released under terms of the AG
 
 
 import os
+import io
+import codecs
 import glob
 import time
 import re
@@ -14,6 +16,9 @@ import Queue as queue
 import logging
 import serial
 import octoprint.plugin
+import octoprint.util.framing as framing
+import octoprint.util.eventloop as eventloop
+import octoprint.util.tokenizer as tokenizer
 
 from collections import deque
 
@@ -21,7 +26,7 @@ from octoprint.util.avr_isp import stk500v2
 from octoprint.util.avr_isp import ispBase
 
 from octoprint.settings import settings, default_settings
-from octoprint.events import eventManager, Events
+from octoprint.events import eventManager, Events, printer_payload
 from octoprint.filemanager import valid_file_type
 from octoprint.filemanager.destinations import FileDestinations
 from octoprint.util import get_exception_string, sanitize_ascii, filter_non_ascii, CountedEvent, RepeatedTimer, to_unicode, bom_aware_open
@@ -104,6 +109,42 @@ Groups will be as follows:
   * ``target``: new target temperature (float)
 """
 
+regex_line_prefix = re.compile("(?P<debug>//)|(?P<error>Error:|!!)|(?P<ok>ok)|(?P<wait>wait)|(?P<resend>[Rr][Ee][Ss][Ee][Nn][Dd]|[Rr][Ss])|(?P<busy>echo:busy)")
+"""Regex matching the prefixes of received lines that determine their type, see :func:`classify_line`."""
+
+regex_temperature_report = re.compile("(^| )(T0?|B):")
+"""Regex matching lines that contain a temperature report."""
+
+sd_message_keywords = ["SD init fail", "volume.init failed", "openRoot failed", "Not SD printing", "SD card ok",
+                       "Begin file list", "End file list", "SD printing byte", "File opened", "File selected",
+                       "Writing to file", "print done", "Done printing file", "Done saving file", "File deleted"]
+"""Keywords identifying SD card related messages from the firmware."""
+
+regex_sd_message = re.compile("|".join(map(re.escape, sd_message_keywords)))
+"""Regex matching any of the :data:`sd_message_keywords`."""
+
+LINE_EMPTY = "empty"
+LINE_DEBUG = "debug"
+LINE_ACTION = "action"
+LINE_ERROR = "error"
+LINE_OK = "ok"
+LINE_WAIT = "wait"
+LINE_RESEND = "resend"
+LINE_BUSY = "busy"
+LINE_TEMPERATURE = "temperature"
+LINE_TARGET_TEMPERATURE = "target_temperature"
+LINE_SD = "sd"
+LINE_MESSAGE = "message"
+
+regex_gcode_handler = re.compile("^_gcode_(?P<gcode>[GMT]\d*)_(?P<phase>queuing|queued|sending|sent)$")
+"""Regex matching the names of :class:`MachineCom`'s GCODE specific command phase handlers.
+
+Groups will be as follows:
+
+  * ``gcode``: the GCODE command the handler is responsible for (str)
+  * ``phase``: the command phase the handler is responsible for (str)
+"""
+
 def serialList():
 	baselist=[]
 	if os.name=="nt":
@@ -143,6 +184,27 @@ def baudrateList():
 		ret.insert(0, prev)
 	return ret
 
+def gcode_hook_filter(*gcodes):
+	"""
+	Decorator for handlers of the ``octoprint.comm.protocol.gcode.*`` hooks, declaring the GCODE commands the
+	handler is interested in. The handler will then only be called for commands matching one of the provided
+	GCODE identifiers (as returned by :func:`gcode_command_for_cmd`, e.g. ``"G28"``, ``"M104"`` or ``"T"``),
+	everything else will bypass it. Handlers without such a declaration are called for every command.
+
+	Example::
+
+	    @gcode_hook_filter("M104", "M109")
+	    def rewrite_temperatures(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+	        ...
+
+	Arguments:
+	    gcodes (str): The GCODE identifiers the decorated handler is interested in.
+	"""
+	def decorator(f):
+		f.gcodes = frozenset(gcodes)
+		return f
+	return decorator
+
 gcodeToEvent = {
 	# pause for user input
 	"M226": Events.WAITING,
@@ -193,9 +255,10 @@ class MachineCom(object):
 	HEAT_OK = "heat_ok"
 	HEAT_END = "heat_end"	
 
-	def __init__(self, port = None, baudrate=None, callbackObject=None, printerProfileManager=None):
+	def __init__(self, port = None, baudrate=None, callbackObject=None, printerProfileManager=None, printerId=None):
 		self._logger = logging.getLogger(__name__)
 		self._serialLogger = logging.getLogger("SERIAL")
+		self._printer_id = printerId
 
 		if port == None:
 			port = settings().get(["serial", "port"])
@@ -227,6 +290,10 @@ class MachineCom(object):
 		self._pauseWaitTimeLost = 0.0
 		self._currentTool = 0
 
+		# latency between an acknowledgement while printing and sending the next line, see getSendLatency
+		self._ok_time = None
+		self._send_latency = None
+
 		self._long_running_command = False
 		self._heating = False
 		self._connection_closing = False
@@ -239,33 +306,55 @@ class MachineCom(object):
 		self._currentLine = 1
 		self._line_mutex = threading.RLock()
 		self._resendDelta = None
-		self._lastLines = deque([], 50)
+		self._lastLines = LineHistory(settings().getInt(["serial", "resendHistory"]))
+		self._resend_statistics = ResendStatistics()
 		self._lastCommError = None
 		self._lastResendNumber = None
 		self._currentResendCount = 0
+		self._resend_duplicates = 0
 		self._resendSwallowNextOk = False
 		self._resendSwallowRepetitions = settings().getBoolean(["feature", "ignoreIdenticalResends"])
 		self._resendSwallowRepetitionsCounter = 0
 
 		self._clear_to_send = CountedEvent(max=10, name="comm.clear_to_send")
 		self._send_queue = TypedQueue()
+
+		# advanced streaming: keep several lines in flight against the firmware's receive buffer
+		# instead of waiting for an "ok" after each line
+		self._streaming_window = None
+		if settings().getBoolean(["serial", "advancedStreaming", "enabled"]):
+			self._streaming_window = SendWindow(settings().getInt(["serial", "advancedStreaming", "maxLines"]),
+			                                    settings().getInt(["serial", "advancedStreaming", "rxBuffer"]))
+
+		# batched file transfer to the printer's SD: send as many lines as fit into the firmware's receive buffer
+		# in one go, then wait until all of them have been acknowledged
+		self._transfer_batched = settings().getBoolean(["serial", "sdTransfer", "batched"])
+		self._transfer_max_lines = settings().getInt(["serial", "sdTransfer", "maxLines"])
+		self._transfer_max_bytes = settings().getInt(["serial", "sdTransfer", "rxBuffer"])
+		self._transfer_outstanding = 0
+		self._transfer_pending = None
+
+		# event loop: read, send and poll on a loop shared by all connections instead of in threads of our own
+		self._event_loop = None
+		self._event_loop_attached = False
+		self._serial_fd = None
+		self._serial_write_fd = None
+		self._write_buffer = ""
+		self._receive_buffer = None
+		self._received_lines = deque()
+		self._received_data = False
+		self._receive_timeout_timer = None
+		if settings().getBoolean(["serial", "eventLoop"]):
+			self._event_loop = eventloop.default_loop()
+
 		self._temperature_timer = None
 		self._sd_status_timer = None
 		self._errorValue = "error"
 
 		# hooks
 		self._pluginManager = octoprint.plugin.plugin_manager()
-
-		self._gcode_hooks = dict(
-			queuing=self._pluginManager.get_hooks("octoprint.comm.protocol.gcode.queuing"),
-			queued=self._pluginManager.get_hooks("octoprint.comm.protocol.gcode.queued"),
-			sending=self._pluginManager.get_hooks("octoprint.comm.protocol.gcode.sending"),
-			sent=self._pluginManager.get_hooks("octoprint.comm.protocol.gcode.sent")
-		)
-
-		self._printer_action_hooks = self._pluginManager.get_hooks("octoprint.comm.protocol.action")
-		self._gcodescript_hooks = self._pluginManager.get_hooks("octoprint.comm.protocol.scripts")
-		self._serial_factory_hooks = self._pluginManager.get_hooks("octoprint.comm.transport.serial.factory")
+		self._gcode_dispatch = dict()
+		self.reload_hooks()
 
 		# SD status data
 		self._sdEnabled = True  #lkj settings().getBoolean(["feature", "sdSupport"])
@@ -299,21 +388,46 @@ class MachineCom(object):
 		self._sendNextLock = threading.Lock()
 		self._sendingLock = threading.RLock()
 
-		# monitoring thread
 		self._monitoring_active = True
-		self.monitoring_thread = threading.Thread(target=self._monitor, name="comm._monitor")
-		self.monitoring_thread.daemon = True
-		self.monitoring_thread.start()
-
-		# sending thread
 		self._send_queue_active = True
-		self.sending_thread = threading.Thread(target=self._send_loop, name="comm.sending_thread")
-		self.sending_thread.daemon = True
-		self.sending_thread.start()
+		self.sending_thread = None
+
+		if self._event_loop is not None:
+			# opening the connection might block, so that still happens in a thread of its own, after that the
+			# connection will be served by the event loop
+			self.monitoring_thread = threading.Thread(target=self._monitor_event_loop, name="comm._monitor")
+			self.monitoring_thread.daemon = True
+			self.monitoring_thread.start()
+		else:
+			# monitoring thread
+			self.monitoring_thread = threading.Thread(target=self._monitor, name="comm._monitor")
+			self.monitoring_thread.daemon = True
+			self.monitoring_thread.start()
+
+			# sending thread
+			self._start_send_loop()
 
 	def __del__(self):
 		self.close()
 
+	def reload_hooks(self):
+		"""
+		Fetches all registered hook handlers from the plugin manager again and rebuilds the GCODE dispatch table
+		from them. Needs to be called whenever plugins get enabled or disabled.
+		"""
+		self._gcode_hooks = dict(
+			queuing=self._pluginManager.get_hooks("octoprint.comm.protocol.gcode.queuing"),
+			queued=self._pluginManager.get_hooks("octoprint.comm.protocol.gcode.queued"),
+			sending=self._pluginManager.get_hooks("octoprint.comm.protocol.gcode.sending"),
+			sent=self._pluginManager.get_hooks("octoprint.comm.protocol.gcode.sent")
+		)
+
+		self._printer_action_hooks = self._pluginManager.get_hooks("octoprint.comm.protocol.action")
+		self._gcodescript_hooks = self._pluginManager.get_hooks("octoprint.comm.protocol.scripts")
+		self._serial_factory_hooks = self._pluginManager.get_hooks("octoprint.comm.transport.serial.factory")
+
+		self._gcode_dispatch = self._build_gcode_dispatch()
+
 	##~~ internal state management
 
 	def _changeState(self, newState):
@@ -323,6 +437,9 @@ class MachineCom(object):
 		if self._state == newState:
 			return
 
+		if newState == self.STATE_ERROR and self._currentFile is not None:
+			self._currentFile.close()
+
 		if newState == self.STATE_CLOSED or newState == self.STATE_CLOSED_WITH_ERROR:
 			if settings().get(["feature", "sdSupport"]):
 				self._sdFileList = False
@@ -341,8 +458,9 @@ class MachineCom(object):
 		self._callback.on_comm_log(message)
 		self._serialLogger.debug(message)
 
-	def _addToLastLines(self, cmd):
-		self._lastLines.append(cmd)
+	def _addToLastLines(self, linenumber, cmd):
+		self._lastLines.add(linenumber, cmd)
+		self._resend_statistics.sent += 1
 
 	##~~ getters
 
@@ -425,6 +543,29 @@ class MachineCom(object):
 			return None
 		return self._currentFile.getFilepos()
 
+	def getPrintLayer(self):
+		if self._currentFile is None:
+			return None
+		return self._currentFile.getLayer()
+
+	def getPrintTimeLeftEstimate(self):
+		if self._currentFile is None:
+			return None
+		return self._currentFile.getEstimatedTimeLeft()
+
+	def getSendLatency(self):
+		"""
+		Returns:
+		    float: The (smoothed) time in seconds between receiving an acknowledgement while printing and sending the
+		        next line, that is how long the printer waits for the host. None if nothing was sent in response to
+		        an acknowledgement during the current print yet.
+		"""
+		return self._send_latency
+
+	def setPrintLayerIndex(self, layer_index):
+		if isinstance(self._currentFile, PrintingGcodeFileInformation):
+			self._currentFile.setLayerIndex(layer_index)
+
 	def getPrintTime(self):
 		if self._currentFile is None or self._currentFile.getStartTime() is None:
 			return None
@@ -456,6 +597,14 @@ class MachineCom(object):
 	def getConnection(self):
 		return self._port, self._baudrate
 
+	def getResendStatistics(self):
+		"""
+		Returns:
+		    dict: Statistics about the resend requests received since the current print job was started, see
+		        :meth:`ResendStatistics.as_dict`.
+		"""
+		return self._resend_statistics.as_dict()
+
 	def getTransport(self):
 		return self._serial
 
@@ -480,6 +629,11 @@ class MachineCom(object):
 
 		self._monitoring_active = False
 		self._send_queue_active = False
+		if self._event_loop is not None:
+			self._detach_from_event_loop()
+		if self._streaming_window is not None:
+			# wakes up the send loop if it's currently waiting for room in the window
+			self._streaming_window.reset()
 
 		printing = self.isPrinting() or self.isPaused()
 		if self._serial is not None:
@@ -505,8 +659,11 @@ class MachineCom(object):
 					"filename": os.path.basename(self._currentFile.getFilename()),
 					"origin": self._currentFile.getFileLocation()
 				}
-			eventManager().fire(Events.PRINT_FAILED, payload)
-		eventManager().fire(Events.DISCONNECTED)
+			self._fire_event(Events.PRINT_FAILED, payload)
+		self._fire_event(Events.DISCONNECTED)
+
+	def _fire_event(self, event, payload=None):
+		eventManager().fire(event, printer_payload(self._printer_id, payload))
 
 	def setTemperatureOffset(self, offsets):
 		self._tempOffsets.update(offsets)
@@ -586,7 +743,15 @@ class MachineCom(object):
 			self.sendCommand(line)
 		return "\n".join(scriptLines)
 
-	def startPrint(self):
+	def startPrint(self, pos=None, checkpoint=None):
+		"""
+		Starts printing the selected file.
+
+		Arguments:
+		    pos (int): Byte offset of the line to start printing at, defaults to the start of the file.
+		    checkpoint (dict): State of the printer at ``pos`` to restore before printing (see
+		        :func:`checkpoint_commands`), e.g. when resuming a failed print at the start of a layer.
+		"""
 		if not self.isOperational() or self.isPrinting():
 			return
 
@@ -594,10 +759,15 @@ class MachineCom(object):
 			raise ValueError("No file selected for printing")
 
 		self._send_M84 = False
+		if self._streaming_window is not None:
+			self._streaming_window.reset()
+		self._resend_statistics.reset()
 		self._heatupWaitStartTime = None
 		self._heatupWaitTimeLost = 0.0
 		self._pauseWaitStartTime = 0
 		self._pauseWaitTimeLost = 0.0
+		self._ok_time = None
+		self._send_latency = None
 		
 		self._heatup_status = self.__class__.HEAT_END
 		self._finish_send_file = False
@@ -624,6 +794,8 @@ class MachineCom(object):
 			self.wait_heat_bed_gcode = False	
 			
 		try:
+			if isinstance(self._currentFile, PrintingGcodeFileInformation):
+				self._currentFile.seek(pos if pos is not None else 0)
 			self._currentFile.start()
 
 			self._changeState(self.STATE_PRINTING)
@@ -635,9 +807,12 @@ class MachineCom(object):
 				"filename": os.path.basename(self._currentFile.getFilename()),
 				"origin": self._currentFile.getFileLocation()
 			}
-			eventManager().fire(Events.PRINT_STARTED, payload)
+			self._fire_event(Events.PRINT_STARTED, payload)
 			self.sendCommand("M80") #lkj
 			self.sendGcodeScript("beforePrintStarted", replacements=dict(event=payload))
+			if checkpoint is not None:
+				for command in checkpoint_commands(checkpoint):
+					self.sendCommand(process_gcode_line(command, offsets=self._tempOffsets, current_tool=self._currentTool))
 
 			if self.isSdFileSelected():
 				#self.sendCommand("M26 S0") # setting the sd post apparently sometimes doesn't work, so we re-select
@@ -646,12 +821,13 @@ class MachineCom(object):
 				# make sure to ignore the "file selected" later on, otherwise we'll reset our progress data
 				self._ignore_select = True
 				self.sendCommand("M23 {filename}".format(filename=self._currentFile.getFilename()))
-				self._currentFile.setFilepos(0)
+				if pos:
+					self.sendCommand("M26 S{pos}".format(pos=pos))
+				self._currentFile.setFilepos(pos if pos is not None else 0)
 
 				self.sendCommand("M24")
 
-				self._sd_status_timer = RepeatedTimer(lambda: get_interval("sdStatus", default_value=1.0), self._poll_sd_status, run_first=True)
-				self._sd_status_timer.start()
+				self._sd_status_timer = self._start_poller(lambda: get_interval("sdStatus", default_value=1.0), self._poll_sd_status)
 			else:
 				line = self._getNext()
 				if line is not None:
@@ -665,18 +841,21 @@ class MachineCom(object):
 			self._logger.exception("Error while trying to start printing")
 			self._errorValue = get_exception_string()
 			self._changeState(self.STATE_ERROR)
-			eventManager().fire(Events.ERROR, {"error": self.getErrorString()})
+			self._fire_event(Events.ERROR, {"error": self.getErrorString()})
 
 	def startFileTransfer(self, filename, localFilename, remoteFilename):
 		if not self.isOperational() or self.isBusy():
 			logging.info("Printer is not operation or busy")
 			return
 
-		self._currentFile = StreamingGcodeFileInformation(filename, localFilename, remoteFilename)
+		self._transfer_outstanding = 0
+		self._transfer_pending = None
+
+		self._currentFile = StreamingGcodeFileInformation(filename, localFilename, remoteFilename, **self._read_ahead_parameters())
 		self._currentFile.start()
 
 		self.sendCommand("M28 %s" % remoteFilename)
-		eventManager().fire(Events.TRANSFER_STARTED, {"local": localFilename, "remote": remoteFilename})
+		self._fire_event(Events.TRANSFER_STARTED, {"local": localFilename, "remote": remoteFilename})
 		self._callback.on_comm_file_transfer_started(remoteFilename, self._currentFile.getFilesize())
 
 	#lkj def selectFile(self, filename, sd):
@@ -691,8 +870,12 @@ class MachineCom(object):
 			self._sdFileToSelect = filename
 			self.sendCommand("M23 %s" % filename)
 		else:
-			self._currentFile = PrintingGcodeFileInformation(filename, offsets_callback=self.getOffsets, current_tool_callback=self.getCurrentTool, origin=origin)
-			eventManager().fire(Events.FILE_SELECTED, {
+			self._currentFile = PrintingGcodeFileInformation(filename,
+			                                                 offsets_callback=self.getOffsets,
+			                                                 current_tool_callback=self.getCurrentTool,
+			                                                 origin=origin,
+			                                                 **self._read_ahead_parameters())
+			self._fire_event(Events.FILE_SELECTED, {
 				"file": self._currentFile.getFilename(),
 				"filename": os.path.basename(self._currentFile.getFilename()),
 				"origin": self._currentFile.getFileLocation()
@@ -702,12 +885,18 @@ class MachineCom(object):
 			#lkj self._callback.on_comm_file_selected(filename, self._currentFile.getFilesize(), False)			
 			self._callback.on_comm_file_selected(filename, self._currentFile.getFilesize(), origin)
 
+	def _read_ahead_parameters(self):
+		read_ahead = 0
+		if settings().getBoolean(["serial", "readAhead", "enabled"]):
+			read_ahead = settings().getInt(["serial", "readAhead", "lines"])
+		return dict(read_ahead=read_ahead, block_size=settings().getInt(["serial", "readAhead", "blockSize"]))
+
 	def unselectFile(self):
 		if self.isBusy():
 			return
 
 		self._currentFile = None
-		eventManager().fire(Events.FILE_DESELECTED)
+		self._fire_event(Events.FILE_DESELECTED)
 		self._callback.on_comm_file_selected(None, None, False)
 
 	def cancelPrint(self):
@@ -725,6 +914,9 @@ class MachineCom(object):
 					self._sd_status_timer.cancel()
 				except:
 					pass
+		elif self._currentFile is not None:
+			# stops reading ahead and closes the file, starting the print again reopens it
+			self._currentFile.close()
 
 		payload = {
 			"file": self._currentFile.getFilename(),
@@ -736,7 +928,7 @@ class MachineCom(object):
 		#self.sendCommand("M84 S1")
 		self._doSendEmergency("M84 S1")
 		self._clear_to_send.set()  
-		eventManager().fire(Events.PRINT_CANCELLED, payload)
+		self._fire_event(Events.PRINT_CANCELLED, payload)
 
 	def setPause(self, pause):
 		if self.isStreaming():
@@ -774,7 +966,7 @@ class MachineCom(object):
 			self._sendFromQueue()
 			self._clear_to_send.set()
 			
-			eventManager().fire(Events.PRINT_RESUMED, payload)
+			self._fire_event(Events.PRINT_RESUMED, payload)
 		elif pause and self.isPrinting():
 			if not self._pauseWaitStartTime:
 				self._pauseWaitStartTime = time.time()
@@ -786,7 +978,7 @@ class MachineCom(object):
 			#self.sendCommand("M600") #lkj 
 			self.sendGcodeScript("afterPrintPaused", replacements=dict(event=payload))
 
-			eventManager().fire(Events.PRINT_PAUSED, payload)
+			self._fire_event(Events.PRINT_PAUSED, payload)
 			
 		
 
@@ -897,15 +1089,38 @@ class MachineCom(object):
 	##~~ Serial monitor processing received messages
 
 	def _monitor(self):
-		feedback_controls, feedback_matcher = convert_feedback_controls(settings().get(["controls"]))
-		feedback_errors = []
-		pause_triggers = convert_pause_triggers(settings().get(["printerParameters", "pauseTriggers"]))
+		if not self._start_monitor():
+			return
+		self._monitor_loop()
+
+	def _monitor_loop(self):
+		while self._monitoring_active:
+			try:
+				line = self._readline()
+				if line is None:
+					break
+				self._process_received_line(line)
+			except:
+				self._handle_monitor_crash()
+		self._log("Connection closed, closing down monitor")
+
+	def _start_monitor(self):
+		"""
+		Opens the serial connection and prepares processing received lines through
+		:meth:`_process_received_line`.
+
+		Returns:
+		    bool: True if the connection could be opened, False otherwise.
+		"""
+		self._feedback_controls, self._feedback_matcher = convert_feedback_controls(settings().get(["controls"]))
+		self._feedback_errors = []
+		self._pause_triggers = convert_pause_triggers(settings().get(["printerParameters", "pauseTriggers"]))
 
-		disable_external_heatup_detection = not settings().getBoolean(["feature", "externalHeatupDetection"])
+		self._disable_external_heatup_detection = not settings().getBoolean(["feature", "externalHeatupDetection"])
 
 		#Open the serial port.
 		if not self._openSerial():
-			return
+			return False
 
 		try_hello = not settings().getBoolean(["feature", "waitForStartOnConnect"])
 
@@ -921,364 +1136,449 @@ class MachineCom(object):
 		#Start monitoring the serial port.
 		self._timeout = get_new_timeout("communication")
 
-		startSeen = False
-		supportRepetierTargetTemp = settings().getBoolean(["feature", "repetierTargetTemp"])
-		supportWait = settings().getBoolean(["feature", "supportWait"])
+		self._start_seen = False
+		self._support_repetier_target_temp = settings().getBoolean(["feature", "repetierTargetTemp"])
+		self._support_wait = settings().getBoolean(["feature", "supportWait"])
 
-		connection_timeout = settings().getFloat(["serial", "timeout", "connection"])
-		detection_timeout = settings().getFloat(["serial", "timeout", "detection"])
+		self._connection_timeout = settings().getFloat(["serial", "timeout", "connection"])
+		self._detection_timeout = settings().getFloat(["serial", "timeout", "detection"])
 
 		# enqueue an M105 first thing
 		if try_hello:
 			self._sendCommand("M110")
 			self._clear_to_send.set()
 
-		while self._monitoring_active:
+		return True
+
+	def _monitor_event_loop(self):
+		"""
+		Opens the serial connection and hands it over to the event loop, see :meth:`_attach_to_event_loop`.
+
+		Serving the connection from the event loop requires it to provide a ``fileno()`` method returning a file
+		descriptor to wait on for received data and a ``read_available()`` method returning all data currently
+		available without blocking. For sending it needs to provide a ``write_fileno()`` method returning a file
+		descriptor to wait on for room to send and a ``write_available(data)`` method writing as much of ``data`` as
+		possible without blocking and returning the number of bytes written. Connections without support for that will
+		be monitored in a thread of their own like usual.
+
+		Connections reestablishing themselves in the background if they break may signal that by returning None from
+		``read_available()`` and ``write_available(data)``. They need to provide a ``set_reconnect_callback(callback)``
+		method then, ``callback`` has to be called once reconnecting finished, after which their file descriptors are
+		looked up again, see :meth:`_on_serial_reconnected`.
+		"""
+		if not self._start_monitor():
+			return
+
+		required = ("fileno", "read_available", "write_fileno", "write_available")
+		if not all(callable(getattr(self._serial, name, None)) for name in required):
+			self._logger.info("Connection doesn't support non-blocking reads and writes, falling back to monitoring it in a thread")
+			self._event_loop = None
+			self._start_send_loop()
+			self._monitor_loop()
+			return
+
+		if self._streaming_window is not None:
+			# reserving room in the window blocks until the printer acknowledged enough lines, which can't happen
+			# if we block the loop that's processing those acknowledgements
+			self._logger.warn("Advanced streaming is not supported on the event loop, disabling it for this connection")
+			self._streaming_window = None
+
+		set_reconnect_callback = getattr(self._serial, "set_reconnect_callback", None)
+		if callable(set_reconnect_callback):
+			set_reconnect_callback(self._on_serial_reconnected)
+
+		self._receive_buffer = eventloop.LineBuffer()
+		self._event_loop.call_soon_threadsafe(self._attach_to_event_loop, self._serial.fileno(), self._serial.write_fileno())
+
+	def _attach_to_event_loop(self, fd, write_fd):
+		if not self._monitoring_active:
+			return
+
+		self._event_loop_attached = True
+		self._watch_serial(fd, write_fd)
+		self._receive_timeout_timer = self._event_loop.call_repeatedly(lambda: settings().getFloat(["serial", "timeout", "communication"]),
+		                                                               self._on_receive_timeout)
+		self._pump_send_queue()
+
+	def _detach_from_event_loop(self):
+		self._event_loop_attached = False
+		self._unwatch_serial()
+		self._write_buffer = ""
+		if self._receive_timeout_timer is not None:
+			self._receive_timeout_timer.cancel()
+			self._receive_timeout_timer = None
+
+	def _watch_serial(self, fd, write_fd):
+		self._serial_fd = fd
+		self._serial_write_fd = write_fd
+		self._event_loop.add_reader(fd, self._on_serial_readable)
+		if self._write_buffer:
+			self._event_loop.add_writer(write_fd, self._on_serial_writable)
+
+	def _unwatch_serial(self):
+		if self._serial_fd is not None:
+			self._event_loop.remove_reader(self._serial_fd)
+			self._serial_fd = None
+		if self._serial_write_fd is not None:
+			self._event_loop.remove_writer(self._serial_write_fd)
+			self._serial_write_fd = None
+
+	def _on_serial_lost(self):
+		"""
+		The connection broke and is being reestablished in the background, its file descriptors are useless until
+		then. Received lines keep waiting for processing and written data in ``self._write_buffer``, see
+		:meth:`_on_serial_reconnected`.
+		"""
+		self._logger.info("Lost the connection to the printer, waiting for it to be reestablished")
+		self._unwatch_serial()
+
+	def _on_serial_reconnected(self):
+		"""
+		Called by the connection from the thread that tried to reestablish it, see :meth:`_monitor_event_loop`.
+		"""
+		if self._event_loop_attached:
+			self._event_loop.call_soon_threadsafe(self._rewatch_serial)
+
+	def _rewatch_serial(self):
+		if not self._event_loop_attached or self._serial is None:
+			return
+
+		try:
+			fd, write_fd = self._serial.fileno(), self._serial.write_fileno()
+		except:
+			# reconnecting failed
+			self._handle_read_error()
+			return
+
+		self._logger.info("Connection to the printer reestablished")
+
+		# a partial line received before the connection broke won't ever be completed
+		self._receive_buffer.clear()
+		self._watch_serial(fd, write_fd)
+		self._flush_write_buffer()
+		self._pump_send_queue()
+
+	def _on_serial_readable(self):
+		if not self._receive_data():
+			return
+
+		self._process_received_lines()
+		self._pump_send_queue()
+
+	def _process_received_lines(self, flush=False):
+		"""
+		Processes the lines in ``self._received_lines``. Since we must not wait for more data on the event loop, a
+		message spanning two lines (see :meth:`_handleErrors`) whose second line didn't arrive yet stays in there
+		until it did, or until ``flush`` is set because it didn't arrive in time.
+		"""
+		while self._received_lines and self._monitoring_active:
+			if not flush and len(self._received_lines) == 1 and regex_minMaxError.match(self._received_lines[0]):
+				break
+
+			line = self._log_received(self._received_lines.popleft())
 			try:
-				line = self._readline()
-				if line is None:
-					break
-				if line.strip() is not "":
-					self._timeout = get_new_timeout("communication")
-
-				##~~ debugging output handling
-				if line.startswith("//"):
-					debugging_output = line[2:].strip()
-					if debugging_output.startswith("action:"):
-						action_command = debugging_output[len("action:"):].strip()
-
-						if action_command == "pause":
-							self._log("Pausing on request of the printer...")
-							self.setPause(True)
-						elif action_command == "resume":
-							self._log("Resuming on request of the printer...")
-							self.setPause(False)
-						elif action_command == "disconnect":
-							self._log("Disconnecting on request of the printer...")
-							self._callback.on_comm_force_disconnect()
-						else:
-							for hook in self._printer_action_hooks:
-								try:
-									self._printer_action_hooks[hook](self, line, action_command)
-								except:
-									self._logger.exception("Error while calling hook {} with action command {}".format(self._printer_action_hooks[hook], action_command))
-									continue
-					else:
-						continue
+				self._process_received_line(line)
+			except:
+				self._handle_monitor_crash()
+
+	def _on_receive_timeout(self):
+		if self._received_lines:
+			# the rest of a message spanning two lines didn't arrive in time, a blocking read would have given up
+			# on it by now too
+			self._process_received_lines(flush=True)
+			self._pump_send_queue()
+			return
 
-				##~~ Error handling
-				line = self._handleErrors(line)
-
-				##~~ SD file list
-				# if we are currently receiving an sd file list, each line is just a filename, so just read it and abort processing
-				if self._sdFileList and not "End file list" in line:
-					preprocessed_line = line.strip().lower()
-					fileinfo = preprocessed_line.rsplit(None, 1)
-					if len(fileinfo) > 1:
-						# we might have extended file information here, so let's split filename and size and try to make them a bit nicer
-						filename, size = fileinfo
-						try:
-							size = int(size)
-						except ValueError:
-							# whatever that was, it was not an integer, so we'll just use the whole line as filename and set size to None
-							filename = preprocessed_line
-							size = None
-					else:
-						# no extended file information, so only the filename is there and we set size to None
-						filename = preprocessed_line
-						size = None
-
-					if valid_file_type(filename, "machinecode"):
-						if filter_non_ascii(filename):
-							self._logger.warn("Got a file from printer's SD that has a non-ascii filename (%s), that shouldn't happen according to the protocol" % filename)
-						else:
-							if not filename.startswith("/"):
-								# file from the root of the sd -- we'll prepend a /
-								filename = "/" + filename
-							self._sdFiles.append((filename, size))
-						continue
+		if self._received_data:
+			self._received_data = False
+			return
 
-				##~~ process oks
-				if line.strip().startswith("ok") or (self.isPrinting() and supportWait and line.strip().startswith("wait")):
-					self._clear_to_send.set()
-					self._long_running_command = False
-
-				##~~ Temperature processing
-				if ' T:' in line or line.startswith('T:') or ' T0:' in line or line.startswith('T0:') or ' B:' in line or line.startswith('B:'):
-					if not disable_external_heatup_detection and not line.strip().startswith("ok") and not self._heating:
-						self._logger.debug("Externally triggered heatup detected")
-						self._heating = True
-						self._heatupWaitStartTime = time.time()
-					self._processTemperatures(line)
-					self._callback.on_comm_temperature_update(self._temp, self._bedTemp)
-					if 'ok' in line :   #lkj
-						self._heatup_status = self.__class__.HEAT_OK
-						print("lkj temperature ok")
-
-				elif supportRepetierTargetTemp and ('TargetExtr' in line or 'TargetBed' in line):
-					matchExtr = regex_repetierTempExtr.match(line)
-					matchBed = regex_repetierTempBed.match(line)
-
-					if matchExtr is not None:
-						toolNum = int(matchExtr.group(1))
-						try:
-							target = float(matchExtr.group(2))
-							if toolNum in self._temp.keys() and self._temp[toolNum] is not None and isinstance(self._temp[toolNum], tuple):
-								(actual, oldTarget) = self._temp[toolNum]
-								self._temp[toolNum] = (actual, target)
-							else:
-								self._temp[toolNum] = (None, target)
-							self._callback.on_comm_temperature_update(self._temp, self._bedTemp)
-						except ValueError:
-							pass
-					elif matchBed is not None:
-						try:
-							target = float(matchBed.group(1))
-							if self._bedTemp is not None and isinstance(self._bedTemp, tuple):
-								(actual, oldTarget) = self._bedTemp
-								self._bedTemp = (actual, target)
-							else:
-								self._bedTemp = (None, target)
-							self._callback.on_comm_temperature_update(self._temp, self._bedTemp)
-						except ValueError:
-							pass
-
-				#If we are waiting for an M109 or M190 then measure the time we lost during heatup, so we can remove that time from our printing time estimate.
-				if 'ok' in line and self._heatupWaitStartTime:
-					self._heatupWaitTimeLost = self._heatupWaitTimeLost + (time.time() - self._heatupWaitStartTime)
-					self._heatupWaitStartTime = None
-					self._heating = False
-
-				##~~ SD Card handling
-				elif 'SD init fail' in line or 'volume.init failed' in line or 'openRoot failed' in line:
-					self._sdAvailable = False
-					self._sdFiles = []
-					#lkj 
-					from octoprint.server import fileManager
-					fileManager.remove_storage(octoprint.filemanager.FileDestinations.FastbotSDCARD)
-					
-					self._callback.on_comm_sd_state_change(self._sdAvailable)
-				elif 'Not SD printing' in line:
-					if self.isSdFileSelected() and self.isPrinting():
-						# something went wrong, printer is reporting that we actually are not printing right now...
-						self._sdFilePos = 0
-						self._changeState(self.STATE_OPERATIONAL)
-				elif 'SD card ok' in line and not self._sdAvailable:
-					self._sdAvailable = True
-					init_ok, baseFolder = line.strip().split(":", 2)
-					#lkj 
-					print("lkj sd init ok 1")
-					from octoprint.server import fileManager
-					storage_managers_FastbotSDCARD = octoprint.filemanager.storage.LocalFileStorage(baseFolder)					
-					fileManager.add_storage(octoprint.filemanager.FileDestinations.FastbotSDCARD, storage_managers_FastbotSDCARD)
-					print("lkj sd init ok 2")
-					
-					self.refreshSdFiles()
-					self._callback.on_comm_sd_state_change(self._sdAvailable)
-				elif 'Begin file list' in line:
-					self._sdFiles = []
-					self._sdFileList = True
-				elif 'End file list' in line:
-					self._sdFileList = False
-					self._callback.on_comm_sd_files(self._sdFiles)
-				elif 'SD printing byte' in line and self.isSdPrinting():
-					# answer to M27, at least on Marlin, Repetier and Sprinter: "SD printing byte %d/%d"
-					match = regex_sdPrintingByte.search(line)
-					self._currentFile.setFilepos(int(match.group("current")))
-					self._callback.on_comm_progress()
-				elif 'File opened' in line and not self._ignore_select:
-					# answer to M23, at least on Marlin, Repetier and Sprinter: "File opened:%s Size:%d"
-					match = regex_sdFileOpened.search(line)
-					if self._sdFileToSelect:
-						name = self._sdFileToSelect
-						self._sdFileToSelect = None
-					else:
-						name = match.group("name")
-					self._currentFile = PrintingSdFileInformation(name, int(match.group("size")))
-				elif 'File selected' in line:
-					if self._ignore_select:
-						self._ignore_select = False
-					elif self._currentFile is not None:
-						# final answer to M23, at least on Marlin, Repetier and Sprinter: "File selected"
-						self._callback.on_comm_file_selected(self._currentFile.getFilename(), self._currentFile.getFilesize(), True)
-						eventManager().fire(Events.FILE_SELECTED, {
-							"file": self._currentFile.getFilename(),
-							"origin": self._currentFile.getFileLocation()
-						})
-				elif 'Writing to file' in line:
-					# anwer to M28, at least on Marlin, Repetier and Sprinter: "Writing to file: %s"
-					self._changeState(self.STATE_PRINTING)
-					self._clear_to_send.set()
-					line = "ok"
-				elif 'print done' in line:  #lkj
-					print("print done")
-					if self.getState() == self.STATE_OPERATIONAL:						
-						while not self._commandQueue.empty():
-							entry = self._commandQueue.get_nowait()
-						print("print should be cancel!!!")							
-						pass
-					else :
-						print("print should be ok!!!")
-						payload = {
-							"file": self._currentFile.getFilename(),
-							"filename": os.path.basename(self._currentFile.getFilename()),
-							"origin": self._currentFile.getFileLocation(),
-							"time": self.getPrintTime()
-						}
-						self._callback.on_comm_print_job_done()
-						self._changeState(self.STATE_OPERATIONAL)
-						eventManager().fire(Events.PRINT_DONE, payload)
-					
-						self.sendGcodeScript("afterPrintDone", replacements=dict(event=payload))										
-				elif 'Done printing file' in line and self.isSdPrinting():
-					# printer is reporting file finished printing
-					self._sdFilePos = 0
-					self._callback.on_comm_print_job_done()
-					self._changeState(self.STATE_OPERATIONAL)
-					eventManager().fire(Events.PRINT_DONE, {
-						"file": self._currentFile.getFilename(),
-						"filename": os.path.basename(self._currentFile.getFilename()),
-						"origin": self._currentFile.getFileLocation(),
-						"time": self.getPrintTime()
-					})
-					if self._sd_status_timer is not None:
-						try:
-							self._sd_status_timer.cancel()
-						except:
-							pass
-				elif 'Done saving file' in line:
-					self.refreshSdFiles()
-				elif 'File deleted' in line and line.strip().endswith("ok"):
-					# buggy Marlin version that doesn't send a proper \r after the "File deleted" statement, fixed in
-					# current versions
+		# nothing received for a whole read timeout, what a blocking read would report as an empty line
+		try:
+			self._process_received_line("")
+		except:
+			self._handle_monitor_crash()
+		self._pump_send_queue()
+
+	def _receive_data(self):
+		"""
+		Reads all data currently available from the connection into ``self._received_lines``.
+
+		Returns:
+		    bool: False if the connection failed and got closed or is being reestablished, True otherwise.
+		"""
+		try:
+			data = self._serial.read_available()
+		except:
+			self._handle_read_error()
+			return False
+
+		if data is None:
+			self._on_serial_lost()
+			return False
+		elif data:
+			self._received_data = True
+			self._received_lines.extend(self._receive_buffer.feed(data))
+		return True
+
+	def _pump_send_queue(self):
+		"""
+		Sends entries from ``self._send_queue`` for as long as we are clear to send, the event loop's equivalent
+		to :meth:`_send_loop`.
+		"""
+		if not self._event_loop_attached:
+			return
+
+		while self._send_queue_active and not self._clear_to_send.blocked():
+			try:
+				entry = self._send_queue.get_nowait()
+			except queue.Empty:
+				break
+
+			try:
+				self._send_entry(entry)
+			except:
+				self._logger.exception("Caught an exception while sending")
+
+	def _handle_monitor_crash(self):
+		self._logger.exception("Something crashed inside the serial connection loop, please report this in OctoPrint's bug tracker:")
+
+		errorMsg = "See octoprint.log for details"
+		self._log(errorMsg)
+		self._errorValue = errorMsg
+		self._changeState(self.STATE_ERROR)
+		self._fire_event(Events.ERROR, {"error": self.getErrorString()})
+
+	def _process_received_line(self, line):
+		"""
+		Processes a ``line`` received from the printer, an empty ``line`` signals a read timeout.
+		"""
+		line_type, acknowledgement, keyword = classify_line(line)
+		if line_type != LINE_EMPTY:
+			self._timeout = get_new_timeout("communication")
+
+		##~~ debugging output handling
+		if line_type == LINE_DEBUG:
+			return
+		elif line_type == LINE_ACTION:
+			self._handle_action_command(line)
+
+		##~~ Error handling
+		elif line_type == LINE_ERROR:
+			line = self._handleErrors(line)
+
+		##~~ SD file list
+		# if we are currently receiving an sd file list, each line is just a filename, so just read it and abort processing
+		if self._sdFileList and keyword != "End file list":
+			preprocessed_line = line.strip().lower()
+			fileinfo = preprocessed_line.rsplit(None, 1)
+			if len(fileinfo) > 1:
+				# we might have extended file information here, so let's split filename and size and try to make them a bit nicer
+				filename, size = fileinfo
+				try:
+					size = int(size)
+				except ValueError:
+					# whatever that was, it was not an integer, so we'll just use the whole line as filename and set size to None
+					filename = preprocessed_line
+					size = None
+			else:
+				# no extended file information, so only the filename is there and we set size to None
+				filename = preprocessed_line
+				size = None
+
+			if valid_file_type(filename, "machinecode"):
+				if filter_non_ascii(filename):
+					self._logger.warn("Got a file from printer's SD that has a non-ascii filename (%s), that shouldn't happen according to the protocol" % filename)
+				else:
+					if not filename.startswith("/"):
+						# file from the root of the sd -- we'll prepend a /
+						filename = "/" + filename
+					self._sdFiles.append((filename, size))
+				return
+
+		##~~ process oks
+		if acknowledgement or (line_type == LINE_WAIT and self.isPrinting() and self._support_wait):
+			if line_type == LINE_WAIT:
+				# the firmware's buffer ran empty, so nothing can be in flight anymore
+				self._transfer_outstanding = 0
+				if self._streaming_window is not None:
+					self._streaming_window.reset()
+				self._clear_to_send.set()
+			elif self._transfer_outstanding > 0:
+				# acknowledges a line of the current file transfer batch, see _sendNextTransferBatch
+				self._transfer_outstanding -= 1
+			elif self._resendSwallowNextOk and self._streaming_window_active():
+				# answers a line that was dropped from the streaming window with a resend request, see _handleResendRequest
+				pass
+			elif self._streaming_window is None or not self._streaming_window.acknowledge():
+				# the ok doesn't belong to a line sent through the streaming window
+				self._clear_to_send.set()
+			self._long_running_command = False
+
+		##~~ Temperature processing
+		if line_type == LINE_TEMPERATURE:
+			if not self._disable_external_heatup_detection and not acknowledgement and not self._heating:
+				self._logger.debug("Externally triggered heatup detected")
+				self._heating = True
+				self._heatupWaitStartTime = time.time()
+			self._processTemperatures(line)
+			self._callback.on_comm_temperature_update(self._temp, self._bedTemp)
+			if 'ok' in line :   #lkj
+				self._heatup_status = self.__class__.HEAT_OK
+				print("lkj temperature ok")
+
+		elif line_type == LINE_TARGET_TEMPERATURE and self._support_repetier_target_temp:
+			self._processTargetTemperatures(line)
+
+		# the "ok" doesn't have to be at the start of the line, e.g. "SD card ok" or "File deleted ... ok"
+		has_ok = acknowledgement or "ok" in line
+		if has_ok and self._state == self.STATE_PRINTING:
+			self._ok_time = time.time()
+
+		#If we are waiting for an M109 or M190 then measure the time we lost during heatup, so we can remove that time from our printing time estimate.
+		if has_ok and self._heatupWaitStartTime:
+			self._heatupWaitTimeLost = self._heatupWaitTimeLost + (time.time() - self._heatupWaitStartTime)
+			self._heatupWaitStartTime = None
+			self._heating = False
+
+		else:
+			handled = None
+
+			##~~ SD Card handling
+			if keyword is not None:
+				handled = self._sd_message_handlers[keyword](self, line)
+				if handled is not None and handled is not line:
+					# the handler replaced the line
+					line = handled
+					has_ok = "ok" in line
+
+			##~~ Message handling
+			if handled is None and line_type not in (LINE_EMPTY, LINE_WAIT, LINE_RESEND) \
+					and line.strip() != 'ok' \
+					and line != 'echo:Unknown command:""\n' \
+					and self.isOperational():
+				if "T0:" in line:  #lkj
+					pass
+				else :
+					self._callback.on_comm_message(line)
+
+		##~~ Parsing for feedback commands
+		if self._feedback_controls and self._feedback_matcher and not "_all" in self._feedback_errors:
+			try:
+				self._process_registered_message(line, self._feedback_matcher, self._feedback_controls, self._feedback_errors)
+			except:
+				# something went wrong while feedback matching
+				self._logger.exception("Error while trying to apply feedback control matching, disabling it")
+				self._feedback_errors.append("_all")
+
+		##~~ Parsing for pause triggers
+		if self._pause_triggers and not self.isStreaming():
+			if "enable" in self._pause_triggers.keys() and self._pause_triggers["enable"].search(line) is not None:
+				self.setPause(True)
+			elif "disable" in self._pause_triggers.keys() and self._pause_triggers["disable"].search(line) is not None:
+				self.setPause(False)
+			elif "toggle" in self._pause_triggers.keys() and self._pause_triggers["toggle"].search(line) is not None:
+				self.setPause(not self.isPaused())
+
+		### Baudrate detection
+		if self._state == self.STATE_DETECT_BAUDRATE:
+			if line == '' or time.time() > self._timeout:
+				if self._baudrateDetectRetry > 0:
+					self._serial.timeout = self._detection_timeout
+					self._baudrateDetectRetry -= 1
+					self._serial.write('\n')
+					self._log("Baudrate test retry: %d" % (self._baudrateDetectRetry))
+					self._sendCommand("M110")
 					self._clear_to_send.set()
-	
-				##~~ Message handling
-				elif line.strip() != '' \
-					        and line.strip() != 'ok' and not line.startswith("wait") \
-					        and not line.startswith('Resend:') \
-					        and line != 'echo:Unknown command:""\n' \
-					        and self.isOperational():
-					if "T0:" in line:  #lkj
-						pass				
-					else :
-						self._callback.on_comm_message(line)
-	
-				##~~ Parsing for feedback commands
-				if feedback_controls and feedback_matcher and not "_all" in feedback_errors:
+				elif len(self._baudrateDetectList) > 0:
+					baudrate = self._baudrateDetectList.pop(0)
 					try:
-						self._process_registered_message(line, feedback_matcher, feedback_controls, feedback_errors)
-					except:
-						# something went wrong while feedback matching
-						self._logger.exception("Error while trying to apply feedback control matching, disabling it")
-						feedback_errors.append("_all")
-
-				##~~ Parsing for pause triggers
-				if pause_triggers and not self.isStreaming():
-					if "enable" in pause_triggers.keys() and pause_triggers["enable"].search(line) is not None:
-						self.setPause(True)
-					elif "disable" in pause_triggers.keys() and pause_triggers["disable"].search(line) is not None:
-						self.setPause(False)
-					elif "toggle" in pause_triggers.keys() and pause_triggers["toggle"].search(line) is not None:
-						self.setPause(not self.isPaused())
-
-				### Baudrate detection
-				if self._state == self.STATE_DETECT_BAUDRATE:
-					if line == '' or time.time() > self._timeout:
-						if self._baudrateDetectRetry > 0:
-							self._serial.timeout = detection_timeout
-							self._baudrateDetectRetry -= 1
-							self._serial.write('\n')
-							self._log("Baudrate test retry: %d" % (self._baudrateDetectRetry))
-							self._sendCommand("M110")
-							self._clear_to_send.set()
-						elif len(self._baudrateDetectList) > 0:
-							baudrate = self._baudrateDetectList.pop(0)
-							try:
-								self._serial.baudrate = baudrate
-								if self._serial.timeout != connection_timeout:
-									self._serial.timeout = connection_timeout
-								self._log("Trying baudrate: %d" % (baudrate))
-								self._baudrateDetectRetry = 5
-								self._timeout = get_new_timeout("communication")
-								self._serial.write('\n')
-								self._sendCommand("M110")
-								self._clear_to_send.set()
-							except:
-								self._log("Unexpected error while setting baudrate: %d %s" % (baudrate, get_exception_string()))
-						else:
-							self.close()
-							self._errorValue = "No more baudrates to test, and no suitable baudrate found."
-							self._changeState(self.STATE_ERROR)
-							eventManager().fire(Events.ERROR, {"error": self.getErrorString()})
-					elif 'start' in line or 'ok' in line:
-						self._onConnected()
-						self._clear_to_send.set()
-
-				### Connection attempt
-				elif self._state == self.STATE_CONNECTING:
-					if "start" in line and not startSeen:
-						startSeen = True
+						self._serial.baudrate = baudrate
+						if self._serial.timeout != self._connection_timeout:
+							self._serial.timeout = self._connection_timeout
+						self._log("Trying baudrate: %d" % (baudrate))
+						self._baudrateDetectRetry = 5
+						self._timeout = get_new_timeout("communication")
+						self._serial.write('\n')
 						self._sendCommand("M110")
 						self._clear_to_send.set()
-					elif "ok" in line:
-						self._onConnected()
-					elif time.time() > self._timeout:
-						self.close()
-
-				### Operational
-				elif self._state == self.STATE_OPERATIONAL or self._state == self.STATE_PAUSED:
-					if "ok" in line:
-						# if we still have commands to process, process them
-						if self._resendSwallowNextOk:
-							self._resendSwallowNextOk = False
-						elif self._resendDelta is not None:
-							self._resendNextCommand()
-						elif self._sendFromQueue():
-							pass
-
-					# resend -> start resend procedure from requested line
-					elif line.lower().startswith("resend") or line.lower().startswith("rs"):
-						self._handleResendRequest(line)
-
-				### Printing
-				elif self._state == self.STATE_PRINTING:
-					if line == "" and time.time() > self._timeout:
-						if not self._long_running_command:
-							self._log("Communication timeout during printing, forcing a line")
-							self._sendCommand("M105")
-							self._clear_to_send.set()
-						else:
-							self._logger.debug("Ran into a communication timeout, but a command known to be a long runner is currently active")
-
-					if "ok" in line or (supportWait and "wait" in line):
-						# a wait while printing means our printer's buffer ran out, probably due to some ok getting
-						# swallowed, so we treat it the same as an ok here teo take up communication again
-						if self._resendSwallowNextOk:
-							self._resendSwallowNextOk = False
-
-						elif self._resendDelta is not None:
-							self._resendNextCommand()
-
-						elif self._heatup_status is not self.__class__.HEAT_START:							
-							if self._sendFromQueue():
-								print("lkj in printing, sendFromQueue")
-								pass
-							elif not self.isSdPrinting() : #and self._heatup_status == self.__class__.HEAT_OK
-								#print("lkj in printing, sendNext")
-								self._sendNext()
-
-					elif line.lower().startswith("resend") or line.lower().startswith("rs"):
-						self._handleResendRequest(line)
-			except:
-				self._logger.exception("Something crashed inside the serial connection loop, please report this in OctoPrint's bug tracker:")
+					except:
+						self._log("Unexpected error while setting baudrate: %d %s" % (baudrate, get_exception_string()))
+				else:
+					self.close()
+					self._errorValue = "No more baudrates to test, and no suitable baudrate found."
+					self._changeState(self.STATE_ERROR)
+					self._fire_event(Events.ERROR, {"error": self.getErrorString()})
+			elif 'start' in line or has_ok:
+				self._onConnected()
+				self._clear_to_send.set()
+
+		### Connection attempt
+		elif self._state == self.STATE_CONNECTING:
+			if "start" in line and not self._start_seen:
+				self._start_seen = True
+				self._sendCommand("M110")
+				self._clear_to_send.set()
+			elif has_ok:
+				self._onConnected()
+			elif time.time() > self._timeout:
+				self.close()
+
+		### Operational
+		elif self._state == self.STATE_OPERATIONAL or self._state == self.STATE_PAUSED:
+			if has_ok:
+				# if we still have commands to process, process them
+				if self._resendSwallowNextOk:
+					self._resendSwallowNextOk = False
+				elif self._resendDelta is not None:
+					self._resendNextCommand()
+				elif self._sendFromQueue():
+					pass
 
-				errorMsg = "See octoprint.log for details"
-				self._log(errorMsg)
-				self._errorValue = errorMsg
-				self._changeState(self.STATE_ERROR)
-				eventManager().fire(Events.ERROR, {"error": self.getErrorString()})
-		self._log("Connection closed, closing down monitor")
+			# resend -> start resend procedure from requested line
+			elif line_type == LINE_RESEND:
+				self._handleResendRequest(line)
+
+		### Printing
+		elif self._state == self.STATE_PRINTING:
+			if line == "" and time.time() > self._timeout:
+				if not self._long_running_command:
+					self._log("Communication timeout during printing, forcing a line")
+					if self._streaming_window is not None:
+						# we apparently lost some acknowledgements, start over with an empty window
+						self._streaming_window.reset()
+					if self._transfer_outstanding > 0:
+						# same for the current file transfer batch, the ok to our forced line triggers the next one,
+						# led by the line kept back from the current batch if any
+						self._transfer_outstanding = 0
+					self._sendCommand("M105")
+					self._clear_to_send.set()
+				else:
+					self._logger.debug("Ran into a communication timeout, but a command known to be a long runner is currently active")
+
+			if has_ok or (self._support_wait and "wait" in line):
+				# a wait while printing means our printer's buffer ran out, probably due to some ok getting
+				# swallowed, so we treat it the same as an ok here teo take up communication again
+				if self._resendSwallowNextOk:
+					self._resendSwallowNextOk = False
+
+				elif self._resendDelta is not None:
+					self._resendNextCommand()
+
+				elif self._transfer_batched and self.isStreaming():
+					if self._transfer_outstanding <= 0:
+						self._sendNextTransferBatch()
+
+				elif self._heatup_status is not self.__class__.HEAT_START:							
+					if self._sendFromQueue():
+						print("lkj in printing, sendFromQueue")
+						pass
+					elif not self.isSdPrinting() : #and self._heatup_status == self.__class__.HEAT_OK
+						#print("lkj in printing, sendNext")
+						self._sendNext()
+
+			elif line_type == LINE_RESEND:
+				self._handleResendRequest(line)
 
 	def _process_registered_message(self, line, feedback_matcher, feedback_controls, feedback_errors):
 		feedback_match = feedback_matcher.search(line)
@@ -1310,7 +1610,7 @@ class MachineCom(object):
 
 					if output is not None:
 						outputs[template_key] = output
-				eventManager().fire(Events.REGISTERED_MESSAGE_RECEIVED, dict(key=feedback_key, matched=matched_part, outputs=outputs))
+				self._fire_event(Events.REGISTERED_MESSAGE_RECEIVED, dict(key=feedback_key, matched=matched_part, outputs=outputs))
 			except:
 				self._logger.exception("Error while trying to match feedback control output, disabling key {key}".format(key=match_key))
 				feedback_errors.append(match_key)
@@ -1339,8 +1639,7 @@ class MachineCom(object):
 
 	def _onConnected(self):
 		self._serial.timeout = settings().getFloat(["serial", "timeout", "communication"])
-		self._temperature_timer = RepeatedTimer(lambda: get_interval("temperature", default_value=4.0), self._poll_temperature, run_first=True)
-		self._temperature_timer.start()
+		self._temperature_timer = self._start_poller(lambda: get_interval("temperature", default_value=4.0), self._poll_temperature)
 
 		self._changeState(self.STATE_OPERATIONAL)
 		#lkj start
@@ -1354,7 +1653,7 @@ class MachineCom(object):
 			#lkj self.initSdCard()
 
 		payload = dict(port=self._port, baudrate=self._baudrate)
-		eventManager().fire(Events.CONNECTED, payload)
+		self._fire_event(Events.CONNECTED, payload)
 		self.sendGcodeScript("afterPrinterConnected", replacements=dict(event=payload))
 
 	def _sendFromQueue(self):
@@ -1405,7 +1704,7 @@ class MachineCom(object):
 				if serial_obj is None:
 					self._errorValue = 'Failed to autodetect serial port, please set it manually.'
 					self._changeState(self.STATE_ERROR)
-					eventManager().fire(Events.ERROR, {"error": self.getErrorString()})
+					self._fire_event(Events.ERROR, {"error": self.getErrorString()})
 					self._log("Failed to autodetect serial port, please set it manually.")
 					return None
 
@@ -1433,7 +1732,7 @@ class MachineCom(object):
 				exception_string = get_exception_string()
 				self._errorValue = "Connection error, see Terminal tab"
 				self._changeState(self.STATE_ERROR)
-				eventManager().fire(Events.ERROR, {"error": self.getErrorString()})
+				self._fire_event(Events.ERROR, {"error": self.getErrorString()})
 
 				self._log("Unexpected error while connecting to serial port: %s %s (hook %s)" % (self._port, exception_string, name))
 
@@ -1451,52 +1750,292 @@ class MachineCom(object):
 
 		return False
 
-	def _handleErrors(self, line):
-		if line is None:
-			return
-
-		lower_line = line.lower()
+	def _handle_action_command(self, line):
+		action_command = line.strip()[2:].strip()[len("action:"):].strip()
+
+		if action_command == "pause":
+			self._log("Pausing on request of the printer...")
+			self.setPause(True)
+		elif action_command == "resume":
+			self._log("Resuming on request of the printer...")
+			self.setPause(False)
+		elif action_command == "disconnect":
+			self._log("Disconnecting on request of the printer...")
+			self._callback.on_comm_force_disconnect()
+		else:
+			for hook in self._printer_action_hooks:
+				try:
+					self._printer_action_hooks[hook](self, line, action_command)
+				except:
+					self._logger.exception("Error while calling hook {} with action command {}".format(self._printer_action_hooks[hook], action_command))
+					continue
 
-		# No matter the state, if we see an error, goto the error state and store the error for reference.
-		if line.startswith('Error:') or line.startswith('!!'):
-			#Oh YEAH, consistency.
-			# Marlin reports an MIN/MAX temp error as "Error:x\n: Extruder switched off. MAXTEMP triggered !\n"
-			#	But a bed temp error is reported as "Error: Temperature heated bed switched off. MAXTEMP triggered !!"
-			#	So we can have an extra newline in the most common case. Awesome work people.
-			if regex_minMaxError.match(line):
-				line = line.rstrip() + self._readline()
+	def _processTargetTemperatures(self, line):
+		matchExtr = regex_repetierTempExtr.match(line)
+		matchBed = regex_repetierTempBed.match(line)
 
-			if 'line number' in lower_line or 'checksum' in lower_line or 'format error' in lower_line or 'expected line' in lower_line:
-				#Skip the communication errors, as those get corrected.
-				self._lastCommError = line[6:] if line.startswith("Error:") else line[2:]
-				pass
-			elif 'volume.init' in lower_line or "openroot" in lower_line or 'workdir' in lower_line\
-					or "error writing to file" in lower_line or "cannot open" in lower_line\
-					or "cannot enter" in lower_line:
-				#Also skip errors with the SD card
+		if matchExtr is not None:
+			toolNum = int(matchExtr.group(1))
+			try:
+				target = float(matchExtr.group(2))
+				if toolNum in self._temp.keys() and self._temp[toolNum] is not None and isinstance(self._temp[toolNum], tuple):
+					(actual, oldTarget) = self._temp[toolNum]
+					self._temp[toolNum] = (actual, target)
+				else:
+					self._temp[toolNum] = (None, target)
+				self._callback.on_comm_temperature_update(self._temp, self._bedTemp)
+			except ValueError:
 				pass
-			elif 'unknown command' in lower_line:
-				#Ignore unkown command errors, it could be a typo or some missing feature
+		elif matchBed is not None:
+			try:
+				target = float(matchBed.group(1))
+				if self._bedTemp is not None and isinstance(self._bedTemp, tuple):
+					(actual, oldTarget) = self._bedTemp
+					self._bedTemp = (actual, target)
+				else:
+					self._bedTemp = (None, target)
+				self._callback.on_comm_temperature_update(self._temp, self._bedTemp)
+			except ValueError:
 				pass
-			elif not self.isError():
-				self._errorValue = line[6:] if line.startswith("Error:") else line[2:]
-				self._changeState(self.STATE_ERROR)
-				eventManager().fire(Events.ERROR, {"error": self.getErrorString()})
+
+	##~~ SD card related messages, see _sd_message_handlers
+	#
+	# The handlers return the line processing should continue with, or None if they didn't handle the line after
+	# all, in which case it will be treated as a regular message.
+
+	def _on_sd_init_failed(self, line):
+		self._sdAvailable = False
+		self._sdFiles = []
+		#lkj 
+		from octoprint.server import fileManager
+		fileManager.remove_storage(octoprint.filemanager.FileDestinations.FastbotSDCARD)
+
+		self._callback.on_comm_sd_state_change(self._sdAvailable)
 		return line
 
-	def _readline(self):
-		if self._serial is None:
+	def _on_not_sd_printing(self, line):
+		if self.isSdFileSelected() and self.isPrinting():
+			# something went wrong, printer is reporting that we actually are not printing right now...
+			self._sdFilePos = 0
+			self._changeState(self.STATE_OPERATIONAL)
+		return line
+
+	def _on_sd_card_ok(self, line):
+		if self._sdAvailable:
 			return None
 
-		try:
-			ret = self._serial.readline()
-		except:
-			if not self._connection_closing:
-				self._logger.exception("Unexpected error while reading from serial port")
-				self._log("Unexpected error while reading serial port, please consult octoprint.log for details: %s" % (get_exception_string()))
-				self._errorValue = get_exception_string()
-				self.close(True)
+		self._sdAvailable = True
+		init_ok, baseFolder = line.strip().split(":", 2)
+		#lkj 
+		print("lkj sd init ok 1")
+		from octoprint.server import fileManager
+		storage_managers_FastbotSDCARD = octoprint.filemanager.storage.LocalFileStorage(baseFolder)
+		fileManager.add_storage(octoprint.filemanager.FileDestinations.FastbotSDCARD, storage_managers_FastbotSDCARD)
+		print("lkj sd init ok 2")
+
+		self.refreshSdFiles()
+		self._callback.on_comm_sd_state_change(self._sdAvailable)
+		return line
+
+	def _on_begin_file_list(self, line):
+		self._sdFiles = []
+		self._sdFileList = True
+		return line
+
+	def _on_end_file_list(self, line):
+		self._sdFileList = False
+		self._callback.on_comm_sd_files(self._sdFiles)
+		return line
+
+	def _on_sd_printing_byte(self, line):
+		if not self.isSdPrinting():
+			return None
+
+		# answer to M27, at least on Marlin, Repetier and Sprinter: "SD printing byte %d/%d"
+		match = regex_sdPrintingByte.search(line)
+		self._currentFile.setFilepos(int(match.group("current")))
+		self._callback.on_comm_progress()
+		return line
+
+	def _on_file_opened(self, line):
+		if self._ignore_select:
+			return None
+
+		# answer to M23, at least on Marlin, Repetier and Sprinter: "File opened:%s Size:%d"
+		match = regex_sdFileOpened.search(line)
+		if self._sdFileToSelect:
+			name = self._sdFileToSelect
+			self._sdFileToSelect = None
+		else:
+			name = match.group("name")
+		self._currentFile = PrintingSdFileInformation(name, int(match.group("size")))
+		return line
+
+	def _on_file_selected(self, line):
+		if self._ignore_select:
+			self._ignore_select = False
+		elif self._currentFile is not None:
+			# final answer to M23, at least on Marlin, Repetier and Sprinter: "File selected"
+			self._callback.on_comm_file_selected(self._currentFile.getFilename(), self._currentFile.getFilesize(), True)
+			self._fire_event(Events.FILE_SELECTED, {
+				"file": self._currentFile.getFilename(),
+				"origin": self._currentFile.getFileLocation()
+			})
+		return line
+
+	def _on_writing_to_file(self, line):
+		# anwer to M28, at least on Marlin, Repetier and Sprinter: "Writing to file: %s"
+		self._changeState(self.STATE_PRINTING)
+		self._clear_to_send.set()
+		return "ok"
+
+	def _on_print_done(self, line):  #lkj
+		print("print done")
+		if self.getState() == self.STATE_OPERATIONAL:
+			while not self._commandQueue.empty():
+				entry = self._commandQueue.get_nowait()
+			print("print should be cancel!!!")
+			pass
+		else :
+			print("print should be ok!!!")
+			payload = {
+				"file": self._currentFile.getFilename(),
+				"filename": os.path.basename(self._currentFile.getFilename()),
+				"origin": self._currentFile.getFileLocation(),
+				"time": self.getPrintTime()
+			}
+			self._callback.on_comm_print_job_done()
+			self._changeState(self.STATE_OPERATIONAL)
+			self._fire_event(Events.PRINT_DONE, payload)
+
+			self.sendGcodeScript("afterPrintDone", replacements=dict(event=payload))
+		return line
+
+	def _on_done_printing_file(self, line):
+		if not self.isSdPrinting():
+			return None
+
+		# printer is reporting file finished printing
+		self._sdFilePos = 0
+		self._callback.on_comm_print_job_done()
+		self._changeState(self.STATE_OPERATIONAL)
+		self._fire_event(Events.PRINT_DONE, {
+			"file": self._currentFile.getFilename(),
+			"filename": os.path.basename(self._currentFile.getFilename()),
+			"origin": self._currentFile.getFileLocation(),
+			"time": self.getPrintTime()
+		})
+		if self._sd_status_timer is not None:
+			try:
+				self._sd_status_timer.cancel()
+			except:
+				pass
+		return line
+
+	def _on_done_saving_file(self, line):
+		self.refreshSdFiles()
+		return line
+
+	def _on_file_deleted(self, line):
+		if not line.strip().endswith("ok"):
+			return None
+
+		# buggy Marlin version that doesn't send a proper \r after the "File deleted" statement, fixed in
+		# current versions
+		self._clear_to_send.set()
+		return line
+
+	# unbound functions on purpose, called with the instance as first argument, see _monitor
+	_sd_message_handlers = {
+		"SD init fail": _on_sd_init_failed,
+		"volume.init failed": _on_sd_init_failed,
+		"openRoot failed": _on_sd_init_failed,
+		"Not SD printing": _on_not_sd_printing,
+		"SD card ok": _on_sd_card_ok,
+		"Begin file list": _on_begin_file_list,
+		"End file list": _on_end_file_list,
+		"SD printing byte": _on_sd_printing_byte,
+		"File opened": _on_file_opened,
+		"File selected": _on_file_selected,
+		"Writing to file": _on_writing_to_file,
+		"print done": _on_print_done,
+		"Done printing file": _on_done_printing_file,
+		"Done saving file": _on_done_saving_file,
+		"File deleted": _on_file_deleted
+	}
+
+	def _handleErrors(self, line):
+		if line is None:
+			return
+
+		lower_line = line.lower()
+
+		# No matter the state, if we see an error, goto the error state and store the error for reference.
+		if line.startswith('Error:') or line.startswith('!!'):
+			#Oh YEAH, consistency.
+			# Marlin reports an MIN/MAX temp error as "Error:x\n: Extruder switched off. MAXTEMP triggered !\n"
+			#	But a bed temp error is reported as "Error: Temperature heated bed switched off. MAXTEMP triggered !!"
+			#	So we can have an extra newline in the most common case. Awesome work people.
+			if regex_minMaxError.match(line):
+				line = line.rstrip() + self._readline()
+
+			if 'line number' in lower_line or 'checksum' in lower_line or 'format error' in lower_line or 'expected line' in lower_line:
+				#Skip the communication errors, as those get corrected.
+				self._lastCommError = line[6:] if line.startswith("Error:") else line[2:]
+				pass
+			elif 'volume.init' in lower_line or "openroot" in lower_line or 'workdir' in lower_line\
+					or "error writing to file" in lower_line or "cannot open" in lower_line\
+					or "cannot enter" in lower_line:
+				#Also skip errors with the SD card
+				pass
+			elif 'unknown command' in lower_line:
+				#Ignore unkown command errors, it could be a typo or some missing feature
+				pass
+			elif not self.isError():
+				self._errorValue = line[6:] if line.startswith("Error:") else line[2:]
+				self._changeState(self.STATE_ERROR)
+				self._fire_event(Events.ERROR, {"error": self.getErrorString()})
+		return line
+
+	def _readline(self):
+		if self._serial is None:
 			return None
+
+		if self._receive_buffer is not None:
+			return self._read_buffered_line()
+
+		try:
+			ret = self._serial.readline()
+		except:
+			self._handle_read_error()
+			return None
+		return self._log_received(ret)
+
+	def _read_buffered_line(self):
+		"""
+		Returns the next line received through the event loop, or ``''`` if there is none. That should only ever be
+		used for the second line of messages spanning two lines (see :meth:`_handleErrors`), which
+		:meth:`_process_received_lines` only processes once both of their lines arrived.
+		"""
+		if not self._received_lines:
+			return ''
+		return self._log_received(self._received_lines.popleft())
+
+	def _handle_read_error(self):
+		if not self._connection_closing:
+			self._logger.exception("Unexpected error while reading from serial port")
+			self._log("Unexpected error while reading serial port, please consult octoprint.log for details: %s" % (get_exception_string()))
+			self._errorValue = get_exception_string()
+			self.close(True)
+
+	def _handle_write_error(self):
+		if not self._connection_closing:
+			self._logger.exception("Unexpected error while writing to serial port")
+			self._log("Unexpected error while writing to serial port: %s" % (get_exception_string()))
+			self._errorValue = get_exception_string()
+			self.close(True)
+
+	def _log_received(self, ret):
 		if ret == '':
 			#self._log("Recv: TIMEOUT")
 			return ''
@@ -1528,11 +2067,13 @@ class MachineCom(object):
 					"remote": remote,
 					"time": self.getPrintTime()
 				}
+				payload.update(self._currentFile.getThroughput())
+				self._log("Transferred {lines} lines ({bytes} bytes) at {linesPerSecond:.1f} lines/s, {bytesPerSecond:.1f} bytes/s".format(**payload))
 
 				self._currentFile = None
 				self._changeState(self.STATE_OPERATIONAL)
 				self._callback.on_comm_file_transfer_done(remote)
-				eventManager().fire(Events.TRANSFER_DONE, payload)
+				self._fire_event(Events.TRANSFER_DONE, payload)
 				self.refreshSdFiles()
 			else:				
 				if not self._send_M84 :
@@ -1548,7 +2089,7 @@ class MachineCom(object):
 				}
 				self._callback.on_comm_print_job_done()
 				self._changeState(self.STATE_OPERATIONAL)
-				eventManager().fire(Events.PRINT_DONE, payload)
+				self._fire_event(Events.PRINT_DONE, payload)
 
 				self.sendGcodeScript("afterPrintDone", replacements=dict(event=payload))
 				'''
@@ -1564,6 +2105,58 @@ class MachineCom(object):
 				self._sendCommand(line)
 				self._callback.on_comm_progress()
 
+	def _sendNextTransferBatch(self):
+		"""
+		Sends as many of the next lines of the file currently being streamed to the printer's SD as fit into the
+		firmware's receive buffer, framed and written in one go. The next batch may only be sent once all lines of
+		this one have been acknowledged, which is tracked through ``self._transfer_outstanding``.
+		"""
+		with self._sendNextLock:
+			batch = []
+			history = []
+			size = 0
+			while len(batch) < self._transfer_max_lines:
+				if self._transfer_pending is not None:
+					line = self._transfer_pending
+					self._transfer_pending = None
+				else:
+					line = self._currentFile.getNext()
+					if line is None:
+						break
+
+				command = line.encode("ascii", errors="replace")
+				# "N<linenumber> " prefix and "*<checksum>\n" suffix, checksum has at most three digits
+				line_size = len(command) + len(str(self._currentLine + len(batch))) + 7
+				if batch and size + line_size > self._transfer_max_bytes:
+					# doesn't fit anymore, keep it for the next batch
+					self._transfer_pending = line
+					break
+
+				if isinstance(line, PreparedCommand):
+					batch.append((command, line.checksum))
+					# resends reuse the checksum from the history
+					history.append(line)
+				else:
+					batch.append((command, None))
+					history.append(command)
+				size += line_size
+
+			if not batch:
+				# nothing left to transfer, let _getNext finish up the transfer
+				self._getNext()
+				return
+
+			with self._line_mutex:
+				data, next_linenumber = framing.frame_batch(batch, self._currentLine)
+				for offset, line in enumerate(history):
+					self._addToLastLines(self._currentLine + offset, line)
+				self._currentLine = next_linenumber
+				self._transfer_outstanding = len(batch)
+
+			# frame_batch terminates the data with a newline, writing it will add one
+			self._enqueue_for_sending(data[:-1], command_type="transfer_batch")
+			self._callback.on_comm_progress()
+
 	def _handleResendRequest(self, line):
 		lineToResend = None
 		try:
@@ -1579,8 +2172,17 @@ class MachineCom(object):
 			self._lastCommError = None
 
 			resendDelta = self._currentLine - lineToResend
+			windowed = self._streaming_window_active()
+
+			if windowed:
+				# each line sent after the requested one before the firmware saw it fail asks for it again, no matter the
+				# error it reports
+				if lineToResend == self._lastResendNumber and self._resend_duplicates > 0:
+					self._logger.debug("Ignoring resend request for line %d, that still originates from lines we sent before we got the first resend request" % lineToResend)
+					self._resend_duplicates -= 1
+					return
 
-			if lastCommError is not None \
+			elif lastCommError is not None \
 					and ("line number" in lastCommError.lower() or "expected line" in lastCommError.lower()) \
 					and lineToResend == self._lastResendNumber \
 					and self._resendDelta is not None and self._currentResendCount < self._resendDelta:
@@ -1601,17 +2203,35 @@ class MachineCom(object):
 			self._currentResendCount = 0
 			self._resendSwallowRepetitionsCounter = settings().getInt(["feature", "identicalResendsCountdown"])
 
-			if self._resendDelta > len(self._lastLines) or len(self._lastLines) == 0 or self._resendDelta < 0:
+			if windowed:
+				# the firmware dropped the requested line and all lines after it, so they won't be acknowledged anymore,
+				# instead each of them that reached it answers with another resend request
+				discarded = self._streaming_window.discard_from(lineToResend)
+				self._resend_duplicates = len([linenumber for linenumber in discarded if linenumber > lineToResend])
+
+			if self._transfer_batched and self.isStreaming():
+				# the firmware acknowledged all lines of the batch before the requested one and dropped the rest, which
+				# get resent one at a time now, the next batch follows once that's done - a line kept back from the
+				# current batch hasn't been numbered yet and will lead it
+				self._transfer_outstanding = 0
+
+			if self._resendDelta == 0:
+				# the printer asks for the line we are going to send next anyway, nothing to resend
+				self._logger.debug("Printer requested line %d which hasn't been sent yet, nothing to resend" % lineToResend)
+				self._resendDelta = None
+			elif lineToResend not in self._lastLines:
+				self._resend_statistics.record_failure()
 				self._errorValue = "Printer requested line %d but no sufficient history is available, can't resend" % lineToResend
 				self._logger.warn(self._errorValue)
 				if self.isPrinting():
 					# abort the print, there's nothing we can do to rescue it now
 					self._changeState(self.STATE_ERROR)
-					eventManager().fire(Events.ERROR, {"error": self.getErrorString()})
+					self._fire_event(Events.ERROR, {"error": self.getErrorString()})
 				else:
 					# reset resend delta, we can't do anything about it
 					self._resendDelta = None
 			else:
+				self._resend_statistics.record(resendDelta)
 				self._resendNextCommand()
 
 	def _resendNextCommand(self):
@@ -1619,8 +2239,8 @@ class MachineCom(object):
 
 		# Make sure we are only handling one sending job at a time
 		with self._sendingLock:
-			cmd = self._lastLines[-self._resendDelta]
 			lineNumber = self._currentLine - self._resendDelta
+			cmd = self._lastLines[lineNumber]
 
 			self._enqueue_for_sending(cmd, linenumber=lineNumber)
 
@@ -1647,7 +2267,7 @@ class MachineCom(object):
 
 				if gcode and gcode in gcodeToEvent:
 					# if this is a gcode bound to an event, trigger that now
-					eventManager().fire(gcodeToEvent[gcode])
+					self._fire_event(gcodeToEvent[gcode])
 
 			# actually enqueue the command for sending
 			self._enqueue_for_sending(cmd, command_type=cmd_type)
@@ -1672,6 +2292,30 @@ class MachineCom(object):
 			self._send_queue.put((command, linenumber, command_type))
 		except TypeAlreadyInQueue as e:
 			self._logger.debug("Type already in queue: " + e.type)
+			return
+
+		if self._event_loop_attached:
+			self._event_loop.call_soon_threadsafe(self._pump_send_queue)
+
+	def _start_send_loop(self):
+		self.sending_thread = threading.Thread(target=self._send_loop, name="comm.sending_thread")
+		self.sending_thread.daemon = True
+		self.sending_thread.start()
+
+	def _start_poller(self, interval, function):
+		"""
+		Calls ``function`` every ``interval`` seconds, on the event loop if the connection is served by one, otherwise
+		in a :class:`~octoprint.util.RepeatedTimer`.
+
+		Returns:
+		    object: The timer, to be stopped through its ``cancel()`` method.
+		"""
+		if self._event_loop is not None:
+			return self._event_loop.call_repeatedly(interval, function, run_first=True)
+
+		timer = RepeatedTimer(interval, function, run_first=True)
+		timer.start()
+		return timer
 
 	def _send_loop(self):
 		"""
@@ -1690,95 +2334,237 @@ class MachineCom(object):
 				if not self._send_queue_active:
 					break
 
-				# fetch command and optional linenumber from queue
-				command, linenumber, command_type = entry
+				if self._send_entry(entry):
+					self._clear_to_send.wait()
+			except:
+				self._logger.exception("Caught an exception in the send loop")
+		self._log("Closing down send loop")
 
-				# some firmwares (e.g. Smoothie) might support additional in-band communication that will not
-				# stick to the acknowledgement behaviour of GCODE, so we check here if we have a GCODE command
-				# at hand here and only clear our clear_to_send flag later if that's the case
-				gcode = gcode_command_for_cmd(command)
+	def _send_entry(self, entry):
+		"""
+		Sends an ``entry`` taken from ``self._send_queue``.
 
-				if linenumber is not None:
-					# line number predetermined - this only happens for resends, so we'll use the number and
-					# send directly without any processing (since that already took place on the first sending!)
-					self._doSendWithChecksum(command, linenumber)
+		Returns:
+		    bool: True if the entry used up the current clear to send and sending has to wait for the next one, False
+		        if the next entry may be sent right away.
+		"""
 
-				else:
-					# trigger "sending" phase
-					command, _, gcode = self._process_command_phase("sending", command, command_type, gcode=gcode)
+		# fetch command and optional linenumber from queue
+		command, linenumber, command_type = entry
 
-					if command is None:
-						# so no, we are not going to send this, that was a last-minute bail, let's fetch the next item from the queue
-						continue
+		if command_type == "transfer_batch":
+			# an already framed batch of lines of a file transfer to the printer's SD, the acknowledgements
+			# for those are tracked separately (see _sendNextTransferBatch), so no need to wait for a clear
+			self._doSendWithoutChecksum(command)
+			return False
 
-					# now comes the part where we increase line numbers and send stuff - no turning back now
-					command_to_send = command.encode("ascii", errors="replace")
-					if (gcode is not None or self._sendChecksumWithUnknownCommands) and (self.isPrinting() or self._alwaysSendChecksum):
-						self._doIncrementAndSendWithChecksum(command_to_send)
-					else:
-						self._doSendWithoutChecksum(command_to_send)
+		# some firmwares (e.g. Smoothie) might support additional in-band communication that will not
+		# stick to the acknowledgement behaviour of GCODE, so we check here if we have a GCODE command
+		# at hand here and only clear our clear_to_send flag later if that's the case
+		gcode = gcode_command_for_cmd(command)
 
-				# trigger "sent" phase and use up one "ok"
-				self._process_command_phase("sent", command, command_type, gcode=gcode)
+		if linenumber is not None:
+			# line number predetermined - this only happens for resends, so we'll use the number and
+			# send directly without any processing (since that already took place on the first sending!)
+			windowed = self._use_streaming_window(gcode)
+			if windowed:
+				self._reserve_streaming_window(command, linenumber)
+			self._doSendWithChecksum(command, linenumber)
 
-				if self.has_heat_bed and self.wait_heat_bed_gcode is False and "M190" in command: #wait bed
-					self.wait_heat_bed_gcode = True
-					print("lkj get M190")
-				if self.wait_heat_extruder_gcode is False and "M109" in command:
-					self.wait_heat_extruder_gcode = True
-					print("lkj get M109")	
-				if self._heatup_status is self.__class__.HEAT_END and self.wait_heat_extruder_gcode and (( self.has_heat_bed and self.wait_heat_bed_gcode ) or not self.has_heat_bed)  :			
-					self._heatup_status = self.__class__.HEAT_START
-					print("lkj get M109, set heat_start")
+		else:
+			# trigger "sending" phase
+			command, _, gcode = self._process_command_phase("sending", command, command_type, gcode=gcode)
 
+			if command is None:
+				# so no, we are not going to send this, that was a last-minute bail, let's fetch the next item from the queue
+				return False
 
+			# now comes the part where we increase line numbers and send stuff - no turning back now
+			windowed = self._use_streaming_window(gcode)
+			if (gcode is not None or self._sendChecksumWithUnknownCommands) and (self.isPrinting() or self._alwaysSendChecksum):
+				# prepared commands go into the line history as they are, so resends can reuse their checksum
+				command_to_send = command if isinstance(command, PreparedCommand) else command.encode("ascii", errors="replace")
+				if windowed:
+					self._reserve_streaming_window(command_to_send, self._currentLine)
+				self._doIncrementAndSendWithChecksum(command_to_send)
+			else:
+				command_to_send = command.encode("ascii", errors="replace")
+				if windowed:
+					self._reserve_streaming_window(command_to_send, None)
+				self._doSendWithoutChecksum(command_to_send)
+
+		# trigger "sent" phase and use up one "ok"
+		self._process_command_phase("sent", command, command_type, gcode=gcode)
+
+		if self.has_heat_bed and self.wait_heat_bed_gcode is False and "M190" in command: #wait bed
+			self.wait_heat_bed_gcode = True
+			print("lkj get M190")
+		if self.wait_heat_extruder_gcode is False and "M109" in command:
+			self.wait_heat_extruder_gcode = True
+			print("lkj get M109")	
+		if self._heatup_status is self.__class__.HEAT_END and self.wait_heat_extruder_gcode and (( self.has_heat_bed and self.wait_heat_bed_gcode ) or not self.has_heat_bed)  :			
+			self._heatup_status = self.__class__.HEAT_START
+			print("lkj get M109, set heat_start")
+
+
+
+		if windowed:
+			# the line will be acknowledged through the streaming window, so instead of waiting for the
+			# next clear we make sure to keep the window filled
+			self._fill_streaming_window()
+			return False
 
-				# we only need to use up a clear if the command we just sent was either a gcode command or if we also
-				# require ack's for unknown commands
-				use_up_clear = self._unknownCommandsNeedAck
-				if gcode is not None:
-					use_up_clear = True
+		# we only need to use up a clear if the command we just sent was either a gcode command or if we also
+		# require ack's for unknown commands
+		use_up_clear = self._unknownCommandsNeedAck
+		if gcode is not None:
+			use_up_clear = True
 
-				# if we need to use up a clear, do that now
-				if use_up_clear:
-					self._clear_to_send.clear()
+		# if we need to use up a clear, do that now
+		if use_up_clear:
+			self._clear_to_send.clear()
 
-				# now we just wait for the next clear and then start again
-				self._clear_to_send.wait()
-			except:
-				self._logger.exception("Caught an exception in the send loop")
-		self._log("Closing down send loop")
+		# now we just wait for the next clear and then start again
+		return True
+
+	def _streaming_window_active(self):
+		"""
+		Whether commands are currently sent through the streaming window, which is the case while printing in advanced
+		streaming mode.
+		"""
+		return self._streaming_window is not None and self.isPrinting() and not self.isStreaming()
+
+	def _use_streaming_window(self, gcode):
+		"""
+		Whether a command with the provided ``gcode`` is to be sent through the streaming window, which is the case
+		for all commands that need to be acknowledged by the firmware while printing in advanced streaming mode.
+		"""
+		if not self._streaming_window_active():
+			return False
+		return gcode is not None or self._unknownCommandsNeedAck
+
+	def _reserve_streaming_window(self, command, linenumber):
+		"""
+		Blocks until the streaming window has room for ``command`` and then registers it as being in flight.
+
+		Arguments:
+		    command (str): The command that is about to be sent.
+		    linenumber (int): The line number the command will be sent with, or ``None`` if it will be sent without
+		        line number and checksum.
+		"""
+		size = len(command) + 1
+		if linenumber is not None:
+			# "N<linenumber> " prefix and "*<checksum>" suffix, checksum has at most three digits
+			size += len(str(linenumber)) + 6
+
+		while self._send_queue_active and not self._streaming_window.wait_for_room(size, timeout=1.0):
+			pass
+		self._streaming_window.add(linenumber, size)
+
+	def _fill_streaming_window(self):
+		"""
+		Fetches the next line to send if the streaming window still has room and nothing else is waiting to be sent.
+		Resends and heatups take precedence and will stop the window from being filled until they are done.
+		"""
+		if not self.isPrinting() or self.isSdPrinting() or self.isStreaming():
+			return
+		if self._resendDelta is not None or self._heatup_status is self.__class__.HEAT_START:
+			return
+		if not self._send_queue.empty() or not self._streaming_window.has_room():
+			return
+
+		if not self._sendFromQueue():
+			self._sendNext()
+
+	def _build_gcode_dispatch(self):
+		"""
+		Builds the dispatch table used by :meth:`_process_command_phase`, mapping each command phase to
+
+		  * the hook handlers to call for commands no handler declared an interest in (see :func:`gcode_hook_filter`),
+		  * a dict mapping GCODE identifiers to the hook handlers to call for them,
+		  * a dict mapping GCODE identifiers to the GCODE specific command phase handler of this class and
+		  * the generic command phase handler of this class, if any.
+
+		Hook handlers are stored as tuples of name, handler and their position among all hook handlers of the phase, in
+		registration order. Handlers of this class are stored unbound to not create a reference cycle with this
+		instance.
+		"""
+		phases = ("queuing", "queued", "sending", "sent")
+
+		gcode_handlers = dict((phase, dict()) for phase in phases)
+		for name in dir(self.__class__):
+			match = regex_gcode_handler.match(name)
+			if match:
+				gcode_handlers[match.group("phase")][match.group("gcode")] = getattr(self.__class__, name)
+
+		dispatch = dict()
+		for phase in phases:
+			hooks = []
+			for position, (name, hook) in enumerate(self._gcode_hooks[phase].items()):
+				gcodes = getattr(hook, "gcodes", None)
+				hooks.append((name, hook, position, frozenset(gcodes) if gcodes is not None else None))
+
+			unfiltered_hooks = [(name, hook, position) for name, hook, position, hook_gcodes in hooks if hook_gcodes is None]
+
+			filtered_gcodes = set()
+			for _, _, _, hook_gcodes in hooks:
+				if hook_gcodes is not None:
+					filtered_gcodes.update(hook_gcodes)
+
+			hooks_by_gcode = dict()
+			for gcode in filtered_gcodes:
+				hooks_by_gcode[gcode] = [(name, hook, position) for name, hook, position, hook_gcodes in hooks if hook_gcodes is None or gcode in hook_gcodes]
+
+			command_phase_handler = getattr(self.__class__, "_command_phase_" + phase, None)
+			dispatch[phase] = (unfiltered_hooks, hooks_by_gcode, gcode_handlers[phase], command_phase_handler)
+
+		return dispatch
 
 	def _process_command_phase(self, phase, command, command_type=None, gcode=None):
-		if phase not in ("queuing", "queued", "sending", "sent"):
+		if phase not in self._gcode_dispatch:
 			return command, command_type, gcode
 
 		if gcode is None:
 			gcode = gcode_command_for_cmd(command)
 
-		# send it through the phase specific handlers provided by plugins
-		for name, hook in self._gcode_hooks[phase].items():
+		unfiltered_hooks, hooks_by_gcode, gcode_handlers, command_phase_handler = self._gcode_dispatch[phase]
+
+		# send it through the phase specific handlers provided by plugins that are interested in this command
+		hooks = hooks_by_gcode.get(gcode, unfiltered_hooks)
+		index = 0
+		while index < len(hooks):
+			name, hook, position = hooks[index]
+			index += 1
+
 			try:
 				hook_result = hook(self, phase, command, command_type, gcode)
 			except:
 				self._logger.exception("Error while processing hook {name} for phase {phase} and command {command}:".format(**locals()))
 			else:
+				previous_gcode = gcode
 				command, command_type, gcode = self._handle_command_handler_result(command, command_type, gcode, hook_result)
 				if command is None:
 					# hook handler return None as command, so we'll stop here and return a full out None result
 					return None, None, None
 
+				if gcode != previous_gcode:
+					# the handler turned the command into a different one, continue with the handlers registered
+					# after it that are interested in that
+					hooks = hooks_by_gcode.get(gcode, unfiltered_hooks)
+					index = 0
+					while index < len(hooks) and hooks[index][2] <= position:
+						index += 1
+
 		# if it's a gcode command send it through the specific handler if it exists
 		if gcode is not None:
-			gcodeHandler = "_gcode_" + gcode + "_" + phase
-			if hasattr(self, gcodeHandler):
-				handler_result = getattr(self, gcodeHandler)(command, cmd_type=command_type)
+			gcode_handler = gcode_handlers.get(gcode)
+			if gcode_handler is not None:
+				handler_result = gcode_handler(self, command, cmd_type=command_type)
 				command, command_type, gcode = self._handle_command_handler_result(command, command_type, gcode, handler_result)
 
 		# send it through the phase specific command handler if it exists
-		commandPhaseHandler = "_command_phase_" + phase
-		if hasattr(self, commandPhaseHandler):
-			handler_result = getattr(self, commandPhaseHandler)(command, cmd_type=command_type, gcode=gcode)
+		if command_phase_handler is not None:
+			handler_result = command_phase_handler(self, command, cmd_type=command_type, gcode=gcode)
 			command, command_type, gcode = self._handle_command_handler_result(command, command_type, gcode, handler_result)
 
 		# finally return whatever we resulted on
@@ -1809,7 +2595,9 @@ class MachineCom(object):
 			# handler returned a tuple of an unexpected length
 			return original_tuple
 
-		gcode = gcode_command_for_cmd(command)
+		if command is not original_tuple[0]:
+			# only parse the command again if the handler actually changed it
+			gcode = gcode_command_for_cmd(command)
 		return command, command_type, gcode
 
 	##~~ actual sending via serial
@@ -1817,15 +2605,20 @@ class MachineCom(object):
 	def _doIncrementAndSendWithChecksum(self, cmd):
 		with self._line_mutex:
 			linenumber = self._currentLine
-			self._addToLastLines(cmd)
+			self._addToLastLines(linenumber, cmd)
 			self._currentLine += 1
 			self._doSendWithChecksum(cmd, linenumber)
 
 	def _doSendWithChecksum(self, cmd, lineNumber):
-		commandToSend = "N%d %s" % (lineNumber, cmd)
-		checksum = reduce(lambda x,y:x^y, map(ord, commandToSend))
-		commandToSend = "%s*%d" % (commandToSend, checksum)
-		self._doSendWithoutChecksum(commandToSend)
+		"""
+		Sends ``cmd`` with line number and checksum. If ``cmd`` is a :class:`PreparedCommand`, its precalculated
+		checksum is used and only the one of the line number prefix is added to it.
+		"""
+		checksum = None
+		if isinstance(cmd, PreparedCommand):
+			checksum = cmd.checksum
+			cmd = cmd.encode("ascii", errors="replace")
+		self._doSendWithoutChecksum(framing.frame(cmd, lineNumber, command_checksum=checksum))
 		
 	def _doSendEmergency(self, cmd):
 		if self._serial is None:
@@ -1856,6 +2649,18 @@ class MachineCom(object):
 		if not self.isPrinting(): #lkj 
 			self._log("Send: %s" % cmd)
 			
+		if self._ok_time is not None:
+			latency = time.time() - self._ok_time
+			self._ok_time = None
+			if self._send_latency is None:
+				self._send_latency = latency
+			else:
+				self._send_latency += (latency - self._send_latency) * 0.2
+
+		if self._event_loop_attached:
+			self._write_nonblocking(cmd + '\n')
+			return
+
 		try:
 			self._serial.write(cmd + '\n')
 		except serial.SerialTimeoutException:
@@ -1875,24 +2680,52 @@ class MachineCom(object):
 				self._errorValue = get_exception_string()
 				self.close(True)
 
+	def _write_nonblocking(self, data):
+		"""
+		Writes ``data`` to the connection without blocking the event loop. Whatever doesn't fit into the connection's
+		buffers right now is kept in ``self._write_buffer`` and written as soon as the connection has room again, see
+		:meth:`_on_serial_writable`.
+		"""
+		self._write_buffer += data
+		self._flush_write_buffer()
+
+	def _flush_write_buffer(self):
+		if not self._write_buffer or self._serial is None or self._serial_write_fd is None:
+			# nothing to write or the connection is being reestablished right now
+			return
+
+		try:
+			written = self._serial.write_available(self._write_buffer)
+		except:
+			self._handle_write_error()
+			return
+
+		if written is None:
+			self._on_serial_lost()
+			return
+
+		self._write_buffer = self._write_buffer[written:]
+		if self._write_buffer and self._serial_write_fd is not None:
+			self._event_loop.add_writer(self._serial_write_fd, self._on_serial_writable)
+
+	def _on_serial_writable(self):
+		self._flush_write_buffer()
+		if not self._write_buffer and self._serial_write_fd is not None:
+			self._event_loop.remove_writer(self._serial_write_fd)
+
 	##~~ command handlers
 
 	def _gcode_T_sent(self, cmd, cmd_type=None):
-		toolMatch = regexes_parameters["intT"].search(cmd)
-		if toolMatch:
-			self._currentTool = int(toolMatch.group("value"))
+		tool = tokenizer.parse_words(cmd).get("T")
+		if tool is not None:
+			self._currentTool = int(tool)
 
 	def _gcode_G0_sent(self, cmd, cmd_type=None):
-		if 'Z' in cmd:
-			match = regexes_parameters["floatZ"].search(cmd)
-			if match:
-				try:
-					z = float(match.group("value"))
-					if self._currentZ != z:
-						self._currentZ = z
-						self._callback.on_comm_z_change(z)
-				except ValueError:
-					pass
+		if 'Z' in cmd or 'z' in cmd:
+			z = tokenizer.parse_words(cmd).get("Z")
+			if z is not None and self._currentZ != z:
+				self._currentZ = z
+				self._callback.on_comm_z_change(z)
 	_gcode_G1_sent = _gcode_G0_sent
 
 	def _gcode_M0_queuing(self, cmd, cmd_type=None):
@@ -1917,34 +2750,26 @@ class MachineCom(object):
 	_gcode_M190_queuing = _gcode_M140_queuing
 
 	def _gcode_M104_sent(self, cmd, cmd_type=None):
+		words = tokenizer.parse_words(cmd)
 		toolNum = self._currentTool
-		toolMatch = regexes_parameters["intT"].search(cmd)
-		if toolMatch:
-			toolNum = int(toolMatch.group("value"))
-		match = regexes_parameters["floatS"].search(cmd)
-		if match:
-			try:
-				target = float(match.group("value"))
-				if toolNum in self._temp.keys() and self._temp[toolNum] is not None and isinstance(self._temp[toolNum], tuple):
-					(actual, oldTarget) = self._temp[toolNum]
-					self._temp[toolNum] = (actual, target)
-				else:
-					self._temp[toolNum] = (None, target)
-			except ValueError:
-				pass
+		if words.get("T") is not None:
+			toolNum = int(words["T"])
+		target = words.get("S")
+		if target is not None:
+			if toolNum in self._temp.keys() and self._temp[toolNum] is not None and isinstance(self._temp[toolNum], tuple):
+				(actual, oldTarget) = self._temp[toolNum]
+				self._temp[toolNum] = (actual, target)
+			else:
+				self._temp[toolNum] = (None, target)
 
 	def _gcode_M140_sent(self, cmd, cmd_type=None):
-		match = regexes_parameters["floatS"].search(cmd)
-		if match:
-			try:
-				target = float(match.group("value"))
-				if self._bedTemp is not None and isinstance(self._bedTemp, tuple):
-					(actual, oldTarget) = self._bedTemp
-					self._bedTemp = (actual, target)
-				else:
-					self._bedTemp = (None, target)
-			except ValueError:
-				pass
+		target = tokenizer.parse_words(cmd).get("S")
+		if target is not None:
+			if self._bedTemp is not None and isinstance(self._bedTemp, tuple):
+				(actual, oldTarget) = self._bedTemp
+				self._bedTemp = (actual, target)
+			else:
+				self._bedTemp = (None, target)
 
 	def _gcode_M109_sent(self, cmd, cmd_type=None):
 		self._heatupWaitStartTime = time.time()
@@ -1959,15 +2784,10 @@ class MachineCom(object):
 		self._gcode_M140_sent(cmd, cmd_type)
 
 	def _gcode_M110_sending(self, cmd, cmd_type=None):
-		newLineNumber = None
-		match = regexes_parameters["intN"].search(cmd)
-		if match:
-			try:
-				newLineNumber = int(match.group("value"))
-			except:
-				pass
-		else:
-			newLineNumber = 0
+		newLineNumber = 0
+		words = tokenizer.parse_words(cmd)
+		if words.get("N") is not None:
+			newLineNumber = int(words["N"])
 
 		with self._line_mutex:
 			# send M110 command with new line number
@@ -2001,7 +2821,7 @@ class MachineCom(object):
 		# fire the M112 event since we sent it and we're going to prevent the caller from seeing it
 		gcode = "M112"
 		if gcode in gcodeToEvent:
-			eventManager().fire(gcodeToEvent[gcode])
+			self._fire_event(gcodeToEvent[gcode])
 
 		# return None 1-tuple to eat the one that is queuing because we don't want to send it twice
 		# I hope it got it the first time because as far as I can tell, there is no way to know
@@ -2009,14 +2829,13 @@ class MachineCom(object):
 
 	def _gcode_G4_sent(self, cmd, cmd_type=None):
 		# we are intending to dwell for a period of time, increase the timeout to match
-		p_match = regexes_parameters["floatP"].search(cmd)
-		s_match = regexes_parameters["floatS"].search(cmd)
+		words = tokenizer.parse_words(cmd)
 
 		_timeout = 0
-		if p_match:
-			_timeout = float(p_match.group("value")) / 1000.0
-		elif s_match:
-			_timeout = float(s_match.group("value"))
+		if words.get("P") is not None:
+			_timeout = words["P"] / 1000.0
+		elif words.get("S") is not None:
+			_timeout = words["S"]
 		self._timeout = get_new_timeout("communication") + _timeout
 
 	##~~ command phase handlers
@@ -2108,6 +2927,18 @@ class PrintingFileInformation(object):
 			return -1
 		return float(self._pos) / float(self._size)
 
+	def getLayer(self):
+		"""
+		The number of the layer currently printed, None if unknown.
+		"""
+		return None
+
+	def getEstimatedTimeLeft(self):
+		"""
+		The estimated print time left according to the file's analysis in seconds, None if unknown.
+		"""
+		return None
+
 	def reset(self):
 		"""
 		Resets the current file position to 0.
@@ -2148,14 +2979,31 @@ class PrintingGcodeFileInformation(PrintingFileInformation):
 	"""
 	Encapsulates information regarding an ongoing direct print. Takes care of the needed file handle and ensures
 	that the file is closed in case of an error.
+
+	If ``read_ahead`` is set to a positive number of lines, the file will be read in blocks of ``block_size`` bytes
+	by a separate thread that strips comments and prepares the lines for sending (see :class:`PreparedCommand`)
+	ahead of time, buffering up to ``read_ahead`` of them. :meth:`getNext` then only has to pop the next prepared
+	line from that buffer. Temperature offsets are still applied when a line is popped, so changes to them take
+	effect immediately.
+
+	If the layer index from the file's analysis is set (see :meth:`setLayerIndex`), progress is reported based on the
+	estimated print time of the file's layers instead of the bytes printed, and the current layer and the estimated
+	print time left are available.
 	"""
 
-	def __init__(self, filename, offsets_callback=None, current_tool_callback=None, origin=FileDestinations.LOCAL):
+	def __init__(self, filename, offsets_callback=None, current_tool_callback=None, origin=FileDestinations.LOCAL, read_ahead=0, block_size=64 * 1024):
 		PrintingFileInformation.__init__(self, filename)
 
 		self._handle = None
 
+		self._read_ahead = read_ahead
+		self._block_size = block_size
+		self._read_ahead_queue = None
+		self._read_ahead_stop = None
+		self._read_ahead_thread = None
+
 		self._first_line = None
+		self._layer_index = None
 
 		self._offsets_callback = offsets_callback
 		self._current_tool_callback = current_tool_callback
@@ -2169,24 +3017,103 @@ class PrintingGcodeFileInformation(PrintingFileInformation):
 	def getFileLocation(self):
 		return self._origin	
 
+	def seek(self, pos):
+		"""
+		Sets the position in the file to start reading from, which needs to be the start of a line. Only takes effect
+		if called before :meth:`start`.
+		"""
+		self._pos = pos
+
+	def setLayerIndex(self, layer_index):
+		"""
+		Sets the :class:`~octoprint.util.gcodeInterpreter.LayerIndex` of the file, None to unset it.
+		"""
+		self._layer_index = layer_index
+
+	def getProgress(self):
+		if self._layer_index is not None:
+			progress = self._layer_index.get_progress(self._pos)
+			if progress is not None:
+				return progress
+		return PrintingFileInformation.getProgress(self)
+
+	def getLayer(self):
+		if self._layer_index is None:
+			return None
+		return self._layer_index.get_layer(self._pos)
+
+	def getEstimatedTimeLeft(self):
+		if self._layer_index is None:
+			return None
+		return self._layer_index.get_time_left(self._pos)
+
 	def start(self):
 		"""
 		Opens the file for reading and determines the file size.
 		"""
 		PrintingFileInformation.start(self)
-		self._handle = bom_aware_open(self._filename, encoding="utf-8", errors="replace")
+
+		# a restarted print must not leave the reader of the previous run behind
+		self._stop_read_ahead()
+
+		if self._read_ahead > 0:
+			# every run gets its own queue and stop event, so a reader that is still winding down can never feed
+			# lines into a later run
+			read_ahead_queue = queue.Queue(maxsize=self._read_ahead)
+			read_ahead_stop = threading.Event()
+
+			read_ahead_thread = threading.Thread(target=self._read_ahead_worker,
+			                                     args=(read_ahead_queue, read_ahead_stop),
+			                                     name="comm.read_ahead")
+			read_ahead_thread.daemon = True
+
+			self._read_ahead_queue = read_ahead_queue
+			self._read_ahead_stop = read_ahead_stop
+			self._read_ahead_thread = read_ahead_thread
+			read_ahead_thread.start()
+		else:
+			self._handle = bom_aware_open(self._filename, encoding="utf-8", errors="replace")
+			if self._pos:
+				self._handle.seek(self._pos)
 
 	def close(self):
 		"""
 		Closes the file if it's still open.
 		"""
 		PrintingFileInformation.close(self)
+		self._stop_read_ahead()
 		if self._handle is not None:
 			try:
 				self._handle.close()
 			except:
 				pass
 		self._handle = None
+
+	def _stop_read_ahead(self):
+		"""
+		Stops the read ahead thread of the current run, if any, and waits for it to finish.
+		"""
+		read_ahead_queue = self._read_ahead_queue
+		read_ahead_stop = self._read_ahead_stop
+		read_ahead_thread = self._read_ahead_thread
+
+		self._read_ahead_queue = None
+		self._read_ahead_stop = None
+		self._read_ahead_thread = None
+
+		if read_ahead_stop is None:
+			return
+		read_ahead_stop.set()
+
+		# make room in the queue so a reader blocked on putting a line notices the stop right away
+		try:
+			while True:
+				read_ahead_queue.get_nowait()
+		except queue.Empty:
+			pass
+
+		if read_ahead_thread is not None and read_ahead_thread is not threading.current_thread():
+			read_ahead_thread.join()
 	#have M190 in file ?
 	def getFileStart50LineHaveM190(self):  
 		fileHandle = open(self._filename, "r")
@@ -2229,6 +3156,9 @@ class PrintingGcodeFileInformation(PrintingFileInformation):
 		"""
 		Retrieves the next line for printing.
 		"""
+		if self._read_ahead > 0:
+			return self._get_next_read_ahead()
+
 		if self._handle is None:
 			return None
 			#lkj raise ValueError("File %s is not open for reading" % self._filename)
@@ -2254,15 +3184,109 @@ class PrintingGcodeFileInformation(PrintingFileInformation):
 			self._logger.exception("Exception while processing line")
 			raise e
 
+	def _get_next_read_ahead(self):
+		read_ahead_queue = self._read_ahead_queue
+		read_ahead_stop = self._read_ahead_stop
+		if read_ahead_queue is None or read_ahead_stop is None:
+			return None
+
+		line = pos = None
+		while not read_ahead_stop.is_set():
+			try:
+				line, pos = read_ahead_queue.get(timeout=1.0)
+				break
+			except queue.Empty:
+				continue
+
+		if line is None:
+			# end of file, stopped run or an error while reading, which then takes the place of the position
+			self.close()
+			if isinstance(pos, Exception):
+				raise pos
+			return None
+
+		self._pos = pos
+
+		if line.gcode in _temperature_gcodes and self._offsets_callback is not None:
+			current_tool = self._current_tool_callback() if self._current_tool_callback is not None else None
+			line = apply_temperature_offsets(line, self._offsets_callback(), current_tool=current_tool)
+		return line
+
+	def _read_ahead_worker(self, read_ahead_queue, read_ahead_stop):
+		"""
+		Reads the file in blocks and puts the prepared lines together with the file position after them into the
+		read ahead queue, until the end of the file is reached or ``read_ahead_stop`` is set. A ``None`` line marks
+		the end of the file, or an error while reading it if the exception takes the place of the position.
+		"""
+		error = None
+		try:
+			with io.open(self._filename, "rb", buffering=self._block_size) as f:
+				pos = self._pos
+				if pos:
+					f.seek(pos)
+				for raw in f:
+					if pos == 0 and raw.startswith(codecs.BOM_UTF8):
+						line = raw[len(codecs.BOM_UTF8):]
+					else:
+						line = raw
+					pos += len(raw)
+
+					processed = process_gcode_line(to_unicode(line, errors="replace"))
+					if processed is None:
+						continue
+					if not self._put_read_ahead(read_ahead_queue, read_ahead_stop, (PreparedCommand(processed), pos)):
+						return
+		except Exception as e:
+			self._logger.exception("Exception while reading ahead in {}".format(self._filename))
+			error = e
+		self._put_read_ahead(read_ahead_queue, read_ahead_stop, (None, error))
+
+	@staticmethod
+	def _put_read_ahead(read_ahead_queue, read_ahead_stop, entry):
+		while not read_ahead_stop.is_set():
+			try:
+				read_ahead_queue.put(entry, timeout=1.0)
+				return True
+			except queue.Full:
+				continue
+		return False
+
 class StreamingGcodeFileInformation(PrintingGcodeFileInformation):
-	def __init__(self, path, localFilename, remoteFilename):
-		PrintingGcodeFileInformation.__init__(self, path)
+	"""
+	Encapsulates information regarding an ongoing transfer of a file to the printer's SD. Keeps track of the number
+	of lines and bytes transferred, see :meth:`getThroughput`.
+	"""
+
+	def __init__(self, path, localFilename, remoteFilename, read_ahead=0, block_size=64 * 1024):
+		PrintingGcodeFileInformation.__init__(self, path, read_ahead=read_ahead, block_size=block_size)
 		self._localFilename = localFilename
 		self._remoteFilename = remoteFilename
+		self._lines = 0
+		self._bytes = 0
 
 	def start(self):
 		PrintingGcodeFileInformation.start(self)
 		self._start_time = time.time()
+		self._lines = 0
+		self._bytes = 0
+
+	def getNext(self):
+		line = PrintingGcodeFileInformation.getNext(self)
+		if line is not None:
+			self._lines += 1
+			self._bytes += len(line) + 1
+		return line
+
+	def getThroughput(self):
+		"""
+		Returns the number of lines and bytes (excluding line numbers and checksums) transferred so far as ``lines``
+		and ``bytes`` and the resulting throughput as ``linesPerSecond`` and ``bytesPerSecond``.
+		"""
+		duration = time.time() - self._start_time if self._start_time is not None else 0
+		return dict(lines=self._lines,
+		            bytes=self._bytes,
+		            linesPerSecond=self._lines / duration if duration > 0 else 0.0,
+		            bytesPerSecond=self._bytes / duration if duration > 0 else 0.0)
 
 	def getLocalFilename(self):
 		return self._localFilename
@@ -2271,6 +3295,230 @@ class StreamingGcodeFileInformation(PrintingGcodeFileInformation):
 		return self._remoteFilename
 
 
+class PreparedCommand(unicode):
+	"""
+	A command that has been prepared for sending ahead of time, e.g. while reading ahead in a file to print.
+
+	Carries its GCODE identifier (``gcode``) and the checksum of its ASCII representation (``checksum``) along, so
+	that neither has to be determined again on the send path. Any modification of the command, e.g. by a hook,
+	results in a plain string, so these values can never get out of sync with the command itself.
+	"""
+
+	def __new__(cls, command):
+		prepared = unicode.__new__(cls, command)
+		prepared.gcode = gcode_command_for_cmd(command)
+		prepared.checksum = framing.checksum(command)
+		return prepared
+
+
+class SendWindow(object):
+	"""
+	Keeps track of the lines that have been sent to the printer but not yet been acknowledged with an ``ok``, for
+	streaming several lines at once into the firmware's receive buffer.
+
+	A line may only be added if both the number of lines in flight stays below ``max_lines`` and the number of bytes
+	in flight stays within ``max_bytes``. A single line is always allowed if nothing is in flight, even if it exceeds
+	the byte budget on its own, since otherwise it could never be sent at all.
+
+	Arguments:
+	    max_lines (int): Maximum number of unacknowledged lines.
+	    max_bytes (int): Maximum number of unacknowledged bytes, usually the size of the firmware's receive buffer.
+	"""
+
+	def __init__(self, max_lines, max_bytes):
+		self._max_lines = max(max_lines, 1)
+		self._max_bytes = max_bytes
+		self._lines = deque()
+		self._bytes = 0
+		self._condition = threading.Condition()
+
+	@property
+	def lines(self):
+		"""Line numbers currently in flight, oldest first. ``None`` for lines sent without line number."""
+		with self._condition:
+			return [linenumber for linenumber, _ in self._lines]
+
+	@property
+	def bytes(self):
+		"""Number of bytes currently in flight."""
+		with self._condition:
+			return self._bytes
+
+	def has_room(self, size=0):
+		with self._condition:
+			return self._has_room(size)
+
+	def wait_for_room(self, size, timeout=None):
+		"""
+		Waits until a line of ``size`` bytes fits into the window or ``timeout`` seconds have passed.
+
+		Returns:
+		    bool: Whether the line fits into the window now.
+		"""
+		with self._condition:
+			if not self._has_room(size):
+				self._condition.wait(timeout)
+			return self._has_room(size)
+
+	def add(self, linenumber, size):
+		with self._condition:
+			self._lines.append((linenumber, size))
+			self._bytes += size
+
+	def acknowledge(self):
+		"""
+		Marks the oldest line in flight as acknowledged.
+
+		Returns:
+		    bool: True if a line was acknowledged, False if there was nothing in flight.
+		"""
+		with self._condition:
+			if not self._lines:
+				return False
+			_, size = self._lines.popleft()
+			self._bytes -= size
+			self._condition.notify_all()
+			return True
+
+	def discard_from(self, linenumber):
+		"""
+		Forgets about the lines in flight sent with ``linenumber`` or a later line number, e.g. because the firmware
+		requested ``linenumber`` to be resent and dropped the lines after it. Lines sent without line number stay.
+
+		Returns:
+		    list: The line numbers of the forgotten lines.
+		"""
+		with self._condition:
+			discarded = [number for number, _ in self._lines if number is not None and number >= linenumber]
+			if discarded:
+				self._lines = deque((number, size) for number, size in self._lines if number is None or number < linenumber)
+				self._bytes = sum(size for _, size in self._lines)
+				self._condition.notify_all()
+			return discarded
+
+	def reset(self):
+		"""
+		Forgets about all lines in flight, e.g. if the firmware reported an empty buffer or we ran into a timeout.
+		"""
+		with self._condition:
+			self._lines.clear()
+			self._bytes = 0
+			self._condition.notify_all()
+
+	def __len__(self):
+		with self._condition:
+			return len(self._lines)
+
+	def _has_room(self, size):
+		if not self._lines:
+			return True
+		return len(self._lines) < self._max_lines and self._bytes + size <= self._max_bytes
+
+
+class LineHistory(object):
+	"""
+	History of the lines sent with line number, for resending them on request of the printer.
+
+	Lines are stored in a fixed size ring buffer indexed by their absolute line number, so looking up a line is
+	independent of how many lines have been sent since and older lines are overwritten without having to shift
+	anything around. Since lines are always added with consecutive line numbers, any line number between the oldest
+	and the newest line still in the buffer is guaranteed to be available.
+
+	Arguments:
+	    depth (int): Number of lines to keep.
+	"""
+
+	def __init__(self, depth):
+		self._depth = max(depth, 1)
+		self._lines = [None] * self._depth
+		self._linenumbers = [None] * self._depth
+		self._oldest = None
+		self._newest = None
+
+	@property
+	def depth(self):
+		return self._depth
+
+	def add(self, linenumber, line):
+		"""
+		Adds ``line`` sent with ``linenumber``. If ``linenumber`` doesn't directly follow the newest line in the
+		history (e.g. because the line numbers were reset by ``M110``) the history is cleared first.
+		"""
+		if self._newest is None or linenumber != self._newest + 1:
+			self.clear()
+			self._oldest = linenumber
+		elif linenumber - self._oldest >= self._depth:
+			self._oldest = linenumber - self._depth + 1
+
+		index = linenumber % self._depth
+		self._lines[index] = line
+		self._linenumbers[index] = linenumber
+		self._newest = linenumber
+
+	def clear(self):
+		self._lines = [None] * self._depth
+		self._linenumbers = [None] * self._depth
+		self._oldest = None
+		self._newest = None
+
+	def __contains__(self, linenumber):
+		return self._oldest is not None and self._oldest <= linenumber <= self._newest
+
+	def __getitem__(self, linenumber):
+		if not linenumber in self:
+			raise KeyError(linenumber)
+		return self._lines[linenumber % self._depth]
+
+	def __len__(self):
+		if self._oldest is None:
+			return 0
+		return self._newest - self._oldest + 1
+
+
+class ResendStatistics(object):
+	"""
+	Counts resend requests and how far back they reach, to help judging the quality of the serial link.
+	"""
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.sent = 0
+		self.requests = 0
+		self.lines = 0
+		self.failed = 0
+		self.max_distance = 0
+		self.last_distance = None
+
+	def record(self, distance):
+		"""
+		Records a resend request for the line ``distance`` lines back, all of which will have to be resent.
+		"""
+		self.requests += 1
+		self.lines += distance
+		self.max_distance = max(self.max_distance, distance)
+		self.last_distance = distance
+
+	def record_failure(self):
+		"""
+		Records a resend request that could not be served from the history.
+		"""
+		self.failed += 1
+
+	def as_dict(self):
+		return dict(
+			sent=self.sent,
+			requests=self.requests,
+			lines=self.lines,
+			failed=self.failed,
+			maxDistance=self.max_distance,
+			lastDistance=self.last_distance,
+			averageDistance=float(self.lines) / self.requests if self.requests else None,
+			ratio=float(self.lines) / self.sent if self.sent else 0.0
+		)
+
+
 class TypedQueue(queue.Queue):
 
 	def __init__(self, maxsize=0):
@@ -2320,6 +3568,8 @@ def get_interval(type, default_value=0.0):
 		else:
 			return value
 
+_temperature_gcodes = ("M104", "M109", "M140", "M190")
+
 _temp_command_regex = re.compile("^M(?P<command>104|109|140|190)(\s+T(?P<tool>\d+)|\s+S(?P<temperature>[-+]?\d*\.?\d*))+")
 
 def apply_temperature_offsets(line, offsets, current_tool=None):
@@ -2383,6 +3633,58 @@ def process_gcode_line(line, offsets=None, current_tool=None):
 
 	return line
 
+def checkpoint_commands(checkpoint, lift=2.0):
+	"""
+	Creates the commands restoring the state of the printer at a checkpoint of a file's layer index (see
+	:meth:`~octoprint.util.gcodeInterpreter.LayerIndex.get_checkpoint`) before printing the file from there on.
+
+	The printer needs to still know its position, e.g. because the print was cancelled or the axes were homed again.
+	The commands heat up to the target temperatures, select the tool, lift the nozzle by ``lift`` mm, move to the
+	checkpoint's position from above and then set the extruder position, the fan speed and the positioning modes.
+	If the file set an offset via ``G92`` before the checkpoint, the position is approached without it and the offset
+	is then restored by setting the position to the one the file expects there.
+	"""
+	def number(value):
+		return ("%.5f" % value).rstrip("0").rstrip(".")
+
+	commands = []
+
+	temperatures = checkpoint.get("temperatures") or dict()
+	tools = sorted(int(key[len("tool"):]) for key in temperatures if key.startswith("tool"))
+	bed = temperatures.get("bed")
+	if bed:
+		commands.append("M140 S%s" % number(bed))
+	for tool in tools:
+		commands.append("M104 T%d S%s" % (tool, number(temperatures["tool%d" % tool])))
+	if bed:
+		commands.append("M190 S%s" % number(bed))
+	for tool in tools:
+		if temperatures["tool%d" % tool]:
+			commands.append("M109 T%d S%s" % (tool, number(temperatures["tool%d" % tool])))
+
+	commands.append("T%d" % checkpoint["tool"])
+
+	x, y, z = checkpoint["position"]
+	ox, oy, oz = checkpoint.get("offset") or (0.0, 0.0, 0.0)
+	commands += ["G21",
+	             "G91",
+	             "G0 Z%s" % number(lift),
+	             "G90",
+	             "G20" if checkpoint["inches"] else "G21",
+	             "G0 X%s Y%s F%s" % (number(x + ox), number(y + oy), number(checkpoint["feedrate"])),
+	             "G0 Z%s" % number(z + oz)]
+	if ox or oy or oz:
+		commands.append("G92 X%s Y%s Z%s" % (number(x), number(y), number(z)))
+	commands += ["G92 E%s" % number(checkpoint["e"]),
+	             "M82" if checkpoint["absoluteExtrusion"] else "M83"]
+
+	if checkpoint.get("fan") is not None:
+		commands.append("M106 S%d" % checkpoint["fan"] if checkpoint["fan"] else "M107")
+	if not checkpoint["absolutePositioning"]:
+		commands.append("G91")
+
+	return commands
+
 def convert_pause_triggers(configured_triggers):
 	triggers = {
 		"enable": [],
@@ -2580,6 +3882,55 @@ def parse_temperature_line(line, current):
 
 	return max(maxToolNum, current), canonicalize_temperatures(result, current)
 
+def classify_line(line):
+	"""
+	Classifies a line received from the printer.
+
+	The line's type is determined from its prefix through a single match against :data:`regex_line_prefix`, only
+	lines without a known prefix are searched for temperature reports and SD card related messages.
+
+	Arguments:
+	    line (str): The line to classify.
+
+	Returns:
+	    tuple: A 3-tuple consisting of the line's type (one of the ``LINE_*`` constants), whether the line
+	        acknowledges a command (starts with ``ok``) and the SD message keyword found in the line (one of
+	        :data:`sd_message_keywords`) or None. Lines starting with ``ok`` that also report temperatures
+	        (answer to ``M105``) will be classified as :data:`LINE_TEMPERATURE`.
+	"""
+	stripped = line.strip()
+	if not stripped:
+		return LINE_EMPTY, False, None
+
+	match = regex_line_prefix.match(stripped)
+	if match is not None:
+		line_type = match.lastgroup
+		if line_type == LINE_OK:
+			if len(stripped) > 2 and regex_temperature_report.search(line):
+				return LINE_TEMPERATURE, True, None
+			return LINE_OK, True, None
+		elif line_type == LINE_DEBUG:
+			if stripped[2:].lstrip().startswith("action:"):
+				return LINE_ACTION, False, None
+			return LINE_DEBUG, False, None
+		elif line_type == LINE_ERROR:
+			# errors might be about the SD card
+			match = regex_sd_message.search(stripped)
+			return LINE_ERROR, False, match.group(0) if match is not None else None
+		return line_type, False, None
+
+	if regex_temperature_report.search(line):
+		return LINE_TEMPERATURE, False, None
+	if "TargetExtr" in stripped or "TargetBed" in stripped:
+		return LINE_TARGET_TEMPERATURE, False, None
+
+	match = regex_sd_message.search(stripped)
+	if match is not None:
+		return LINE_SD, False, match.group(0)
+
+	return LINE_MESSAGE, False, None
+
+
 def gcode_command_for_cmd(cmd):
 	"""
 	Tries to parse the provided ``cmd`` and extract the GCODE command identifier from it (e.g. "G0" for "G0 X10.0").
@@ -2593,6 +3944,9 @@ def gcode_command_for_cmd(cmd):
 	if not cmd:
 		return None
 
+	if isinstance(cmd, PreparedCommand):
+		return cmd.gcode
+
 	gcode = regex_command.search(cmd)
 	if not gcode:
 		return None
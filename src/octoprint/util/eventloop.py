@@ -0,0 +1,480 @@
+# coding=utf-8
+"""
+This module contains a small event loop for driving non-blocking connections from a single thread.
+
+It multiplexes file descriptors via :func:`select.select` and additionally runs one-shot and repeated timers as well as
+callbacks scheduled from other threads, which allows serving several printer connections including their poll timers
+from one thread instead of a reading, a sending and several timer threads per connection.
+
+:class:`LineBuffer` and :class:`ReceiveBuffer` help with reassembling lines received through such connections.
+
+Since :func:`select.select` only supports sockets on Windows, the event loop is only available on POSIX systems.
+"""
+
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import errno
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+
+from collections import deque
+
+
+class EventLoop(object):
+	"""
+	Event loop dispatching readable and writable file descriptors, timers and callbacks scheduled from other threads.
+
+	All public methods may be called from any thread. Callbacks are always executed on the loop's thread, one after
+	the other, so they must not block.
+
+	Example:
+
+	.. code-block:: python
+
+	   loop = EventLoop()
+	   loop.start()
+
+	   loop.add_reader(sock.fileno(), on_readable)
+	   timer = loop.call_repeatedly(2.0, poll)
+	   ...
+	   timer.cancel()
+	   loop.remove_reader(sock.fileno())
+
+	Arguments:
+	    name (str): Name of the loop's thread.
+	"""
+
+	def __init__(self, name="eventloop"):
+		self._logger = logging.getLogger(__name__)
+		self._name = name
+
+		self._mutex = threading.RLock()
+		self._readers = dict()
+		self._writers = dict()
+		self._timers = []
+		self._timer_sequence = itertools.count()
+		self._callbacks = deque()
+
+		self._wakeup_read, self._wakeup_write = os.pipe()
+		_set_nonblocking(self._wakeup_read)
+		_set_nonblocking(self._wakeup_write)
+
+		self._thread = None
+		self._running = False
+
+	@property
+	def running(self):
+		return self._running
+
+	def is_loop_thread(self):
+		"""
+		Returns:
+		    bool: Whether the caller is running on the loop's thread.
+		"""
+		return self._thread is not None and threading.current_thread() is self._thread
+
+	def start(self):
+		"""
+		Starts the loop in a daemon thread of its own. Does nothing if the loop is already running.
+		"""
+		with self._mutex:
+			if self._running:
+				return
+			self._running = True
+			self._thread = threading.Thread(target=self._run, name=self._name)
+			self._thread.daemon = True
+			self._thread.start()
+
+	def stop(self):
+		"""
+		Stops the loop after its current iteration.
+		"""
+		with self._mutex:
+			self._running = False
+		self._wakeup()
+
+	def add_reader(self, fd, callback, *args):
+		"""
+		Calls ``callback(*args)`` whenever ``fd`` is readable, replacing any callback previously registered for ``fd``.
+		"""
+		with self._mutex:
+			self._readers[fd] = (callback, args)
+		self._wakeup()
+
+	def remove_reader(self, fd):
+		"""
+		Stops watching ``fd``.
+
+		Returns:
+		    bool: True if a reader was registered for ``fd``, False otherwise.
+		"""
+		with self._mutex:
+			removed = self._readers.pop(fd, None) is not None
+		self._wakeup()
+		return removed
+
+	def add_writer(self, fd, callback, *args):
+		"""
+		Calls ``callback(*args)`` whenever ``fd`` is writable, replacing any callback previously registered for ``fd``.
+		"""
+		with self._mutex:
+			self._writers[fd] = (callback, args)
+		self._wakeup()
+
+	def remove_writer(self, fd):
+		"""
+		Stops watching ``fd`` for being writable.
+
+		Returns:
+		    bool: True if a writer was registered for ``fd``, False otherwise.
+		"""
+		with self._mutex:
+			removed = self._writers.pop(fd, None) is not None
+		self._wakeup()
+		return removed
+
+	def call_soon_threadsafe(self, callback, *args):
+		"""
+		Calls ``callback(*args)`` on the loop's thread as soon as possible.
+		"""
+		with self._mutex:
+			self._callbacks.append((callback, args))
+		self._wakeup()
+
+	def call_later(self, delay, callback, *args):
+		"""
+		Calls ``callback(*args)`` on the loop's thread after ``delay`` seconds.
+
+		Returns:
+		    Timer: The timer, can be used to cancel the call.
+		"""
+		timer = Timer(self, callback, args)
+		self._schedule(timer, time.time() + delay)
+		return timer
+
+	def call_repeatedly(self, interval, callback, condition=None, run_first=False):
+		"""
+		Calls ``callback()`` on the loop's thread every ``interval`` seconds, similar to
+		:class:`~octoprint.util.RepeatedTimer`.
+
+		Arguments:
+		    interval (float or callable): Interval between calls in seconds, or a callable returning that interval,
+		        which will be evaluated before each call.
+		    callback (callable): The callback to call.
+		    condition (callable): Condition to evaluate before each call, the timer stops as soon as it returns False.
+		    run_first (bool): Whether to call ``callback`` right away instead of waiting for the first interval.
+
+		Returns:
+		    Timer: The timer, can be used to cancel further calls.
+		"""
+		if not callable(interval):
+			interval_value = interval
+			interval = lambda: interval_value
+
+		timer = RepeatingTimer(self, callback, interval, condition)
+		self._schedule(timer, time.time() + (0 if run_first else interval()))
+		return timer
+
+	def _schedule(self, timer, deadline):
+		with self._mutex:
+			heapq.heappush(self._timers, (deadline, next(self._timer_sequence), timer))
+		self._wakeup()
+
+	def _wakeup(self):
+		if self.is_loop_thread():
+			# we'll pick up any changes on the next iteration anyhow
+			return
+
+		try:
+			os.write(self._wakeup_write, "x")
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+
+	def _run(self):
+		try:
+			while self._running:
+				self._run_once()
+		finally:
+			self._running = False
+
+	def _run_once(self):
+		with self._mutex:
+			readers = list(self._readers.keys())
+			writers = list(self._writers.keys())
+			if self._callbacks:
+				timeout = 0
+			elif self._timers:
+				timeout = max(self._timers[0][0] - time.time(), 0)
+			else:
+				timeout = None
+
+		try:
+			readable, writable, _ = select.select(readers + [self._wakeup_read], writers, [], timeout)
+		except (select.error, OSError, ValueError):
+			# one of our descriptors probably got closed underneath us, find and drop it
+			self._drop_invalid_descriptors(readers, writers)
+			return
+
+		if self._wakeup_read in readable:
+			self._drain_wakeup()
+
+		for fd in readable:
+			if fd == self._wakeup_read:
+				continue
+			with self._mutex:
+				reader = self._readers.get(fd)
+			if reader is None:
+				# removed by one of the callbacks we just ran
+				continue
+			callback, args = reader
+			self._execute(callback, args)
+
+		for fd in writable:
+			with self._mutex:
+				writer = self._writers.get(fd)
+			if writer is None:
+				# removed by one of the callbacks we just ran
+				continue
+			callback, args = writer
+			self._execute(callback, args)
+
+		now = time.time()
+		while True:
+			with self._mutex:
+				if not self._timers or self._timers[0][0] > now:
+					break
+				_, _, timer = heapq.heappop(self._timers)
+			timer._fire()
+
+		while True:
+			with self._mutex:
+				if not self._callbacks:
+					break
+				callback, args = self._callbacks.popleft()
+			self._execute(callback, args)
+
+	def _execute(self, callback, args):
+		try:
+			callback(*args)
+		except:
+			self._logger.exception("Error while running callback {!r} on event loop {}".format(callback, self._name))
+
+	def _drain_wakeup(self):
+		try:
+			while os.read(self._wakeup_read, 4096):
+				pass
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+
+	def _drop_invalid_descriptors(self, readers, writers):
+		for fd in readers:
+			if not _is_valid(fd):
+				self._logger.warn("Dropping invalid file descriptor {!r} from event loop {}".format(fd, self._name))
+				self.remove_reader(fd)
+		for fd in writers:
+			if not _is_valid(fd):
+				self._logger.warn("Dropping invalid file descriptor {!r} from event loop {}".format(fd, self._name))
+				self.remove_writer(fd)
+
+
+class Timer(object):
+	"""
+	A call scheduled on an :class:`EventLoop`, see :meth:`EventLoop.call_later`.
+	"""
+
+	def __init__(self, loop, callback, args):
+		self._loop = loop
+		self._callback = callback
+		self._args = args
+		self._cancelled = False
+
+	@property
+	def cancelled(self):
+		return self._cancelled
+
+	def cancel(self):
+		self._cancelled = True
+
+	def _fire(self):
+		if self._cancelled:
+			return
+		self._loop._execute(self._callback, self._args)
+
+
+class RepeatingTimer(Timer):
+	"""
+	A repeated call scheduled on an :class:`EventLoop`, see :meth:`EventLoop.call_repeatedly`.
+	"""
+
+	def __init__(self, loop, callback, interval, condition):
+		Timer.__init__(self, loop, callback, ())
+		self._interval = interval
+		self._condition = condition
+
+	def _fire(self):
+		if self._cancelled:
+			return
+		if self._condition is not None and not self._condition():
+			self._cancelled = True
+			return
+
+		self._loop._execute(self._callback, self._args)
+		if not self._cancelled:
+			self._loop._schedule(self, time.time() + self._interval())
+
+
+class LineBuffer(object):
+	"""
+	Reassembles lines from chunks of data as read from a non-blocking connection.
+	"""
+
+	def __init__(self, terminator="\n"):
+		self._terminator = terminator
+		self._partial = ""
+
+	def feed(self, data):
+		"""
+		Adds ``data`` to the buffer.
+
+		Returns:
+		    list: All lines completed by ``data``, including their terminator. An incomplete last line stays in the
+		        buffer until it is completed by a later call.
+		"""
+		if not data:
+			return []
+
+		data = self._partial + data
+		lines = data.split(self._terminator)
+		self._partial = lines.pop()
+		return [line + self._terminator for line in lines]
+
+	@property
+	def partial(self):
+		"""The incomplete line currently held in the buffer."""
+		return self._partial
+
+	def clear(self):
+		self._partial = ""
+
+
+class ReceiveBuffer(object):
+	"""
+	Receive buffer for a stream socket, data is received directly into a preallocated ``bytearray`` via
+	``recv_into`` and only copied once more when handing out complete lines.
+
+	Arguments:
+	    size (int): Maximum number of bytes to receive at once. The buffer holds twice that and only grows if a single
+	        line doesn't fit.
+	"""
+
+	def __init__(self, size=4096):
+		self._size = size
+		self._buffer = bytearray(2 * size)
+		self._view = memoryview(self._buffer)
+		self._start = 0
+		self._end = 0
+
+	def fill(self, sock, flags=0):
+		"""
+		Receives up to ``size`` bytes from ``sock`` into the buffer.
+
+		Returns:
+		    int: The number of bytes received.
+
+		Raises:
+		    IOError: The connection was closed by the remote end.
+		"""
+		self._make_room()
+		count = sock.recv_into(self._view[self._end:], 0, flags)
+		if count == 0:
+			raise IOError("Connection closed by remote")
+		self._end += count
+		return count
+
+	def readline(self):
+		"""
+		Returns:
+		    str: The next complete line in the buffer including its terminating newline, or None if there is none yet.
+		"""
+		index = self._buffer.find("\n", self._start, self._end)
+		if index < 0:
+			return None
+		line = self._view[self._start:index + 1].tobytes()
+		self._start = index + 1
+		if self._start == self._end:
+			self._start = self._end = 0
+		return line
+
+	def read_all(self):
+		"""
+		Returns:
+		    str: All data currently in the buffer, including an incomplete last line.
+		"""
+		data = self._view[self._start:self._end].tobytes()
+		self._start = self._end = 0
+		return data
+
+	def _make_room(self):
+		if len(self._buffer) - self._end >= self._size:
+			return
+
+		pending = self._end - self._start
+		if pending + self._size > len(self._buffer):
+			# a single line is longer than what we can hold, grow the buffer
+			buffer = bytearray(pending + self._size)
+			buffer[:pending] = self._view[self._start:self._end]
+			self._buffer = buffer
+			self._view = memoryview(buffer)
+		elif pending:
+			self._view[:pending] = self._view[self._start:self._end].tobytes()
+		self._start = 0
+		self._end = pending
+
+	def clear(self):
+		self._start = self._end = 0
+
+	def __len__(self):
+		return self._end - self._start
+
+
+_default_loop = None
+_default_loop_mutex = threading.Lock()
+
+
+def default_loop():
+	"""
+	Returns:
+	    EventLoop: The process wide event loop shared by all connections, started on first access.
+	"""
+	global _default_loop
+	with _default_loop_mutex:
+		if _default_loop is None:
+			_default_loop = EventLoop(name="comm.eventloop")
+		_default_loop.start()
+		return _default_loop
+
+
+def _is_valid(fd):
+	try:
+		select.select([fd], [], [], 0)
+	except (select.error, OSError, ValueError):
+		return False
+	return True
+
+
+def _set_nonblocking(fd):
+	import fcntl
+	flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+	fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
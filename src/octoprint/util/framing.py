@@ -0,0 +1,146 @@
+# coding=utf-8
+"""
+This module contains the line framing used when talking to the printer's firmware, that is prefixing commands
+with a line number and suffixing them with a checksum::
+
+   N<line number> <command>*<checksum>
+
+The checksum is the XOR of all bytes preceding the ``*``. Since XOR is associative, the checksum of a command can
+be calculated independently of its line number and combined with the one of the line number prefix later on, which
+allows preparing commands ahead of time (see :func:`checksum` and :func:`frame`).
+
+Running this module (``python -m octoprint.util.framing``) performs a micro benchmark comparing the framing
+implemented here with the previous per character implementation.
+"""
+
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import operator
+
+_xor = operator.xor
+
+
+def checksum(data, initial=0):
+	"""
+	Calculates the XOR checksum of ``data``.
+
+	Instead of calling a function per character the data is converted into a ``bytearray`` once and folded via
+	the C implementation of ``operator.xor``.
+
+	Arguments:
+	    data (str): The data to calculate the checksum for. Unicode will be encoded to ASCII first, replacing
+	        unencodable characters.
+	    initial (int): Checksum to continue from, e.g. the checksum of data preceding ``data``.
+
+	Returns:
+	    int: The checksum.
+	"""
+	if isinstance(data, unicode):
+		data = data.encode("ascii", errors="replace")
+	return reduce(_xor, bytearray(data), initial)
+
+
+def frame(command, linenumber, command_checksum=None):
+	"""
+	Frames ``command`` with ``linenumber`` and checksum.
+
+	Arguments:
+	    command (str): The command to frame.
+	    linenumber (int): The line number to use.
+	    command_checksum (int): The checksum of ``command`` alone if already known, e.g. because it was calculated
+	        ahead of time. Will be calculated if not provided.
+
+	Returns:
+	    str: The framed command, without trailing newline.
+	"""
+	if command_checksum is None:
+		line = "N%d %s" % (linenumber, command)
+		return "%s*%d" % (line, reduce(_xor, bytearray(line)))
+
+	prefix = "N%d " % linenumber
+	return "%s%s*%d" % (prefix, command, reduce(_xor, bytearray(prefix), command_checksum))
+
+
+def frame_batch(commands, first_linenumber):
+	"""
+	Frames a batch of consecutive ``commands``, starting at line number ``first_linenumber``.
+
+	Arguments:
+	    commands (iterable): The commands to frame, either plain strings or ``(command, checksum)`` tuples with
+	        precalculated checksums.
+	    first_linenumber (int): The line number to use for the first command.
+
+	Returns:
+	    tuple: A 2-tuple consisting of the framed lines joined by (and terminated with) newlines, ready to be written
+	        in one go, and the next line number to use after the batch.
+	"""
+	framed = []
+	linenumber = first_linenumber
+	for command in commands:
+		if isinstance(command, tuple):
+			command, command_checksum = command
+		else:
+			command_checksum = None
+		framed.append(frame(command, linenumber, command_checksum=command_checksum))
+		linenumber += 1
+
+	if not framed:
+		return "", linenumber
+	return "\n".join(framed) + "\n", linenumber
+
+
+def _legacy_frame(command, linenumber):
+	command_to_send = "N%d %s" % (linenumber, command)
+	cs = reduce(lambda x, y: x ^ y, map(ord, command_to_send))
+	return "%s*%d" % (command_to_send, cs)
+
+
+def benchmark(count=100000):
+	"""
+	Micro benchmark comparing the per line cost of the previous framing implementation with :func:`frame` and
+	:func:`frame_batch`.
+
+	Arguments:
+	    count (int): Number of lines to frame per run.
+
+	Returns:
+	    dict: Per line cost in microseconds, mapped by implementation.
+	"""
+	import timeit
+
+	commands = ["G1 X%.3f Y%.3f E%.5f F1800" % (i * 0.1, i * 0.2, i * 0.01) for i in range(100)]
+	prepared = [(command, checksum(command)) for command in commands]
+	runs = count // len(commands)
+
+	def legacy():
+		for n, command in enumerate(commands):
+			_legacy_frame(command, n + 10000)
+
+	def single():
+		for n, command in enumerate(commands):
+			frame(command, n + 10000)
+
+	def single_prepared():
+		for n, (command, command_checksum) in enumerate(prepared):
+			frame(command, n + 10000, command_checksum=command_checksum)
+
+	def batch_prepared():
+		frame_batch(prepared, 10000)
+
+	result = dict()
+	for name, func in (("legacy", legacy), ("frame", single), ("frame (prepared)", single_prepared), ("frame_batch (prepared)", batch_prepared)):
+		duration = min(timeit.repeat(func, number=runs, repeat=3))
+		result[name] = duration / (runs * len(commands)) * 1000000
+	return result
+
+
+if __name__ == "__main__":
+	results = benchmark()
+	baseline = results["legacy"]
+	for name in sorted(results, key=lambda x: -results[x]):
+		print("{name:<24} {cost:6.2f} us/line ({factor:.1f}x)".format(name=name, cost=results[name], factor=baseline / results[name]))
@@ -0,0 +1,420 @@
+# coding=utf-8
+"""
+This module contains the print time estimators used by the GCODE analysis
+(:class:`~octoprint.util.gcodeInterpreter.gcode`).
+
+Two estimators are available:
+
+``legacy`` (:class:`LegacyEstimator`, the default)
+    Divides the distance of each move by its feedrate, ignoring acceleration.
+
+``planner`` (:class:`PlannerEstimator`)
+    Simulates the motion planner of the firmware: Every move accelerates and decelerates along a trapezoidal speed
+    profile limited by the maximum feedrates and accelerations of the axes it moves, the speed at the junction of two
+    moves is limited by the maximum jerk of the axes and the planner looks ahead a limited number of moves to decide
+    how fast it may go without being unable to stop in time. It takes about twice as long as the ``legacy``
+    estimator, so it needs to be enabled explicitly.
+
+The estimator to use is configured through the ``gcodeAnalysis.estimator`` setting. Further estimators can be added
+through :func:`register_estimator`.
+
+Running this module (``python -m octoprint.util.gcodeEstimator <gcode file> [<recordings>]``) benchmarks all
+estimators on the given file. If a YAML file with recorded print durations is provided, their accuracy is compared
+on the recorded files, see :func:`accuracy`.
+"""
+
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import math
+
+
+class TimeEstimator(object):
+	"""
+	Interface of the print time estimators. An estimator is fed all moves and dwells of a file in order and sums up
+	the time they take.
+
+	Estimators need to be able to continue from the state of another instance for the same printer profile, as
+	returned by :meth:`get_state` (this is how the analysis is split into chunks, see
+	:mod:`octoprint.util.gcodeParallel`). That state needs to be picklable and contain the time of all moves the
+	estimator is done with as ``total`` in seconds, which the analysis might adjust before continuing from it.
+
+	Arguments:
+	    printer_profile (dict): The printer profile to estimate for.
+	"""
+
+	def __init__(self, printer_profile):
+		self._total = 0.0
+
+	def move(self, start, end, e, feedrate, xyz):
+		"""
+		Adds a move.
+
+		Arguments:
+		    start (list): Position of the X, Y and Z axes at the start of the move, in mm.
+		    end (list): Position of the X, Y and Z axes at the end of the move, in mm.
+		    e (float): Extruded length during the move, negative for retractions, in mm.
+		    feedrate (float): Requested feedrate, in mm/min.
+		    xyz (bool): Whether the move addressed any of the X, Y and Z axes.
+		"""
+		raise NotImplementedError()
+
+	def dwell(self, seconds):
+		"""
+		Adds a pause of ``seconds``.
+		"""
+		self._total += seconds
+
+	def get_total(self):
+		"""
+		Returns:
+		    float: The time of all moves and dwells added so far, in seconds.
+		"""
+		return self._total
+
+	def get_state(self):
+		"""
+		Returns:
+		    dict: The state to continue from via :meth:`set_state`.
+		"""
+		return dict(total=self._total)
+
+	def set_state(self, state):
+		self._total = state["total"]
+
+
+class LegacyEstimator(TimeEstimator):
+	"""
+	Estimates each move to take its (XY) distance divided by its feedrate, regardless of acceleration. Moves only
+	moving the extruder take their extruded length divided by the feedrate.
+	"""
+
+	def move(self, start, end, e, feedrate, xyz):
+		diffX = start[0] - end[0]
+		diffY = start[1] - end[1]
+		if xyz:
+			self._total += math.sqrt(diffX * diffX + diffY * diffY) / feedrate * 60.0
+		elif e > 0.0:
+			self._total += max(math.sqrt(diffX * diffX + diffY * diffY) / feedrate, abs(e / feedrate)) * 60.0
+		elif e < 0.0:
+			self._total += abs(e / feedrate) * 60.0
+
+
+class PlannerEstimator(TimeEstimator):
+	"""
+	Estimates moves the way the motion planner of the firmware executes them.
+
+	Moves are planned like Marlin does: A move's nominal speed is its feedrate, limited so that no axis exceeds its
+	maximum feedrate (``axes.<axis>.speed``, mm/s). It accelerates with the acceleration for printing moves or, if it
+	only moves the extruder, for retractions (``accelerationMoveRetract``, mm/s²), limited so that no axis exceeds its
+	maximum acceleration (``accelerationMaximum``, mm/s²). Its entry speed is limited so that the change of speed of
+	each axis at the junction with the previous move doesn't exceed its maximum jerk (``advancedVariables``, mm/s),
+	moves starting from or ending in standstill start or end with the jerk speed. The planner holds :attr:`BUFFER_SIZE`
+	moves, and when planning assumes the printer needs to stop at the end of the last one.
+
+	Arguments:
+	    printer_profile (dict): The printer profile to estimate for.
+	"""
+
+	BUFFER_SIZE = 16
+	"""Number of moves the planner looks ahead, like the block buffer of the firmware."""
+
+	def __init__(self, printer_profile):
+		TimeEstimator.__init__(self, printer_profile)
+
+		def value(default, *path):
+			node = printer_profile
+			for key in path:
+				if not isinstance(node, dict) or not key in node:
+					return default
+				node = node[key]
+			try:
+				value = float(node)
+			except (TypeError, ValueError):
+				return default
+			return value if value > 0 else default
+
+		self._maxFeedrate = [value(500.0, "axes", "x", "speed"),
+		                     value(500.0, "axes", "y", "speed"),
+		                     value(5.0, "axes", "z", "speed"),
+		                     value(25.0, "axes", "e", "speed")]
+		self._maxAcceleration = [value(9000.0, "accelerationMaximum", "x"),
+		                         value(9000.0, "accelerationMaximum", "y"),
+		                         value(100.0, "accelerationMaximum", "z"),
+		                         value(10000.0, "accelerationMaximum", "e")]
+		self._acceleration = value(4000.0, "accelerationMoveRetract", "move")
+		self._retractAcceleration = value(3000.0, "accelerationMoveRetract", "retract")
+		self._xyJerk = value(20.0, "advancedVariables", "maxXYJerk")
+		self._zJerk = value(0.4, "advancedVariables", "maxZJerk")
+		self._eJerk = value(5.0, "advancedVariables", "maxEJerk")
+
+		# moves not finally planned yet, as (length, acceleration, nominal speed, maximum entry speed, speed from and
+		# to standstill)
+		self._pending = []
+		# entry speed of the first pending move, None if it starts from standstill
+		self._entry = None
+		# unit vector and nominal speed of the last move, None if the printer stopped after it
+		self._previous = None
+
+	def move(self, start, end, e, feedrate, xyz):
+		dx = end[0] - start[0]
+		dy = end[1] - start[1]
+		dz = end[2] - start[2]
+
+		length = math.sqrt(dx * dx + dy * dy + dz * dz)
+		if length < 0.000001:
+			if e == 0.0:
+				return
+			length = abs(e)
+			dx = dy = dz = 0.0
+			acceleration = self._retractAcceleration
+		else:
+			acceleration = self._acceleration
+
+		inverse = 1.0 / length
+		ux = dx * inverse
+		uy = dy * inverse
+		uz = dz * inverse
+		ue = e * inverse
+
+		speed = feedrate / 60.0
+		maxFeedrate = self._maxFeedrate
+		maxAcceleration = self._maxAcceleration
+		for axis, unit in ((0, ux), (1, uy), (2, uz), (3, ue)):
+			if unit != 0.0:
+				unit = abs(unit)
+				if speed * unit > maxFeedrate[axis]:
+					speed = maxFeedrate[axis] / unit
+				if acceleration * unit > maxAcceleration[axis]:
+					acceleration = maxAcceleration[axis] / unit
+
+		# junction speed: the change of speed of each axis may not exceed its jerk
+		safe = self._limitJerk(speed, ux, uy, uz, ue)
+		previous = self._previous
+		if previous is None:
+			maxEntry = safe
+		else:
+			px, py, pz, pe, previousSpeed = previous
+			maxEntry = self._limitJerk(min(speed, previousSpeed), ux - px, uy - py, uz - pz, ue - pe)
+
+		self._previous = (ux, uy, uz, ue, speed)
+		self._add((length, acceleration, speed, maxEntry, safe))
+
+	def dwell(self, seconds):
+		# the firmware finishes all moves before dwelling
+		self._finish(len(self._pending))
+		self._previous = None
+		self._entry = None
+		self._total += seconds
+
+	def get_total(self):
+		return self._total + self._plan(len(self._pending), self._pending, self._entry)[0]
+
+	def get_state(self):
+		return dict(total=self._total, pending=list(self._pending), entry=self._entry, previous=self._previous)
+
+	def set_state(self, state):
+		self._total = state["total"]
+		self._pending = list(state.get("pending", []))
+		self._entry = state.get("entry")
+		self._previous = state.get("previous")
+
+	def _limitJerk(self, speed, jx, jy, jz, je):
+		"""Limits ``speed`` so that no axis changes its speed by more than its jerk when changing direction by ``j``."""
+		xy = math.sqrt(jx * jx + jy * jy)
+		if xy * speed > self._xyJerk:
+			speed = self._xyJerk / xy
+		if abs(jz) * speed > self._zJerk:
+			speed = self._zJerk / abs(jz)
+		if abs(je) * speed > self._eJerk:
+			speed = self._eJerk / abs(je)
+		return speed
+
+	def _add(self, block):
+		pending = self._pending
+		pending.append(block)
+		if self._entry is None:
+			self._entry = pending[0][4]
+
+		# Going backwards from the last move, which needs to be able to stop, find the latest move that can be
+		# entered at its maximum entry speed no matter what follows. All moves before it are final.
+		exit = pending[-1][4]
+		for index in range(len(pending) - 1, 0, -1):
+			length, acceleration, _, maxEntry, _ = pending[index]
+			entry = math.sqrt(exit * exit + 2.0 * acceleration * length)
+			if entry >= maxEntry:
+				self._finish(index)
+				return
+			exit = entry
+
+		if len(pending) > self.BUFFER_SIZE:
+			self._finish(1)
+
+	def _finish(self, count):
+		"""Finally plans the first ``count`` pending moves."""
+		if not count:
+			return
+
+		duration, entry = self._plan(count, self._pending, self._entry)
+		self._total += duration
+		del self._pending[:count]
+		self._entry = entry if self._pending else None
+
+	def _plan(self, count, pending, entry):
+		"""
+		Plans the first ``count`` of the ``pending`` moves, the first one entered at ``entry``, assuming the printer
+		needs to stop at the end of the last pending move.
+
+		Returns:
+		    tuple: The time the moves take and the speed at the end of the last of them.
+		"""
+		if not count:
+			return 0.0, entry
+
+		sqrt = math.sqrt
+
+		# backwards: maximum speed at the end of each move to still be able to stop in time
+		exits = [0.0] * count
+		exit = pending[-1][4]
+		if count == len(pending):
+			exits[-1] = exit
+		for index in range(len(pending) - 1, 0, -1):
+			length, acceleration, _, maxEntry, _ = pending[index]
+			exit = min(maxEntry, sqrt(exit * exit + 2.0 * acceleration * length))
+			if index <= count:
+				exits[index - 1] = exit
+
+		# forwards: accelerate as far as possible
+		duration = 0.0
+		for index in range(count):
+			length, acceleration, speed, _, _ = pending[index]
+			exit = min(exits[index], sqrt(entry * entry + 2.0 * acceleration * length))
+
+			# trapezoidal profile: accelerate from entry to speed, cruise, decelerate to exit
+			accelerating = (speed * speed - entry * entry) / (2.0 * acceleration)
+			decelerating = (speed * speed - exit * exit) / (2.0 * acceleration)
+			if accelerating + decelerating <= length:
+				duration += (speed - entry) / acceleration + (speed - exit) / acceleration + (length - accelerating - decelerating) / speed
+			else:
+				# doesn't reach the nominal speed
+				peak = sqrt(max(acceleration * length + (entry * entry + exit * exit) / 2.0, entry * entry, exit * exit))
+				duration += (peak - entry) / acceleration + (peak - exit) / acceleration
+			entry = exit
+
+		return duration, entry
+
+
+_estimators = dict(
+	legacy=LegacyEstimator,
+	planner=PlannerEstimator
+)
+
+DEFAULT = "legacy"
+
+
+def register_estimator(name, factory):
+	"""
+	Registers an additional estimator.
+
+	Arguments:
+	    name (str): Name of the estimator, to be used for the ``gcodeAnalysis.estimator`` setting.
+	    factory (callable): Called with the printer profile to estimate for, needs to return a :class:`TimeEstimator`.
+	        When analyzing on a process pool, estimators need to be registered before the pool is created.
+	"""
+	_estimators[name] = factory
+
+
+def get_estimator(name, printer_profile):
+	"""
+	Arguments:
+	    name (str): Name of the estimator, the default estimator is used if None or unknown.
+	    printer_profile (dict): The printer profile to estimate for.
+
+	Returns:
+	    TimeEstimator: A new estimator.
+	"""
+	factory = _estimators.get(name, _estimators[DEFAULT])
+	return factory(printer_profile)
+
+
+def benchmark(path, printer_profile, names=None):
+	"""
+	Analyzes the file at ``path`` with each of the estimators.
+
+	Arguments:
+	    path (str): Path of the GCODE file to analyze.
+	    printer_profile (dict): The printer profile to analyze for.
+	    names (list): Names of the estimators to benchmark, defaults to all.
+
+	Returns:
+	    dict: The estimated print time in seconds and the duration of the analysis in seconds, mapped by estimator.
+	"""
+	import time
+	from octoprint.util.gcodeInterpreter import gcode, read_lines
+
+	if names is None:
+		names = sorted(_estimators.keys())
+
+	result = dict()
+	for name in names:
+		start = time.time()
+		analysis = gcode(estimator=name)
+		analysis._load(read_lines(path), printer_profile, max_extruders=10)
+		result[name] = dict(estimate=analysis.totalMoveTimeMinute * 60.0, duration=time.time() - start)
+	return result
+
+
+def accuracy(recordings, printer_profile, names=None):
+	"""
+	Compares the estimates of the estimators with recorded print durations.
+
+	``recordings`` is a list of dicts with the ``path`` of a printed file and its recorded print ``duration`` in seconds
+	(as found in the print history of the file's metadata), e.g. loaded from YAML:
+
+	.. code-block:: yaml
+
+	   - path: /home/pi/.octoprint/uploads/bracket.gcode
+	     duration: 5321.4
+
+	Arguments:
+	    recordings (list): The recorded print durations.
+	    printer_profile (dict): The printer profile the files were printed with.
+	    names (list): Names of the estimators to compare, defaults to all.
+
+	Returns:
+	    dict: Per estimator the relative ``errors`` (estimate / duration - 1) per recording in the same order and the
+	        mean absolute relative error as ``mean``.
+	"""
+	result = dict()
+	for recording in recordings:
+		estimates = benchmark(recording["path"], printer_profile, names=names)
+		for name, estimate in estimates.items():
+			if not name in result:
+				result[name] = dict(errors=[])
+			result[name]["errors"].append(estimate["estimate"] / float(recording["duration"]) - 1.0)
+
+	for name in result:
+		errors = result[name]["errors"]
+		result[name]["mean"] = sum(map(abs, errors)) / len(errors) if errors else None
+	return result
+
+
+if __name__ == "__main__":
+	import sys
+	import yaml
+	from octoprint.printer.profile import PrinterProfileManager
+
+	profile = PrinterProfileManager.default
+
+	for name, data in sorted(benchmark(sys.argv[1], profile).items()):
+		print("{name:<8} estimate {estimate:10.0f}s   analysis {duration:6.2f}s".format(name=name, **data))
+
+	if len(sys.argv) > 2:
+		with open(sys.argv[2]) as f:
+			recordings = yaml.safe_load(f)
+		for name, data in sorted(accuracy(recordings, profile).items()):
+			print("{name:<8} mean absolute error {mean:6.1%}".format(name=name, **data))
@@ -5,24 +5,139 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 __copyright__ = "Copyright (C) 2013 David Braam, Gina Häußge - Released under terms of the AGPLv3 License"
 
 
+import bisect
+import io
 import math
+import mmap
 import os
 import base64
 import zlib
 import logging
 
 from octoprint.settings import settings
+from octoprint.util import gcodeEstimator
+from octoprint.util.tokenizer import parse_words
 
 
 class AnalysisAborted(Exception):
 	pass
 
 
+_map_window = 16 * 1024 * 1024
+_volume_tolerance = 1e-3
+
+
+def print_volume(printer_profile):
+	"""
+	Arguments:
+	    printer_profile (dict): The printer profile to get the print volume of.
+
+	Returns:
+	    tuple: The minimum and maximum X and Y coordinate, the maximum Z coordinate and for circular beds the radius
+	        of the print volume of ``printer_profile`` (None for rectangular ones), None if the profile doesn't
+	        define it.
+	"""
+	volume = printer_profile.get("volume")
+	if not volume:
+		return None
+
+	try:
+		width = float(volume["width"])
+		depth = float(volume["depth"])
+		height = float(volume["height"])
+	except (KeyError, TypeError, ValueError):
+		return None
+
+	if volume.get("origin") == "center":
+		minX, maxX, minY, maxY = -width / 2.0, width / 2.0, -depth / 2.0, depth / 2.0
+	else:
+		minX, maxX, minY, maxY = 0.0, width, 0.0, depth
+
+	radius = None
+	if volume.get("formFactor") == "circular":
+		radius = min(width, depth) / 2.0
+	return minX, maxX, minY, maxY, height, radius
+
+
+def read_lines(path, start=0, end=None):
+	"""
+	Iterates over the lines of the file at ``path`` as raw bytes. GCODE is ASCII apart from comments, so lines are not
+	decoded. The file is read through memory maps of a limited window, so the memory used stays the same no matter the
+	file's size, falling back to regular reads if it cannot be mapped.
+
+	Arguments:
+	    path (str): Path of the file to read.
+	    start (int): Byte offset of the first line to read, must be the start of a line.
+	    end (int): Byte offset after which to stop reading, the line containing it is still read completely. Defaults
+	        to the end of the file.
+
+	Returns:
+	    generator: The lines including their line endings.
+	"""
+	size = os.stat(path).st_size
+	if end is None or end > size:
+		end = size
+	if start >= end:
+		return
+
+	with open(path, "rb") as f:
+		position = start
+		window = _map_window
+		while position < end:
+			base = position - position % mmap.ALLOCATIONGRANULARITY
+			length = min(window, size - base)
+			try:
+				buf = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=base)
+			except (EnvironmentError, ValueError):
+				break
+
+			try:
+				buf.seek(position - base)
+				readline = buf.readline
+				first = position
+				while position < end:
+					line = readline()
+					if not line:
+						break
+					if base + length < size and not line.endswith("\n"):
+						# continues in the next window
+						if position == first:
+							# and doesn't even fit into one
+							window *= 2
+						break
+					position += len(line)
+					yield line
+			finally:
+				buf.close()
+
+		if position < end:
+			f.seek(position)
+			for line in f:
+				if position >= end:
+					break
+				position += len(line)
+				yield line
+
+
 class gcode(object):
-	def __init__(self):
+	"""
+	Analysis of a GCODE file, determining the extruded filament per tool and the estimated print time.
+
+	Arguments:
+	    estimator (str): Name of the print time estimator to use (see :mod:`octoprint.util.gcodeEstimator`), defaults
+	        to the ``gcodeAnalysis.estimator`` setting.
+	"""
+
+	def __init__(self, estimator=None):
 		self._logger = logging.getLogger(__name__)
+		self._estimator = estimator
 
 		self.layerList = None
+		self.bounds = None
+		self.travelBounds = None
+		self.travelDistance = 0.0
+		self.extrudeDistance = 0.0
+		self.outOfVolume = None
 		self.extrusionAmount = [0]
 		self.extrusionVolume = [0]
 		self.totalMoveTimeMinute = 0
@@ -30,93 +145,285 @@ class gcode(object):
 		self.progressCallback = None
 		self._abort = False
 		self._filamentDiameter = 0
-
-	def load(self, filename, printer_profile, throttle=None):
+		self._fileSize = None
+
+	def load(self, filename, printer_profile, throttle=None, pool=None, chunks=1):
+		"""
+		Analyzes the file ``filename``.
+
+		Arguments:
+		    filename (str): Path of the file to analyze.
+		    printer_profile (dict): The printer profile to analyze for.
+		    throttle (callable): Called after every line analyzed in the calling process if set.
+		    pool (multiprocessing.Pool): If set and ``chunks`` is larger than 1, the file is split into ``chunks``
+		        chunks that are analyzed in parallel on the pool, see :mod:`octoprint.util.gcodeParallel`.
+		    chunks (int): Number of chunks to split the file into.
+		"""
 		if os.path.isfile(filename):
 			self.filename = filename
 			self._fileSize = os.stat(filename).st_size
 
-			import codecs
-			with codecs.open(filename, encoding="utf-8", errors="replace") as f:
-				self._load(f, printer_profile, throttle=throttle)
+			if pool is not None and chunks > 1:
+				from octoprint.util.gcodeParallel import analyze
+				maxExtruders = settings().getInt(["gcodeAnalysis", "maxExtruders"])
+				state = analyze(self, filename, printer_profile, pool, chunks, max_extruders=maxExtruders, throttle=throttle)
+				self._setResult(state)
+			else:
+				self._load(read_lines(filename), printer_profile, throttle=throttle)
+
+			# not reported by _load, which also analyzes the parts of a file
+			if self.progressCallback is not None:
+				self.progressCallback(1.0)
 
 	def abort(self):
 		self._abort = True
 
-	def _load(self, gcodeFile, printer_profile, throttle=None):
-		filePos = 0
-		readBytes = 0
-		pos = [0.0, 0.0, 0.0]
-		posOffset = [0.0, 0.0, 0.0]
-		currentE = [0.0]
-		totalExtrusion = [0.0]
-		maxExtrusion = [0.0]
-		currentExtruder = 0
-		totalMoveTimeMinute = 0.0
-		absoluteE = True
-		scale = 1.0
-		posAbs = True
-		feedRateXY = min(printer_profile["axes"]["x"]["speed"], printer_profile["axes"]["y"]["speed"])
+	def get_estimator_name(self):
+		"""
+		Returns:
+		    str: Name of the print time estimator used by this analysis.
+		"""
+		if self._estimator is None:
+			self._estimator = settings().get(["gcodeAnalysis", "estimator"])
+		return self._estimator
+
+	@staticmethod
+	def initial_state(printer_profile):
+		"""
+		Returns:
+		    dict: The state of the analysis at the start of a file, see :meth:`_load`.
+		"""
+		# axis speeds are configured in mm/s, feedrates are in mm/min
+		feedRateXY = min(printer_profile["axes"]["x"]["speed"], printer_profile["axes"]["y"]["speed"]) * 60
 		if feedRateXY == 0:
 			# some somewhat sane default if axes speeds are insane...
 			feedRateXY = 2000
+
+		return dict(
+			pos=[0.0, 0.0, 0.0],
+			posOffset=[0.0, 0.0, 0.0],
+			currentE=[0.0],
+			totalExtrusion=[0.0],
+			maxExtrusion=[0.0],
+			currentExtruder=0,
+			totalMoveTimeMinute=0.0,
+			estimator=None,
+			absoluteE=True,
+			scale=1.0,
+			posAbs=True,
+			feedRateXY=feedRateXY,
+			filamentDiameter=0,
+			temperatures=dict(),
+			fan=None,
+			lines=0,
+			layers=[],
+			layerZ=None,
+			layerMark=None,
+			bounds=dict(),
+			travelBounds=None,
+			travelDistance=0.0,
+			extrudeDistance=0.0,
+			outOfVolume=[0, 0, None]
+		)
+
+	def _load(self, gcodeFile, printer_profile, throttle=None, state=None, sync=False, max_extruders=None, offset=0):
+		"""
+		Analyzes the lines of ``gcodeFile``.
+
+		Arguments:
+		    gcodeFile (iterable): The lines to analyze.
+		    printer_profile (dict): The printer profile to analyze for.
+		    throttle (callable): Called after every line if set.
+		    state (dict): The state to start from, e.g. the one returned by a previous call for the lines preceding
+		        ``gcodeFile``. Defaults to :meth:`initial_state`.
+		    sync (bool): Whether ``state`` is only a guess (apart from the modal settings like absolute or relative
+		        positioning) since the lines preceding ``gcodeFile`` are analyzed elsewhere, see
+		        :mod:`octoprint.util.gcodeParallel`. If set, the analysis tracks from which line on the position,
+		        the feedrate, the extruder position and the height of the last extrusion have all been set explicitly
+		        and the result doesn't depend on the guess anymore. The returned state then also contains the state at that line (including the
+		        number of lines up to it as ``line``) as ``sync`` - None if there is no such line or a later line
+		        depends on the guess after all - and the extruders whose position was set as ``knownE``.
+		    max_extruders (int): Highest tool number to accept, defaults to the ``gcodeAnalysis.maxExtruders``
+		        setting.
+		    offset (int): Byte offset of the first line of ``gcodeFile`` within the analyzed file, for reporting the
+		        progress and for the layer index.
+
+		Layers are detected as extruding moves starting at a different height than the last extrusion (so neither Z
+		hops nor spiralized moves start a new layer). A layer starts at the last move that changed the height before
+		it, its entry in the ``layers`` of the state is a tuple of its height, the byte offset and (zero based) number
+		of that line, the estimated print time in seconds and the extruded filament in mm of all lines before it, the
+		state of the printer before it (see :meth:`LayerIndex.get_checkpoint`) and whether the position of the
+		selected extruder in that state was set explicitly (in ``sync`` mode).
+
+		The bounds of the moves are tracked in the coordinate system of the printer (that is including offsets set
+		via ``G92`` and tool offsets): ``bounds`` maps tools to the minimum and maximum X, Y and Z of their
+		extruding moves, ``travelBounds`` are those of all other moves. ``travelDistance`` and ``extrudeDistance`` sum
+		up the lengths of both kinds of moves and ``outOfVolume`` counts the non-extruding and the extruding moves
+		ending outside the print volume of ``printer_profile`` (see :func:`print_volume`) and holds the number of the
+		first line containing such a move. In ``sync`` mode all of these only cover the lines after the sync line.
+
+		Returns:
+		    dict: The state after the last line.
+		"""
+		if state is None:
+			state = self.initial_state(printer_profile)
+		if max_extruders is None:
+			max_extruders = settings().getInt(["gcodeAnalysis", "maxExtruders"])
+
+		estimator = gcodeEstimator.get_estimator(self.get_estimator_name(), printer_profile)
+		if state.get("estimator") is not None:
+			estimator.set_state(state["estimator"])
+		else:
+			estimator.set_state(dict(total=state["totalMoveTimeMinute"] * 60.0))
+
+		filePos = 0
+		readBytes = 0
+		pos = state["pos"][:]
+		posOffset = state["posOffset"][:]
+		currentE = state["currentE"][:]
+		totalExtrusion = state["totalExtrusion"][:]
+		maxExtrusion = state["maxExtrusion"][:]
+		currentExtruder = state["currentExtruder"]
+		absoluteE = state["absoluteE"]
+		scale = state["scale"]
+		posAbs = state["posAbs"]
+		feedRateXY = state["feedRateXY"]
+		lines = state["lines"]
+		layers = list(state["layers"])
+		layerZ = state["layerZ"]
+		layerMark = state["layerMark"]
+		temperatures = state["temperatures"]
+		fan = state["fan"]
+		bounds = dict((tool, toolBounds[:]) for tool, toolBounds in state["bounds"].items())
+		travelBounds = state["travelBounds"][:] if state["travelBounds"] is not None else None
+		travelDistance = state["travelDistance"]
+		extrudeDistance = state["extrudeDistance"]
+		outOfVolume = state["outOfVolume"][:]
+		self._filamentDiameter = state["filamentDiameter"]
 		offsets = printer_profile["extruder"]["offsets"]
+		volume = print_volume(printer_profile)
+		if volume is not None:
+			volumeMinX, volumeMaxX, volumeMinY, volumeMaxY, volumeMaxZ, volumeRadius = volume
+			volumeMinX -= _volume_tolerance
+			volumeMinY -= _volume_tolerance
+			volumeMaxX += _volume_tolerance
+			volumeMaxY += _volume_tolerance
+			volumeMaxZ += _volume_tolerance
+			volumeCenterX = (volumeMinX + volumeMaxX) / 2.0
+			volumeCenterY = (volumeMinY + volumeMaxY) / 2.0
+		# the end of the last extruding move, which is already within the bounds of its tool
+		lastExtruded = lastExtruder = None
+
+		def pack():
+			return dict(
+				pos=pos[:],
+				posOffset=posOffset[:],
+				currentE=currentE[:],
+				totalExtrusion=totalExtrusion[:],
+				maxExtrusion=maxExtrusion[:],
+				currentExtruder=currentExtruder,
+				totalMoveTimeMinute=estimator.get_total() / 60.0,
+				estimator=estimator.get_state(),
+				absoluteE=absoluteE,
+				scale=scale,
+				posAbs=posAbs,
+				feedRateXY=feedRateXY,
+				filamentDiameter=self._filamentDiameter,
+				temperatures=temperatures,
+				fan=fan,
+				lines=lines + filePos,
+				layers=list(layers),
+				layerZ=layerZ,
+				layerMark=layerMark,
+				bounds=dict((tool, toolBounds[:]) for tool, toolBounds in bounds.items()),
+				travelBounds=travelBounds[:] if travelBounds is not None else None,
+				travelDistance=travelDistance,
+				extrudeDistance=extrudeDistance,
+				outOfVolume=outOfVolume[:]
+			)
+
+		def extend(box, position):
+			if position[0] < box[0]:
+				box[0] = position[0]
+			elif position[0] > box[1]:
+				box[1] = position[0]
+			if position[1] < box[2]:
+				box[2] = position[1]
+			elif position[1] > box[3]:
+				box[3] = position[1]
+			if position[2] < box[4]:
+				box[4] = position[2]
+			elif position[2] > box[5]:
+				box[5] = position[2]
+
+		def mark(position, extruded):
+			# the state before the current line for the layer index, position being the position before it and
+			# extruded what it already added to the extruder position
+			toolOffset = offsets[currentExtruder] if currentExtruder < len(offsets) else (0, 0)
+			checkpoint = dict(
+				position=[(position[i] - posOffset[i]) / scale for i in range(3)],
+				offset=[(posOffset[0] - toolOffset[0]) / scale, (posOffset[1] - toolOffset[1]) / scale, posOffset[2] / scale],
+				e=currentE[currentExtruder] - extruded,
+				feedrate=feedRateXY,
+				tool=currentExtruder,
+				absolutePositioning=posAbs,
+				absoluteExtrusion=absoluteE,
+				inches=scale != 1.0,
+				temperatures=temperatures,
+				fan=fan
+			)
+			return (lineOffset, lines + filePos - 1, estimator.get_total(), sum(totalExtrusion) - extruded, checkpoint,
+			        currentExtruder in knownE)
+
+		# sync tracking, see docstring
+		syncState = None
+		failed = False
+		knownX = knownY = knownZ = knownF = knownLayer = False
+		knownE = set()
 
 		for line in gcodeFile:
 			if self._abort:
 				raise AnalysisAborted()
+			lineOffset = offset + readBytes
 			filePos += 1
 			readBytes += len(line)
 
-			if isinstance(gcodeFile, (file)):
-				percentage = float(readBytes) / float(self._fileSize)
-			elif isinstance(gcodeFile, (list)):
-				percentage = float(filePos) / float(len(gcodeFile))
-			else:
-				percentage = None
+			if self.progressCallback is not None and filePos % 1000 == 0:
+				if self._fileSize:
+					percentage = float(offset + readBytes) / float(self._fileSize)
+				elif isinstance(gcodeFile, (list)):
+					percentage = float(filePos) / float(len(gcodeFile))
+				else:
+					percentage = None
 
-			try:
-				if self.progressCallback is not None and (filePos % 1000 == 0) and percentage is not None:
-					self.progressCallback(percentage)
-			except:
-				pass
+				try:
+					if percentage is not None:
+						self.progressCallback(percentage)
+				except:
+					pass
 
 			if ';' in line:
 				comment = line[line.find(';')+1:].strip()
-				if comment.startswith("filament_diameter"):
-					filamentValue = comment.split("=", 1)[1].strip()
-					try:
-						self._filamentDiameter = float(filamentValue)
-					except ValueError:
-						try:
-							self._filamentDiameter = float(filamentValue.split(",")[0].strip())
-						except ValueError:
-							self._filamentDiameter = 0.0
-				elif comment.startswith("CURA_PROFILE_STRING") or comment.startswith("CURA_OCTO_PROFILE_STRING"):
-					if comment.startswith("CURA_PROFILE_STRING"):
-						prefix = "CURA_PROFILE_STRING:"
-					else:
-						prefix = "CURA_OCTO_PROFILE_STRING:"
-
-					curaOptions = self._parseCuraProfileString(comment, prefix)
-					if "filament_diameter" in curaOptions:
-						try:
-							self._filamentDiameter = float(curaOptions["filament_diameter"])
-						except:
-							self._filamentDiameter = 0.0
+				if isinstance(comment, str):
+					# only comments may contain anything but ASCII
+					comment = comment.decode("utf-8", "replace")
+				filamentDiameter = self._parseFilamentDiameter(comment)
+				if filamentDiameter is not None:
+					self._filamentDiameter = filamentDiameter
 				line = line[0:line.find(';')]
 
-			G = getCodeInt(line, 'G')
-			M = getCodeInt(line, 'M')
-			T = getCodeInt(line, 'T')
+			words = parse_words(line)
+			G = words.get("G")
+			M = words.get("M")
+			T = words.get("T")
 
 			if G is not None:
 				if G == 0 or G == 1:	#Move
-					x = getCodeFloat(line, 'X')
-					y = getCodeFloat(line, 'Y')
-					z = getCodeFloat(line, 'Z')
-					e = getCodeFloat(line, 'E')
-					f = getCodeFloat(line, 'F')
+					x = words.get("X")
+					y = words.get("Y")
+					z = words.get("Z")
+					e = words.get("E")
+					f = words.get("F")
 					oldPos = pos
 					pos = pos[:]
 					if posAbs:
@@ -133,6 +440,8 @@ class gcode(object):
 							pos[1] += y * scale
 						if z is not None:
 							pos[2] += z * scale
+					if pos[2] != oldPos[2]:
+						layerMark = mark(oldPos, 0.0)
 					if f is not None and f != 0:
 						feedRateXY = f
 
@@ -151,57 +460,88 @@ class gcode(object):
 					else:
 						e = 0.0
 
-					if x is not None or y is not None or z is not None:
-						diffX = oldPos[0] - pos[0]
-						diffY = oldPos[1] - pos[1]
-						totalMoveTimeMinute += math.sqrt(diffX * diffX + diffY * diffY) / feedRateXY
-					elif moveType == "extrude":
-						diffX = oldPos[0] - pos[0]
-						diffY = oldPos[1] - pos[1]
-						time1 = math.sqrt(diffX * diffX + diffY * diffY) / feedRateXY
-						time2 = abs(e / feedRateXY)
-						totalMoveTimeMinute += max(time1, time2)
-					elif moveType == "retract":
-						totalMoveTimeMinute += abs(e / feedRateXY)
+					if moveType == 'extrude':
+						if oldPos[2] != layerZ:
+							if layerMark is None:
+								layerMark = mark(oldPos, e)
+							layers.append((oldPos[2],) + layerMark)
+						layerZ = pos[2]
+
+					xyz = x is not None or y is not None or z is not None
+					if xyz:
+						diffX = pos[0] - oldPos[0]
+						diffY = pos[1] - oldPos[1]
+						diffZ = pos[2] - oldPos[2]
+						distance = math.sqrt(diffX * diffX + diffY * diffY + diffZ * diffZ)
+						if moveType == 'extrude':
+							extrudeDistance += distance
+							toolBounds = bounds.get(currentExtruder)
+							if toolBounds is None:
+								toolBounds = bounds[currentExtruder] = [oldPos[0], oldPos[0], oldPos[1], oldPos[1], oldPos[2], oldPos[2]]
+							elif oldPos is not lastExtruded or currentExtruder != lastExtruder:
+								extend(toolBounds, oldPos)
+							extend(toolBounds, pos)
+							lastExtruded = pos
+							lastExtruder = currentExtruder
+						else:
+							travelDistance += distance
+							if travelBounds is None:
+								travelBounds = [pos[0], pos[0], pos[1], pos[1], pos[2], pos[2]]
+							else:
+								extend(travelBounds, pos)
+
+						if volume is not None:
+							if not volumeMinX <= pos[0] <= volumeMaxX or not volumeMinY <= pos[1] <= volumeMaxY \
+									or not -_volume_tolerance <= pos[2] <= volumeMaxZ \
+									or volumeRadius is not None and math.sqrt((pos[0] - volumeCenterX) ** 2 + (pos[1] - volumeCenterY) ** 2) > volumeRadius + _volume_tolerance:
+								outOfVolume[1 if moveType == 'extrude' else 0] += 1
+								if outOfVolume[2] is None:
+									outOfVolume[2] = lines + filePos - 1
+
+					estimator.move(oldPos, pos, e, feedRateXY, xyz)
 
 					if moveType == 'move' and oldPos[2] != pos[2]:
 						if oldPos[2] > pos[2] and abs(oldPos[2] - pos[2]) > 5.0 and pos[2] < 1.0:
 							oldPos[2] = 0.0
 				elif G == 4:	#Delay
-					S = getCodeFloat(line, 'S')
+					S = words.get("S")
 					if S is not None:
-						totalMoveTimeMinute += S / 60.0
-					P = getCodeFloat(line, 'P')
+						estimator.dwell(S)
+					P = words.get("P")
 					if P is not None:
-						totalMoveTimeMinute += P / 60.0 / 1000.0
+						estimator.dwell(P / 1000.0)
 				elif G == 20:	#Units are inches
 					scale = 25.4
 				elif G == 21:	#Units are mm
 					scale = 1.0
 				elif G == 28:	#Home
-					x = getCodeFloat(line, 'X')
-					y = getCodeFloat(line, 'Y')
-					z = getCodeFloat(line, 'Z')
+					# axes to home are given without values, e.g. "G28 X Y"
+					x = "X" in words
+					y = "Y" in words
+					z = "Z" in words
 					center = [0.0,0.0,0.0]
-					if x is None and y is None and z is None:
+					oldPos = pos
+					if not x and not y and not z:
 						pos = center
 					else:
 						pos = pos[:]
-						if x is not None:
+						if x:
 							pos[0] = center[0]
-						if y is not None:
+						if y:
 							pos[1] = center[1]
-						if z is not None:
+						if z:
 							pos[2] = center[2]
+					if pos[2] != oldPos[2]:
+						layerMark = mark(oldPos, 0.0)
 				elif G == 90:	#Absolute position
 					posAbs = True
 				elif G == 91:	#Relative position
 					posAbs = False
 				elif G == 92:
-					x = getCodeFloat(line, 'X')
-					y = getCodeFloat(line, 'Y')
-					z = getCodeFloat(line, 'Z')
-					e = getCodeFloat(line, 'E')
+					x = words.get("X")
+					y = words.get("Y")
+					z = words.get("Z")
+					e = words.get("E")
 					if e is not None:
 						currentE[currentExtruder] = e
 					if x is not None:
@@ -216,9 +556,24 @@ class gcode(object):
 					absoluteE = True
 				elif M == 83:   #Relative E
 					absoluteE = False
+				elif M == 104 or M == 109 or M == 140 or M == 190:	#Temperatures
+					S = words.get("S")
+					if S is None:
+						S = words.get("R")
+					tool = words.get("T")
+					tool = int(tool) if tool is not None else currentExtruder
+					if S is not None and tool <= max_extruders:
+						temperatures = dict(temperatures)
+						temperatures["bed" if M == 140 or M == 190 else "tool%d" % tool] = S
+				elif M == 106:	#Fan on
+					S = words.get("S")
+					fan = int(S) if S is not None else 255
+				elif M == 107:	#Fan off
+					fan = 0
 
 			elif T is not None:
-				if T > settings().getInt(["gcodeAnalysis", "maxExtruders"]):
+				T = int(T)
+				if T > max_extruders:
 					self._logger.warn("GCODE tried to select tool %d, that looks wrong, ignoring for GCODE analysis" % T)
 				else:
 					posOffset[0] -= offsets[currentExtruder][0] if currentExtruder < len(offsets) else 0
@@ -239,23 +594,289 @@ class gcode(object):
 						for i in range(len(totalExtrusion), currentExtruder + 1):
 							totalExtrusion.append(0.0)
 
+			if sync and not failed:
+				if G == 0 or G == 1:
+					if posAbs:
+						knownX = knownX or words.get("X") is not None
+						knownY = knownY or words.get("Y") is not None
+						knownZ = knownZ or words.get("Z") is not None
+					knownF = knownF or bool(words.get("F"))
+					# the height of the last extrusion decides whether the next one starts a new layer
+					knownLayer = knownLayer or knownZ and moveType == 'extrude'
+					if absoluteE and words.get("E") is not None:
+						if syncState is not None and not currentExtruder in knownE:
+							# absolute extrusion on an extruder whose position we only guessed
+							failed = True
+						knownE.add(currentExtruder)
+				elif G == 28:
+					homeAll = not "X" in words and not "Y" in words and not "Z" in words
+					knownX = knownX or homeAll or "X" in words
+					knownY = knownY or homeAll or "Y" in words
+					knownZ = knownZ or homeAll or "Z" in words
+				elif G == 92:
+					if words.get("X") is not None and not knownX or words.get("Y") is not None and not knownY \
+							or words.get("Z") is not None and not knownZ:
+						# the new offset depends on a position we don't know
+						failed = True
+					if words.get("E") is not None:
+						knownE.add(currentExtruder)
+
+				if syncState is None:
+					if knownX and knownY and knownZ and knownF and knownLayer and (currentExtruder in knownE or not absoluteE):
+						syncState = pack()
+						syncState["line"] = filePos
+						# from here on track the maximum extrusion relative to the synced state
+						maxExtrusion = totalExtrusion[:]
+						# and the moves only from here on, the positions before were guessed
+						bounds = dict()
+						travelBounds = None
+						travelDistance = extrudeDistance = 0.0
+						outOfVolume = [0, 0, None]
+						lastExtruded = None
+
 			if throttle is not None:
 				throttle()
 
-		if self.progressCallback is not None:
-			self.progressCallback(100.0)
+		result = pack()
+		if sync:
+			result["sync"] = syncState if not failed else None
+			result["knownE"] = sorted(knownE)
+		self._setResult(result)
+		return result
 
+	def _setResult(self, state):
+		maxExtrusion = state["maxExtrusion"]
 		self.extrusionAmount = maxExtrusion
 		self.extrusionVolume = [0] * len(maxExtrusion)
 		for i in range(len(maxExtrusion)):
-			radius = self._filamentDiameter / 2
+			radius = state["filamentDiameter"] / 2
 			self.extrusionVolume[i] = (self.extrusionAmount[i] * (math.pi * radius * radius)) / 1000
-		self.totalMoveTimeMinute = totalMoveTimeMinute
+		self.totalMoveTimeMinute = state["totalMoveTimeMinute"]
+		self.layerList = [dict(z=z, offset=offset, line=line, time=time, filament=filament, state=checkpoint)
+		                  for z, offset, line, time, filament, checkpoint, _ in state["layers"]]
+		self.bounds = dict((tool, _bounds_dict(toolBounds)) for tool, toolBounds in state["bounds"].items())
+		self.travelBounds = _bounds_dict(state["travelBounds"]) if state["travelBounds"] is not None else None
+		self.travelDistance = state["travelDistance"]
+		self.extrudeDistance = state["extrudeDistance"]
+		travel, extrude, line = state["outOfVolume"]
+		self.outOfVolume = dict(travel=travel, extrude=extrude, line=line)
+
+	def _parseFilamentDiameter(self, comment):
+		"""
+		Returns:
+		    float: The filament diameter configured in ``comment`` (by the slicer), None if ``comment`` doesn't
+		        configure it.
+		"""
+		if comment.startswith("filament_diameter"):
+			filamentValue = comment.split("=", 1)[1].strip()
+			try:
+				return float(filamentValue)
+			except ValueError:
+				try:
+					return float(filamentValue.split(",")[0].strip())
+				except ValueError:
+					return 0.0
+		elif comment.startswith("CURA_PROFILE_STRING") or comment.startswith("CURA_OCTO_PROFILE_STRING"):
+			if comment.startswith("CURA_PROFILE_STRING"):
+				prefix = "CURA_PROFILE_STRING:"
+			else:
+				prefix = "CURA_OCTO_PROFILE_STRING:"
+
+			curaOptions = self._parseCuraProfileString(comment, prefix)
+			if "filament_diameter" in curaOptions:
+				try:
+					return float(curaOptions["filament_diameter"])
+				except:
+					return 0.0
+		return None
 
 	def _parseCuraProfileString(self, comment, prefix):
 		return {key: value for (key, value) in map(lambda x: x.split("=", 1), zlib.decompress(base64.b64decode(comment[len(prefix):])).split("\b"))}
 
 
+def _bounds_dict(box):
+	return dict(minX=box[0], maxX=box[1], minY=box[2], maxY=box[3], minZ=box[4], maxZ=box[5])
+
+
+class StreamingAnalysis(object):
+	"""
+	Analysis of a GCODE file whose contents are supplied in chunks of arbitrary size, e.g. while the file is still
+	being received. Complete lines are analyzed as soon as they are fed, the analysis continues from the state the
+	previous chunk left it in, so the result is the same as that of :meth:`gcode.load` on the whole file.
+
+	Arguments:
+	    printer_profile (dict): The printer profile to analyze for.
+	    estimator (str): Name of the print time estimator to use, see :class:`gcode`.
+	    max_extruders (int): Highest tool number to accept, defaults to the ``gcodeAnalysis.maxExtruders`` setting.
+	    throttle (callable): Called after every line analyzed if set.
+	"""
+
+	def __init__(self, printer_profile, estimator=None, max_extruders=None, throttle=None):
+		if max_extruders is None:
+			max_extruders = settings().getInt(["gcodeAnalysis", "maxExtruders"])
+
+		self.analysis = gcode(estimator=estimator)
+		self._printer_profile = printer_profile
+		self._max_extruders = max_extruders
+		self._throttle = throttle
+		self._state = None
+		self._offset = 0
+		self._buffer = b""
+
+	def feed(self, data):
+		"""
+		Analyzes all lines completed by ``data``, an incomplete last line is kept until the next call.
+
+		Raises:
+		    AnalysisAborted: The analysis was aborted via :meth:`abort`.
+		"""
+		data = self._buffer + data
+		end = data.rfind(b"\n") + 1
+		self._buffer = data[end:]
+		if end:
+			self._analyze(io.BytesIO(data[:end]), end)
+
+	def finish(self):
+		"""
+		Analyzes the last line if it didn't end with a line break.
+
+		Returns:
+		    gcode: The finished analysis.
+		"""
+		if self._buffer or self._state is None:
+			self._analyze([self._buffer] if self._buffer else [], len(self._buffer))
+			self._buffer = b""
+		return self.analysis
+
+	def abort(self):
+		self.analysis.abort()
+
+	def _analyze(self, lines, length):
+		self._state = self.analysis._load(lines, self._printer_profile, throttle=self._throttle, state=self._state,
+		                                  max_extruders=self._max_extruders, offset=self._offset)
+		self._offset += length
+
+
+class LayerIndex(object):
+	"""
+	The layer index of a file as contained in its analysis result (``layers``, see
+	:class:`~octoprint.filemanager.analysis.GcodeAnalysisQueue`). Allows looking up the layer at a position in the file
+	and the estimated print time up to it without reading the file, within a layer the time is interpolated by bytes.
+
+	Arguments:
+	    layers (dict): The layer index from the analysis result.
+	    total_time (float): The estimated print time of the whole file, in seconds.
+	    size (int): The size of the file, in bytes.
+	"""
+
+	def __init__(self, layers, total_time, size):
+		self._z = layers["z"]
+		self._offset = layers["offset"]
+		self._line = layers["line"]
+		self._time = layers["time"]
+		self._filament = layers["filament"]
+		self._state = layers.get("state")
+		self._total_time = total_time
+		self._size = size
+
+	def __len__(self):
+		return len(self._offset)
+
+	def get_layer(self, offset):
+		"""
+		Returns:
+		    int: The number of the layer containing the byte ``offset``, None if it lies before the first layer.
+		"""
+		layer = bisect.bisect_right(self._offset, offset) - 1
+		return layer if layer >= 0 else None
+
+	def get_layer_data(self, layer):
+		"""
+		Returns:
+		    dict: Number, height, byte offset and line number of the ``layer`` and estimated print time and filament
+		        before it.
+		"""
+		return dict(layer=layer,
+		            z=self._z[layer],
+		            offset=self._offset[layer],
+		            line=self._line[layer],
+		            time=self._time[layer],
+		            filament=self._filament[layer])
+
+	def get_checkpoint(self, layer):
+		"""
+		Returns the state of the printer at the start of the ``layer`` as determined by the analysis, for resuming a
+		print from there. It is a :class:`dict` with the following keys:
+
+		``position``
+		    X, Y and Z position as addressed by the file (in the units it uses at that point).
+		``offset``
+		    Offset of the X, Y and Z axes set by the file via ``G92`` (in the same units), the position without it is
+		    ``position`` plus ``offset``.
+		``e``
+		    Position of the selected extruder.
+		``feedrate``
+		    The current feedrate, in mm/min.
+		``tool``
+		    The selected tool.
+		``absolutePositioning``, ``absoluteExtrusion``
+		    Whether positions respectively extrusions are absolute (``G90``, ``M82``) or relative (``G91``, ``M83``).
+		``inches``
+		    Whether the file uses inches (``G20``).
+		``temperatures``
+		    Target temperatures set so far, keys are ``tool0``, ``tool1``, ... and ``bed``.
+		``fan``
+		    The fan speed (0 to 255), None if not set so far.
+
+		Returns:
+		    dict: The state, None if the index doesn't contain it.
+		"""
+		if self._state is None:
+			return None
+		return self._state[layer]
+
+	def get_time(self, offset):
+		"""
+		Returns:
+		    float: The estimated print time of the file up to the byte ``offset``, in seconds.
+		"""
+		layer = bisect.bisect_right(self._offset, offset) - 1
+		if layer < 0:
+			start, startTime = 0, 0.0
+		else:
+			start, startTime = self._offset[layer], self._time[layer]
+
+		if layer + 1 < len(self._offset):
+			end, endTime = self._offset[layer + 1], self._time[layer + 1]
+		else:
+			end, endTime = self._size, self._total_time
+
+		if end <= start:
+			return endTime
+		fraction = min(max(float(offset - start) / float(end - start), 0.0), 1.0)
+		return startTime + fraction * (endTime - startTime)
+
+	def get_progress(self, offset):
+		"""
+		Returns:
+		    float: The estimated progress of a print at the byte ``offset``, based on the estimated print time, as a
+		        value between 0 and 1. None if the print time is unknown.
+		"""
+		if not self._total_time:
+			return None
+		return min(self.get_time(offset) / float(self._total_time), 1.0)
+
+	def get_time_left(self, offset):
+		"""
+		Returns:
+		    float: The estimated print time of the rest of the file after the byte ``offset``, in seconds. None if the
+		        print time is unknown.
+		"""
+		if not self._total_time:
+			return None
+		return max(self._total_time - self.get_time(offset), 0.0)
+
+
 def getCodeInt(line, code):
 	n = line.find(code) + 1
 	if n < 1:
@@ -270,7 +891,6 @@ def getCodeInt(line, code):
 
 
 def getCodeFloat(line, code):
-	import math
 	n = line.find(code) + 1
 	if n < 1:
 		return None
@@ -0,0 +1,407 @@
+# coding=utf-8
+"""
+This module contains the multi process variant of the GCODE analysis performed by
+:class:`~octoprint.util.gcodeInterpreter.gcode`.
+
+A file is split into chunks at line boundaries (preferably at layer changes or extruder resets, where slicers set
+the position and feedrate explicitly again) which are then analyzed in two rounds on a :class:`multiprocessing.Pool`:
+
+  1. A cheap scan of each chunk for the modal settings it changes (absolute/relative positioning and extrusion,
+     units, the selected tool and hence the tool offset, the filament diameter, the target temperatures and the fan
+     speed). Folding these in file order yields the modal settings at the start of every chunk.
+  2. A full analysis of each chunk starting from those settings and a guessed position, feedrate, extruder
+     position and layer height. The analysis tracks the line from which on all of these have been set explicitly by
+     the file (the "sync" line) - from there on the results are exact.
+
+The results are then merged in file order. The lines up to the sync line of a chunk are replayed, starting from the
+exact state at the end of the preceding chunk. The results of the chunk from the sync line on (time, extrusion,
+layers, bounds and lengths of the moves) are then added to that.
+
+Chunks for which any assumption turns out to be wrong (e.g. the modal settings differ because a ``G92 X`` changed the
+offset in an earlier chunk) are replayed completely, so the result is the same as that of the sequential analysis,
+only how much work remains in the merging process depends on the file. The only exception is the print time as
+estimated by the ``planner`` estimator (see :mod:`octoprint.util.gcodeEstimator`), which can't look ahead across
+chunks - the speed at the first moves after each sync line may differ slightly.
+"""
+
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+
+from octoprint.util.gcodeInterpreter import gcode, read_lines, AnalysisAborted
+from octoprint.util.tokenizer import parse_words
+
+
+_boundary_window = 64 * 1024
+_boundary_prefixes = (";LAYER", "G92 E")
+
+_mode_keys = ("posAbs", "absoluteE", "scale", "currentExtruder", "filamentDiameter", "temperatures", "fan")
+_tolerance = 1e-9
+
+
+def split(path, count, window=_boundary_window):
+	"""
+	Splits the file at ``path`` into up to ``count`` chunks of roughly the same size. Chunks end at line boundaries,
+	within ``window`` bytes after the exact split position lines starting with ``;LAYER`` or ``G92 E`` are preferred
+	as the first line of the next chunk.
+
+	Arguments:
+	    path (str): Path of the file to split.
+	    count (int): Number of chunks to split the file into.
+	    window (int): Size of the window in which to look for preferred split lines.
+
+	Returns:
+	    list: ``(start, end)`` byte offsets of the chunks, covering the whole file.
+	"""
+	size = os.stat(path).st_size
+	if count < 2 or size == 0:
+		return [(0, size)]
+
+	offsets = [0]
+	with open(path, "rb") as f:
+		for i in range(1, count):
+			position = max(size * i // count, offsets[-1])
+			f.seek(position)
+			data = f.read(window)
+
+			# the first line that starts within the window
+			newline = data.find("\n")
+			if newline < 0:
+				continue
+			boundary = newline + 1
+
+			for prefix in _boundary_prefixes:
+				index = data.find("\n" + prefix, newline)
+				if index >= 0:
+					boundary = index + 1
+					break
+
+			offset = position + boundary
+			if offsets[-1] < offset < size:
+				offsets.append(offset)
+	offsets.append(size)
+
+	return zip(offsets[:-1], offsets[1:])
+
+
+def analyze(analysis, path, printer_profile, pool, count, max_extruders=10, throttle=None):
+	"""
+	Analyzes the file at ``path`` split into ``count`` chunks on ``pool``.
+
+	Arguments:
+	    analysis (gcode): The analysis on whose behalf to analyze, used for replaying chunks. Aborting it aborts the
+	        parallel analysis too, its progress callback is called after each merged chunk.
+	    path (str): Path of the file to analyze.
+	    printer_profile (dict): The printer profile to analyze for.
+	    pool (multiprocessing.Pool): The pool to analyze the chunks on.
+	    count (int): Number of chunks to split the file into.
+	    max_extruders (int): Highest tool number to accept.
+	    throttle (callable): Passed on to replays in the calling process.
+
+	Returns:
+	    dict: The state after the last line of the file, see :meth:`~octoprint.util.gcodeInterpreter.gcode._load`.
+
+	Raises:
+	    AnalysisAborted: The analysis was aborted.
+	"""
+	logger = logging.getLogger(__name__)
+
+	chunks = split(path, count)
+	initial = gcode.initial_state(printer_profile)
+	offsets = printer_profile["extruder"]["offsets"]
+
+	scans = _wait(analysis, pool.map_async(_scan_chunk, [(path, start, end, max_extruders) for start, end in chunks]))
+
+	assumed = [initial]
+	for scan in scans[:-1]:
+		assumed.append(_apply_scan(assumed[-1], scan, offsets))
+
+	estimator = analysis.get_estimator_name()
+	jobs = [(path, start, end, printer_profile, state, max_extruders, estimator) for (start, end), state in zip(chunks, assumed)]
+	results = pool.imap(_analyze_chunk, jobs)
+
+	state = None
+	replayed = 0
+	for index, (start, end) in enumerate(chunks):
+		result = _wait(analysis, results)
+		if index == 0:
+			state = result
+		else:
+			sync = result["sync"]
+			if sync is None or not _modes_match(state, assumed[index]):
+				state = _replay(analysis, path, start, end, printer_profile, state, max_extruders, throttle)
+				replayed += end - start
+			else:
+				prefix = _replay(analysis, path, start, end, printer_profile, state, max_extruders, throttle, lines=sync["line"])
+				if _synced(prefix, sync):
+					state = _combine(prefix, sync, result)
+				else:
+					state = _replay(analysis, path, start, end, printer_profile, prefix, max_extruders, throttle, skip=sync["line"])
+					replayed += end - start
+
+		# the end of the last chunk is reported by the caller once the analysis is finished
+		if analysis.progressCallback is not None and index < len(chunks) - 1:
+			try:
+				analysis.progressCallback(float(end) / float(chunks[-1][1]))
+			except:
+				pass
+
+	logger.debug("Analyzed {} in {} chunks, replayed {} bytes".format(path, len(chunks), replayed))
+	for key in ("sync", "knownE"):
+		state.pop(key, None)
+	analysis._filamentDiameter = state["filamentDiameter"]
+	return state
+
+
+def analyze_file(job):
+	"""
+	Analyzes a whole file in a pool process.
+
+	Arguments:
+	    job (tuple): Path of the file, printer profile, highest tool number to accept and name of the print time
+	        estimator.
+
+	Returns:
+	    dict: The analysis result, see :func:`analyze`.
+	"""
+	path, printer_profile, max_extruders, estimator = job
+	return gcode(estimator=estimator)._load(read_lines(path), printer_profile, max_extruders=max_extruders)
+
+
+def _wait(analysis, result, interval=0.5):
+	while True:
+		if analysis._abort:
+			raise AnalysisAborted()
+		try:
+			if isinstance(result, multiprocessing.pool.IMapIterator):
+				return result.next(interval)
+			else:
+				return result.get(interval)
+		except multiprocessing.TimeoutError:
+			pass
+
+
+def _scan_chunk(job):
+	path, start, end, max_extruders = job
+
+	# temperatures are (tool, key, value) in file order, tool being None if set for the tool selected at the start
+	scan = dict(posAbs=None, absoluteE=None, scale=None, tool=None, offsetChanged=False, filamentDiameter=None,
+	            temperatures=[], fan=None)
+	parser = gcode()
+	for line in read_lines(path, start, end):
+		if line.startswith("G1 ") or line.startswith("G0 "):
+			# moves are by far the most common lines and don't change any mode
+			continue
+
+		if ";" in line:
+			filamentDiameter = parser._parseFilamentDiameter(line[line.find(";")+1:].strip().decode("utf-8", "replace"))
+			if filamentDiameter is not None:
+				scan["filamentDiameter"] = filamentDiameter
+
+		words = parse_words(line)
+		G = words.get("G")
+		M = words.get("M")
+		T = words.get("T")
+
+		if G is not None:
+			if G == 20:
+				scan["scale"] = 25.4
+			elif G == 21:
+				scan["scale"] = 1.0
+			elif G == 90:
+				scan["posAbs"] = True
+			elif G == 91:
+				scan["posAbs"] = False
+			elif G == 92 and (words.get("X") is not None or words.get("Y") is not None or words.get("Z") is not None):
+				scan["offsetChanged"] = True
+		elif M is not None:
+			if M == 82:
+				scan["absoluteE"] = True
+			elif M == 83:
+				scan["absoluteE"] = False
+			elif M in (104, 109, 140, 190):
+				S = words.get("S")
+				if S is None:
+					S = words.get("R")
+				if S is not None:
+					if M == 140 or M == 190:
+						scan["temperatures"].append((None, "bed", S))
+					elif words.get("T") is not None:
+						if int(words.get("T")) <= max_extruders:
+							scan["temperatures"].append((int(words.get("T")), None, S))
+					else:
+						scan["temperatures"].append((scan["tool"], None, S))
+			elif M == 106:
+				S = words.get("S")
+				scan["fan"] = int(S) if S is not None else 255
+			elif M == 107:
+				scan["fan"] = 0
+		elif T is not None and int(T) <= max_extruders:
+			scan["tool"] = int(T)
+	return scan
+
+
+def _apply_scan(state, scan, offsets):
+	def offset(tool, axis):
+		return offsets[tool][axis] if tool < len(offsets) else 0
+
+	result = dict(state)
+	for key in ("posAbs", "absoluteE", "scale", "filamentDiameter", "fan"):
+		if scan[key] is not None:
+			result[key] = scan[key]
+
+	if scan["temperatures"]:
+		temperatures = dict(state["temperatures"])
+		for tool, key, value in scan["temperatures"]:
+			if key is None:
+				key = "tool%d" % (tool if tool is not None else state["currentExtruder"])
+			temperatures[key] = value
+		result["temperatures"] = temperatures
+
+	posOffset = state["posOffset"]
+	if scan["offsetChanged"] or posOffset is None:
+		# depends on the position, the chunk will have to be replayed
+		posOffset = None
+	elif scan["tool"] is not None:
+		posOffset = [posOffset[0] - offset(state["currentExtruder"], 0) + offset(scan["tool"], 0),
+		             posOffset[1] - offset(state["currentExtruder"], 1) + offset(scan["tool"], 1),
+		             posOffset[2]]
+	result["posOffset"] = posOffset
+
+	if scan["tool"] is not None:
+		result["currentExtruder"] = scan["tool"]
+	return result
+
+
+def _analyze_chunk(job):
+	path, start, end, printer_profile, state, max_extruders, estimator = job
+
+	sync = start > 0
+	if sync:
+		state = dict(state)
+		if state["posOffset"] is None:
+			state["posOffset"] = [0.0, 0.0, 0.0]
+		for key in ("currentE", "totalExtrusion", "maxExtrusion"):
+			state[key] = [0.0] * (state["currentExtruder"] + 1)
+		state.update(lines=0, layers=[], layerZ=None, layerMark=None)
+
+	return gcode(estimator=estimator)._load(read_lines(path, start, end), printer_profile, state=state, sync=sync, max_extruders=max_extruders, offset=start)
+
+
+def _replay(analysis, path, start, end, printer_profile, state, max_extruders, throttle, lines=None, skip=0):
+	chunk = itertools.islice(read_lines(path, start, end), skip, lines)
+	return analysis._load(chunk, printer_profile, throttle=throttle, state=state, max_extruders=max_extruders, offset=start)
+
+
+def _modes_match(state, assumed):
+	for key in _mode_keys:
+		if state[key] != assumed[key]:
+			return False
+	if assumed["posOffset"] is None:
+		return False
+	return _close(state["posOffset"], assumed["posOffset"])
+
+
+def _synced(state, sync):
+	return _modes_match(state, sync) \
+	       and _close(state["pos"], sync["pos"]) \
+	       and _close([state["feedRateXY"]], [sync["feedRateXY"]]) \
+	       and state["layerZ"] is not None and sync["layerZ"] is not None \
+	       and _close([state["layerZ"]], [sync["layerZ"]]) \
+	       and _mark_line(state, 0) == _mark_line(sync, state["lines"] - sync["lines"])
+
+
+def _mark_line(state, lines):
+	return state["layerMark"][1] + lines if state["layerMark"] is not None else None
+
+
+def _close(a, b):
+	return all(abs(x - y) <= _tolerance for x, y in zip(a, b))
+
+
+def _pad(values, count):
+	return values + [0.0] * (count - len(values))
+
+
+def _merge_bounds(a, b):
+	if a is None:
+		return b
+	if b is None:
+		return a
+	return [min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]), min(a[4], b[4]), max(a[5], b[5])]
+
+
+def _combine(state, sync, result):
+	"""
+	Combines the exact ``state`` at the sync line of a chunk with the ``result`` of its analysis from guessed values,
+	``sync`` being the state of that analysis at the sync line.
+	"""
+	count = max(len(state["totalExtrusion"]), len(result["totalExtrusion"]))
+	real = dict((key, _pad(state[key], count)) for key in ("currentE", "totalExtrusion", "maxExtrusion"))
+	guessed = dict((key, _pad(sync[key], count)) for key in ("currentE", "totalExtrusion"))
+	end = dict((key, _pad(result[key], count)) for key in ("currentE", "totalExtrusion", "maxExtrusion"))
+
+	combined = dict(result)
+	combined["totalMoveTimeMinute"] = state["totalMoveTimeMinute"] + result["totalMoveTimeMinute"] - sync["totalMoveTimeMinute"]
+	combined["estimator"] = dict(result["estimator"])
+	combined["estimator"]["total"] += (combined["totalMoveTimeMinute"] - result["totalMoveTimeMinute"]) * 60.0
+
+	# layers (and the start of the next one) found after the sync line: line numbers and the time and filament before
+	# them are shifted like the totals, unless they start before the sync line - then the replay knows them exactly,
+	# see _synced
+	lines = state["lines"] - sync["lines"]
+	time = (state["totalMoveTimeMinute"] - sync["totalMoveTimeMinute"]) * 60.0
+	filament = sum(state["totalExtrusion"]) - sum(sync["totalExtrusion"])
+
+	def shift(mark):
+		if mark is None:
+			return None
+		if mark[1] < sync["lines"]:
+			return state["layerMark"]
+		offset, line, markTime, markFilament, checkpoint, knownE = mark
+		if not knownE:
+			# only moved relatively since the sync line, by the same amount as in the guess
+			tool = checkpoint["tool"]
+			checkpoint = dict(checkpoint)
+			checkpoint["e"] += real["currentE"][tool] - guessed["currentE"][tool] if tool < count else 0.0
+		return offset, line + lines, markTime + time, markFilament + filament, checkpoint, True
+
+	combined["lines"] = result["lines"] + lines
+	combined["layers"] = list(state["layers"])
+	for layer in result["layers"][len(sync["layers"]):]:
+		combined["layers"].append((layer[0],) + shift(layer[1:]))
+	combined["layerMark"] = shift(result["layerMark"])
+	combined["currentE"] = []
+	combined["totalExtrusion"] = []
+	combined["maxExtrusion"] = []
+	for i in range(count):
+		if i in result["knownE"]:
+			currentE = end["currentE"][i]
+		else:
+			# only moved relatively, by the same amount as in the guess
+			currentE = real["currentE"][i] + end["currentE"][i] - guessed["currentE"][i]
+		combined["currentE"].append(currentE)
+		combined["totalExtrusion"].append(real["totalExtrusion"][i] + end["totalExtrusion"][i] - guessed["totalExtrusion"][i])
+		combined["maxExtrusion"].append(max(real["maxExtrusion"][i], real["totalExtrusion"][i] + end["maxExtrusion"][i] - guessed["totalExtrusion"][i]))
+
+	# the moves are only tracked from the sync line on, see gcode._load
+	combined["bounds"] = dict(state["bounds"])
+	for tool, bounds in result["bounds"].items():
+		combined["bounds"][tool] = _merge_bounds(combined["bounds"].get(tool), bounds)
+	combined["travelBounds"] = _merge_bounds(state["travelBounds"], result["travelBounds"])
+	combined["travelDistance"] = state["travelDistance"] + result["travelDistance"]
+	combined["extrudeDistance"] = state["extrudeDistance"] + result["extrudeDistance"]
+	travel, extrude, line = state["outOfVolume"]
+	if line is None and result["outOfVolume"][2] is not None:
+		line = result["outOfVolume"][2] + lines
+	combined["outOfVolume"] = [travel + result["outOfVolume"][0], extrude + result["outOfVolume"][1], line]
+	return combined
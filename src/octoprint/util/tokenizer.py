@@ -0,0 +1,164 @@
+# coding=utf-8
+"""
+This module contains a tokenizer for GCODE lines, parsing a line once into a table of its words, that is a ``dict``
+mapping each (upper case) word letter to its value::
+
+   >>> parse_words("G1 X10.5 Y-3 E0.25 F1800 ; perimeter")
+   {'G': 1.0, 'X': 10.5, 'Y': -3.0, 'E': 0.25, 'F': 1800.0}
+
+Words without a (valid) value such as the axes in ``G28 X Y`` are contained with a value of ``None``, if a letter is
+contained more than once only its first occurrence counts. Comments and checksums are ignored.
+
+Running this module (``python -m octoprint.util.tokenizer [<gcode file>]``) performs a benchmark comparing the
+tokenizer with the previous approach of searching for every parameter separately, on the provided file or on
+generated lines.
+"""
+
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import re
+
+_word_regex = re.compile("([A-Za-z])([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))?")
+_infinity = float("inf")
+
+
+def strip_comment(line):
+	"""
+	Arguments:
+	    line (str): The line to strip the comment from.
+
+	Returns:
+	    tuple: A 2-tuple consisting of the code part of ``line`` and its comment without the leading ``;``, or None
+	        if ``line`` has no comment.
+	"""
+	index = line.find(";")
+	if index < 0:
+		return line, None
+	return line[:index], line[index + 1:]
+
+
+def parse_words(line):
+	"""
+	Parses ``line`` into a table of its words.
+
+	The line is split at whitespace and every token converted in one go, only tokens consisting of several words
+	without separating whitespace (e.g. ``G1X10``) take a slower path through a regular expression.
+
+	Arguments:
+	    line (str): The line to parse, may contain a comment and a checksum.
+
+	Returns:
+	    dict: Values of the line's words as ``float`` (or None if a word has no valid value), mapped by their upper
+	        case letter.
+	"""
+	if ";" in line:
+		line = line[:line.find(";")]
+	if "*" in line:
+		line = line[:line.rfind("*")]
+
+	words = dict()
+	for token in line.split():
+		letter = token[0].upper()
+		if letter in words:
+			continue
+
+		if len(token) == 1:
+			if letter.isalpha():
+				words[letter] = None
+			continue
+
+		try:
+			value = float(token[1:])
+		except ValueError:
+			_parse_token(token, words)
+			continue
+
+		if value != value or value == _infinity or value == -_infinity:
+			# float() happily accepts "nan" and "inf", GCODE doesn't
+			_parse_token(token, words)
+			continue
+
+		if letter.isalpha():
+			words[letter] = value
+
+	return words
+
+
+def _parse_token(token, words):
+	for letter, value in _word_regex.findall(token):
+		letter = letter.upper()
+		if letter in words:
+			continue
+		words[letter] = float(value) if value else None
+
+
+def _legacy_get_code_float(line, code):
+	import math
+	n = line.find(code) + 1
+	if n < 1:
+		return None
+	m = line.find(' ', n)
+	try:
+		if m < 0:
+			val = float(line[n:])
+		else:
+			val = float(line[n:m])
+		return val if not (math.isnan(val) or math.isinf(val)) else None
+	except:
+		return None
+
+
+def benchmark(lines=None, path=None):
+	"""
+	Benchmark comparing the per line cost of parsing the words of GCODE lines via :func:`parse_words` with searching
+	for each of the parameters the analysis is interested in separately.
+
+	Arguments:
+	    lines (list): The lines to parse, defaults to 100000 generated lines.
+	    path (str): Path of a GCODE file to parse instead of ``lines``.
+
+	Returns:
+	    dict: Throughput in lines and MB per second, mapped by implementation.
+	"""
+	import time
+
+	if path is not None:
+		def source():
+			with open(path, "rb") as f:
+				for line in f:
+					yield line
+	else:
+		if lines is None:
+			lines = ["G1 X%.3f Y%.3f E%.5f F1800\n" % (i * 0.1, i * 0.2, i * 0.01) if i % 10 else "G0 Z%.2f F9000\n" % (i * 0.01) for i in range(100000)]
+		def source():
+			return iter(lines)
+
+	def legacy(line):
+		for code in "GMTXYZEF":
+			_legacy_get_code_float(line, code)
+
+	result = dict()
+	for name, func in (("legacy", legacy), ("parse_words", parse_words)):
+		count = 0
+		size = 0
+		start = time.time()
+		for line in source():
+			func(strip_comment(line)[0])
+			count += 1
+			size += len(line)
+		duration = time.time() - start
+		result[name] = dict(lines=count / duration, mb=size / duration / 1024 / 1024)
+	return result
+
+
+if __name__ == "__main__":
+	import sys
+	results = benchmark(path=sys.argv[1] if len(sys.argv) > 1 else None)
+	baseline = results["legacy"]["lines"]
+	for name in sorted(results, key=lambda x: results[x]["lines"]):
+		print("{name:<12} {lines:10.0f} lines/s {mb:6.2f} MB/s ({factor:.1f}x)".format(name=name, factor=results[name]["lines"] / baseline, **results[name]))
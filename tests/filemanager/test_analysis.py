@@ -0,0 +1,523 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import mock
+
+from multiprocessing.dummy import Pool
+
+from ddt import ddt, data, unpack
+
+from octoprint.filemanager.analysis import AnalysisCache, AnalysisQueue, AnalysisThrottle, GcodeAnalysisQueue, QueueEntry, printer_profile_fingerprint, check_print_volume
+
+printer_profile = dict(
+	axes=dict(x=dict(speed=6000), y=dict(speed=6000), z=dict(speed=200), e=dict(speed=300)),
+	extruder=dict(count=1, offsets=[(0, 0)])
+)
+
+
+class GcodeAnalysisQueueTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+
+		self.settings_patchers = [mock.patch("octoprint.filemanager.analysis.settings"),
+		                          mock.patch("octoprint.util.gcodeInterpreter.settings")]
+		values = {
+			("gcodeAnalysis", "maxExtruders"): 10,
+			("gcodeAnalysis", "estimator"): "legacy",
+			("gcodeAnalysis", "parallel", "enabled"): True,
+			("gcodeAnalysis", "parallel", "processes"): 2,
+			("gcodeAnalysis", "parallel", "minChunkSize"): 1024,
+			("gcodeAnalysis", "throttle", "maxLoad"): 100.0
+		}
+		for patcher in self.settings_patchers:
+			settings = patcher.start()
+			settings.return_value.getInt.side_effect = lambda path: values[tuple(path)]
+			settings.return_value.getFloat.side_effect = lambda path: values[tuple(path)]
+			settings.return_value.getBoolean.side_effect = lambda path: values[tuple(path)]
+			settings.return_value.get.side_effect = lambda path: values[tuple(path)]
+
+		self.event_manager_patcher = mock.patch("octoprint.filemanager.analysis.eventManager")
+		self.event_manager_patcher.start()
+
+		self.results = dict()
+		self.done = threading.Event()
+
+	def tearDown(self):
+		for patcher in self.settings_patchers:
+			patcher.stop()
+		self.event_manager_patcher.stop()
+		shutil.rmtree(self.basefolder)
+
+	def _finished(self, entry, result):
+		self.results[entry.path] = result
+		if len(self.results) == self.expected:
+			self.done.set()
+
+	def _entry(self, name, moves):
+		path = os.path.join(self.basefolder, name)
+		with open(path, "wb") as f:
+			f.write("G28\nG92 E0\n")
+			# moves of 10mm each at 6000mm/min, except for the first one
+			for i in range(moves):
+				f.write("G1 X%d Y%d E%d F6000\n" % (i % 2 * 10, 0, i + 1))
+		return QueueEntry(name, "gcode", "local", path, printer_profile)
+
+	def test_batch(self):
+		queue = GcodeAnalysisQueue(self._finished)
+		queue._create_pool = lambda processes: Pool(processes)
+		queue.pause()
+
+		self.expected = 3
+		for i in range(self.expected):
+			queue.enqueue(self._entry("file%d.gcode" % i, 10 * (i + 1)))
+
+		with mock.patch.object(queue, "_analyze_batch", wraps=queue._analyze_batch) as analyze_batch:
+			queue.resume()
+			self.assertTrue(self.done.wait(5.0))
+			self.assertEquals(1, analyze_batch.call_count)
+
+		for i in range(self.expected):
+			result = self.results["file%d.gcode" % i]
+			self.assertEquals(10.0 * (i + 1), result["filament"]["tool0"]["length"])
+			self.assertAlmostEquals((10 * (i + 1) - 1) * 0.1, result["estimatedPrintTime"], places=6)
+
+	def test_chunked(self):
+		queue = GcodeAnalysisQueue(self._finished)
+		queue._create_pool = lambda processes: Pool(processes)
+
+		self.expected = 1
+		queue.enqueue(self._entry("large.gcode", 1000), high_priority=True)
+
+		self.assertTrue(self.done.wait(5.0))
+		result = self.results["large.gcode"]
+		self.assertEquals(1000.0, result["filament"]["tool0"]["length"])
+		self.assertAlmostEquals(999 * 0.1, result["estimatedPrintTime"], places=6)
+		self.assertEquals([0.0], result["layers"]["z"])
+		self.assertEquals([11], result["layers"]["offset"])
+		self.assertEquals([2], result["layers"]["line"])
+		self.assertEquals([0.0, 0.0, 0.0], result["layers"]["state"][0]["position"])
+
+
+@ddt
+class CheckPrintVolumeTest(unittest.TestCase):
+
+	def _analysis(self, minX=10.0, maxX=90.0, minY=10.0, maxY=90.0, maxZ=20.0, extrude=0):
+		return dict(bounds=dict(tool0=dict(minX=minX, maxX=maxX, minY=minY, maxY=maxY, minZ=0.3, maxZ=maxZ)),
+		            outOfVolume=dict(travel=3, extrude=extrude, line=12 if extrude else None))
+
+	def _profile(self, origin="lowerleft", formFactor="rectangular"):
+		return dict(printer_profile, volume=dict(width=100, depth=100, height=50, origin=origin, formFactor=formFactor))
+
+	@data(
+		(dict(), dict(), False),
+		(dict(maxX=100.0), dict(), False),
+		(dict(maxX=100.5), dict(), True),
+		(dict(minY=-1.0), dict(), True),
+		(dict(maxZ=51.0), dict(), True),
+		(dict(minX=-40.0, maxX=40.0, minY=-40.0, maxY=40.0), dict(origin="center"), False),
+		(dict(), dict(origin="center"), True),
+		(dict(minX=-40.0, maxX=40.0, minY=-40.0, maxY=40.0), dict(origin="center", formFactor="circular"), False),
+		(dict(minX=-40.0, maxX=40.0, minY=-40.0, maxY=40.0, extrude=2), dict(origin="center", formFactor="circular"), True),
+		(dict(extrude=2), dict(), False)
+	)
+	@unpack
+	def test_check(self, analysis, profile, rejected):
+		reason = check_print_volume(self._analysis(**analysis), self._profile(**profile))
+		self.assertEquals(rejected, reason is not None)
+
+	def test_unknown(self):
+		self.assertIsNone(check_print_volume(self._analysis(maxX=500.0), printer_profile))
+		self.assertIsNone(check_print_volume(dict(estimatedPrintTime=6.0), self._profile()))
+		self.assertIsNone(check_print_volume(None, self._profile()))
+
+
+class AnalysisCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+		self.path = os.path.join(self.basefolder, "analysis_cache")
+
+	def tearDown(self):
+		shutil.rmtree(self.basefolder)
+
+	def test_eviction(self):
+		cache = AnalysisCache(size=2)
+		cache.put("a", dict(estimatedPrintTime=1))
+		cache.put("b", dict(estimatedPrintTime=2))
+
+		# a is now used more recently than b
+		self.assertEquals(dict(estimatedPrintTime=1), cache.get("a"))
+		cache.put("c", dict(estimatedPrintTime=3))
+
+		self.assertTrue("a" in cache)
+		self.assertFalse("b" in cache)
+		self.assertTrue("c" in cache)
+		self.assertIsNone(cache.get("b"))
+		self.assertEquals(dict(count=2, size=2, hits=1, misses=1, evictions=1), cache.stats)
+
+	def test_persistence(self):
+		cache = AnalysisCache(path=self.path, size=10)
+		for key in ("a", "b", "c"):
+			cache.put(key, dict(filament=dict(tool0=dict(length=1.0, volume=2.0))))
+		cache.get("a")
+		cache.put("d", dict())
+
+		loaded = AnalysisCache(path=self.path, size=2)
+
+		self.assertEquals(2, len(loaded))
+		self.assertFalse("b" in loaded)
+		self.assertFalse("c" in loaded)
+		self.assertTrue("d" in loaded)
+		self.assertEquals(dict(filament=dict(tool0=dict(length=1.0, volume=2.0))), loaded.get("a"))
+
+		# evicted results are removed from disk
+		self.assertEquals(2, len(os.listdir(self.path)))
+
+	def test_put_writes_one_file(self):
+		cache = AnalysisCache(path=self.path)
+		cache.put("a", dict(estimatedPrintTime=1))
+
+		with mock.patch("yaml.safe_dump") as safe_dump:
+			cache.put("b", dict(estimatedPrintTime=2))
+			self.assertEquals(1, safe_dump.call_count)
+			self.assertEquals(dict(key="b", result=dict(estimatedPrintTime=2)), safe_dump.call_args[0][0])
+
+	def test_corrupt_file(self):
+		cache = AnalysisCache(path=self.path)
+		cache.put("a", dict(estimatedPrintTime=1))
+		for name in os.listdir(self.path):
+			with open(os.path.join(self.path, name), "wb") as f:
+				f.write("{not: [yaml")
+
+		loaded = AnalysisCache(path=self.path)
+		self.assertIsNone(loaded.get("a"))
+		self.assertEquals(0, len(loaded))
+
+	def test_fingerprint(self):
+		renamed = dict(printer_profile, id="other", name="Other")
+		faster = dict(printer_profile, axes=dict(printer_profile["axes"], x=dict(speed=9000)))
+
+		self.assertEquals(printer_profile_fingerprint(printer_profile), printer_profile_fingerprint(renamed))
+		self.assertNotEquals(printer_profile_fingerprint(printer_profile), printer_profile_fingerprint(faster))
+
+
+class AnalysisQueueCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+
+		self.event_manager_patcher = mock.patch("octoprint.filemanager.analysis.eventManager")
+		self.event_manager_patcher.start()
+
+		self.cache = AnalysisCache()
+		self.queue = AnalysisQueue(cache=self.cache)
+		self.finished = mock.Mock()
+		self.queue.register_finish_callback(self.finished)
+
+		self.gcode_queue = mock.Mock(ANALYSIS_VERSION=1)
+		self.queue._queues["gcode"] = self.gcode_queue
+
+	def tearDown(self):
+		self.event_manager_patcher.stop()
+		shutil.rmtree(self.basefolder)
+
+	def _entry(self, name, content="G28\nG1 X10 F6000\n"):
+		path = os.path.join(self.basefolder, name)
+		with open(path, "wb") as f:
+			f.write(content)
+		return QueueEntry(name, "gcode", "local", path, printer_profile)
+
+	def _process(self, entry, high_priority=False):
+		# what the worker of the type specific queue does with an enqueued entry
+		self.queue.enqueue(entry, high_priority=high_priority)
+		self.gcode_queue.enqueue.assert_called_with(entry, high_priority=high_priority)
+		return self.queue._cached_result(entry)
+
+	def test_miss_then_hit(self):
+		entry = self._entry("first.gcode")
+		self.assertIsNone(self._process(entry))
+		self.assertFalse(self.finished.called)
+
+		result = dict(estimatedPrintTime=6.0)
+		self.queue._analysis_finished(entry, result)
+		self.finished.assert_called_once_with(entry, result)
+
+		# same contents under another name
+		copy = self._entry("copy.gcode")
+		self.assertEquals(result, self._process(copy, high_priority=True))
+		self.assertEquals(dict(count=1, size=1000, hits=1, misses=1, evictions=0), self.queue.cache_stats)
+
+	def test_different_contents(self):
+		entry = self._entry("first.gcode")
+		self._process(entry)
+		self.queue._analysis_finished(entry, dict(estimatedPrintTime=6.0))
+
+		other = self._entry("other.gcode", content="G28\nG1 X20 F6000\n")
+		self.assertIsNone(self._process(other))
+		self.assertNotEquals(self.queue.cache_key(entry), self.queue.cache_key(other))
+
+	def test_enqueue_does_not_hash(self):
+		hasher = mock.Mock()
+		hasher.hash.return_value = "known hash"
+		queue = AnalysisQueue(cache=self.cache, hasher=hasher)
+		queue._queues["gcode"] = self.gcode_queue
+
+		entry = self._entry("first.gcode")
+		queue.enqueue(entry)
+		self.assertFalse(hasher.hash.called)
+
+		queue._cached_result(entry)
+		hasher.hash.assert_called_once_with(entry.absolute_path)
+
+	def test_worker_skips_known(self):
+		finished = mock.Mock()
+		lookup = mock.Mock(side_effect=lambda entry: dict(estimatedPrintTime=6.0) if entry.path == "known.gcode" else None)
+		gcode_queue = GcodeAnalysisQueue(finished, lookup_callback=lookup)
+		known = self._entry("known.gcode")
+		unknown = self._entry("unknown.gcode")
+
+		with mock.patch.object(gcode_queue, "_analyze") as analyze:
+			gcode_queue.enqueue(known, high_priority=True)
+			gcode_queue.enqueue(unknown, high_priority=True)
+			gcode_queue._queue.join()
+
+			finished.assert_called_once_with(known, dict(estimatedPrintTime=6.0))
+			analyze.assert_called_once_with(unknown, high_priority=True)
+
+	def test_hasher(self):
+		entry = self._entry("first.gcode")
+
+		hasher = mock.Mock()
+		hasher.hash.return_value = "known hash"
+		queue = AnalysisQueue(cache=self.cache, hasher=hasher)
+		queue._queues["gcode"] = self.gcode_queue
+
+		self.assertTrue("-known hash-" in queue.cache_key(entry))
+		hasher.hash.assert_called_once_with(entry.absolute_path)
+
+
+class AnalysisStreamTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+
+		self.settings_patchers = [mock.patch("octoprint.filemanager.analysis.settings"),
+		                          mock.patch("octoprint.util.gcodeInterpreter.settings")]
+		self.values = {
+			("gcodeAnalysis", "maxExtruders"): 10,
+			("gcodeAnalysis", "estimator"): "legacy",
+			("gcodeAnalysis", "parallel", "enabled"): False,
+			("gcodeAnalysis", "streaming", "enabled"): True,
+			("gcodeAnalysis", "streaming", "maxBacklog"): 1024 * 1024,
+			("gcodeAnalysis", "throttle", "maxLoad"): 100.0
+		}
+		for patcher in self.settings_patchers:
+			settings = patcher.start()
+			settings.return_value.getInt.side_effect = lambda path: self.values[tuple(path)]
+			settings.return_value.getFloat.side_effect = lambda path: self.values[tuple(path)]
+			settings.return_value.getBoolean.side_effect = lambda path: self.values[tuple(path)]
+			settings.return_value.get.side_effect = lambda path: self.values[tuple(path)]
+
+		self.event_manager_patcher = mock.patch("octoprint.filemanager.analysis.eventManager")
+		self.event_manager_patcher.start()
+
+		self.queue = AnalysisQueue(cache=AnalysisCache())
+		self.results = dict()
+		self.done = threading.Event()
+		self.queue.register_finish_callback(self._finished)
+
+	def tearDown(self):
+		for patcher in self.settings_patchers:
+			patcher.stop()
+		self.event_manager_patcher.stop()
+		shutil.rmtree(self.basefolder)
+
+	def _finished(self, entry, result):
+		self.results[entry.path] = result
+		self.done.set()
+
+	def _content(self):
+		lines = ["G28\n", "G92 E0\n", "G1 Z0.3 F6000\n"]
+		for i in range(100):
+			lines.append("G1 X%d Y%d E%d\n" % (i % 2 * 10, i % 3, i + 1))
+		return "".join(lines)
+
+	def _entry(self, name, content):
+		path = os.path.join(self.basefolder, name)
+		with open(path, "wb") as f:
+			f.write(content)
+		return QueueEntry(name, "gcode", "local", path, printer_profile)
+
+	def test_stream(self):
+		import hashlib
+
+		content = self._content()
+		stream = self.queue.stream("gcode", printer_profile)
+		for i in range(0, len(content), 100):
+			stream.update(content[i:i + 100])
+		stream.finish()
+
+		entry = self._entry("streamed.gcode", content)
+		self.queue.enqueue(entry, high_priority=True, stream=stream, file_hash=hashlib.sha1(content).hexdigest())
+		self.assertTrue(self.done.wait(5.0))
+
+		# same result as when analyzing the file
+		gcode_queue = self.queue._queues["gcode"]
+		gcode_queue._current = entry
+		self.assertEquals(gcode_queue._do_analysis(high_priority=True), self.results["streamed.gcode"])
+		self.assertTrue(self.results["streamed.gcode"]["estimatedPrintTime"] > 0)
+
+		# and cached
+		self.assertEquals(1, self.queue.cache_stats["count"])
+
+	def test_backlog_exceeded(self):
+		self.values[("gcodeAnalysis", "streaming", "maxBacklog")] = 10
+
+		content = self._content()
+		stream = self.queue.stream("gcode", printer_profile)
+		stream.update(content)
+		stream.finish()
+
+		with mock.patch.object(self.queue._queues["gcode"], "enqueue") as enqueue:
+			entry = self._entry("backlog.gcode", content)
+			self.queue.enqueue(entry, stream=stream)
+			stream._worker.join(5.0)
+
+			enqueue.assert_called_once_with(entry, high_priority=False)
+		self.assertFalse(self.done.is_set())
+
+	def test_paused(self):
+		stream = self.queue.stream("gcode", printer_profile)
+		stream.update("G28\n")
+
+		self.queue.pause()
+		stream._worker.join(5.0)
+		self.assertFalse(stream._worker.is_alive())
+		self.assertEquals(None, self.queue.stream("gcode", printer_profile))
+
+		self.queue.resume()
+		stream = self.queue.stream("gcode", printer_profile)
+		self.assertNotEquals(None, stream)
+		stream.abort()
+
+	def test_disabled(self):
+		self.values[("gcodeAnalysis", "streaming", "enabled")] = False
+		self.assertEquals(None, self.queue.stream("gcode", printer_profile))
+		self.assertEquals(None, self.queue.stream("stl", printer_profile))
+
+
+class AnalysisThrottleTest(unittest.TestCase):
+
+	def setUp(self):
+		self.settings_patcher = mock.patch("octoprint.filemanager.analysis.settings")
+		settings = self.settings_patcher.start()
+		self.values = {
+			("gcodeAnalysis", "throttle", "enabled"): True,
+			("gcodeAnalysis", "throttle", "printingBudget"): 0.25,
+			("gcodeAnalysis", "throttle", "maxSendLatency"): 0.02,
+			("gcodeAnalysis", "throttle", "maxLoad"): 1.5
+		}
+		settings.return_value.getFloat.side_effect = lambda path: self.values[tuple(path)]
+		settings.return_value.getBoolean.side_effect = lambda path: self.values[tuple(path)]
+
+		self.throttle = AnalysisThrottle()
+		self.load = 0.1
+		self.throttle._get_load = lambda: self.load
+
+	def tearDown(self):
+		self.settings_patcher.stop()
+
+	def test_idle(self):
+		self.assertFalse(self.throttle.busy)
+		self.assertEquals(1.0, self.throttle.get_budget())
+
+	def test_printing(self):
+		latency = mock.Mock(return_value=None)
+		self.throttle.register_latency_source(latency)
+		self.assertTrue(self.throttle.busy)
+		self.assertAlmostEquals(0.25, self.throttle.get_budget())
+
+		latency.return_value = 0.01
+		self.assertAlmostEquals(0.25, self.throttle.get_budget())
+
+		# the printer is waiting for the host, yield more
+		latency.return_value = 0.08
+		self.assertAlmostEquals(0.0625, self.throttle.get_budget())
+
+		latency.return_value = 10.0
+		self.assertAlmostEquals(AnalysisThrottle.MIN_BUDGET, self.throttle.get_budget())
+
+		self.throttle.unregister_latency_source(latency)
+		self.assertFalse(self.throttle.busy)
+		self.assertEquals(1.0, self.throttle.get_budget())
+
+	def test_failing_source(self):
+		self.throttle.register_latency_source(mock.Mock(side_effect=IOError()))
+		self.throttle.register_latency_source(lambda: 0.04)
+		self.assertAlmostEquals(0.125, self.throttle.get_budget())
+
+	def test_load(self):
+		self.load = 3.0
+		self.assertAlmostEquals(0.5, self.throttle.get_budget())
+
+		self.load = None
+		self.assertEquals(1.0, self.throttle.get_budget())
+
+	def _run(self, lines, line_time=0.001):
+		clock = [0.0]
+		sleeps = []
+
+		def sleep(duration):
+			sleeps.append(duration)
+			clock[0] += duration
+
+		with mock.patch("octoprint.filemanager.analysis.time") as patched_time:
+			patched_time.time.side_effect = lambda: clock[0]
+			patched_time.sleep.side_effect = sleep
+
+			callback = self.throttle.callback()
+			for _ in range(lines):
+				clock[0] += line_time
+				callback()
+
+		return clock[0], sleeps
+
+	def test_slices_idle(self):
+		duration, sleeps = self._run(5000)
+		self.assertEquals([], sleeps)
+		self.assertAlmostEquals(5.0, duration)
+
+	def test_slices_printing(self):
+		self.throttle.register_latency_source(lambda: 0.01)
+		duration, sleeps = self._run(5000)
+
+		# slices of 10ms of work, each followed by 30ms of sleep
+		self.assertEquals(500, len(sleeps))
+		for sleep in sleeps:
+			self.assertAlmostEquals(0.03, sleep)
+		self.assertAlmostEquals(20.0, duration)
+
+	def test_disabled(self):
+		self.values[("gcodeAnalysis", "throttle", "enabled")] = False
+		queue = AnalysisQueue(throttle=self.throttle)
+		queue.pause = mock.Mock()
+		queue.resume = mock.Mock()
+
+		source = lambda: 0.01
+		queue.register_latency_source(source)
+		queue.pause.assert_called_once_with()
+		self.assertFalse(self.throttle.busy)
+
+		queue.unregister_latency_source(source)
+		queue.resume.assert_called_once_with()
@@ -157,6 +157,87 @@ class FileManagerTest(unittest.TestCase):
 		self.local_storage.add_file.assert_called_once_with("test.file", wrapper, printer_profile=test_profile, allow_overwrite=False, links=None)
 		self.fire_event.assert_called_once_with(octoprint.filemanager.Events.UPDATED_FILES, dict(type="printables"))
 
+	def test_add_uploaded_file(self):
+		test_profile = dict(id="_default", name="My Default Profile")
+		self.printer_profile_manager.get_current_or_default.return_value = test_profile
+		stream = self.analysis_queue.stream.return_value
+
+		processor = self.file_manager.create_upload_processor("test.gcode", "/tmp/upload.tmp")
+		processor.update(b"G28\n")
+		processor.update(b"G1 X10\n")
+		processor.finish()
+
+		self.analysis_queue.stream.assert_called_once_with("gcode", test_profile)
+		self.assertEquals([mock.call(b"G28\n"), mock.call(b"G1 X10\n")], stream.update.call_args_list)
+
+		self.local_storage.add_file.return_value = ("", "test.gcode")
+		self.local_storage.path_on_disk.return_value = "prefix/test.gcode"
+
+		wrapper = octoprint.filemanager.util.DiskFileWrapper("test.gcode", "/tmp/upload.tmp")
+		self.file_manager.add_file(octoprint.filemanager.FileDestinations.LOCAL, "test.gcode", wrapper)
+		processor.close()
+
+		import hashlib
+		file_hash = hashlib.sha1(b"G28\nG1 X10\n").hexdigest()
+		self.assertEquals(file_hash, wrapper.hash)
+		self.local_storage.add_file.assert_called_once_with("test.gcode", wrapper, printer_profile=test_profile, allow_overwrite=False, links=None)
+		self.analysis_queue.enqueue.assert_called_once_with(mock.ANY, high_priority=True, stream=stream, file_hash=file_hash)
+		self.assertFalse(stream.abort.called)
+
+	def test_add_uploaded_file_for_printer_profile(self):
+		self.printer_profile_manager.get_current_or_default.return_value = dict(id="_default", name="My Default Profile")
+		other_profile = dict(id="other", name="Other Profile")
+		stream = self.analysis_queue.stream.return_value
+
+		processor = self.file_manager.create_upload_processor("test.gcode", "/tmp/upload.tmp", printer_profile=other_profile)
+		processor.update(b"G28\n")
+		processor.finish()
+
+		self.analysis_queue.stream.assert_called_once_with("gcode", other_profile)
+
+		self.local_storage.add_file.return_value = ("", "test.gcode")
+		self.local_storage.path_on_disk.return_value = "prefix/test.gcode"
+
+		wrapper = octoprint.filemanager.util.DiskFileWrapper("test.gcode", "/tmp/upload.tmp")
+		self.file_manager.add_file(octoprint.filemanager.FileDestinations.LOCAL, "test.gcode", wrapper, printer_profile=other_profile)
+		processor.close()
+
+		import hashlib
+		self.analysis_queue.enqueue.assert_called_once_with(mock.ANY, high_priority=True, stream=stream, file_hash=hashlib.sha1(b"G28\n").hexdigest())
+		self.assertFalse(stream.abort.called)
+
+	def test_add_preprocessed_upload(self):
+		self.printer_profile_manager.get_current_or_default.return_value = dict(id="_default", name="My Default Profile")
+		stream = self.analysis_queue.stream.return_value
+
+		processor = self.file_manager.create_upload_processor("test.gcode", "/tmp/upload.tmp")
+		processor.update(b"G28\n")
+		processor.finish()
+
+		# a preprocessor changing the contents invalidates hash and analysis
+		preprocessed = octoprint.filemanager.util.StreamWrapper("test.gcode", io.BytesIO(b"G28\nM84\n"))
+		self.file_manager._preprocessor_hooks = dict(preprocessor=lambda *args, **kwargs: preprocessed)
+
+		self.local_storage.add_file.return_value = ("", "test.gcode")
+		self.local_storage.path_on_disk.return_value = "prefix/test.gcode"
+
+		wrapper = octoprint.filemanager.util.DiskFileWrapper("test.gcode", "/tmp/upload.tmp")
+		self.file_manager.add_file(octoprint.filemanager.FileDestinations.LOCAL, "test.gcode", wrapper)
+
+		self.assertEquals(None, preprocessed.hash)
+		self.analysis_queue.enqueue.assert_called_once_with(mock.ANY, high_priority=True)
+		stream.abort.assert_called_once_with()
+
+	def test_failed_upload(self):
+		stream = self.analysis_queue.stream.return_value
+
+		processor = self.file_manager.create_upload_processor("test.gcode", "/tmp/upload.tmp")
+		processor.update(b"G28\n")
+		processor.close()
+
+		stream.abort.assert_called_once_with()
+		self.assertEquals(dict(), self.file_manager._uploads)
+
 	def test_remove_file(self):
 		self.file_manager.remove_file(octoprint.filemanager.FileDestinations.LOCAL, "test.file")
 
@@ -13,6 +13,10 @@ from ddt import ddt, unpack, data
 
 import octoprint.filemanager.storage
 
+# octoprint.filemanager is mocked during the tests
+storage_module = octoprint.filemanager.storage
+LocalFileStorage = storage_module.LocalFileStorage
+
 
 class FileWrapper(object):
 	def __init__(self, filename):
@@ -39,10 +43,12 @@ FILE_CRAZYRADIO_STL = FileWrapper("crazyradio.stl")
 @ddt
 class LocalStorageTest(unittest.TestCase):
 
+	metadata_backend = None
+
 	def setUp(self):
 		import tempfile
 		self.basefolder = tempfile.mkdtemp()
-		self.storage = octoprint.filemanager.storage.LocalFileStorage(self.basefolder)
+		self.storage = octoprint.filemanager.storage.LocalFileStorage(self.basefolder, metadata_backend=self.metadata_backend)
 
 		# mock file manager module
 		self.filemanager_patcher = mock.patch("octoprint.filemanager")
@@ -61,6 +67,7 @@ class LocalStorageTest(unittest.TestCase):
 
 	def tearDown(self):
 		import shutil
+		self.storage._metadata.close()
 		shutil.rmtree(self.basefolder)
 
 		self.filemanager_patcher.stop()
@@ -182,6 +189,32 @@ class LocalStorageTest(unittest.TestCase):
 
 		self.storage.remove_folder(content_folder, recursive=False)
 
+	def test_remove_folder_forgets_metadata(self):
+		content_folder = self._add_folder("content", "content")
+		self._add_file((content_folder, "crazyradio.stl"), content_folder + "/crazyradio.stl", FILE_CRAZYRADIO_STL)
+		self.storage.set_additional_metadata(content_folder + "/crazyradio.stl", "notes", ["some note"], overwrite=True)
+
+		self.storage.remove_folder(content_folder, recursive=True)
+		self._add_folder("content", "content")
+		self._add_file((content_folder, "crazyradio.stl"), content_folder + "/crazyradio.stl", FILE_CRAZYRADIO_STL)
+
+		self.assertFalse("notes" in self.storage.get_metadata(content_folder + "/crazyradio.stl"))
+
+	def test_find_files(self):
+		self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
+		content_folder = self._add_folder("content", "content")
+		self._add_file((content_folder, "bp_case.stl"), content_folder + "/bp_case.stl", FILE_BP_CASE_STL)
+		self._add_file((content_folder, "crazyradio.stl"), content_folder + "/crazyradio.stl", FILE_CRAZYRADIO_STL)
+
+		found = self.storage.find_files(hash=FILE_BP_CASE_STL.hash)
+		self.assertEquals(["bp_case.stl", "content/bp_case.stl"], [path for path, _ in found])
+		self.assertEquals(FILE_BP_CASE_STL.hash, found[0][1]["hash"])
+
+		found = self.storage.find_files(name="crazyradio.stl")
+		self.assertEquals(["content/crazyradio.stl"], [path for path, _ in found])
+
+		self.assertEquals([], self.storage.find_files(name="crazyradio.stl", hash=FILE_BP_CASE_STL.hash))
+
 	def test_list(self):
 		bp_case_stl = self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
 		self._add_file("bp_case.gcode", "bp_case.gcode", FILE_BP_CASE_GCODE, links=[("model", dict(name=bp_case_stl))])
@@ -213,6 +246,127 @@ class LocalStorageTest(unittest.TestCase):
 		self.assertEquals("folder", file_list["empty"]["type"])
 		self.assertEquals(0, len(file_list["empty"]["children"]))
 
+	def test_list_cached(self):
+		self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
+		content_folder = self._add_folder("content", "content")
+		self._add_file((content_folder, "crazyradio.stl"), content_folder + "/crazyradio.stl", FILE_CRAZYRADIO_STL)
+
+		with mock.patch.object(LocalFileStorage, "RACY_SCAN_WINDOW", -1.0):
+			with mock.patch.object(storage_module, "_scan", wraps=storage_module._scan) as scan:
+				first = self.storage.list_files()
+				self.assertEquals(2, scan.call_count)
+
+				# nothing changed, nothing scanned
+				self.assertEquals(first, self.storage.list_files())
+				self.assertEquals(2, scan.call_count)
+
+				# only the changed folder is scanned again
+				self._add_file((content_folder, "bp_case.stl"), content_folder + "/bp_case.stl", FILE_BP_CASE_STL)
+				second = self.storage.list_files()
+				self.assertEquals(3, scan.call_count)
+				self.assertEquals(["bp_case.stl", "crazyradio.stl"], sorted(second["content"]["children"].keys()))
+
+	def test_list_racy(self):
+		self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
+
+		# the folder was just modified, so a later change might not change its modification date
+		with mock.patch.object(storage_module, "_scan", wraps=storage_module._scan) as scan:
+			self.storage.list_files()
+			self.storage.list_files()
+			self.assertEquals(2, scan.call_count)
+
+	def test_list_defers_hashing(self):
+		FILE_CRAZYRADIO_STL.save(os.path.join(self.basefolder, "crazyradio.stl"))
+
+		with mock.patch.object(self.storage, "_hash_later") as hash_later:
+			file_list = self.storage.list_files()
+		self.assertFalse("hash" in file_list["crazyradio.stl"])
+		self.assertEquals("model", file_list["crazyradio.stl"]["type"])
+		hash_later.assert_called_once_with(self.basefolder, "crazyradio.stl")
+
+		self.storage._hash_files(self.basefolder, ["crazyradio.stl"])
+		self.assertEquals(FILE_CRAZYRADIO_STL.hash, self.storage.list_files()["crazyradio.stl"]["hash"])
+
+	def test_hash_files_keeps_concurrent_metadata(self):
+		FILE_CRAZYRADIO_STL.save(os.path.join(self.basefolder, "crazyradio.stl"))
+
+		submit = self.storage._hasher.submit
+		def submit_and_update(path, callback=None):
+			job = submit(path, callback=callback)
+			job.wait()
+
+			# another thread adds metadata to the file while it's being hashed in the background
+			self.storage.get_metadata("crazyradio.stl")
+			self.storage.set_additional_metadata("crazyradio.stl", "analysis", dict(estimatedPrintTime=42))
+			return job
+
+		with mock.patch.object(self.storage._hasher, "submit", side_effect=submit_and_update):
+			self.storage._hash_files(self.basefolder, ["crazyradio.stl"])
+
+		metadata = self.storage.get_metadata("crazyradio.stl")
+		self.assertEquals(FILE_CRAZYRADIO_STL.hash, metadata["hash"])
+		self.assertEquals(dict(estimatedPrintTime=42), metadata["analysis"])
+
+	def test_list_hashes_in_background(self):
+		FILE_CRAZYRADIO_STL.save(os.path.join(self.basefolder, "crazyradio.stl"))
+		self.storage.list_files()
+
+		import time
+		for _ in range(50):
+			if self.storage.list_files()["crazyradio.stl"].get("hash"):
+				break
+			time.sleep(0.1)
+		self.assertEquals(FILE_CRAZYRADIO_STL.hash, self.storage.list_files()["crazyradio.stl"]["hash"])
+
+	def test_add_file_remembers_hash(self):
+		# known from the wrapper, never read
+		with mock.patch.object(storage_module.FileHasher, "RACY_WINDOW", -1.0):
+			self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
+			with mock.patch("octoprint.filemanager.util.content_hash") as content_hash:
+				self.assertEquals(FILE_BP_CASE_STL.hash, self.storage._create_hash(os.path.join(self.basefolder, "bp_case.stl")))
+				self.assertFalse(content_hash.called)
+
+	def test_add_file_racy_hash_not_remembered(self):
+		# just touched, so a rewrite within the file system's timestamp resolution couldn't be told apart
+		self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
+		self.assertIsNone(self.storage._hasher.lookup(os.path.join(self.basefolder, "bp_case.stl")))
+
+	def test_get_metadata_not_listed(self):
+		FILE_CRAZYRADIO_STL.save(os.path.join(self.basefolder, "crazyradio.stl"))
+		self.assertEquals(FILE_CRAZYRADIO_STL.hash, self.storage.get_metadata("crazyradio.stl")["hash"])
+
+	def test_diagnostics(self):
+		self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
+		self.storage.get_metadata("bp_case.stl")
+
+		diagnostics = self.storage.get_diagnostics()
+		self.assertEquals(self.metadata_backend or "yaml", diagnostics["metadata"]["backend"])
+		self.assertEquals(1, diagnostics["metadata"]["cache"]["entries"])
+		self.assertTrue(diagnostics["metadata"]["cache"]["hits"] > 0)
+		self.assertEquals(0, diagnostics["pendingHashes"])
+
+	def test_watch(self):
+		import watchdog.events
+
+		content_folder = self._add_folder("content", "content")
+		self.storage.list_files()
+
+		observer = mock.Mock()
+		self.storage.watch(observer)
+		handler = observer.schedule.call_args[0][0]
+
+		content_path = os.path.join(self.basefolder, content_folder)
+		self.assertTrue(content_path in self.storage._scans)
+		handler.dispatch(watchdog.events.FileModifiedEvent(os.path.join(self.basefolder, ".metadata.yaml")))
+		self.assertTrue(self.basefolder in self.storage._scans)
+
+		handler.dispatch(watchdog.events.FileModifiedEvent(os.path.join(content_path, "crazyradio.stl")))
+		self.assertFalse(content_path in self.storage._scans)
+		self.assertTrue(self.basefolder in self.storage._scans)
+
+		handler.dispatch(watchdog.events.DirModifiedEvent(content_path))
+		self.assertFalse(self.basefolder in self.storage._scans)
+
 	def test_add_link_model(self):
 		stl_name = self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
 		gcode_name = self._add_file("bp_case.gcode", "bp_case.gcode", FILE_BP_CASE_GCODE)
@@ -390,7 +544,8 @@ class LocalStorageTest(unittest.TestCase):
 
 		self.assertEquals(expected_path, sanitized_path)
 		self.assertTrue(os.path.exists(file_path))
-		self.assertTrue(os.path.exists(os.path.join(folder_path, ".metadata.yaml")))
+		if self.metadata_backend is None:
+			self.assertTrue(os.path.exists(os.path.join(folder_path, ".metadata.yaml")))
 
 		metadata = self.storage.get_metadata(sanitized_path)
 		self.assertIsNotNone(metadata)
@@ -413,3 +568,78 @@ class LocalStorageTest(unittest.TestCase):
 
 		return sanitized_path
 
+
+class SqliteLocalStorageTest(LocalStorageTest):
+
+	metadata_backend = "sqlite"
+
+	def test_persistence(self):
+		stl_name = self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
+		self.storage.set_additional_metadata(stl_name, "analysis", dict(estimatedPrintTime=60.0))
+		self.storage._metadata.close()
+
+		self.storage = LocalFileStorage(self.basefolder, metadata_backend="sqlite")
+		metadata = self.storage.get_metadata(stl_name)
+		self.assertEquals(FILE_BP_CASE_STL.hash, metadata["hash"])
+		self.assertEquals(dict(estimatedPrintTime=60.0), metadata["analysis"])
+
+	def test_find_changed(self):
+		import time
+
+		stl_name = self._add_file("bp_case.stl", "bp_case.stl", FILE_BP_CASE_STL)
+		self._add_file("crazyradio.stl", "crazyradio.stl", FILE_CRAZYRADIO_STL)
+
+		timestamp = time.time()
+		with mock.patch("time.time", return_value=timestamp + 10):
+			self.storage.set_additional_metadata(stl_name, "notes", ["some note"], overwrite=True)
+
+		found = self.storage.find_files(changed_since=timestamp)
+		self.assertEquals([stl_name], [path for path, _ in found])
+
+	def test_migrate(self):
+		import yaml
+
+		self.storage._metadata.close()
+		os.mkdir(os.path.join(self.basefolder, "content"))
+		FILE_CRAZYRADIO_STL.save(os.path.join(self.basefolder, "content", "crazyradio.stl"))
+		with open(os.path.join(self.basefolder, "content", ".metadata.yaml"), "w") as f:
+			yaml.safe_dump({"crazyradio.stl": dict(hash=FILE_CRAZYRADIO_STL.hash, links=[], notes=["migrated"])}, f)
+
+		self.storage = LocalFileStorage(self.basefolder, metadata_backend="sqlite")
+
+		self.assertEquals(["migrated"], self.storage.get_metadata("content/crazyradio.stl")["notes"])
+		self.assertFalse(os.path.exists(os.path.join(self.basefolder, "content", ".metadata.yaml")))
+		self.assertTrue(os.path.exists(os.path.join(self.basefolder, "content", ".metadata.yaml.backup")))
+		self.assertEquals(["content/crazyradio.stl"], [path for path, _ in self.storage.find_files(hash=FILE_CRAZYRADIO_STL.hash)])
+
+		# the backup of the migrated metadata doesn't keep the folder from being removed
+		self.storage.remove_file("content/crazyradio.stl")
+		self.storage.remove_folder("content", recursive=False)
+		self.assertFalse(os.path.exists(os.path.join(self.basefolder, "content")))
+
+	def test_switch_to_yaml(self):
+		import yaml
+
+		self._add_folder("content", "content")
+		stl_name = self._add_file("content/bp_case.stl", "content/bp_case.stl", FILE_BP_CASE_STL)
+		self.storage.set_additional_metadata(stl_name, "notes", ["exported"])
+		self._add_file("crazyradio.stl", "crazyradio.stl", FILE_CRAZYRADIO_STL)
+		self.storage._metadata.close()
+
+		# entries from the database take precedence, others are kept
+		with open(os.path.join(self.basefolder, "content", ".metadata.yaml"), "w") as f:
+			yaml.safe_dump({"bp_case.stl": dict(notes=["stale"]), "other.stl": dict(notes=["kept"])}, f)
+
+		self.storage = LocalFileStorage(self.basefolder, metadata_backend="yaml")
+
+		self.assertEquals(["exported"], self.storage.get_metadata(stl_name)["notes"])
+		self.assertEquals(FILE_CRAZYRADIO_STL.hash, self.storage.get_metadata("crazyradio.stl")["hash"])
+		with open(os.path.join(self.basefolder, "content", ".metadata.yaml")) as f:
+			self.assertEquals(dict(notes=["kept"]), yaml.safe_load(f)["other.stl"])
+		self.assertFalse(os.path.exists(os.path.join(self.basefolder, ".metadata.db")))
+		self.assertTrue(os.path.exists(os.path.join(self.basefolder, ".metadata.db.backup")))
+
+		# switching back migrates the exported metadata into a new database
+		self.storage._metadata.close()
+		self.storage = LocalFileStorage(self.basefolder, metadata_backend="sqlite")
+		self.assertEquals(["exported"], self.storage.get_metadata(stl_name)["notes"])
@@ -0,0 +1,85 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ddt import ddt, data
+
+from octoprint.filemanager.metadata import MetadataCache, create_backend
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+	def test_evicts_by_size(self):
+		cache = MetadataCache(100)
+		cache.put("a", "A", 40)
+		cache.put("b", "B", 40)
+		self.assertEquals("A", cache.get("a"))
+
+		# b was used least recently
+		cache.put("c", "C", 40)
+		self.assertEquals(None, cache.get("b"))
+		self.assertEquals("A", cache.get("a"))
+		self.assertEquals("C", cache.get("c"))
+
+		self.assertEquals(dict(hits=3, misses=1, evictions=1, entries=2, size=80, maxSize=100), cache.get_stats())
+
+	def test_replace(self):
+		cache = MetadataCache(100)
+		cache.put("a", "A", 40)
+		cache.put("a", "A2", 60)
+		self.assertEquals("A2", cache.get("a"))
+		self.assertEquals(60, cache.get_stats()["size"])
+
+		cache.remove("a")
+		self.assertEquals(dict(hits=1, misses=0, evictions=0, entries=0, size=0, maxSize=100), cache.get_stats())
+
+	def test_keeps_one(self):
+		cache = MetadataCache(100)
+		cache.put("a", "A", 40)
+		cache.put("huge", "H", 1000)
+
+		self.assertEquals(["huge"], cache.keys())
+		self.assertEquals("H", cache.get("huge"))
+
+
+@ddt
+class MetadataBackendCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.basefolder)
+
+	@data("yaml", "sqlite")
+	def test_cache_size(self, name):
+		backend = create_backend(name, self.basefolder, cache_size=1024)
+		try:
+			folders = []
+			for i in range(4):
+				folder = os.path.join(self.basefolder, "folder%d" % i)
+				os.mkdir(folder)
+				folders.append(folder)
+
+				metadata = backend.get(folder)
+				metadata["file.gcode"] = dict(hash="%040d" % i, notes=["x" * 300])
+				backend.save(folder, metadata)
+
+			stats = backend.get_cache_stats()
+			self.assertTrue(0 < stats["entries"] < 4)
+			self.assertTrue(stats["size"] <= 1024)
+			self.assertEquals(4 - stats["entries"], stats["evictions"])
+
+			# evicted metadata is read again
+			self.assertEquals(["x" * 300], backend.get(folders[0])["file.gcode"]["notes"])
+			self.assertEquals(stats["misses"] + 1, backend.get_cache_stats()["misses"])
+		finally:
+			backend.close()
@@ -0,0 +1,162 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import mock
+
+import octoprint.filemanager.util
+
+# octoprint.filemanager is mocked during some of the tests
+util_module = octoprint.filemanager.util
+FileHasher = util_module.FileHasher
+
+
+class ContentHashTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.basefolder)
+
+	def test_blocks(self):
+		path = os.path.join(self.basefolder, "test.gcode")
+		content = "G1 X10\n" * 1000
+		with open(path, "wb") as f:
+			f.write(content)
+
+		expected = hashlib.sha1(content).hexdigest()
+		self.assertEquals(expected, util_module.content_hash(path))
+		self.assertEquals(expected, util_module.content_hash(path, blocksize=100))
+		self.assertEquals(expected, util_module.content_hash(path, blocksize=7))
+
+
+class FileHasherTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+		self.hasher = FileHasher(workers=3)
+
+		# files are only remembered once they are older than the racy window
+		self.racy_patcher = mock.patch.object(FileHasher, "RACY_WINDOW", -1.0)
+		self.racy_patcher.start()
+
+	def tearDown(self):
+		self.racy_patcher.stop()
+		shutil.rmtree(self.basefolder)
+
+	def _write(self, name, content, mtime=None):
+		path = os.path.join(self.basefolder, name)
+		with open(path, "wb") as f:
+			f.write(content)
+		if mtime is not None:
+			os.utime(path, (mtime, mtime))
+		return path
+
+	def test_hash_once(self):
+		path = self._write("test.gcode", "G28\n")
+
+		with mock.patch.object(util_module, "content_hash", wraps=util_module.content_hash) as content_hash:
+			self.assertEquals(hashlib.sha1("G28\n").hexdigest(), self.hasher.hash(path))
+			self.assertEquals(hashlib.sha1("G28\n").hexdigest(), self.hasher.hash(path))
+			self.assertEquals(1, content_hash.call_count)
+
+	def test_modified(self):
+		path = self._write("test.gcode", "G28\n", mtime=1000)
+		self.hasher.hash(path)
+
+		# same size, but modified
+		self._write("test.gcode", "G29\n", mtime=2000)
+		self.assertEquals(None, self.hasher.lookup(path))
+		self.assertEquals(hashlib.sha1("G29\n").hexdigest(), self.hasher.hash(path))
+
+	def test_moved(self):
+		path = self._write("test.gcode", "G28\n")
+		file_hash = self.hasher.hash(path)
+
+		moved = os.path.join(self.basefolder, "moved.gcode")
+		os.rename(path, moved)
+		self.assertEquals(file_hash, self.hasher.lookup(moved))
+
+	def test_racy(self):
+		path = self._write("test.gcode", "G28\n")
+
+		with mock.patch.object(FileHasher, "RACY_WINDOW", 2.0):
+			self.hasher.hash(path)
+		self.assertEquals(None, self.hasher.lookup(path))
+
+	def test_remember(self):
+		path = self._write("test.gcode", "G28\n")
+		self.hasher.remember(path, "some hash")
+		self.assertEquals("some hash", self.hasher.hash(path))
+
+	def test_remember_racy(self):
+		path = self._write("test.gcode", "G28\n")
+
+		with mock.patch.object(FileHasher, "RACY_WINDOW", 2.0):
+			self.hasher.remember(path, "some hash")
+		self.assertEquals(None, self.hasher.lookup(path))
+
+	def test_signature_device(self):
+		path = self._write("test.gcode", "G28\n")
+		stat = os.stat(path)
+		self.assertEquals((stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime), util_module.file_signature(path))
+
+	def test_hash_all(self):
+		paths = [self._write("test{}.gcode".format(i), "G1 X{}\n".format(i)) for i in range(10)]
+		missing = os.path.join(self.basefolder, "missing.gcode")
+
+		expected = dict((path, hashlib.sha1("G1 X{}\n".format(i)).hexdigest()) for i, path in enumerate(paths))
+		expected[missing] = None
+		self.assertEquals(expected, self.hasher.hash_all(paths + [missing]))
+
+		stats = self.hasher.get_stats()
+		self.assertEquals(10, stats["entries"])
+		self.assertEquals(0, stats["pending"])
+
+	def test_submit_callback(self):
+		path = self._write("test.gcode", "G28\n")
+
+		done = threading.Event()
+		hashes = []
+		def callback(file_hash):
+			hashes.append(file_hash)
+			done.set()
+
+		self.hasher.submit(path, callback=callback)
+		done.wait(5)
+
+		# known by now, called back right away
+		self.hasher.submit(path, callback=hashes.append)
+		self.assertEquals([hashlib.sha1("G28\n").hexdigest()] * 2, hashes)
+
+	def test_persistence(self):
+		cache_path = os.path.join(self.basefolder, "file_hashes.json")
+		path = self._write("test.gcode", "G28\n")
+
+		hasher = FileHasher(cache_path, size=2)
+		hasher.hash_all([path])
+		hasher.remember(self._write("other.gcode", "G29\n"), "other hash")
+		hasher.flush()
+
+		with mock.patch.object(util_module, "content_hash") as content_hash:
+			loaded = FileHasher(cache_path, size=2)
+			self.assertEquals(hashlib.sha1("G28\n").hexdigest(), loaded.hash(path))
+			self.assertEquals("other hash", loaded.lookup(os.path.join(self.basefolder, "other.gcode")))
+			self.assertFalse(content_hash.called)
+
+	def test_corrupt_file(self):
+		cache_path = os.path.join(self.basefolder, "file_hashes.json")
+		with open(cache_path, "wb") as f:
+			f.write("{ not json")
+
+		self.assertEquals(0, FileHasher(cache_path).get_stats()["entries"])
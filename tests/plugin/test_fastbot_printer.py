@@ -0,0 +1,213 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import os
+import select
+import socket
+import sys
+import threading
+import unittest
+
+import octoprint
+
+# bundled plugins are loaded from their folder by the plugin manager, they are not part of the octoprint package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(octoprint.__file__)), "plugins"))
+from fastbot_printer.pipeReadWrite import PipeReadWrite
+
+
+class FakeDaemon(object):
+	"""
+	Listens on the read, write and emergency ports like the Fastbot daemon and accepts connections in the background.
+	"""
+
+	def __init__(self):
+		self.listeners = dict()
+		self.connections = dict(read=[], write=[], emergency=[])
+		self.accepted = threading.Semaphore(0)
+
+		for name in ("read", "write", "emergency"):
+			listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			listener.bind(("127.0.0.1", 0))
+			listener.listen(5)
+			self.listeners[name] = listener
+
+			thread = threading.Thread(target=self._accept, args=(name, listener))
+			thread.daemon = True
+			thread.start()
+
+	@property
+	def ports(self):
+		return dict(readPort=self.listeners["read"].getsockname()[1],
+		            writePort=self.listeners["write"].getsockname()[1],
+		            emergencyPort=self.listeners["emergency"].getsockname()[1])
+
+	def _accept(self, name, listener):
+		while True:
+			try:
+				connection, _ = listener.accept()
+			except socket.error:
+				return
+			self.connections[name].append(connection)
+			self.accepted.release()
+
+	def wait_connected(self, count=3):
+		for _ in range(count):
+			self.accepted.acquire()
+
+	def drop_connections(self):
+		for connections in self.connections.values():
+			for connection in connections:
+				connection.close()
+			del connections[:]
+
+	def stop(self):
+		for listener in self.listeners.values():
+			try:
+				listener.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			listener.close()
+		self.drop_connections()
+
+
+class PipeReadWriteTest(unittest.TestCase):
+
+	def setUp(self):
+		self.daemon = FakeDaemon()
+		self.pipes = []
+
+	def tearDown(self):
+		for pipe in self.pipes:
+			pipe.close()
+		self.daemon.stop()
+
+	def _pipe(self, **kwargs):
+		options = dict(reconnectDelay=0.05, reconnectMaxDelay=0.1, reconnectTimeout=2.0)
+		options.update(self.daemon.ports)
+		options.update(kwargs)
+		pipe = PipeReadWrite(0.1, 1.0, **options)
+		self.pipes.append(pipe)
+		self.daemon.wait_connected()
+		return pipe
+
+	def test_connect(self):
+		pipe = self._pipe()
+
+		pipe.write("M105\n")
+		self.assertEquals("M105\n", self.daemon.connections["write"][0].recv(256))
+
+		pipe.writeEmerg("M112\n")
+		self.assertEquals("M112\n", self.daemon.connections["emergency"][0].recv(256))
+
+		self.daemon.connections["read"][0].sendall("ok T:21.0\n")
+		self.assertEquals("ok T:21.0\n", pipe.readline())
+
+	def test_reconnect(self):
+		pipe = self._pipe()
+
+		self.daemon.drop_connections()
+
+		# noticed on the read timeout, reported as a timeout once reconnected
+		self.assertEquals("", pipe.readline())
+		self.daemon.wait_connected()
+
+		metrics = pipe.getMetrics()
+		self.assertEquals(1, metrics["reconnects"])
+		self.assertTrue(metrics["connected"])
+
+		# the connection is usable again
+		pipe.write("M105\n")
+		self.assertEquals("M105\n", self.daemon.connections["write"][0].recv(256))
+
+	def test_reconnect_in_background(self):
+		pipe = self._pipe()
+		reconnected = threading.Event()
+		pipe.setReconnectCallback(reconnected.set)
+
+		self.daemon.drop_connections()
+
+		# doesn't wait for the daemon to come back
+		data = ""
+		for _ in range(20):
+			data = pipe.read_available()
+			if data is None:
+				break
+			threading.Event().wait(0.05)
+		self.assertIsNone(data)
+
+		self.assertTrue(reconnected.wait(2.0))
+		self.daemon.wait_connected()
+		self.assertEquals(1, pipe.getMetrics()["reconnects"])
+
+		# the connection is usable again through its new sockets
+		self.daemon.connections["read"][0].sendall("ok\n")
+		select.select([pipe.fileno()], [], [], 1.0)
+		self.assertEquals("ok\n", pipe.read_available())
+
+		self.assertEquals(5, pipe.write_available("M105\n"))
+		self.assertEquals("M105\n", self.daemon.connections["write"][0].recv(256))
+
+	def test_reconnect_in_background_failed(self):
+		pipe = self._pipe(reconnectTimeout=0.2)
+		reconnected = threading.Event()
+		pipe.setReconnectCallback(reconnected.set)
+
+		self.daemon.stop()
+
+		# the first writes might still make it into the socket's buffer before the reset arrives
+		written = 0
+		for _ in range(20):
+			written = pipe.write_available("M105\n")
+			if written is None:
+				break
+			threading.Event().wait(0.05)
+		self.assertIsNone(written)
+
+		self.assertTrue(reconnected.wait(2.0))
+		self.assertRaises(IOError, pipe.fileno)
+		self.assertRaises(IOError, pipe.write_fileno)
+		self.assertRaises(IOError, pipe.read_available)
+
+	def test_write_failure(self):
+		pipe = self._pipe(reconnectTimeout=0.2)
+
+		self.daemon.stop()
+
+		# the first write might still make it into the socket's buffer before the reset arrives
+		with self.assertRaises(IOError):
+			for _ in range(10):
+				pipe.write("M105\n")
+				threading.Event().wait(0.05)
+		self.assertTrue(pipe.getMetrics()["failedAttempts"] > 0)
+
+	def test_write_timeout(self):
+		pipe = self._pipe(reconnect=False, sendBufferSize=4096)
+
+		# the daemon never reads what we write, so the buffers fill up
+		with self.assertRaises(IOError):
+			pipe.write("G1 X10 Y10\n" * 1024 * 1024)
+
+	def test_write_available(self):
+		pipe = self._pipe(reconnect=False, sendBufferSize=4096)
+		data = "G1 X10 Y10\n" * 1024
+
+		# the daemon never reads what we write, so the buffers fill up without us ever waiting for room
+		written = [pipe.write_available(data) for _ in range(1024)]
+		self.assertTrue(written[0] > 0)
+		self.assertEquals(0, written[-1])
+
+		received = ""
+		while len(received) < written[0]:
+			received += self.daemon.connections["write"][0].recv(written[0] - len(received))
+		self.assertEquals(data[:written[0]], received)
+
+	def test_write_after_close(self):
+		pipe = self._pipe()
+		pipe.close()
+
+		self.assertRaises(IOError, pipe.write, "M105\n")
@@ -0,0 +1,132 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+
+import unittest
+import mock
+from ddt import ddt, data, unpack
+
+from octoprint.events import CommandTrigger, Events, printer_payload
+from octoprint.printer import UnknownPrinter
+from octoprint.printer.registry import PrinterRegistry
+
+
+@ddt
+class PrinterRegistryTest(unittest.TestCase):
+
+	def setUp(self):
+		self.factory = mock.Mock(side_effect=lambda identifier: mock.Mock(name=identifier))
+		self.registry = PrinterRegistry(self.factory)
+		self.default = self.registry.add(PrinterRegistry.DEFAULT)
+
+	def test_add(self):
+		printer = self.registry.add("left", name="Left printer")
+
+		self.factory.assert_called_with("left")
+		self.assertEquals(2, len(self.registry))
+		self.assertTrue("left" in self.registry)
+		self.assertIs(printer, self.registry.get("left"))
+		self.assertIs(self.default, self.registry.get())
+		self.assertIs(self.default, self.registry.default)
+		self.assertEquals([PrinterRegistry.DEFAULT, "left"], list(self.registry))
+		self.assertEquals([dict(id=PrinterRegistry.DEFAULT, name=PrinterRegistry.DEFAULT, printer=self.default),
+		                   dict(id="left", name="Left printer", printer=printer)],
+		                  self.registry.get_all())
+
+	@data(None, "", "with space", "../left", PrinterRegistry.DEFAULT)
+	def test_add_invalid(self, identifier):
+		self.assertRaises(ValueError, self.registry.add, identifier)
+		self.assertEquals(1, len(self.registry))
+
+	def test_remove(self):
+		printer = self.registry.add("left")
+		self.registry.remove("left")
+
+		printer.disconnect.assert_called_once_with()
+		self.assertFalse("left" in self.registry)
+		self.assertRaises(UnknownPrinter, self.registry.get, "left")
+		self.assertRaises(UnknownPrinter, self.registry.remove, "left")
+		self.assertRaises(ValueError, self.registry.remove, PrinterRegistry.DEFAULT)
+
+	def test_load_from_settings(self):
+		added = self.registry.load_from_settings([
+			dict(id="left", name="Left", port="/dev/ttyACM1", autoconnect=True),
+			dict(id="right", port="/dev/ttyACM2", baudrate=115200, profile="other", autoconnect=True),
+			dict(id="offline", port="/dev/ttyACM3"),
+			dict(name="no identifier"),
+			"not a dict",
+			dict(id="left")
+		])
+		self.assertEquals(["left", "right", "offline"], added)
+
+		self.registry.autoconnect(["/dev/ttyACM1", "/dev/ttyACM3"])
+
+		self.registry.get("left").connect.assert_called_once_with(port="/dev/ttyACM1", baudrate=None, profile=None)
+		self.assertFalse(self.registry.get("right").connect.called)
+		self.assertFalse(self.registry.get("offline").connect.called)
+		self.assertFalse(self.default.connect.called)
+
+	def test_reload_plugins(self):
+		printer = self.registry.add("left")
+		self.registry.reload_plugins()
+
+		self.default.reload_plugins.assert_called_once_with()
+		printer.reload_plugins.assert_called_once_with()
+
+
+@ddt
+class CommandTriggerTest(unittest.TestCase):
+
+	def setUp(self):
+		def printer(identifier):
+			result = mock.Mock(name=identifier)
+			result.get_identifier.return_value = identifier
+			result.get_current_data.return_value = dict()
+			return result
+
+		self.registry = PrinterRegistry(printer)
+		self.default = self.registry.add(PrinterRegistry.DEFAULT)
+		self.left = self.registry.add("left")
+
+	def _trigger(self, *subscriptions):
+		with mock.patch("octoprint.events.settings") as settings, mock.patch("octoprint.events.eventManager"):
+			settings.return_value.get.side_effect = lambda path: dict(events=True, subscriptions=list(subscriptions))[path[-1]]
+			settings.return_value.getBoolean.return_value = True
+			return CommandTrigger(self.registry)
+
+	@data(
+		(None, None, "default"),
+		("left", None, "left"),
+		(None, "left", "left"),
+		("left", "left", "left"),
+		(PrinterRegistry.DEFAULT, "left", None),
+		("unknown", None, None)
+	)
+	@unpack
+	def test_gcode_command(self, event_printer, subscription_printer, expected):
+		subscription = dict(event=Events.PRINT_DONE, type="gcode", command="M117 {__printer} {file}")
+		if subscription_printer is not None:
+			subscription["printer"] = subscription_printer
+		trigger = self._trigger(subscription)
+
+		trigger.eventCallback(Events.PRINT_DONE, printer_payload(event_printer, dict(file="test.gco")))
+
+		printers = dict(default=self.default, left=self.left)
+		for name, printer in printers.items():
+			if name == expected:
+				printer.commands.assert_called_once_with(["M117 {} test.gco".format(printer.get_identifier())])
+			else:
+				self.assertFalse(printer.commands.called)
+
+	def test_printer_payload(self):
+		payload = dict(file="test.gco")
+
+		self.assertIs(payload, printer_payload(None, payload))
+		self.assertIsNone(printer_payload(None))
+		self.assertEquals(dict(file="test.gco", printer="left"), printer_payload("left", payload))
+		self.assertEquals(dict(printer="left"), printer_payload("left"))
+		self.assertEquals(dict(file="test.gco"), payload)
@@ -9,6 +9,217 @@ import unittest
 
 from ddt import ddt, data, unpack
 
+
+def machine_com(**attributes):
+	"""
+	Creates a :class:`~octoprint.util.comm.MachineCom` with the state of a fresh connection, without connecting
+	anywhere, starting any threads or reading the settings. ``attributes`` are set on it on top of that.
+	"""
+	import logging
+	import threading
+	import Queue as queue
+	from collections import deque
+	from octoprint.util import CountedEvent
+	from octoprint.util.comm import MachineCom, MachineComPrintCallback, TypedQueue, LineHistory, ResendStatistics
+
+	comm = MachineCom.__new__(MachineCom)
+
+	# there is no connection to close, keeps __del__ from trying anyhow
+	comm._connection_closing = True
+
+	comm._logger = logging.getLogger("octoprint.util.comm")
+	comm._serialLogger = logging.getLogger("SERIAL")
+	comm._printer_id = None
+	comm._callback = MachineComPrintCallback()
+	comm._state = MachineCom.STATE_OPERATIONAL
+	comm._serial = None
+	comm._errorValue = "error"
+	comm._currentFile = None
+	comm._commandQueue = queue.Queue()
+	comm._temp = dict()
+	comm._bedTemp = None
+	comm._timeout = None
+	comm._ok_time = None
+	comm._send_latency = None
+
+	comm._long_running_command = False
+	comm._long_running_commands = []
+	comm._heating = False
+	comm._heatupWaitStartTime = None
+	comm._heatup_status = MachineCom.HEAT_END
+	comm.has_heat_bed = False
+	comm.wait_heat_bed_gcode = False
+	comm.wait_heat_extruder_gcode = False
+	comm._send_M84 = False
+
+	comm._alwaysSendChecksum = False
+	comm._sendChecksumWithUnknownCommands = False
+	comm._unknownCommandsNeedAck = False
+	comm._support_wait = True
+	comm._support_repetier_target_temp = False
+	comm._disable_external_heatup_detection = True
+	comm._feedback_controls = None
+	comm._feedback_matcher = None
+	comm._feedback_errors = []
+	comm._pause_triggers = dict()
+	comm._sdFileList = False
+	comm._sdFiles = []
+
+	comm._currentLine = 1
+	comm._line_mutex = threading.RLock()
+	comm._resendDelta = None
+	comm._lastLines = LineHistory(50)
+	comm._resend_statistics = ResendStatistics()
+	comm._lastCommError = None
+	comm._lastResendNumber = None
+	comm._currentResendCount = 0
+	comm._resend_duplicates = 0
+	comm._resendSwallowNextOk = False
+	comm._resendSwallowRepetitions = False
+	comm._resendSwallowRepetitionsCounter = 0
+
+	comm._clear_to_send = CountedEvent(max=10)
+	comm._send_queue = TypedQueue()
+	comm._send_queue_active = True
+	comm._monitoring_active = True
+	comm._sendNextLock = threading.Lock()
+	comm._sendingLock = threading.RLock()
+	comm._streaming_window = None
+	comm._transfer_batched = False
+	comm._transfer_max_lines = 8
+	comm._transfer_max_bytes = 127
+	comm._transfer_outstanding = 0
+	comm._transfer_pending = None
+	comm._event_loop = None
+	comm._event_loop_attached = False
+	comm._serial_fd = None
+	comm._serial_write_fd = None
+	comm._write_buffer = ""
+	comm._receive_buffer = None
+	comm._received_lines = deque()
+	comm._received_data = False
+	comm._receive_timeout_timer = None
+
+	comm._gcode_hooks = dict(queuing=dict(), queued=dict(), sending=dict(), sent=dict())
+
+	for key, value in attributes.items():
+		setattr(comm, key, value)
+	comm._gcode_dispatch = comm._build_gcode_dispatch()
+	return comm
+
+
+class FakeMarlin(object):
+	"""
+	Answers the lines written to it like Marlin does, one line at a time through :meth:`process`. The line numbers
+	listed in ``corrupt`` arrive with a wrong checksum, those listed in ``lost`` don't arrive at all and the ``ok`` to
+	those listed in ``swallowed`` gets lost on the way back, once for each time they are listed.
+	"""
+
+	def __init__(self, corrupt=(), lost=(), swallowed=()):
+		from collections import deque
+		self.received = deque()
+		self.executed = []
+		self.last_line = 0
+		self._corrupt = list(corrupt)
+		self._lost = list(lost)
+		self._swallowed = list(swallowed)
+
+	def write(self, data):
+		import re
+
+		for line in data.split("\n"):
+			match = re.match(r"N(\d+) ", line)
+			if match is not None and int(match.group(1)) in self._lost:
+				self._lost.remove(int(match.group(1)))
+			elif line:
+				self.received.append(line)
+
+	def process(self):
+		"""
+		Processes the oldest line written but not processed yet and returns the lines answered to it.
+		"""
+		import re
+		from octoprint.util.framing import frame
+
+		line = self.received.popleft()
+		match = re.match(r"N(?P<number>\d+) (?P<command>.*)\*\d+$", line)
+		assert match is not None and line == frame(match.group("command"), int(match.group("number")))
+		number = int(match.group("number"))
+
+		if number in self._corrupt:
+			self._corrupt.remove(number)
+			error = "Error:checksum mismatch, Last Line: %d" % self.last_line
+		elif number != self.last_line + 1:
+			error = "Error:Line Number is not Last Line Number+1, Last Line: %d" % self.last_line
+		else:
+			self.last_line = number
+			self.executed.append(match.group("command"))
+			if number in self._swallowed:
+				self._swallowed.remove(number)
+				return []
+			return ["ok"]
+
+		# Marlin flushes its buffer, asks for the line after the last one it executed and acknowledges the broken one
+		return [error, "Resend: %d" % (self.last_line + 1), "ok"]
+
+
+class FakeReconnectingConnection(object):
+	"""
+	Non-blocking connection to the socket in ``remote``, which reestablishes itself with a new pair of sockets in the
+	background once ``remote`` gets closed, like the connection to the Fastbot printer daemon does.
+	"""
+
+	def __init__(self):
+		import threading
+		self.reconnected = threading.Event()
+		self._callback = None
+		self._connect()
+
+	def _connect(self):
+		import socket
+		self._socket, self.remote = socket.socketpair()
+		self._socket.setblocking(False)
+
+	def _reconnect(self):
+		self._connect()
+		self._callback()
+		self.reconnected.set()
+
+	def set_reconnect_callback(self, callback):
+		self._callback = callback
+
+	def fileno(self):
+		return self._socket.fileno()
+
+	def write_fileno(self):
+		return self._socket.fileno()
+
+	def read_available(self):
+		import errno
+		import socket
+		import threading
+
+		try:
+			data = self._socket.recv(4096)
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+			return ""
+
+		if not data:
+			self._socket.close()
+			threading.Thread(target=self._reconnect).start()
+			return None
+		return data
+
+	def write_available(self, data):
+		return self._socket.send(data)
+
+	def close(self):
+		self._socket.close()
+		self.remote.close()
+
+
 @ddt
 class TestCommHelpers(unittest.TestCase):
 
@@ -229,3 +440,801 @@ class TestCommHelpers(unittest.TestCase):
 		result = canonicalize_temperatures(parsed, current)
 		self.assertDictEqual(expected, result)
 
+
+	@data(
+		(4, 127, [10, 10, 10], 10, True),
+		(4, 127, [10, 10, 10, 10], 10, False),
+		(4, 127, [60, 60], 10, False),
+		(4, 127, [60, 60], 7, True),
+		(4, 127, [], 200, True),
+		(1, 127, [10], 10, False)
+	)
+	@unpack
+	def test_send_window_has_room(self, max_lines, max_bytes, in_flight, size, expected):
+		from octoprint.util.comm import SendWindow
+		window = SendWindow(max_lines, max_bytes)
+		for linenumber, line_size in enumerate(in_flight):
+			window.add(linenumber, line_size)
+		self.assertEquals(expected, window.has_room(size))
+
+	def test_send_window_acknowledge(self):
+		from octoprint.util.comm import SendWindow
+		window = SendWindow(4, 127)
+		window.add(1, 20)
+		window.add(2, 30)
+		window.add(None, 10)
+
+		self.assertEquals(3, len(window))
+		self.assertEquals(60, window.bytes)
+
+		self.assertTrue(window.acknowledge())
+		self.assertEquals([2, None], window.lines)
+		self.assertEquals(40, window.bytes)
+
+		window.reset()
+		self.assertEquals(0, len(window))
+		self.assertFalse(window.acknowledge())
+
+	@data(0, 1, 500)
+	def test_printing_gcode_file_information_read_ahead(self, read_ahead):
+		import tempfile
+		import os
+		from octoprint.util.comm import PrintingGcodeFileInformation
+
+		content = "\xef\xbb\xbfG28 ; home\n; only a comment\n\nM104 S200\nG1 X10 Y10 E1.0\n"
+		handle, path = tempfile.mkstemp(suffix=".gcode")
+		try:
+			os.write(handle, content)
+			os.close(handle)
+
+			file_information = PrintingGcodeFileInformation(path,
+			                                                offsets_callback=lambda: dict(tool0=10),
+			                                                current_tool_callback=lambda: 0,
+			                                                read_ahead=read_ahead)
+			file_information.start()
+
+			lines = []
+			line = file_information.getNext()
+			while line is not None:
+				lines.append(line)
+				line = file_information.getNext()
+
+			self.assertEquals(3, len(lines))
+			self.assertEquals("G28", lines[0])
+			self.assertTrue(lines[1].startswith("M104 S210"))
+			self.assertEquals("G1 X10 Y10 E1.0", lines[2])
+			self.assertEquals(len(content), file_information.getFilepos())
+		finally:
+			os.remove(path)
+
+	def test_printing_gcode_file_information_read_ahead_restart(self):
+		import tempfile
+		import threading
+		import os
+		from octoprint.util.comm import PrintingGcodeFileInformation
+
+		def read_ahead_threads():
+			return [thread for thread in threading.enumerate() if thread.name == "comm.read_ahead" and thread.is_alive()]
+
+		content = "".join("G1 X%d Y%d\n" % (i, i) for i in range(1000))
+		handle, path = tempfile.mkstemp(suffix=".gcode")
+		try:
+			os.write(handle, content)
+			os.close(handle)
+
+			# a small buffer keeps the reader blocked on a full queue while the print is cancelled
+			file_information = PrintingGcodeFileInformation(path, read_ahead=2)
+			file_information.start()
+			self.assertEquals("G1 X0 Y0", file_information.getNext())
+
+			# cancel, as done by MachineCom.cancelPrint
+			file_information.close()
+			self.assertEquals([], read_ahead_threads())
+
+			# restart from the beginning
+			file_information.reset()
+			file_information.start()
+			self.assertEquals(1, len(read_ahead_threads()))
+
+			lines = []
+			line = file_information.getNext()
+			while line is not None:
+				lines.append(line)
+				line = file_information.getNext()
+
+			self.assertEquals(1000, len(lines))
+			self.assertEquals("G1 X0 Y0", lines[0])
+			self.assertEquals([], read_ahead_threads())
+		finally:
+			os.remove(path)
+
+	def test_printing_gcode_file_information_layer_index(self):
+		import tempfile
+		import os
+		from octoprint.util.comm import PrintingGcodeFileInformation
+		from octoprint.util.gcodeInterpreter import LayerIndex
+
+		content = "G28\nG1 Z0.3\nG1 X10 E1\nG1 Z0.6\nG1 X20 E2\n"
+		handle, path = tempfile.mkstemp(suffix=".gcode")
+		try:
+			os.write(handle, content)
+			os.close(handle)
+
+			layers = dict(z=[0.3, 0.6], offset=[4, 22], line=[1, 3], time=[0.0, 30.0], filament=[0.0, 1.0])
+			file_information = PrintingGcodeFileInformation(path, read_ahead=10)
+			file_information.setLayerIndex(LayerIndex(layers, 40.0, len(content)))
+			file_information.start()
+
+			self.assertEquals(None, file_information.getLayer())
+			for _ in range(4):
+				file_information.getNext()
+
+			# just read the first line of the second layer
+			self.assertEquals(1, file_information.getLayer())
+			self.assertAlmostEquals((30.0 + 10.0 * 8 / 18.0) / 40.0, file_information.getProgress())
+			self.assertAlmostEquals(10.0 * 10 / 18.0, file_information.getEstimatedTimeLeft())
+			file_information.close()
+		finally:
+			os.remove(path)
+
+	@data(0, 10)
+	def test_printing_gcode_file_information_seek(self, read_ahead):
+		import tempfile
+		import os
+		from octoprint.util.comm import PrintingGcodeFileInformation
+
+		content = "G28\nG1 Z0.3\nG1 X10 E1\nG1 Z0.6\nG1 X20 E2\n"
+		handle, path = tempfile.mkstemp(suffix=".gcode")
+		try:
+			os.write(handle, content)
+			os.close(handle)
+
+			file_information = PrintingGcodeFileInformation(path, read_ahead=read_ahead)
+			file_information.seek(22)
+			file_information.start()
+
+			lines = []
+			line = file_information.getNext()
+			while line is not None:
+				lines.append(line)
+				line = file_information.getNext()
+
+			self.assertEquals(["G1 Z0.6", "G1 X20 E2"], lines)
+			self.assertEquals(len(content), file_information.getFilepos())
+		finally:
+			os.remove(path)
+
+	def test_checkpoint_commands(self):
+		from octoprint.util.comm import checkpoint_commands
+
+		checkpoint = dict(position=[10.5, 20.0, 0.3], e=12.34567, feedrate=1800.0, tool=1, absolutePositioning=True,
+		                  absoluteExtrusion=True, inches=False, temperatures=dict(bed=60.0, tool0=0.0, tool1=210.0),
+		                  fan=255)
+
+		self.assertEquals(["M140 S60",
+		                   "M104 T0 S0",
+		                   "M104 T1 S210",
+		                   "M190 S60",
+		                   "M109 T1 S210",
+		                   "T1",
+		                   "G21",
+		                   "G91",
+		                   "G0 Z2",
+		                   "G90",
+		                   "G21",
+		                   "G0 X10.5 Y20 F1800",
+		                   "G0 Z0.3",
+		                   "G92 E12.34567",
+		                   "M82",
+		                   "M106 S255"], checkpoint_commands(checkpoint))
+
+	def test_checkpoint_commands_relative(self):
+		from octoprint.util.comm import checkpoint_commands
+
+		checkpoint = dict(position=[1.0, 2.0, 0.1], e=0.0, feedrate=600.0, tool=0, absolutePositioning=False,
+		                  absoluteExtrusion=False, inches=True, temperatures=dict(), fan=None)
+
+		self.assertEquals(["T0", "G21", "G91", "G0 Z2", "G90", "G20", "G0 X1 Y2 F600", "G0 Z0.1", "G92 E0", "M83", "G91"],
+		                  checkpoint_commands(checkpoint))
+
+	def test_checkpoint_commands_offset(self):
+		from octoprint.util.comm import checkpoint_commands
+
+		# e.g. after "G92 X-5 Z0" at X0 Z0.2
+		checkpoint = dict(position=[-5.0, 2.0, 0.3], offset=[5.0, 0.0, 0.2], e=1.5, feedrate=600.0, tool=0,
+		                  absolutePositioning=True, absoluteExtrusion=True, inches=False, temperatures=dict(), fan=None)
+
+		self.assertEquals(["T0", "G21", "G91", "G0 Z2", "G90", "G21", "G0 X0 Y2 F600", "G0 Z0.5", "G92 X-5 Y2 Z0.3",
+		                   "G92 E1.5", "M82"], checkpoint_commands(checkpoint))
+
+	@data(
+		("G1 X10 Y10", "G1"),
+		("M104 S200", "M104"),
+		("T1", "T"),
+		("Hello", None)
+	)
+	@unpack
+	def test_prepared_command(self, command, expected_gcode):
+		from octoprint.util.comm import PreparedCommand, gcode_command_for_cmd
+		prepared = PreparedCommand(command)
+
+		self.assertEquals(command, prepared)
+		self.assertEquals(expected_gcode, prepared.gcode)
+		self.assertEquals(expected_gcode, gcode_command_for_cmd(prepared))
+
+		# checksum of the prepared command combined with the one of a line number prefix needs to match
+		# the checksum of the full line
+		prefix = "N42 "
+		expected_checksum = reduce(lambda x, y: x ^ y, map(ord, prefix + command))
+		self.assertEquals(expected_checksum, reduce(lambda x, y: x ^ y, map(ord, prefix), prepared.checksum))
+
+	def test_process_command_phase_gcode_hook_filter(self):
+		from octoprint.util.comm import gcode_hook_filter
+
+		calls = []
+
+		def unfiltered_hook(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+			calls.append(("unfiltered", gcode))
+
+		@gcode_hook_filter("M117")
+		def filtered_hook(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+			calls.append(("filtered", gcode))
+			return cmd + " World"
+
+		comm = machine_com(_gcode_hooks=dict(queuing=dict(), queued=dict(), sending=dict(unfiltered=unfiltered_hook, filtered=filtered_hook), sent=dict()))
+
+		result = comm._process_command_phase("sending", "G1 X10")
+		self.assertEquals(("G1 X10", None, "G1"), result)
+		self.assertEquals([("unfiltered", "G1")], calls)
+
+		del calls[:]
+		result = comm._process_command_phase("sending", "M117 Hello")
+		self.assertEquals(("M117 Hello World", None, "M117"), result)
+		self.assertItemsEqual([("unfiltered", "M117"), ("filtered", "M117")], calls)
+
+		# GCODE specific handlers of the class need to end up in the dispatch table as well
+		_, _, gcode_handlers, _ = comm._gcode_dispatch["sent"]
+		self.assertIn("G1", gcode_handlers)
+		self.assertIn("T", gcode_handlers)
+
+	def test_process_command_phase_gcode_hook_rewrite(self):
+		from collections import OrderedDict
+		from octoprint.util.comm import gcode_hook_filter
+
+		calls = []
+
+		@gcode_hook_filter("M104")
+		def m104_before_hook(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+			calls.append(("m104_before", gcode))
+
+		@gcode_hook_filter("M104")
+		def rewriting_hook(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+			calls.append(("rewriting", gcode))
+			return cmd.replace("M104", "M109")
+
+		def unfiltered_hook(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+			calls.append(("unfiltered", gcode))
+
+		@gcode_hook_filter("M104")
+		def m104_after_hook(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+			calls.append(("m104_after", gcode))
+
+		@gcode_hook_filter("M109")
+		def m109_after_hook(comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+			calls.append(("m109_after", gcode))
+
+		hooks = OrderedDict([("m104_before", m104_before_hook),
+		                     ("rewriting", rewriting_hook),
+		                     ("unfiltered", unfiltered_hook),
+		                     ("m104_after", m104_after_hook),
+		                     ("m109_after", m109_after_hook)])
+
+		comm = machine_com(_gcode_hooks=dict(queuing=dict(), queued=dict(), sending=hooks, sent=dict()))
+
+		result = comm._process_command_phase("sending", "M104 S200")
+		self.assertEquals(("M109 S200", None, "M109"), result)
+
+		# handlers after the rewrite are selected by the new GCODE
+		self.assertEquals([("m104_before", "M104"),
+		                   ("rewriting", "M104"),
+		                   ("unfiltered", "M109"),
+		                   ("m109_after", "M109")], calls)
+
+	def test_send_next_transfer_batch(self):
+		from octoprint.util.comm import PreparedCommand
+		from octoprint.util.framing import frame
+
+		class FakeFile(object):
+			def __init__(self, lines):
+				self._lines = list(lines)
+
+			def getNext(self):
+				if not self._lines:
+					return None
+				return PreparedCommand(self._lines.pop(0))
+
+		lines = ["G1 X%d Y%d" % (i, i) for i in range(10)]
+
+		comm = machine_com(_currentFile=FakeFile(lines),
+		                   _transfer_max_lines=4,
+		                   _transfer_max_bytes=40)
+
+		comm._sendNextTransferBatch()
+
+		# lines are estimated at 16 bytes each ("N1 G1 X0 Y0*ccc\n"), so only two fit into 40 bytes
+		data, linenumber, command_type = comm._send_queue.get_nowait()
+		self.assertEquals("transfer_batch", command_type)
+		self.assertEquals("\n".join([frame(lines[0], 1), frame(lines[1], 2)]), data)
+		self.assertEquals(2, comm._transfer_outstanding)
+		self.assertEquals(3, comm._currentLine)
+		self.assertEquals(lines[:2], [comm._lastLines[1], comm._lastLines[2]])
+		self.assertEquals(lines[2], comm._transfer_pending)
+
+	def test_resend_prepared_command(self):
+		import mock
+		from octoprint.util.comm import PreparedCommand
+		from octoprint.util import framing
+
+		comm = machine_com(_alwaysSendChecksum=True)
+
+		sent = []
+		comm._doSendWithoutChecksum = sent.append
+
+		command = PreparedCommand("G1 X10 Y10")
+		comm._send_entry((command, None, None))
+		self.assertEquals([framing.frame("G1 X10 Y10", 1)], sent)
+		self.assertIsInstance(comm._lastLines[1], PreparedCommand)
+
+		# the printer asks for line 1 again
+		comm._resendDelta = 1
+		comm._resendNextCommand()
+		entry = comm._send_queue.get_nowait()
+		self.assertEquals((command, 1, None), entry)
+
+		with mock.patch.object(framing, "frame", wraps=framing.frame) as frame:
+			comm._send_entry(entry)
+			frame.assert_called_once_with("G1 X10 Y10", 1, command_checksum=command.checksum)
+		self.assertEquals([framing.frame("G1 X10 Y10", 1)] * 2, sent)
+		self.assertIsInstance(sent[1], str)
+
+	def _print_against(self, firmware, lines, max_lines, transfer=False):
+		"""
+		Prints ``lines`` against ``firmware`` in advanced streaming mode with up to ``max_lines`` lines in flight, or
+		transfers them to its SD in batches of ``max_lines`` lines if ``transfer`` is set. Lines are sent while the
+		streaming window has room, the answers of the firmware are processed one at a time. If the firmware has nothing
+		left to answer while lines are still outstanding, the communication times out.
+
+		Returns the :class:`MachineCom` instance and the number of communication timeouts.
+		"""
+		import mock
+		from octoprint.util.comm import MachineCom, SendWindow
+
+		class FakeFile(object):
+			def __init__(self, lines):
+				self._lines = list(lines)
+
+			def getNext(self):
+				if not self._lines:
+					return None
+				return self._lines.pop(0)
+
+		serial = mock.Mock()
+		serial.write.side_effect = lambda data: firmware.write(data)
+		if transfer:
+			comm = machine_com(_state=MachineCom.STATE_PRINTING,
+			                   _serial=serial,
+			                   _currentFile=FakeFile(lines),
+			                   _alwaysSendChecksum=True,
+			                   _transfer_batched=True,
+			                   _transfer_max_lines=max_lines,
+			                   _transfer_max_bytes=1024)
+			comm.isStreaming = lambda: True
+			# finishing the transfer is of no interest here
+			comm._getNext = mock.Mock()
+		else:
+			comm = machine_com(_state=MachineCom.STATE_PRINTING,
+			                   _serial=serial,
+			                   _currentFile=FakeFile(lines),
+			                   _alwaysSendChecksum=True,
+			                   _send_M84=True,
+			                   _streaming_window=SendWindow(max_lines, 1024))
+
+		def send():
+			while not comm._send_queue.empty() and (transfer or comm._streaming_window.has_room()):
+				comm._send_entry(comm._send_queue.get_nowait())
+
+		def outstanding():
+			if transfer:
+				return comm._transfer_outstanding > 0 or comm._transfer_pending is not None
+			return len(comm._streaming_window) > 0
+
+		with mock.patch("octoprint.util.comm.settings") as settings:
+			settings.return_value.getFloat.return_value = 30.0
+			settings.return_value.getInt.return_value = 7
+
+			if transfer:
+				comm._sendNextTransferBatch()
+			else:
+				comm._sendNext()
+			send()
+			timeouts = 0
+			for _ in range(10):
+				while firmware.received:
+					for answer in firmware.process():
+						comm._process_received_line(answer + "\n")
+						send()
+
+				if comm._currentFile._lines or outstanding():
+					timeouts += 1
+					comm._timeout = 0
+					comm._process_received_line("")
+					send()
+				else:
+					break
+
+		return comm, timeouts
+
+	@data(
+		(1, [5], [], 1),
+		(4, [5], [], 1),
+		(4, [1], [], 1),
+		(4, [20], [], 1),
+		(4, [5, 12], [], 2),
+		(4, [5, 5, 5], [], 3),
+		(4, [], [5], 1),
+		(4, [], [20], 1),
+
+		# broken lines still in flight behind the first broken one are resent along with it
+		(4, [5, 6], [], 1),
+		(4, [5, 6, 7], [], 1),
+		(8, [3, 9, 10], [], 1),
+		(4, [], [5, 6], 1),
+		(4, [5], [7], 1)
+	)
+	@unpack
+	def test_resend_while_streaming(self, max_lines, corrupt, lost, requests):
+		lines = ["G1 X%d Y%d" % (i, i) for i in range(20)]
+		firmware = FakeMarlin(corrupt=corrupt, lost=lost)
+
+		comm, _ = self._print_against(firmware, lines, max_lines)
+
+		# every line made it to the firmware exactly once, in order, and nothing is left in flight
+		self.assertEquals(lines, [command for command in firmware.executed if command != "M105"])
+		# the lines sent after a broken one don't trigger resends of their own
+		self.assertEquals(requests, comm._resend_statistics.as_dict()["requests"])
+		self.assertEquals(0, len(comm._streaming_window))
+		self.assertIsNone(comm._resendDelta)
+		self.assertFalse(comm._resendSwallowNextOk)
+
+	@data(
+		# resend requests during a batch
+		(4, [], [], 0, 0),
+		(4, [6], [], 1, 0),
+		(4, [5], [], 1, 0),
+		(4, [3, 11], [], 2, 0),
+
+		# swallowed oks during a batch, the timeout gets the transfer going again
+		(4, [], [6], 0, 1),
+		(4, [], [8], 0, 1),
+		(4, [], [6, 7], 0, 1),
+		(4, [6], [2], 1, 1)
+	)
+	@unpack
+	def test_resend_while_transferring(self, max_lines, corrupt, swallowed, requests, timeouts):
+		lines = ["G1 X%d Y%d" % (i, i) for i in range(20)]
+		firmware = FakeMarlin(corrupt=corrupt, swallowed=swallowed)
+
+		comm, actual_timeouts = self._print_against(firmware, lines, max_lines, transfer=True)
+
+		# every line made it to the firmware exactly once, in order, and the transfer ran to its end
+		self.assertEquals(lines, [command for command in firmware.executed if command != "M105"])
+		self.assertEquals(requests, comm._resend_statistics.as_dict()["requests"])
+		self.assertEquals(timeouts, actual_timeouts)
+		self.assertEquals(0, comm._transfer_outstanding)
+		self.assertIsNone(comm._resendDelta)
+		self.assertTrue(comm._getNext.called)
+
+	def _transferring(self, lines):
+		import mock
+		from octoprint.util.comm import MachineCom, PreparedCommand
+
+		class FakeFile(object):
+			def __init__(self, lines):
+				self._lines = list(lines)
+
+			def getNext(self):
+				if not self._lines:
+					return None
+				return PreparedCommand(self._lines.pop(0))
+
+		comm = machine_com(_state=MachineCom.STATE_PRINTING,
+		                   _serial=mock.Mock(),
+		                   _currentFile=FakeFile(lines),
+		                   _alwaysSendChecksum=True,
+		                   _transfer_batched=True,
+		                   _transfer_max_lines=8,
+		                   _transfer_max_bytes=64)
+		comm.isStreaming = lambda: True
+		return comm
+
+	def _sent(self, comm):
+		sent = []
+		while not comm._send_queue.empty():
+			data, linenumber, command_type = comm._send_queue.get_nowait()
+			sent.append((data, linenumber))
+		return sent
+
+	def test_resend_request_during_transfer_batch(self):
+		import mock
+		from octoprint.util.framing import frame
+
+		lines = ["G1 X%d Y%d" % (i, i) for i in range(10)]
+		comm = self._transferring(lines)
+
+		# lines are estimated at 16 bytes each, so only four fit into 64 bytes and the fifth is kept back for the next batch
+		comm._sendNextTransferBatch()
+		self._sent(comm)
+		self.assertEquals(4, comm._transfer_outstanding)
+		self.assertEquals(lines[4], comm._transfer_pending)
+
+		with mock.patch("octoprint.util.comm.settings") as settings:
+			settings.return_value.getInt.return_value = 7
+
+			comm._process_received_line("ok\n")
+			comm._process_received_line("Error:checksum mismatch, Last Line: 1\n")
+			comm._process_received_line("Resend: 2\n")
+			comm._process_received_line("ok\n")
+
+			# lines 2 to 4 won't be acknowledged as part of the batch anymore
+			self.assertEquals(0, comm._transfer_outstanding)
+			self.assertEquals([(lines[1], 2)], self._sent(comm))
+
+			comm._process_received_line("ok\n")
+			self.assertEquals([(lines[2], 3)], self._sent(comm))
+			comm._process_received_line("ok\n")
+			self.assertEquals([(lines[3], 4)], self._sent(comm))
+
+			# resend is done, the next batch is led by the line kept back from the last one
+			comm._process_received_line("ok\n")
+			data, _ = self._sent(comm)[0]
+			self.assertEquals([frame(line, linenumber) for linenumber, line in enumerate(lines[4:8], 5)], data.split("\n"))
+
+	def test_swallowed_ok_during_transfer_batch(self):
+		import mock
+		from octoprint.util.framing import frame
+
+		lines = ["G1 X%d Y%d" % (i, i) for i in range(10)]
+		comm = self._transferring(lines)
+
+		comm._sendNextTransferBatch()
+		self._sent(comm)
+
+		with mock.patch("octoprint.util.comm.settings") as settings:
+			settings.return_value.getFloat.return_value = 30.0
+
+			# two of four oks get lost, the communication times out
+			comm._process_received_line("ok\n")
+			comm._process_received_line("ok\n")
+			comm._timeout = 0
+			comm._process_received_line("")
+
+			self.assertEquals(0, comm._transfer_outstanding)
+			self.assertEquals([("M105", None)], self._sent(comm))
+
+			# the ok to the forced line triggers the next batch, led by the line kept back from the last one
+			comm._process_received_line("ok\n")
+			data, _ = self._sent(comm)[0]
+			self.assertEquals(frame(lines[4], 5), data.split("\n")[0])
+
+	def _served_by_event_loop(self, connection, **attributes):
+		import mock
+		from octoprint.util.eventloop import LineBuffer
+
+		return machine_com(_serial=connection,
+		                   _event_loop=mock.Mock(),
+		                   _event_loop_attached=True,
+		                   _serial_fd=3,
+		                   _serial_write_fd=4,
+		                   _receive_buffer=LineBuffer(),
+		                   **attributes)
+
+	def test_write_on_event_loop(self):
+		import mock
+
+		connection = mock.Mock()
+		connection.write_available.side_effect = [4, 0, 6]
+		comm = self._served_by_event_loop(connection)
+
+		# what doesn't fit gets written once the connection has room again
+		comm._doSendWithoutChecksum("M105")
+		self.assertEquals("\n", comm._write_buffer)
+		comm._event_loop.add_writer.assert_called_once_with(4, comm._on_serial_writable)
+
+		comm._doSendWithoutChecksum("M106")
+		self.assertEquals("\nM106\n", comm._write_buffer)
+
+		comm._on_serial_writable()
+		self.assertEquals("", comm._write_buffer)
+		comm._event_loop.remove_writer.assert_called_once_with(4)
+
+		self.assertEquals([mock.call("M105\n"), mock.call("\nM106\n"), mock.call("\nM106\n")],
+		                  connection.write_available.call_args_list)
+		self.assertFalse(connection.write.called)
+
+	def test_reconnect_on_event_loop(self):
+		import mock
+		import Queue as queue
+		from octoprint.util.eventloop import EventLoop, LineBuffer
+
+		connection = FakeReconnectingConnection()
+		loop = EventLoop(name="test.eventloop")
+		loop.start()
+
+		comm = machine_com(_serial=connection,
+		                   _event_loop=loop,
+		                   _receive_buffer=LineBuffer())
+		received = queue.Queue()
+		comm._process_received_line = received.put
+		connection.set_reconnect_callback(comm._on_serial_reconnected)
+
+		try:
+			with mock.patch("octoprint.util.comm.settings") as settings:
+				settings.return_value.getFloat.return_value = 30.0
+				loop.call_soon_threadsafe(comm._attach_to_event_loop, connection.fileno(), connection.write_fileno())
+
+				connection.remote.sendall("ok\nok T:2")
+				self.assertEquals("ok\n", received.get(timeout=1.0))
+
+				# the printer goes away and comes back on a new descriptor, the partial line is lost with it
+				connection.remote.close()
+				self.assertTrue(connection.reconnected.wait(1.0))
+
+				connection.remote.sendall("ok T:21.0\n")
+				self.assertEquals("ok T:21.0\n", received.get(timeout=1.0))
+
+				loop.call_soon_threadsafe(comm._doSendWithoutChecksum, "M105")
+				self.assertEquals("M105\n", connection.remote.recv(256))
+		finally:
+			loop.call_soon_threadsafe(comm._detach_from_event_loop)
+			loop.stop()
+			connection.close()
+
+	@data(
+		(["ok\nError:1\n", ": Extruder switched off. MAXTEMP triggered !\n"], False, "1: Extruder switched off. MAXTEMP triggered !\n"),
+		(["ok\nError:1\n: Extruder switched off. MAXTEMP triggered !\n"], False, "1: Extruder switched off. MAXTEMP triggered !\n"),
+		(["ok\nError:1\n"], True, "1")
+	)
+	@unpack
+	def test_multi_line_error_on_event_loop(self, received, timeout, expected):
+		import mock
+
+		connection = mock.Mock()
+		connection.read_available.side_effect = received
+		comm = self._served_by_event_loop(connection)
+
+		with mock.patch("octoprint.util.comm.settings") as settings, mock.patch("octoprint.util.comm.eventManager"):
+			settings.return_value.getFloat.return_value = 30.0
+
+			comm._on_serial_readable()
+			if len(received) > 1 or timeout:
+				# processing the first line of the error has to wait for the second one without blocking for it
+				self.assertFalse(comm.isError())
+
+			for _ in received[1:]:
+				comm._on_serial_readable()
+			if timeout:
+				comm._on_receive_timeout()
+
+		self.assertTrue(comm.isError())
+		self.assertEquals(expected, comm._errorValue)
+		self.assertEquals(0, len(comm._received_lines))
+
+	@data(
+		(None, {"error": "1: Extruder switched off. MAXTEMP triggered !\n"}),
+		("left", {"error": "1: Extruder switched off. MAXTEMP triggered !\n", "printer": "left"})
+	)
+	@unpack
+	def test_events_carry_printer_id(self, printer_id, expected_payload):
+		import mock
+		from octoprint.events import Events
+
+		connection = mock.Mock()
+		connection.read_available.side_effect = ["Error:1\n: Extruder switched off. MAXTEMP triggered !\n"]
+		comm = self._served_by_event_loop(connection)
+		comm._printer_id = printer_id
+
+		with mock.patch("octoprint.util.comm.settings"), mock.patch("octoprint.util.comm.eventManager") as eventManager:
+			comm._on_serial_readable()
+
+		eventManager.return_value.fire.assert_any_call(Events.ERROR, expected_payload)
+
+	def test_line_history(self):
+		from octoprint.util.comm import LineHistory
+
+		history = LineHistory(3)
+		for linenumber in range(10, 15):
+			history.add(linenumber, "line %d" % linenumber)
+
+		self.assertEquals(3, len(history))
+		for linenumber in (10, 11, 15):
+			self.assertFalse(linenumber in history)
+			self.assertRaises(KeyError, history.__getitem__, linenumber)
+		for linenumber in (12, 13, 14):
+			self.assertTrue(linenumber in history)
+			self.assertEquals("line %d" % linenumber, history[linenumber])
+
+	def test_line_history_non_consecutive(self):
+		from octoprint.util.comm import LineHistory
+
+		history = LineHistory(10)
+		history.add(1, "G28")
+		history.add(2, "G1 X10")
+
+		# e.g. after M110 N0
+		history.add(1, "M105")
+
+		self.assertEquals(1, len(history))
+		self.assertEquals("M105", history[1])
+		self.assertFalse(2 in history)
+
+	@data(
+		("M110", 0),
+		("M110 N", 0),
+		("M110 N0", 0),
+		("M110 N100", 100)
+	)
+	@unpack
+	def test_gcode_M110_sending(self, cmd, expected):
+		comm = machine_com(_currentLine=6)
+		comm._lastLines.add(5, "G28")
+
+		comm._gcode_M110_sending(cmd)
+
+		self.assertEquals(expected, comm._currentLine)
+		self.assertEquals(0, len(comm._lastLines))
+
+	def test_resend_statistics(self):
+		from octoprint.util.comm import ResendStatistics
+
+		statistics = ResendStatistics()
+		statistics.sent = 100
+		statistics.record(3)
+		statistics.record(1)
+		statistics.record_failure()
+
+		self.assertDictEqual(dict(sent=100, requests=2, lines=4, failed=1, maxDistance=3, lastDistance=1,
+		                          averageDistance=2.0, ratio=0.04),
+		                     statistics.as_dict())
+
+	@data(
+		("\n", "empty", False, None),
+		("ok\n", "ok", True, None),
+		("ok N12\n", "ok", True, None),
+		("ok T:21.3 /0.0 B:20.1 /0.0 @:0\n", "temperature", True, None),
+		("T:180.2 E:0 W:?\n", "temperature", False, None),
+		(" T0:180.2 /210.0\n", "temperature", False, None),
+		("TargetExtr0:210\n", "target_temperature", False, None),
+		("wait\n", "wait", False, None),
+		("Resend: 12\n", "resend", False, None),
+		("rs 12\n", "resend", False, None),
+		("Error:Line Number is not Last Line Number+1, Last Line: 11\n", "error", False, None),
+		("Error:volume.init failed\n", "error", False, "volume.init failed"),
+		("!! MAXTEMP triggered\n", "error", False, None),
+		("echo:busy: processing\n", "busy", False, None),
+		("echo:SD card ok\n", "sd", False, "SD card ok"),
+		("SD printing byte 123/456\n", "sd", False, "SD printing byte"),
+		("File deleted:test.gco ok\n", "sd", False, "File deleted"),
+		("// some debug output\n", "debug", False, None),
+		("//action:pause\n", "action", False, None),
+		("// action:disconnect\n", "action", False, None),
+		("echo:Unknown command: \"G99\"\n", "message", False, None),
+		("start\n", "message", False, None)
+	)
+	@unpack
+	def test_classify_line(self, line, expected_type, expected_acknowledgement, expected_keyword):
+		from octoprint.util.comm import classify_line
+		self.assertEquals((expected_type, expected_acknowledgement, expected_keyword), classify_line(line))
+
+	def test_sd_message_handlers(self):
+		from octoprint.util.comm import MachineCom, sd_message_keywords
+		self.assertItemsEqual(sd_message_keywords, MachineCom._sd_message_handlers.keys())
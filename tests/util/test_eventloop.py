@@ -0,0 +1,182 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import unittest
+import socket
+import threading
+
+from octoprint.util.eventloop import EventLoop, LineBuffer, ReceiveBuffer
+
+
+class EventLoopTest(unittest.TestCase):
+
+	def setUp(self):
+		self.loop = EventLoop(name="test.eventloop")
+		self.loop.start()
+
+	def tearDown(self):
+		self.loop.stop()
+
+	def test_reader(self):
+		a, b = socket.socketpair()
+		received = []
+		done = threading.Event()
+
+		def on_readable():
+			received.append(a.recv(4096))
+			if "".join(received).endswith("\n"):
+				done.set()
+
+		try:
+			self.loop.add_reader(a.fileno(), on_readable)
+			b.sendall("ok\n")
+
+			self.assertTrue(done.wait(1.0))
+			self.assertEquals("ok\n", "".join(received))
+			self.assertTrue(self.loop.remove_reader(a.fileno()))
+			self.assertFalse(self.loop.remove_reader(a.fileno()))
+		finally:
+			a.close()
+			b.close()
+
+	def test_writer(self):
+		a, b = socket.socketpair()
+		writable = threading.Event()
+
+		def on_writable():
+			self.loop.remove_writer(a.fileno())
+			a.send("ok\n")
+			writable.set()
+
+		try:
+			self.loop.add_writer(a.fileno(), on_writable)
+
+			self.assertTrue(writable.wait(1.0))
+			self.assertEquals("ok\n", b.recv(4096))
+			self.assertFalse(self.loop.remove_writer(a.fileno()))
+		finally:
+			a.close()
+			b.close()
+
+	def test_call_soon_threadsafe(self):
+		done = threading.Event()
+		threads = []
+
+		def callback(value):
+			threads.append((threading.current_thread().name, value))
+			done.set()
+
+		self.loop.call_soon_threadsafe(callback, 23)
+
+		self.assertTrue(done.wait(1.0))
+		self.assertEquals([("test.eventloop", 23)], threads)
+
+	def test_call_later_cancelled(self):
+		calls = []
+		done = threading.Event()
+
+		timer = self.loop.call_later(0.05, calls.append, "cancelled")
+		self.loop.call_later(0.1, done.set)
+		timer.cancel()
+
+		self.assertTrue(done.wait(1.0))
+		self.assertEquals([], calls)
+
+	def test_call_repeatedly(self):
+		calls = []
+		done = threading.Event()
+
+		def callback():
+			calls.append(len(calls))
+			if len(calls) == 3:
+				done.set()
+
+		self.loop.call_repeatedly(0.01, callback, condition=lambda: len(calls) < 3, run_first=True)
+
+		self.assertTrue(done.wait(1.0))
+		self.assertEquals([0, 1, 2], calls)
+
+
+class LineBufferTest(unittest.TestCase):
+
+	def test_feed(self):
+		buffer = LineBuffer()
+
+		self.assertEquals(["ok\n"], buffer.feed("ok\nT:21"))
+		self.assertEquals("T:21", buffer.partial)
+		self.assertEquals([], buffer.feed(".3 /0.0"))
+		self.assertEquals(["T:21.3 /0.0\n", "ok\n"], buffer.feed("\nok\n"))
+		self.assertEquals("", buffer.partial)
+		self.assertEquals([], buffer.feed(""))
+
+
+class ReceiveBufferTest(unittest.TestCase):
+
+	def setUp(self):
+		self.remote, self.local = socket.socketpair()
+
+	def tearDown(self):
+		self.remote.close()
+		self.local.close()
+
+	def _receive(self, buffer, data):
+		self.remote.sendall(data)
+		received = 0
+		while received < len(data):
+			received += buffer.fill(self.local)
+
+	def test_partial_lines(self):
+		buffer = ReceiveBuffer(size=8)
+
+		self._receive(buffer, "ok\nT:21")
+		self.assertEquals("ok\n", buffer.readline())
+		self.assertIsNone(buffer.readline())
+
+		self._receive(buffer, ".3 /0.0\nok")
+		self.assertEquals("T:21.3 /0.0\n", buffer.readline())
+		self.assertIsNone(buffer.readline())
+		self.assertEquals(2, len(buffer))
+
+		self._receive(buffer, "\n")
+		self.assertEquals("ok\n", buffer.readline())
+		self.assertEquals(0, len(buffer))
+
+	def test_long_line(self):
+		buffer = ReceiveBuffer(size=4)
+		line = "echo:" + "x" * 50 + "\n"
+
+		self._receive(buffer, line + "ok\n")
+
+		self.assertEquals(line, buffer.readline())
+		self.assertEquals("ok\n", buffer.readline())
+
+	def test_many_lines(self):
+		buffer = ReceiveBuffer(size=16)
+		lines = ["ok N%d\n" % i for i in range(100)]
+
+		received = []
+		for line in lines:
+			self._receive(buffer, line)
+			while True:
+				next_line = buffer.readline()
+				if next_line is None:
+					break
+				received.append(next_line)
+
+		self.assertEquals(lines, received)
+
+	def test_read_all(self):
+		buffer = ReceiveBuffer(size=16)
+
+		self._receive(buffer, "ok\nT:")
+		self.assertEquals("ok\nT:", buffer.read_all())
+		self.assertEquals("", buffer.read_all())
+
+	def test_closed(self):
+		buffer = ReceiveBuffer()
+		self.remote.close()
+		self.assertRaises(IOError, buffer.fill, self.local)
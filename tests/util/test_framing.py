@@ -0,0 +1,55 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import unittest
+
+from ddt import ddt, data, unpack
+
+def legacy_checksum(line):
+	return reduce(lambda x, y: x ^ y, map(ord, line), 0)
+
+@ddt
+class TestFraming(unittest.TestCase):
+
+	@data(
+		"",
+		"G28",
+		"N1 G1 X10.0 Y10.0 E1.0",
+		u"M117 Hällo",
+		"M117 " + "x" * 200
+	)
+	def test_checksum(self, line):
+		from octoprint.util.framing import checksum
+		self.assertEquals(legacy_checksum(line.encode("ascii", "replace") if isinstance(line, unicode) else line), checksum(line))
+
+	def test_checksum_initial(self):
+		from octoprint.util.framing import checksum
+		self.assertEquals(legacy_checksum("N10 G28"), checksum("G28", initial=checksum("N10 ")))
+
+	@data(
+		("G28", 1, "N1 G28*18"),
+		("M110 N0", 0, "N0 M110 N0*125"),
+		("G1 X10.0 Y10.0 E1.0", 12345, "N12345 G1 X10.0 Y10.0 E1.0*%d" % legacy_checksum("N12345 G1 X10.0 Y10.0 E1.0"))
+	)
+	@unpack
+	def test_frame(self, command, linenumber, expected):
+		from octoprint.util.framing import frame, checksum
+		self.assertEquals(expected, frame(command, linenumber))
+		self.assertEquals(expected, frame(command, linenumber, command_checksum=checksum(command)))
+
+	def test_frame_batch(self):
+		from octoprint.util.framing import frame_batch, frame, checksum
+
+		commands = ["G28", ("G1 X10", checksum("G1 X10")), "M105"]
+		framed, next_linenumber = frame_batch(commands, 5)
+
+		self.assertEquals("\n".join([frame("G28", 5), frame("G1 X10", 6), frame("M105", 7)]) + "\n", framed)
+		self.assertEquals(8, next_linenumber)
+
+	def test_frame_batch_empty(self):
+		from octoprint.util.framing import frame_batch
+		self.assertEquals(("", 3), frame_batch([], 3))
@@ -0,0 +1,174 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from ddt import ddt, data, unpack
+
+from octoprint.util.gcodeEstimator import LegacyEstimator, PlannerEstimator, get_estimator, accuracy
+
+printer_profile = dict(
+	axes=dict(x=dict(speed=200), y=dict(speed=200), z=dict(speed=5), e=dict(speed=50)),
+	extruder=dict(count=1, offsets=[(0, 0)]),
+	accelerationMaximum=dict(x=2000, y=2000, z=50, e=5000),
+	accelerationMoveRetract=dict(move=1000, retract=2500),
+	advancedVariables=dict(maxXYJerk=10, maxZJerk=0.5, maxEJerk=5)
+)
+
+
+def _trapezoid(length, entry, speed, exit, acceleration):
+	acceleration = float(acceleration)
+	accelerating = (speed ** 2 - entry ** 2) / (2.0 * acceleration)
+	decelerating = (speed ** 2 - exit ** 2) / (2.0 * acceleration)
+	if accelerating + decelerating > length:
+		peak = math.sqrt(acceleration * length + (entry ** 2 + exit ** 2) / 2.0)
+		return (peak - entry) / acceleration + (peak - exit) / acceleration
+	return (speed - entry) / acceleration + (speed - exit) / acceleration + (length - accelerating - decelerating) / speed
+
+
+def _estimate(moves, estimator=None):
+	if estimator is None:
+		estimator = PlannerEstimator(printer_profile)
+
+	position = [0.0, 0.0, 0.0]
+	for move in moves:
+		if move[0] == "dwell":
+			estimator.dwell(move[1])
+			continue
+		target, e, feedrate = move
+		estimator.move(position, list(target), e, feedrate, True)
+		position = list(target)
+	return estimator.get_total()
+
+
+@ddt
+class PlannerEstimatorTest(unittest.TestCase):
+
+	@data(
+		# long move reaching the nominal speed, starting and ending with the jerk speed
+		((100, 0, 0), 6000, _trapezoid(100, 10, 100, 10, 1000)),
+		# short move not reaching the nominal speed
+		((2, 0, 0), 6000, _trapezoid(2, 10, 100, 10, 1000)),
+		# feedrate limited by the maximum feedrate of Z, acceleration by the maximum acceleration of Z
+		((0, 0, 10), 6000, _trapezoid(10, 0.5, 5, 0.5, 50)),
+		# diagonal XY move, axis limits don't apply
+		((30, 40, 0), 3000, _trapezoid(50, 10, 50, 10, 1000))
+	)
+	@unpack
+	def test_single_move(self, target, feedrate, expected):
+		self.assertAlmostEquals(expected, _estimate([(target, 0.0, feedrate)]), places=6)
+
+	def test_collinear_moves(self):
+		split = _estimate([((50, 0, 0), 0.0, 6000), ((100, 0, 0), 0.0, 6000)])
+		single = _estimate([((100, 0, 0), 0.0, 6000)])
+		self.assertAlmostEquals(single, split, places=6)
+
+	def test_corner(self):
+		# the speed of each axis may change by 10mm/s at the corner: sqrt(2) * v <= 10
+		corner = 10 / math.sqrt(2)
+		expected = _trapezoid(100, 10, 100, corner, 1000) + _trapezoid(100, corner, 100, 10, 1000)
+		self.assertAlmostEquals(expected, _estimate([((100, 0, 0), 0.0, 6000), ((100, 100, 0), 0.0, 6000)]), places=6)
+
+	def test_retract(self):
+		# only moving the extruder uses the retract acceleration and the E jerk
+		expected = _trapezoid(5, 5, 50, 5, 2500)
+		self.assertAlmostEquals(expected, _estimate([((0, 0, 0), -5.0, 6000)]), places=6)
+
+	def test_dwell(self):
+		moves = [((100, 0, 0), 0.0, 6000), ("dwell", 2.5), ((200, 0, 0), 0.0, 6000)]
+		expected = 2 * _trapezoid(100, 10, 100, 10, 1000) + 2.5
+		self.assertAlmostEquals(expected, _estimate(moves), places=6)
+
+	def test_lookahead_limited(self):
+		# a thousand segments of 0.01mm, with 16 moves buffered the planner never gets far from the jerk speed
+		moves = [((0.01 * (i + 1), 0, 0), 0.0, 6000) for i in range(1000)]
+		single = _estimate([((10, 0, 0), 0.0, 6000)])
+		segmented = _estimate(moves)
+
+		maximum = math.sqrt(10 ** 2 + 2 * 1000 * 0.01 * PlannerEstimator.BUFFER_SIZE)
+		self.assertTrue(segmented > single)
+		self.assertTrue(segmented >= 10 / maximum)
+
+	def test_state(self):
+		moves = [((10 * (i % 7), 5 * (i % 3), 0), 0.1, 1200 + 100 * i) for i in range(50)]
+
+		complete = _estimate(moves)
+
+		first = PlannerEstimator(printer_profile)
+		_estimate(moves[:20], estimator=first)
+		second = PlannerEstimator(printer_profile)
+		second.set_state(first.get_state())
+		position = list(moves[19][0])
+		for target, e, feedrate in moves[20:]:
+			second.move(position, list(target), e, feedrate, True)
+			position = list(target)
+
+		self.assertAlmostEquals(complete, second.get_total(), places=6)
+
+	def test_profile_defaults(self):
+		estimator = PlannerEstimator(dict(axes=dict(x=dict(speed="invalid"))))
+		estimator.move([0, 0, 0], [100, 0, 0], 0.0, 6000, True)
+		self.assertTrue(estimator.get_total() > 1.0)
+
+
+class LegacyEstimatorTest(unittest.TestCase):
+
+	def test_moves(self):
+		estimator = LegacyEstimator(printer_profile)
+		estimator.move([0, 0, 0], [30, 40, 0], 1.0, 600, True)
+		estimator.move([30, 40, 0], [30, 40, 0], 6.0, 60, False)
+		estimator.move([30, 40, 0], [30, 40, 0], -3.0, 60, False)
+		estimator.dwell(1.5)
+
+		self.assertAlmostEquals(5.0 + 6.0 + 3.0 + 1.5, estimator.get_total(), places=6)
+
+	def test_get_estimator(self):
+		self.assertTrue(isinstance(get_estimator("legacy", printer_profile), LegacyEstimator))
+		self.assertTrue(isinstance(get_estimator("planner", printer_profile), PlannerEstimator))
+		self.assertTrue(isinstance(get_estimator(None, printer_profile), LegacyEstimator))
+		self.assertTrue(isinstance(get_estimator("unknown", printer_profile), LegacyEstimator))
+
+
+class AccuracyTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.basefolder)
+
+	def test_accuracy(self):
+		path = os.path.join(self.basefolder, "square.gcode")
+		with open(path, "wb") as f:
+			f.write("G28\nG1 X100 F6000\nG1 Y100\nG1 X0\nG1 Y0\n")
+
+		corner = 10 / math.sqrt(2)
+		duration = 2 * _trapezoid(100, 10, 100, corner, 1000) + 2 * _trapezoid(100, corner, 100, corner, 1000)
+
+		result = accuracy([dict(path=path, duration=duration)], printer_profile)
+
+		self.assertAlmostEquals(0.0, result["planner"]["mean"], places=6)
+		# no acceleration at all: 4 * 100mm at 100mm/s
+		self.assertAlmostEquals(4.0 / duration - 1.0, result["legacy"]["errors"][0], places=6)
+
+	def test_sliced_file(self):
+		path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "filemanager", "_files", "bp_case.gcode")
+
+		# not a recorded duration, this only compares the estimators on the moves of an actual slicer
+		result = accuracy([dict(path=path, duration=3600.0)], printer_profile)
+
+		legacy = result["legacy"]["errors"][0]
+		planner = result["planner"]["errors"][0]
+
+		# accelerating and slowing down at corners only ever takes longer than moving at the feedrate
+		self.assertTrue(planner > legacy)
+		# but not beyond what these limits allow for the short moves of the file
+		self.assertTrue((planner + 1.0) / (legacy + 1.0) < 1.5)
@@ -0,0 +1,313 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+
+from ddt import ddt, data, unpack
+
+import octoprint.util.gcodeInterpreter
+from octoprint.util.gcodeInterpreter import gcode, read_lines, LayerIndex, StreamingAnalysis
+
+printer_profile = dict(
+	axes=dict(x=dict(speed=6000), y=dict(speed=6000), z=dict(speed=200), e=dict(speed=300)),
+	extruder=dict(count=2, offsets=[(0, 0), (0, 0)])
+)
+
+class TestGcodeInterpreter(unittest.TestCase):
+
+	def _analyze(self, lines):
+		interpreter = gcode(estimator="legacy")
+		with mock.patch("octoprint.util.gcodeInterpreter.settings") as settings:
+			settings.return_value.getInt.return_value = 10
+			interpreter._load(lines, printer_profile)
+		return interpreter
+
+	def test_extrusion(self):
+		result = self._analyze([
+			";filament_diameter = 1.75",
+			"G21",
+			"G90",
+			"M82",
+			"G1 X10 Y0 E1.5 F1200",
+			"G1 X10 Y10 E3.0",
+			"G1 E1.0 ; retract",
+			"G1 X0 Y10 E4.0",
+			"T1",
+			"G1 X0 Y0 E2.0"
+		])
+
+		self.assertEquals([4.0, 2.0], result.extrusionAmount)
+		self.assertAlmostEquals(4.0 * 3.14159 * 0.875 * 0.875 / 1000, result.extrusionVolume[0], places=5)
+		self.assertTrue(result.totalMoveTimeMinute > 0)
+
+	def test_home_axes(self):
+		result = self._analyze([
+			"G1 X10 Y10 F6000",
+			"G28 X",
+			"G1 Y20",
+		])
+
+		# homing X only leaves Y at 10, so the last move is only 10mm long
+		self.assertAlmostEquals((200 ** 0.5 + 10) / 6000.0, result.totalMoveTimeMinute, places=6)
+
+	def test_layers(self):
+		lines = [
+			"G28\n",
+			"G1 Z0.3 F1200\n",
+			"G1 X10 E1\n",
+			"G1 Z1.3 ; hop\n",
+			"G1 X20\n",
+			"G1 Z0.3\n",
+			"G1 X30 E2\n",
+			";LAYER:1\n",
+			"G1 Z0.6\n",
+			"G1 X40 E3\n",
+			"G1 X50 Z0.8 E4 ; spiralized\n",
+			"G1 X60 E5\n"
+		]
+		result = self._analyze(lines)
+
+		self.assertEquals([
+			dict(z=0.3, offset=4, line=1, time=0.0, filament=0.0),
+			dict(z=0.6, offset=len("".join(lines[0:8])), line=8, time=1.5, filament=2.0)
+		], self._without_state(result.layerList))
+
+	def test_first_layer_without_z(self):
+		result = self._analyze(["G28\n", "G92 E0\n", "G1 X10 E1 F600\n"])
+		self.assertEquals([dict(z=0.0, offset=11, line=2, time=0.0, filament=0.0)], self._without_state(result.layerList))
+
+	def test_checkpoints(self):
+		result = self._analyze([
+			"M140 S60\n",
+			"M104 S200\n",
+			"M104 T1 S210\n",
+			"G28\n",
+			"G92 X-5\n",
+			"G1 F3000\n",
+			"M83\n",
+			"G1 Z0.3 F1200\n",
+			"G1 X10 E1\n",
+			"M106 S128\n",
+			"T1\n",
+			"G91\n",
+			"G1 Z0.3 F600\n",
+			"G1 X10 E1.5\n"
+		])
+
+		self.assertEquals([
+			dict(position=[-5.0, 0.0, 0.0], offset=[5.0, 0.0, 0.0], e=0.0, feedrate=3000.0, tool=0, absolutePositioning=True,
+			     absoluteExtrusion=False, inches=False, temperatures=dict(bed=60.0, tool0=200.0, tool1=210.0), fan=None),
+			dict(position=[10.0, 0.0, 0.3], offset=[5.0, 0.0, 0.0], e=0.0, feedrate=1200.0, tool=1, absolutePositioning=False,
+			     absoluteExtrusion=False, inches=False, temperatures=dict(bed=60.0, tool0=200.0, tool1=210.0), fan=128)
+		], [layer["state"] for layer in result.layerList])
+
+	def test_bounds(self):
+		profile = dict(printer_profile, volume=dict(width=100, depth=100, height=50, origin="lowerleft", formFactor="rectangular"))
+		interpreter = gcode(estimator="legacy")
+		with mock.patch("octoprint.util.gcodeInterpreter.settings") as settings:
+			settings.return_value.getInt.return_value = 10
+			interpreter._load([
+				"G28",
+				"G1 Z0.3 F1200",
+				"G1 X10 Y10",
+				"G1 X40 Y10 E1",
+				"G1 X40 Y50 E2",
+				"T1",
+				"G1 X120 Y50 ; travel outside",
+				"G1 X130 Y50 E3",
+				"G1 Z60"
+			], profile)
+
+		self.assertEquals(dict(minX=10.0, maxX=40.0, minY=10.0, maxY=50.0, minZ=0.3, maxZ=0.3), interpreter.bounds[0])
+		self.assertEquals(dict(minX=120.0, maxX=130.0, minY=50.0, maxY=50.0, minZ=0.3, maxZ=0.3), interpreter.bounds[1])
+		self.assertEquals(dict(minX=0.0, maxX=130.0, minY=0.0, maxY=50.0, minZ=0.3, maxZ=60.0), interpreter.travelBounds)
+		self.assertAlmostEquals(70.0 + 10.0, interpreter.extrudeDistance)
+		self.assertAlmostEquals(0.3 + 200 ** 0.5 + 80.0 + 59.7, interpreter.travelDistance)
+		self.assertEquals(dict(travel=2, extrude=1, line=6), interpreter.outOfVolume)
+
+	def test_bounds_circular(self):
+		profile = dict(printer_profile, volume=dict(width=100, depth=100, height=50, origin="center", formFactor="circular"))
+		interpreter = gcode(estimator="legacy")
+		with mock.patch("octoprint.util.gcodeInterpreter.settings") as settings:
+			settings.return_value.getInt.return_value = 10
+			interpreter._load(["G28", "G1 X-40 Y-40 Z0.3", "G1 X-30 Y-30 E1", "G1 X0 Y50 E2"], profile)
+
+		self.assertEquals(dict(travel=1, extrude=0, line=1), interpreter.outOfVolume)
+
+	def test_bounds_without_volume(self):
+		result = self._analyze(["G28", "G1 X-10 Y-10 E1"])
+		self.assertEquals(dict(travel=0, extrude=0, line=None), result.outOfVolume)
+		self.assertEquals(dict(minX=-10.0, maxX=0.0, minY=-10.0, maxY=0.0, minZ=0.0, maxZ=0.0), result.bounds[0])
+
+	def _without_state(self, layers):
+		return [dict((key, value) for key, value in layer.items() if key != "state") for layer in layers]
+
+
+class TestLayerIndex(unittest.TestCase):
+
+	def setUp(self):
+		layers = dict(z=[0.3, 0.6], offset=[10, 100], line=[1, 5], time=[0.0, 60.0], filament=[0.0, 12.5])
+		self.index = LayerIndex(layers, 100.0, 200)
+
+	def test_get_layer(self):
+		self.assertEquals(2, len(self.index))
+		self.assertEquals(None, self.index.get_layer(5))
+		self.assertEquals(0, self.index.get_layer(10))
+		self.assertEquals(0, self.index.get_layer(99))
+		self.assertEquals(1, self.index.get_layer(100))
+		self.assertEquals(dict(layer=1, z=0.6, offset=100, line=5, time=60.0, filament=12.5), self.index.get_layer_data(1))
+
+	def test_get_checkpoint(self):
+		# indices from before the analysis recorded the state of the printer
+		self.assertEquals(None, self.index.get_checkpoint(1))
+
+		layers = dict(z=[0.3], offset=[0], line=[0], time=[0.0], filament=[0.0], state=[dict(tool=1)])
+		self.assertEquals(dict(tool=1), LayerIndex(layers, 10.0, 100).get_checkpoint(0))
+
+	def test_time(self):
+		self.assertAlmostEquals(0.0, self.index.get_time(5))
+		self.assertAlmostEquals(30.0, self.index.get_time(55))
+		self.assertAlmostEquals(80.0, self.index.get_time(150))
+		self.assertAlmostEquals(100.0, self.index.get_time(200))
+		self.assertAlmostEquals(0.8, self.index.get_progress(150))
+		self.assertAlmostEquals(20.0, self.index.get_time_left(150))
+
+	def test_unknown_time(self):
+		index = LayerIndex(dict(z=[0.3], offset=[0], line=[0], time=[0.0], filament=[0.0]), None, 200)
+		self.assertEquals(None, index.get_progress(100))
+		self.assertEquals(None, index.get_time_left(100))
+
+
+@ddt
+class TestStreamingAnalysis(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+		self.settings_patcher = mock.patch("octoprint.util.gcodeInterpreter.settings")
+		settings = self.settings_patcher.start()
+		settings.return_value.getInt.return_value = 10
+
+	def tearDown(self):
+		self.settings_patcher.stop()
+		shutil.rmtree(self.basefolder)
+
+	def _content(self):
+		lines = [";filament_diameter = 1.75\r\n", "G28\r\n", "M104 S210\r\n", "G92 E0\n"]
+		for layer in range(5):
+			lines.append("G1 Z%.1f F3000\n" % (0.3 + layer * 0.2))
+			for i in range(20):
+				lines.append("G1 X%d Y%d E%.1f F%d\n" % ((i * 7) % 50, (i * 3 + layer) % 50, layer * 20 + i + 1, 1200 + i * 10))
+		lines.append("M84")
+		return "".join(lines)
+
+	@data(
+		("legacy", 1),
+		("legacy", 7),
+		("planner", 13),
+		("planner", 4096)
+	)
+	@unpack
+	def test_same_as_load(self, estimator, chunk_size):
+		content = self._content()
+		path = os.path.join(self.basefolder, "test.gcode")
+		with open(path, "wb") as f:
+			f.write(content)
+
+		expected = gcode(estimator=estimator)
+		expected.load(path, printer_profile)
+
+		streaming = StreamingAnalysis(printer_profile, estimator=estimator)
+		for i in range(0, len(content), chunk_size):
+			streaming.feed(content[i:i + chunk_size])
+		actual = streaming.finish()
+
+		self.assertEquals(expected.totalMoveTimeMinute, actual.totalMoveTimeMinute)
+		self.assertEquals(expected.extrusionAmount, actual.extrusionAmount)
+		self.assertEquals(expected.extrusionVolume, actual.extrusionVolume)
+		self.assertEquals(5, len(actual.layerList))
+		self.assertEquals(expected.layerList, actual.layerList)
+
+	def test_empty(self):
+		result = StreamingAnalysis(printer_profile).finish()
+		self.assertEquals(0, result.totalMoveTimeMinute)
+		self.assertEquals([], result.layerList)
+
+	def test_abort(self):
+		streaming = StreamingAnalysis(printer_profile)
+		streaming.feed("G28\n")
+		streaming.abort()
+		self.assertRaises(octoprint.util.gcodeInterpreter.AnalysisAborted, streaming.feed, "G1 X10\n")
+
+
+@ddt
+class TestReadLines(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.basefolder)
+
+	def _write(self, content):
+		path = os.path.join(self.basefolder, "test.gcode")
+		with open(path, "wb") as f:
+			f.write(content)
+		return path
+
+	@data(64 * 1024, 16 * 1024 * 1024)
+	def test_windows(self, window):
+		lines = ["G1 X%d Y%d E%d\r\n" % (i, i, i) for i in range(20000)]
+		lines.insert(5000, ";" + "x" * 200000 + "\n")
+		lines.append("M84")
+		path = self._write("".join(lines))
+
+		with mock.patch.object(octoprint.util.gcodeInterpreter, "_map_window", window):
+			self.assertEquals(lines, list(read_lines(path)))
+
+	@data(
+		(0, None, ["G28\n", "G1 X10\n", "G1 X20\n"]),
+		(4, None, ["G1 X10\n", "G1 X20\n"]),
+		(4, 5, ["G1 X10\n"]),
+		(4, 11, ["G1 X10\n"]),
+		(4, 12, ["G1 X10\n", "G1 X20\n"]),
+		(18, None, [])
+	)
+	@unpack
+	def test_range(self, start, end, expected):
+		path = self._write("G28\nG1 X10\nG1 X20\n")
+		self.assertEquals(expected, list(read_lines(path, start=start, end=end)))
+
+	def test_empty(self):
+		path = self._write("")
+		self.assertEquals([], list(read_lines(path)))
+
+	def test_progress(self):
+		path = self._write("G1 X10\n" * 2500)
+		progress = []
+
+		interpreter = gcode()
+		interpreter.progressCallback = progress.append
+		with mock.patch("octoprint.util.gcodeInterpreter.settings") as settings:
+			settings.return_value.getInt.return_value = 10
+			interpreter.load(path, printer_profile)
+
+		self.assertEquals([0.4, 0.8, 1.0], progress)
+
+	def test_non_ascii_comment(self):
+		path = self._write("; generated by S\xc3\xa9icer \xff\n;filament_diameter = 2.85\nG92 E0\nG1 X10 E100 F6000 ; \xe2\x80\x94\n")
+
+		interpreter = gcode()
+		with mock.patch("octoprint.util.gcodeInterpreter.settings") as settings:
+			settings.return_value.getInt.return_value = 10
+			interpreter.load(path, printer_profile)
+
+		self.assertEquals([100.0], interpreter.extrusionAmount)
+		self.assertAlmostEquals(100.0 * 3.14159 * 1.425 * 1.425 / 1000, interpreter.extrusionVolume[0], places=4)
@@ -0,0 +1,186 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+
+from multiprocessing.dummy import Pool
+from ddt import ddt, data, unpack
+
+from octoprint.util.gcodeInterpreter import gcode
+from octoprint.util import gcodeParallel
+
+printer_profile = dict(
+	axes=dict(x=dict(speed=6000), y=dict(speed=6000), z=dict(speed=200), e=dict(speed=300)),
+	extruder=dict(count=2, offsets=[(0, 0), (20.0, 5.0)])
+)
+
+
+def _layers(count, relative_e=False, tool_changes=False, offset_reset=False, inches_from=None):
+	lines = [";filament_diameter = 1.75", "G21", "G90", "M83" if relative_e else "M82", "G28"]
+	e = 0.0
+	for layer in range(count):
+		lines.append(";LAYER:%d" % layer)
+		if inches_from is not None and layer == inches_from:
+			lines.append("G20")
+		if tool_changes and layer % 3 == 1:
+			lines.append("T%d" % (layer % 2))
+		if offset_reset and layer == count // 2:
+			lines.append("G92 X0 Y0")
+		if layer % 4 == 2:
+			lines.append("M104 S%d" % (200 + layer))
+			lines.append("M106 S%d" % (layer * 5))
+		if not relative_e:
+			lines.append("G92 E0")
+			e = 0.0
+		lines.append("G0 Z%.2f F9000" % (layer * 0.2))
+		for i in range(40):
+			x = (i * 7 + layer * 3) % 100
+			y = (i * 13 + layer) % 100
+			if relative_e:
+				lines.append("G1 X%d Y%d E0.5 F%d" % (x, y, 1200 + i))
+			else:
+				e += 0.5
+				lines.append("G1 X%d Y%d E%.2f F%d" % (x, y, e, 1200 + i))
+			if i % 10 == 9:
+				lines.append("G1 E%.2f" % (-1.0 if relative_e else e - 1.0))
+				lines.append("G1 E%.2f" % (1.0 if relative_e else e))
+	return lines
+
+
+@ddt
+class GcodeParallelTest(unittest.TestCase):
+
+	def setUp(self):
+		self.basefolder = tempfile.mkdtemp()
+		self.pool = Pool(3)
+
+	def tearDown(self):
+		self.pool.terminate()
+		shutil.rmtree(self.basefolder)
+
+	def _write(self, lines):
+		path = os.path.join(self.basefolder, "test.gcode")
+		with open(path, "wb") as f:
+			f.write("\n".join(lines) + "\n")
+		return path
+
+	def _analyze(self, path, pool=None, chunks=1, estimator="legacy", profile=printer_profile):
+		analysis = gcode(estimator=estimator)
+		with mock.patch("octoprint.util.gcodeInterpreter.settings") as settings:
+			settings.return_value.getInt.return_value = 10
+			analysis.load(path, profile, pool=pool, chunks=chunks)
+		return analysis
+
+	@data(
+		(dict(), 2),
+		(dict(), 7),
+		(dict(relative_e=True), 5),
+		(dict(tool_changes=True), 5),
+		(dict(tool_changes=True, relative_e=True), 6),
+		(dict(offset_reset=True), 4),
+		(dict(inches_from=10), 4)
+	)
+	@unpack
+	def test_same_as_sequential(self, options, chunks):
+		path = self._write(_layers(30, **options))
+
+		sequential = self._analyze(path)
+		parallel = self._analyze(path, pool=self.pool, chunks=chunks)
+
+		self.assertAlmostEquals(sequential.totalMoveTimeMinute, parallel.totalMoveTimeMinute, places=6)
+		self._assert_same_extrusion(sequential, parallel)
+		self._assert_same_layers(sequential, parallel)
+		self._assert_same_bounds(sequential, parallel)
+
+	@data(2, 7)
+	def test_planner_close_to_sequential(self, chunks):
+		path = self._write(_layers(30, tool_changes=True))
+
+		sequential = self._analyze(path, estimator="planner")
+		parallel = self._analyze(path, pool=self.pool, chunks=chunks, estimator="planner")
+
+		# the planner doesn't look ahead across chunks, so only the speeds at the sync lines may differ
+		self.assertAlmostEquals(sequential.totalMoveTimeMinute, parallel.totalMoveTimeMinute, delta=sequential.totalMoveTimeMinute * 0.0001)
+		self._assert_same_extrusion(sequential, parallel)
+
+	def _assert_same_extrusion(self, sequential, parallel):
+		self.assertEquals(len(sequential.extrusionAmount), len(parallel.extrusionAmount))
+		for expected, actual in zip(sequential.extrusionAmount, parallel.extrusionAmount):
+			self.assertAlmostEquals(expected, actual, places=6)
+		for expected, actual in zip(sequential.extrusionVolume, parallel.extrusionVolume):
+			self.assertAlmostEquals(expected, actual, places=6)
+
+	def test_progress(self):
+		path = self._write(_layers(30, offset_reset=True))
+
+		progress = []
+		analysis = gcode()
+		analysis.progressCallback = progress.append
+		with mock.patch("octoprint.util.gcodeInterpreter.settings") as settings:
+			settings.return_value.getInt.return_value = 10
+			settings.return_value.get.return_value = "legacy"
+			analysis.load(path, printer_profile, pool=self.pool, chunks=4)
+
+		self.assertEquals(sorted(progress), progress)
+		self.assertEquals(1, progress.count(1.0))
+		self.assertEquals(1.0, progress[-1])
+
+	def _assert_same_layers(self, sequential, parallel):
+		self.assertEquals(30, len(sequential.layerList))
+		self.assertEquals(len(sequential.layerList), len(parallel.layerList))
+		for expected, actual in zip(sequential.layerList, parallel.layerList):
+			for key in ("z", "offset", "line"):
+				self.assertEquals(expected[key], actual[key])
+			for key in ("time", "filament"):
+				self.assertAlmostEquals(expected[key], actual[key], places=6)
+			self.assertAlmostEquals(expected["state"].pop("e"), actual["state"].pop("e"), places=6)
+			self.assertEquals(expected["state"], actual["state"])
+
+	def _assert_same_bounds(self, sequential, parallel):
+		self.assertEquals(sequential.bounds, parallel.bounds)
+		self.assertEquals(sequential.travelBounds, parallel.travelBounds)
+		self.assertAlmostEquals(sequential.travelDistance, parallel.travelDistance, places=6)
+		self.assertAlmostEquals(sequential.extrudeDistance, parallel.extrudeDistance, places=6)
+		self.assertEquals(sequential.outOfVolume, parallel.outOfVolume)
+
+	def test_out_of_volume(self):
+		lines = _layers(30, tool_changes=True)
+		lines.insert(len(lines) * 2 // 3, "G1 X150 Y20 E100")
+		path = self._write(lines)
+
+		profile = dict(printer_profile, volume=dict(width=140, depth=140, height=50, origin="lowerleft", formFactor="rectangular"))
+		sequential = self._analyze(path, profile=profile)
+		parallel = self._analyze(path, pool=self.pool, chunks=4, profile=profile)
+
+		self.assertEquals(1, sequential.outOfVolume["extrude"])
+		self._assert_same_bounds(sequential, parallel)
+
+	def test_split(self):
+		lines = _layers(20)
+		path = self._write(lines)
+		size = os.stat(path).st_size
+
+		chunks = gcodeParallel.split(path, 4)
+
+		self.assertEquals(4, len(chunks))
+		self.assertEquals(0, chunks[0][0])
+		self.assertEquals(size, chunks[-1][1])
+		with open(path, "rb") as f:
+			content = f.read()
+		for (start, end), (next_start, _) in zip(chunks, chunks[1:]):
+			self.assertEquals(end, next_start)
+			self.assertTrue(content[next_start:].startswith(";LAYER") or content[next_start:].startswith("G92 E"))
+
+	def test_split_small(self):
+		path = self._write(["G28", "G1 X10", "G1 X20"])
+		self.assertEquals([(0, 18)], gcodeParallel.split(path, 1))
+		self.assertEquals([(0, 11), (11, 18)], gcodeParallel.split(path, 2))
+		self.assertEquals([(0, 11), (11, 18)], gcodeParallel.split(path, 3))
@@ -0,0 +1,51 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+__copyright__ = "Copyright (C) 2015 The OctoPrint Project - Released under terms of the AGPLv3 License"
+
+import unittest
+
+from ddt import ddt, data, unpack
+
+@ddt
+class TestTokenizer(unittest.TestCase):
+
+	@data(
+		("", dict()),
+		("G28", dict(G=28.0)),
+		("G28 X Y", dict(G=28.0, X=None, Y=None)),
+		("G1 X10.5 Y-3 E.25 F1800 ; perimeter", dict(G=1.0, X=10.5, Y=-3.0, E=0.25, F=1800.0)),
+		("g1 x10", dict(G=1.0, X=10.0)),
+		("G1X10Y20", dict(G=1.0, X=10.0, Y=20.0)),
+		("N123 M110 N0*125", dict(N=123.0, M=110.0)),
+		("M104 T1 S210 T2", dict(M=104.0, T=1.0, S=210.0)),
+		("G1 Xnan Yinf Z1", dict(G=1.0, X=None, Y=None, Z=1.0)),
+		("G1 X1a", dict(G=1.0, X=1.0, A=None)),
+		(";only a comment", dict())
+	)
+	@unpack
+	def test_parse_words(self, line, expected):
+		from octoprint.util.tokenizer import parse_words
+		words = parse_words(line)
+		for letter, value in expected.items():
+			self.assertTrue(letter in words, "{} missing in {!r}".format(letter, words))
+			self.assertEquals(value, words[letter])
+		if "nan" not in line and "1a" not in line:
+			self.assertEquals(expected, words)
+
+	@data(
+		("G1 X10", ("G1 X10", None)),
+		("G1 X10 ; comment", ("G1 X10 ", " comment")),
+		(";comment", ("", "comment"))
+	)
+	@unpack
+	def test_strip_comment(self, line, expected):
+		from octoprint.util.tokenizer import strip_comment
+		self.assertEquals(expected, strip_comment(line))
+
+	def test_benchmark(self):
+		from octoprint.util.tokenizer import benchmark
+		result = benchmark(lines=["G1 X10 Y10 E1.0\n"] * 100)
+		self.assertEquals(set(["legacy", "parse_words"]), set(result.keys()))